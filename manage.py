@@ -2,8 +2,11 @@
 
 import os
 import unittest
+import configparser
+import click
 import coverage
 import git
+import numpy as np
 
 from flask.cli import FlaskGroup
 
@@ -68,6 +71,98 @@ def drop_db():
     """Drops the db tables."""
     db.drop_all()
 
+@cli.command("convert_random_vars")
+def convert_random_vars():
+    """Converts the pickled random variates in config.ini to a .npy file"""
+    from src.algorithm.smooth_allocation import load_random_vars
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), 'config.ini'))
+    path = config['ALLOCATION_FUNCTION']['RANDOM_VARS_PATH']
+    random_vars = np.asarray(load_random_vars(path))
+    npy_path = os.path.splitext(path)[0] + '.npy'
+    np.save(npy_path, random_vars)
+    print('Saved {} random variates to {}'.format(random_vars.size, npy_path))
+    print('Set RANDOM_VARS_PATH={} in config.ini to use them'.format(npy_path))
+
+@cli.command("calibrate")
+def calibrate():
+    """Measures the NumPy/JAX crossover of the algorithm kernels on this host"""
+    from src.algorithm import backends
+
+    algorithm = app.config.get('ALGORITHM')
+    path = app.config.get('COST_MODEL_PATH')
+    model = backends.calibrate(len(algorithm.prior_mean))
+    for kernel in backends.KERNELS:
+        print('{} (ms per {})'.format(
+            kernel, 'iteration' if kernel == 'hyperparameters' else 'update'))
+        for i, nusers in enumerate(model.users):
+            print('  {:>5} users: numpy {:8.3f}  jax {:8.3f}'.format(
+                nusers,
+                1000 * model.timings[kernel]['numpy'][i],
+                1000 * model.timings[kernel]['jax'][i],
+            ))
+        crossover = model.crossover[kernel]
+        if crossover is None:
+            print('  JAX is never faster')
+        else:
+            print('  JAX from {} users'.format(crossover))
+    backends.save_cost_model(model, path)
+    print('Saved the cost model to {}, restart the server to use it'.format(path))
+
+@cli.command("migrate_rl_weights")
+@click.option('--drop-arrays', is_flag=True,
+              help='Clear posterior_var_array of the converted rows')
+def migrate_rl_weights(drop_arrays):
+    """Writes the posterior of the rl_weights rows without an artifact to artifacts"""
+    from src.algorithm import artifact
+    from src.server.tables import RLWeights
+
+    directory = app.config.get('POLICY_ARTIFACT_DIR')
+    dtype = app.config.get('POLICY_ARTIFACT_DTYPE')
+    rows = RLWeights.query.filter(
+        RLWeights.artifact_path.is_(None), RLWeights.posterior_var_array.isnot(None)
+    ).order_by(RLWeights.id).all()
+    for row in rows:
+        arrays = artifact.legacy_arrays(
+            row.posterior_mean_array,
+            row.posterior_var_array,
+            row.posterior_theta_pop_mean_array,
+            row.posterior_theta_pop_var_array,
+            row.random_eff_cov_array,
+        )
+        metadata = {
+            'policy_id': row.policy_id,
+            'user_list': list(row.user_list or []),
+            'noise_var': row.noise_var,
+            'rl_weights_id': row.id,
+        }
+        path = os.path.join(directory, 'rl_weights_{}.rlpolicy'.format(row.id))
+        row.artifact_sha256 = artifact.write_artifact(path, arrays, metadata, dtype)
+        row.artifact_path = path
+        if drop_arrays:
+            row.posterior_var_array = None
+
+        # One row at a time, an interrupted migration resumes where it stopped
+        db.session.commit()
+        print('Converted rl_weights row {} (policy {}) to {}'.format(
+            row.id, row.policy_id, path))
+    print('Converted {} rows'.format(len(rows)))
+
+@cli.command("rebuild")
+def rebuild():
+    """Rebuilds the algorithm from the database, and saves its checkpoint"""
+    from src.server.checkpoints import save_algorithm_checkpoint
+    from src.server.rebuild import rebuild_algorithm
+
+    if not rebuild_algorithm(force=True):
+        print('Rebuild failed, see the API log')
+        return 1
+    algorithm = app.config.get('ALGORITHM')
+    print('Rebuilt {} users at policy {}'.format(algorithm.num_users, algorithm.policyid))
+    save_algorithm_checkpoint()
+    print('Saved the checkpoint to {}'.format(app.config.get('CHECKPOINT_PATH')))
+
 @cli.command("populate_commit_id")
 def populate_commit_id():
     """Populates the COMMIT_ID in config.ini"""
@@ -0,0 +1,223 @@
+# src/algorithm/artifact.py
+
+# Binary policy artifacts. The posterior of a policy is written once to a
+# single file, which the RLWeights row references by path and SHA-256, in
+# place of the (N * d) x (N * d) joint covariance as a Postgres float array.
+# The file holds the compact posterior (per-user blocks and the coupling to
+# theta_pop, see structured.BlockPosterior) and the population terms:
+#   magic (8 bytes) | header length (8 bytes, little endian) | JSON header |
+#   arrays, each at an offset aligned to ALIGNMENT bytes
+# The header has the format version, the dtype and the shape and offset of
+# every array, and the metadata of the policy. The arrays are not compressed,
+# so they can be memory-mapped back, and only the blocks a reader touches are
+# read from disk.
+
+# Imports
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from src.algorithm import structured
+
+MAGIC = b"RLPOLICY"
+VERSION = 1
+ALIGNMENT = 64
+DTYPES = ["float64", "float32"]
+
+# Bytes read at once when hashing a file
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def _aligned(offset: int) -> int:
+    """Next multiple of ALIGNMENT"""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_artifact(
+    path: str, arrays: dict, metadata: dict = None, dtype: str = "float64"
+) -> str:
+    """
+    Write arrays to an artifact file. The file is written next to path and
+    renamed, so a reader never sees a partial artifact
+    :param path: path of the artifact
+    :param arrays: arrays by name
+    :param metadata: JSON serializable metadata
+    :param dtype: "float64" or "float32", the dtype the arrays are stored in,
+        None to keep the dtype of each array
+    :return: SHA-256 of the file, as a hex string
+    """
+    if dtype is not None and dtype not in DTYPES:
+        raise ValueError(f"Unknown artifact dtype: {dtype}")
+    arrays = {
+        name: np.ascontiguousarray(array, dtype=dtype) for name, array in arrays.items()
+    }
+
+    # Offsets relative to the first array, which follows the header
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"shape": list(array.shape), "dtype": array.dtype.str, "offset": offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps(
+        {
+            "version": VERSION,
+            "dtype": dtype,
+            "arrays": layout,
+            "metadata": metadata or {},
+        }
+    ).encode()
+    start = _aligned(len(MAGIC) + 8 + len(header))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    sha256 = hashlib.sha256()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+
+        def write(buffer) -> None:
+            f.write(buffer)
+            sha256.update(buffer)
+
+        write(MAGIC + len(header).to_bytes(8, "little") + header)
+        position = len(MAGIC) + 8 + len(header)
+        for name, array in arrays.items():
+            write(bytes(start + layout[name]["offset"] - position))
+
+            # The array buffers are written and hashed without a copy
+            write(memoryview(array))
+            position = start + layout[name]["offset"] + array.nbytes
+    os.replace(tmp_path, path)
+    return sha256.hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file, as a hex string"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_artifact(path: str, sha256: str = None, mode: str = "r") -> tuple[dict, dict]:
+    """
+    Memory-map the arrays of an artifact
+    :param path: path of the artifact
+    :param sha256: expected SHA-256 of the file, not checked if not given
+    :param mode: "r" for read-only arrays, "c" for copy-on-write ones
+    :return: arrays by name, and the metadata
+    """
+    if sha256 is not None and file_sha256(path) != sha256:
+        raise ValueError(f"Checksum mismatch for policy artifact {path}")
+
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a policy artifact")
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length))
+    if header["version"] > VERSION:
+        raise ValueError(f"Unsupported policy artifact version: {header['version']}")
+
+    start = _aligned(len(MAGIC) + 8 + header_length)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        shape = tuple(entry["shape"])
+        dtype = entry.get("dtype", header["dtype"])
+        if np.prod(shape) == 0:
+            # Empty arrays cannot be memory-mapped
+            arrays[name] = np.zeros(shape, dtype=dtype)
+            continue
+        arrays[name] = np.memmap(
+            path,
+            dtype=dtype,
+            mode=mode,
+            offset=start + entry["offset"],
+            shape=shape,
+        )
+    return arrays, header["metadata"]
+
+
+def policy_arrays(snapshot) -> tuple[dict, dict]:
+    """
+    Arrays and metadata of the artifact of a policy
+    :param snapshot: the policy, a policy.PolicySnapshot with a posterior
+    :return: arrays by name, and the metadata
+    """
+    arrays = {
+        **snapshot.posterior._asdict(),
+        "theta_pop_mean": snapshot.theta_pop_mean,
+        "sigma_u": snapshot.sigma_u,
+    }
+    metadata = {
+        "policy_id": int(snapshot.policyid),
+        "user_list": list(snapshot.user_list),
+        "noise_var": float(snapshot.noise_var),
+    }
+    return arrays, metadata
+
+
+def save_policy(directory: str, snapshot, dtype: str = "float64") -> tuple[str, str]:
+    """
+    Write the artifact of a policy. The file name has the policy id and the
+    start of the checksum, so an artifact is never overwritten by another one
+    :param directory: directory of the artifacts
+    :param snapshot: the policy, a policy.PolicySnapshot with a posterior
+    :param dtype: "float64" or "float32"
+    :return: path and SHA-256 of the artifact
+    """
+    arrays, metadata = policy_arrays(snapshot)
+    partial_path = os.path.join(directory, f"policy_{snapshot.policyid}.partial")
+    sha256 = write_artifact(partial_path, arrays, metadata, dtype)
+    path = os.path.join(directory, f"policy_{snapshot.policyid}_{sha256[:16]}.rlpolicy")
+    os.replace(partial_path, path)
+    return path, sha256
+
+
+def legacy_arrays(
+    posterior_mean: list,
+    posterior_var: list,
+    theta_pop_mean: list,
+    theta_pop_var: list,
+    sigma_u: list,
+) -> dict:
+    """
+    Arrays of the artifact of a policy exported as flat float arrays, before
+    the artifacts. The coupling to theta_pop cannot be recovered from the
+    joint covariance, so the per-user blocks are stored with the full joint
+    :param posterior_mean: stacked posterior means of the users
+    :param posterior_var: joint posterior covariance, flattened
+    :param theta_pop_mean: posterior mean of theta_pop
+    :param theta_pop_var: posterior covariance of theta_pop, flattened
+    :param sigma_u: random effects covariance, flattened
+    :return: arrays by name
+    """
+    size = len(theta_pop_mean)
+    user_mean = np.asarray(posterior_mean, dtype=float).reshape(-1, size)
+    nusers = user_mean.shape[0]
+    joint_cov = np.asarray(posterior_var, dtype=float).reshape(nusers * size, nusers * size)
+    user_cov = np.zeros((nusers, size, size))
+    for i in range(nusers):
+        user_cov[i] = joint_cov[i * size : (i + 1) * size, i * size : (i + 1) * size]
+    return {
+        "user_mean": user_mean,
+        "user_cov": user_cov,
+        "theta_pop_mean": np.asarray(theta_pop_mean, dtype=float),
+        "theta_pop_cov": np.asarray(theta_pop_var, dtype=float).reshape(size, size),
+        "sigma_u": np.asarray(sigma_u, dtype=float).reshape(size, size),
+        "joint_cov": joint_cov,
+    }
+
+
+def posterior_of(arrays: dict) -> structured.BlockPosterior:
+    """
+    Compact posterior of the arrays of an artifact
+    :return: the posterior, None for a legacy artifact without the coupling
+    """
+    if "coupling" not in arrays:
+        return None
+    return structured.BlockPosterior(
+        *(arrays[field] for field in structured.BlockPosterior._fields)
+    )
@@ -0,0 +1,561 @@
+# src/algorithm/backends.py
+
+# Compute backends of the hyperparameter and posterior kernels. The JAX
+# kernels (optimizer.py) are compiled once per user bucket and run the whole
+# gradient descent as one XLA program, which pays off on large cohorts. Early
+# in a study there are only a few users, and a NumPy/LAPACK evaluation takes
+# less than the dispatch of a compiled one. This module has the NumPy
+# (float64) objective with its analytic gradient, the NumPy gradient descent
+# loop, a compiled posterior, and the cost model that picks a backend per
+# kernel from the number of users. The kernels work on the per-user
+# sufficient statistics, so their cost does not depend on the number of
+# decisions. The model is measured on the host with calibrate (manage.py
+# calibrate), DEFAULT_COST_MODEL is used until then.
+
+# Imports
+import json
+import os
+import time
+from functools import partial
+from typing import NamedTuple
+
+import numpy as np
+
+import jax
+import jax.numpy as jnp
+
+from src.algorithm import optimizer, parameterization, structured
+
+BACKENDS = ["numpy", "jax"]
+
+# Backend settings of the algorithm, "auto" selects with the cost model
+SELECTIONS = ["auto"] + BACKENDS
+
+# Kernels the cost model selects a backend for
+KERNELS = ["hyperparameters", "posterior"]
+
+# Number of users, and decisions per user, of the calibration cohorts
+CALIBRATION_USERS = [8, 16, 32, 64, 128, 256]
+CALIBRATION_DECISIONS = 20
+
+# Gradient descent iterations, and posterior updates, timed per cohort
+CALIBRATION_ITERS = 20
+CALIBRATION_REPEATS = 5
+
+
+class CostModel(NamedTuple):
+    """
+    Measured seconds per call of each kernel and backend, by number of
+    users, and the number of users from which JAX is faster, None if it
+    never is on the measured cohorts
+    """
+
+    size: int
+    users: tuple
+    timings: dict
+    crossover: dict
+
+
+# For hosts that have not been calibrated. On a single-core x86 host with
+# d = 24, a gradient descent iteration costs about the same on both backends
+# up to 256 users (0.6 to 20 ms, within the run-to-run noise), and NumPy
+# saves compiling a bucket (8 to 10 s each). The compiled posterior is 10 to
+# 30 times faster than the NumPy one, but in float32.
+DEFAULT_COST_MODEL = CostModel(
+    size=24,
+    users=(),
+    timings={},
+    crossover={"hyperparameters": 64, "posterior": None},
+)
+
+
+def select_backend(model: CostModel, kernel: str, nusers: int) -> str:
+    """
+    Backend of a kernel for a number of users
+    :param model: the cost model
+    :param kernel: "hyperparameters" or "posterior"
+    :param nusers: number of users
+    :return: "numpy" or "jax"
+    """
+    crossover = model.crossover.get(kernel)
+    if crossover is None or nusers < crossover:
+        return "numpy"
+    return "jax"
+
+
+def crossover_of(users: list, numpy_times: list, jax_times: list) -> int:
+    """Smallest number of users from which JAX is faster on every larger cohort"""
+    crossover = None
+    for nusers, numpy_time, jax_time in reversed(list(zip(users, numpy_times, jax_times))):
+        if jax_time >= numpy_time:
+            break
+        crossover = nusers
+    return crossover
+
+
+def save_cost_model(model: CostModel, path: str) -> None:
+    """Write a cost model as JSON"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(model._asdict(), f, indent=2)
+
+
+def load_cost_model(path: str = None) -> CostModel:
+    """Cost model saved by calibrate, DEFAULT_COST_MODEL if there is none"""
+    if path is None or not os.path.exists(path):
+        return DEFAULT_COST_MODEL
+    with open(path) as f:
+        model = json.load(f)
+    model["users"] = tuple(model["users"])
+    return CostModel(**model)
+
+
+def _numpy_data(data: optimizer.ObjectiveData) -> optimizer.ObjectiveData:
+    """Sufficient statistics as float64 NumPy arrays"""
+    return optimizer.ObjectiveData(
+        np.asarray(data.A_hat, dtype=float),
+        np.asarray(data.B_hat, dtype=float),
+        np.asarray(data.mu_prior, dtype=float),
+        np.asarray(data.sigma_prior, dtype=float),
+        float(data.sum_sq_reward),
+        float(data.ts),
+        None if data.user_mask is None else np.asarray(data.user_mask, dtype=float),
+    )
+
+
+def _inverse_and_logdet(
+    params: np.array, structure: parameterization.Parameterization
+) -> tuple:
+    """Sigma_u^-1 and log det Sigma_u, raises LinAlgError if Sigma_u is singular"""
+    sigma_u = parameterization.sigma_u_of(params, structure)
+    sign, logdet = np.linalg.slogdet(sigma_u)
+    if sign <= 0:
+        raise np.linalg.LinAlgError("Sigma_u is not PD")
+    return parameterization.sigma_u_inverse(params, structure), logdet
+
+
+def _terms(
+    params: np.array, y: float, data: optimizer.ObjectiveData, structure
+) -> dict:
+    """
+    NumPy version of structured.marginal_terms, with the intermediate
+    quantities the gradient needs. Raises LinAlgError if one of the
+    precisions is not PD
+    """
+    sigma_u_inv, logdet_sigma_u = _inverse_and_logdet(params, structure)
+    A_hat, B_hat = data.A_hat, data.B_hat
+    mask = np.ones(A_hat.shape[0]) if data.user_mask is None else data.user_mask
+
+    # Per-user conditional precision D_i and covariance W_i = D_i^-1
+    D = sigma_u_inv + y * A_hat
+    D_chol = np.linalg.cholesky(D)
+    W = np.linalg.inv(D)
+    logdet_D = 2 * np.sum(np.log(np.diagonal(D_chol, axis1=-2, axis2=-1)), axis=-1)
+
+    # Contributions of each user to the posterior of theta_pop
+    coupling = W @ sigma_u_inv
+    W_B = np.einsum("nij,nj->ni", W, B_hat)
+    Q = (sigma_u_inv - sigma_u_inv @ coupling) * mask[:, None, None]
+    r = y * (W_B @ sigma_u_inv) * mask[:, None]
+
+    # Posterior precision S and information vector g of theta_pop
+    prior_inv = np.linalg.inv(data.sigma_prior)
+    S = prior_inv + np.sum(Q, axis=0)
+    g = prior_inv @ data.mu_prior + np.sum(r, axis=0)
+    S_chol = np.linalg.cholesky(S)
+    theta_pop_cov = np.linalg.inv(S)
+    theta_pop_mean = theta_pop_cov @ g
+
+    obj = (
+        np.sum(mask * (logdet_sigma_u + logdet_D))
+        - y**2 * np.sum(mask * np.einsum("ni,ni->n", B_hat, W_B))
+        + y * data.sum_sq_reward
+        - data.ts * np.log(y)
+        + np.linalg.slogdet(data.sigma_prior)[1]
+        + 2 * np.sum(np.log(np.diag(S_chol)))
+        + data.mu_prior @ prior_inv @ data.mu_prior
+        - g @ theta_pop_mean
+    )
+    return {
+        "objective": obj,
+        "mask": mask,
+        "sigma_u_inv": sigma_u_inv,
+        "cond_cov": W,
+        "coupling": coupling,
+        "W_B": W_B,
+        "theta_pop_mean": theta_pop_mean,
+        "theta_pop_cov": theta_pop_cov,
+    }
+
+
+class _TermsCache:
+    """
+    _terms of the last point, the gradient descent validates a point and then
+    takes the gradient at it on the next iteration
+    """
+
+    def __init__(self):
+        self.key = None
+        self.terms = None
+
+    def __call__(self, params, y, data, structure) -> dict:
+        key = (params.tobytes(), y)
+        if key != self.key:
+            self.terms = _terms(params, y, data, structure)
+            self.key = key
+        return self.terms
+
+
+def _params_gradient(
+    sigma_u_grad: np.array, params: np.array, structure: parameterization.Parameterization
+) -> np.array:
+    """Gradient with respect to the parameters, from the (symmetric) one of Sigma_u"""
+    d = structure.size
+    if structure.kind == "full":
+        L = np.zeros((d, d))
+        L[np.tril_indices(d)] = params
+        return (2 * sigma_u_grad @ L)[np.tril_indices(d)]
+    if structure.kind == "diagonal":
+        return 2 * params * np.diag(sigma_u_grad)
+    if structure.kind == "block":
+        grads = []
+        for entries, rows in parameterization.block_slices(structure):
+            k = rows.stop - rows.start
+            L = np.zeros((k, k))
+            L[np.tril_indices(k)] = params[entries]
+            grads.append((2 * sigma_u_grad[rows, rows] @ L)[np.tril_indices(k)])
+        return np.concatenate(grads)
+
+    V = params[d:].reshape(d, structure.rank)
+    return np.concatenate(
+        [2 * params[:d] * np.diag(sigma_u_grad), (2 * sigma_u_grad @ V).flatten()]
+    )
+
+
+def value_and_grad(
+    flat_lower_t: np.array, noise_precision: float, data: optimizer.ObjectiveData, size
+) -> tuple:
+    """
+    NumPy version of the objective and its gradients with respect to the
+    parameters of Sigma_u and the noise precision, from the closed forms of
+    the derivatives of the block-structured terms, NaN where a precision is
+    not PD. Same signature and result as jax.value_and_grad(objective,
+    argnums=(0, 1))
+    """
+    return _value_and_grad(flat_lower_t, noise_precision, _numpy_data(data), size)
+
+
+def validate(
+    flat_lower_t: np.array, noise_precision: float, data: optimizer.ObjectiveData, size
+) -> tuple:
+    """NumPy version of optimizer.validate"""
+    return _validate(flat_lower_t, noise_precision, _numpy_data(data), size)
+
+
+def _value_and_grad(
+    flat_lower_t: np.array,
+    noise_precision: float,
+    data: optimizer.ObjectiveData,
+    size,
+    terms_fun=_terms,
+) -> tuple:
+    """value_and_grad on float64 NumPy sufficient statistics"""
+    structure = parameterization.as_parameterization(size)
+    params = np.asarray(flat_lower_t, dtype=float)
+    y = float(noise_precision)
+    try:
+        terms = terms_fun(params, y, data, structure)
+    except np.linalg.LinAlgError:
+        return np.nan, (np.full(params.shape, np.nan), np.nan)
+
+    mask = terms["mask"]
+    P = terms["sigma_u_inv"]
+    W = terms["cond_cov"]
+    coupling = terms["coupling"]
+    w = terms["W_B"]
+    m = terms["theta_pop_mean"]
+    C = terms["theta_pop_cov"]
+    A_hat, B_hat = data.A_hat, data.B_hat
+
+    # Gradient with respect to P = Sigma_u^-1, through the per-user precisions,
+    # dQ_i = K_i^T dP K_i and dr_i = y K_i^T dP w_i with K_i = I - W_i P
+    K = np.identity(P.shape[0]) - coupling
+    K_m = K @ m
+    M = C + np.outer(m, m)
+    per_user = (
+        W
+        + y**2 * w[:, :, None] * w[:, None, :]
+        + K @ M @ K.transpose(0, 2, 1)
+        - y * (K_m[:, :, None] * w[:, None, :] + w[:, :, None] * K_m[:, None, :])
+    )
+    P_grad = np.sum(per_user * mask[:, None, None], axis=0)
+
+    # With the log det Sigma_u of each user, as a gradient of Sigma_u
+    sigma_u_grad = -P @ P_grad @ P + np.sum(mask) * P
+    params_grad = _params_gradient((sigma_u_grad + sigma_u_grad.T) / 2, params, structure)
+
+    # Gradient with respect to the noise precision, dD_i = A_i dy
+    A_w = np.einsum("nij,nj->ni", A_hat, w)
+    c_m = coupling @ m
+    c_M_c = coupling @ M @ coupling.transpose(0, 2, 1)
+    per_user = (
+        np.einsum("nij,nji->n", W, A_hat)
+        - 2 * y * np.einsum("ni,ni->n", B_hat, w)
+        + y**2 * np.einsum("ni,ni->n", w, A_w)
+        + np.einsum("nij,nij->n", c_M_c, A_hat)
+        - 2 * (w @ (P @ m))
+        + 2 * y * np.einsum("ni,ni->n", c_m, A_w)
+    )
+    y_grad = np.sum(mask * per_user) + data.sum_sq_reward - data.ts / y
+
+    return terms["objective"], (params_grad, y_grad)
+
+
+def _validate(
+    flat_lower_t: np.array,
+    noise_precision: float,
+    data: optimizer.ObjectiveData,
+    size,
+    terms_fun=_terms,
+) -> tuple:
+    """validate on float64 NumPy sufficient statistics"""
+    structure = parameterization.as_parameterization(size)
+    y = float(noise_precision)
+    try:
+        terms = terms_fun(np.asarray(flat_lower_t, dtype=float), y, data, structure)
+    except np.linalg.LinAlgError:
+        return optimizer.INVALID_OBJECTIVE, np.bool_(False)
+
+    # Posterior means of theta_i and diagonals of their covariances
+    coupling, mask = terms["coupling"], terms["mask"]
+    mean = (coupling @ terms["theta_pop_mean"] + y * terms["W_B"]) * mask[:, None]
+    var = np.diagonal(terms["cond_cov"], axis1=-2, axis2=-1) + np.sum(
+        (coupling @ terms["theta_pop_cov"]) * coupling, axis=-1
+    )
+    var = var * mask[:, None]
+
+    result = terms["objective"]
+    valid = np.bool_(
+        np.all(np.isfinite(terms["cond_cov"]))
+        and np.all(np.isfinite(terms["theta_pop_cov"]))
+        and not np.isnan(result)
+        and np.min(var) >= 0
+        and np.max(np.abs(mean)) <= 10
+    )
+    return (result if valid else optimizer.INVALID_OBJECTIVE), valid
+
+
+def init_gradient_descent(
+    ltu_flat: np.array, noise_precision: float, init_obj: float, learning_rate: float
+) -> optimizer.GradientDescentState:
+    """Loop carry of optimizer.init_gradient_descent, as float64 NumPy arrays"""
+    ltu_flat = np.asarray(ltu_flat, dtype=float)
+    noise_precision = np.asarray(noise_precision, dtype=float)
+    init_obj = np.asarray(init_obj, dtype=float)
+    learning_rate = np.asarray(learning_rate, dtype=float)
+    return optimizer.GradientDescentState(
+        idx=np.asarray(0),
+        ltu_flat=ltu_flat,
+        noise_precision=noise_precision,
+        min_ltu_flat=ltu_flat,
+        min_noise_precision=noise_precision,
+        min_obj=init_obj,
+        old_obj=init_obj,
+        lr=learning_rate,
+        lr2=learning_rate,
+        skip_count=np.asarray(0),
+        last_update_index=np.asarray(-1),
+        reset_flag=np.asarray(False),
+        done=np.asarray(False),
+        num_resets=np.asarray(0),
+    )
+
+
+def run_gradient_descent(
+    state: optimizer.GradientDescentState,
+    data: optimizer.ObjectiveData,
+    reset_point: tuple,
+    size,
+    max_iter: int,
+    learning_rate: float,
+    tolerance: float,
+    stop_at: int = None,
+) -> optimizer.GradientDescentState:
+    """
+    NumPy version of optimizer.run_gradient_descent, the same iterations in a
+    Python loop, with the NumPy objective and gradients
+    """
+    if stop_at is None:
+        stop_at = max_iter
+
+    data = _numpy_data(data)
+    reset_point = (
+        np.asarray(reset_point[0], dtype=float),
+        np.asarray(reset_point[1], dtype=float),
+    )
+    terms_fun = _TermsCache()
+    while not state.done and state.idx < stop_at:
+        state = optimizer.gradient_descent_step(
+            state,
+            data,
+            reset_point,
+            size,
+            max_iter,
+            learning_rate,
+            tolerance,
+            partial(_value_and_grad, terms_fun=terms_fun),
+            partial(_validate, terms_fun=terms_fun),
+            np,
+        )
+    return state
+
+
+# Loop carry initializer and loop of the optimizers the NumPy backend runs
+NUMPY_OPTIMIZERS = {"gd": (init_gradient_descent, run_gradient_descent)}
+
+
+@jax.jit
+def _posterior_kernel(
+    sigma_u_inv: jnp.array,
+    noise_precision: float,
+    data: optimizer.ObjectiveData,
+) -> tuple:
+    """Compiled posterior blocks of padded sufficient statistics"""
+    terms = structured.marginal_terms_from_inverse(
+        sigma_u_inv,
+        0.0,
+        noise_precision,
+        data.A_hat,
+        data.B_hat,
+        data.mu_prior,
+        data.sigma_prior,
+        data.user_mask,
+    )
+    user_mean, _ = structured.posterior_summary(terms, noise_precision, data.B_hat)
+    return (
+        user_mean,
+        terms["cond_cov"],
+        terms["coupling"],
+        terms["theta_pop_mean"],
+        terms["theta_pop_cov"],
+    )
+
+
+def posterior_blocks(
+    A_hat: np.array,
+    B_hat: np.array,
+    prior_mean: np.array,
+    prior_cov: np.array,
+    sigma_u: np.array,
+    noise_var: float,
+    sigma_u_inv: np.array = None,
+) -> dict:
+    """
+    JAX version of structured.posterior_blocks, with the same arguments and
+    result. The users are padded to their bucket so the kernel is compiled
+    once per bucket. It runs in the precision of JAX, float32 unless x64 is
+    enabled
+    """
+    nusers = A_hat.shape[0]
+    if sigma_u_inv is None:
+        sigma_u_inv = np.linalg.inv(sigma_u)
+    data = optimizer.pad_objective_data(
+        optimizer.ObjectiveData(A_hat, B_hat, prior_mean, prior_cov, 0.0, 1.0),
+        optimizer.user_bucket(nusers),
+    )
+    user_mean, cond_cov, coupling, theta_pop_mean, theta_pop_cov = _posterior_kernel(
+        sigma_u_inv, 1.0 / noise_var, data
+    )
+    return {
+        "user_mean": np.asarray(user_mean, dtype=float)[:nusers],
+        "cond_cov": np.asarray(cond_cov, dtype=float)[:nusers],
+        "coupling": np.asarray(coupling, dtype=float)[:nusers],
+        "theta_pop_mean": np.asarray(theta_pop_mean, dtype=float).reshape(-1, 1),
+        "theta_pop_cov": np.asarray(theta_pop_cov, dtype=float),
+    }
+
+
+POSTERIOR_KERNELS = {"numpy": structured.posterior_blocks, "jax": posterior_blocks}
+
+
+def _calibration_data(
+    nusers: int, size: int, rng: np.random.Generator
+) -> optimizer.ObjectiveData:
+    """Sufficient statistics of a random cohort, at the prior of calibrate"""
+    X = rng.integers(0, 2, size=(nusers, CALIBRATION_DECISIONS, size)).astype(float)
+    y = rng.normal(size=(nusers, CALIBRATION_DECISIONS))
+    return optimizer.ObjectiveData(
+        X.transpose(0, 2, 1) @ X,
+        np.einsum("nti,nt->ni", X, y),
+        np.zeros(size),
+        np.identity(size),
+        float(np.sum(y**2)),
+        float(y.size),
+    )
+
+
+def _seconds_per_call(fun, repeats: int) -> float:
+    """Shortest wall time of a call, out of repeats"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def calibrate(size: int, users: list = CALIBRATION_USERS, seed: int = 0) -> CostModel:
+    """
+    Measure the kernels of both backends on random cohorts of each number of
+    users, after compiling the JAX ones: seconds per gradient descent
+    iteration of the hyperparameter fit, and per posterior update
+    :param size: dimension of the parameters
+    :param users: numbers of users of the cohorts, padded like the algorithm
+    :param seed: seed of the cohorts
+    :return: the cost model
+    """
+    rng = np.random.default_rng(seed)
+    sigma_u = 0.01 * np.identity(size)
+    ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(size)]
+    timings = {kernel: {backend: [] for backend in BACKENDS} for kernel in KERNELS}
+
+    for nusers in users:
+        data = optimizer.pad_objective_data(
+            _calibration_data(nusers, size, rng), optimizer.user_bucket(nusers)
+        )
+
+        # Fixed number of iterations, tolerance 0 never converges
+        for backend in BACKENDS:
+            check = optimizer.validate_function(backend)
+            init_optimizer, run_optimizer = optimizer.optimizer_functions("gd", backend)
+            init_obj, _ = check(ltu_flat, 1.0, data, size)
+
+            def fit():
+                state = init_optimizer(ltu_flat, 1.0, init_obj, 0.001)
+                state = run_optimizer(
+                    state, data, (ltu_flat, 1.0), size, CALIBRATION_ITERS, 0.001, 0.0
+                )
+                jax.block_until_ready(state)
+                return state
+
+            iterations = int(fit().idx)
+            seconds = _seconds_per_call(fit, CALIBRATION_REPEATS)
+            timings["hyperparameters"][backend].append(seconds / iterations)
+
+        A_hat, B_hat = data.A_hat[:nusers], data.B_hat[:nusers]
+        for backend, kernel in POSTERIOR_KERNELS.items():
+            update = partial(
+                kernel, A_hat, B_hat, data.mu_prior, data.sigma_prior, sigma_u, 1.0
+            )
+            update()
+            timings["posterior"][backend].append(
+                _seconds_per_call(update, CALIBRATION_REPEATS)
+            )
+
+    crossover = {
+        kernel: crossover_of(users, timings[kernel]["numpy"], timings[kernel]["jax"])
+        for kernel in KERNELS
+    }
+    return CostModel(int(size), tuple(users), timings, crossover)
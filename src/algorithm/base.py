@@ -3,6 +3,8 @@
 # Imports
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 
 # Create RL algorithm abstract class
 class RLAlgorithm(ABC):
@@ -29,3 +31,25 @@ class RLAlgorithm(ABC):
     @abstractmethod
     def make_reward(params):
         pass
+
+    def get_actions(self, user_ids, states, decision_times):
+        """Get actions for several users, one get_action call per user"""
+        results = [
+            self.get_action(user_id, state, decision_time)
+            for user_id, state, decision_time in zip(user_ids, states, decision_times)
+        ]
+        actions = np.array([result[0] for result in results], dtype=int)
+        seeds = np.array([result[1] for result in results], dtype=int)
+        act_probs = np.array([result[2] for result in results], dtype=float)
+        policy_id = results[-1][3] if results else None
+        return actions, seeds, act_probs, policy_id
+
+    @classmethod
+    def make_states(cls, params_list):
+        """Make the states of several users, one make_state call per user"""
+        return np.array([cls.make_state(params) for params in params_list], dtype=int)
+
+    @classmethod
+    def make_rewards(cls, params_list):
+        """Make the rewards of several users, one make_reward call per user"""
+        return np.array([cls.make_reward(params) for params in params_list])
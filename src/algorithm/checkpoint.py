@@ -0,0 +1,193 @@
+# src/algorithm/checkpoint.py
+
+# Checkpoints of the learned state of a MixedEffectsAlgorithm: the decision
+# history of the users, the published policy (posterior, hyperparameters and
+# probability tables) and the hyperparameters staged for the next update. A
+# checkpoint is one artifact file (see artifact.py), so restoring it only maps
+# the arrays, copy-on-write, and the probability tables are not recomputed.
+# The history of older policies is not part of it, it is kept by
+# history.PolicyHistory.
+
+# Imports
+import numpy as np
+
+from src.algorithm import artifact, policy, structured
+from src.algorithm.user_store import UserHistoryStore
+
+# Version of the contents of a checkpoint, a checkpoint of another version is
+# not restored
+CHECKPOINT_VERSION = 1
+
+# Arrays of the user store, in the order of UserHistoryStore.nbytes
+STORE_ARRAYS = [
+    "num_decisions",
+    "state",
+    "action",
+    "act_prob",
+    "reward",
+    "design",
+    "A",
+    "B",
+    "sum_sq_reward",
+    "num_timesteps",
+]
+
+
+def save_checkpoint(algorithm, path: str, metadata: dict = None) -> str:
+    """
+    Write the learned state of an algorithm to a checkpoint
+    :param algorithm: the MixedEffectsAlgorithm
+    :param path: path of the checkpoint, replaced in one step
+    :param metadata: JSON serializable metadata, e.g. the code version
+    :return: SHA-256 of the checkpoint
+    """
+    snapshot = algorithm.snapshot
+    pending = algorithm.pending_hyperparameters
+    users = algorithm.users
+
+    # Copied under the lock of the store, decision points keep arriving
+    store_arrays, user_ids = users.copy(STORE_ARRAYS)
+    arrays = {"users." + name: array for name, array in store_arrays.items()}
+    arrays.update(
+        {
+            "theta_pop_mean": snapshot.theta_pop_mean,
+            "theta_pop_cov": snapshot.theta_pop_cov,
+            "sigma_u": snapshot.sigma_u,
+            "ltu_flat": snapshot.ltu_flat,
+            "prob_table": snapshot.prob_table,
+            "act_prob_table": snapshot.act_prob_table,
+        }
+    )
+    if snapshot.posterior is not None:
+        arrays.update(
+            {"posterior." + name: value for name, value in snapshot.posterior._asdict().items()}
+        )
+    if pending is not None:
+        arrays["pending.sigma_u"] = pending[0]
+        arrays["pending.ltu_flat"] = pending[2]
+
+    contents = {
+        "checkpoint_version": CHECKPOINT_VERSION,
+        "num_params": users.num_params,
+        "user_ids": user_ids,
+        "policy_id": int(snapshot.policyid),
+        "user_list": list(snapshot.user_list),
+        "noise_var": float(snapshot.noise_var),
+        "hyperparam_update_id": snapshot.hyperparam_update_id,
+        "pending": None if pending is None else {
+            "noise_var": float(pending[1]),
+            "request_id": pending[3],
+        },
+        "current_study_decision_point": int(algorithm.current_study_decision_point),
+        "time_of_day": int(algorithm.time_of_day),
+    }
+    return artifact.write_artifact(path, arrays, {**(metadata or {}), **contents}, dtype=None)
+
+
+def restore_checkpoint(
+    algorithm,
+    path: str,
+    sha256: str = None,
+    code_version: str = None,
+    policy_id: int = None,
+    num_decisions: dict = None,
+) -> dict:
+    """
+    Restore the learned state of an algorithm from a checkpoint, and publish
+    its policy
+    :param algorithm: the MixedEffectsAlgorithm, with the configuration of
+        the one the checkpoint was saved from
+    :param path: path of the checkpoint
+    :param sha256: expected SHA-256 of the checkpoint, not checked if not given
+    :param code_version: code version the checkpoint must have been saved
+        with, in the "code_version" metadata, not checked if not given
+    :param policy_id: policy id the checkpoint must have, not checked if not given
+    :param num_decisions: number of decision points recorded for each user
+        since the start of the study, the checkpoint must have all of them,
+        not checked if not given
+    :return: metadata of the checkpoint
+    """
+    arrays, metadata = artifact.read_artifact(path, sha256, mode="c")
+    if metadata.get("checkpoint_version") != CHECKPOINT_VERSION:
+        raise ValueError(
+            f"Checkpoint version {metadata.get('checkpoint_version')} is not {CHECKPOINT_VERSION}"
+        )
+    if code_version is not None and metadata.get("code_version") != code_version:
+        raise ValueError(
+            f"Checkpoint of code version {metadata.get('code_version')}, not {code_version}"
+        )
+    if policy_id is not None and metadata["policy_id"] != policy_id:
+        raise ValueError(f"Checkpoint of policy {metadata['policy_id']}, not {policy_id}")
+    if metadata["num_params"] != algorithm.users.num_params:
+        raise ValueError(
+            "Checkpoint with {} parameters, not {}".format(
+                metadata["num_params"], algorithm.users.num_params
+            )
+        )
+
+    # Decision points recorded after the checkpoint was saved would be lost,
+    # and the next reward of the user paired with a stale design row
+    if num_decisions is not None:
+        saved = dict(zip(metadata["user_ids"], arrays["users.num_decisions"].tolist()))
+        recorded = {user_id: int(count) for user_id, count in num_decisions.items() if count > 0}
+        if saved != recorded:
+            changed = sorted(
+                user_id
+                for user_id in saved.keys() | recorded.keys()
+                if saved.get(user_id) != recorded.get(user_id)
+            )
+            raise ValueError(
+                "Checkpoint without the latest decision points of {} users, e.g. {}".format(
+                    len(changed), changed[:5]
+                )
+            )
+
+    # The store grows the copy-on-write arrays like its own ones
+    users = UserHistoryStore(
+        algorithm.users.design.shape[1], algorithm.users.num_params, algorithm.users.state_size
+    )
+    for name in STORE_ARRAYS:
+        setattr(users, name, arrays["users." + name])
+    users.user_ids = list(metadata["user_ids"])
+    users.registry = {user_id: index for index, user_id in enumerate(users.user_ids)}
+
+    posterior = None
+    posterior_mean = None
+    if "posterior.user_mean" in arrays:
+        posterior = structured.BlockPosterior(
+            *(
+                policy.freeze(arrays["posterior." + field])
+                for field in structured.BlockPosterior._fields
+            )
+        )
+        posterior_mean = posterior.user_mean.reshape(-1, 1)
+    snapshot = policy.PolicySnapshot.create(
+        metadata["user_list"],
+        policyid=metadata["policy_id"],
+        posterior_mean=posterior_mean,
+        posterior=posterior,
+        theta_pop_mean=arrays["theta_pop_mean"],
+        theta_pop_cov=arrays["theta_pop_cov"],
+        sigma_u=arrays["sigma_u"],
+        noise_var=metadata["noise_var"],
+        ltu_flat=arrays["ltu_flat"],
+        hyperparam_update_id=metadata["hyperparam_update_id"],
+        prob_table=arrays["prob_table"],
+        act_prob_table=arrays["act_prob_table"],
+    )
+
+    pending = None
+    if metadata["pending"] is not None:
+        pending = (
+            np.array(arrays["pending.sigma_u"]),
+            metadata["pending"]["noise_var"],
+            np.array(arrays["pending.ltu_flat"]),
+            metadata["pending"]["request_id"],
+        )
+
+    algorithm.users = users
+    algorithm.pending_hyperparameters = pending
+    algorithm.current_study_decision_point = metadata["current_study_decision_point"]
+    algorithm.time_of_day = metadata["time_of_day"]
+    algorithm.snapshot = snapshot
+    return metadata
@@ -0,0 +1,169 @@
+# src/algorithm/counter_rng.py
+
+# Counter-based random numbers for the action draws. Each decision gets its own
+# Philox4x32-10 block, keyed on the study seed and with the user and decision
+# index as the counter, so a draw does not depend on any shared generator
+# state: it is reproducible regardless of the order or concurrency of the
+# requests, needs no lock, and a batch of draws is a few array operations.
+#
+# The seed recorded with an action is the random word of its block, offset to
+# lie above the legacy seeds (drawn below 2**16 and expanded with
+# np.random.default_rng), so the action of any recorded seed can be replayed.
+
+# Imports
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+# Philox4x32 multipliers and key increments (Salmon et al., 2011)
+PHILOX_M0 = 0xD2511F53
+PHILOX_M1 = 0xCD9E8D57
+PHILOX_W0 = 0x9E3779B9
+PHILOX_W1 = 0xBB67AE85
+PHILOX_ROUNDS = 10
+
+MASK32 = 0xFFFFFFFF
+
+# Recorded seeds at or above the offset are counter-based, the ones below are
+# legacy seeds. The random word is truncated to 30 bits so the recorded seed
+# fits in a 32-bit signed integer column.
+COUNTER_SEED_OFFSET = 2**16
+COUNTER_SEED_BITS = 30
+
+
+def philox4x32(counter: tuple, key: tuple, rounds: int = PHILOX_ROUNDS) -> tuple:
+    """
+    Philox4x32 block of a single counter
+    :param counter: four 32-bit words
+    :param key: two 32-bit words
+    :param rounds: number of rounds
+    :return: four random 32-bit words
+    """
+    c0, c1, c2, c3 = counter
+    k0, k1 = key
+    for _ in range(rounds):
+        product0 = PHILOX_M0 * c0
+        product1 = PHILOX_M1 * c2
+        c0, c1, c2, c3 = (
+            (product1 >> 32) ^ c1 ^ k0,
+            product1 & MASK32,
+            (product0 >> 32) ^ c3 ^ k1,
+            product0 & MASK32,
+        )
+        k0 = (k0 + PHILOX_W0) & MASK32
+        k1 = (k1 + PHILOX_W1) & MASK32
+
+    return c0, c1, c2, c3
+
+
+def philox4x32_batch(
+    counters: np.array, key: tuple, rounds: int = PHILOX_ROUNDS
+) -> np.array:
+    """
+    Philox4x32 blocks of an array of counters, identical to philox4x32
+    :param counters: array of shape (n, 4) of 32-bit words
+    :param key: two 32-bit words
+    :param rounds: number of rounds
+    :return: array of shape (n, 4) of random 32-bit words, as uint64
+    """
+    counters = np.asarray(counters, dtype=np.uint64)
+    c0, c1, c2, c3 = counters.T
+    k0, k1 = np.uint64(key[0]), np.uint64(key[1])
+    mask = np.uint64(MASK32)
+    shift = np.uint64(32)
+    for _ in range(rounds):
+        product0 = np.uint64(PHILOX_M0) * c0
+        product1 = np.uint64(PHILOX_M1) * c2
+        c0, c1, c2, c3 = (
+            (product1 >> shift) ^ c1 ^ k0,
+            product1 & mask,
+            (product0 >> shift) ^ c3 ^ k1,
+            product0 & mask,
+        )
+        k0 = (k0 + np.uint64(PHILOX_W0)) & mask
+        k1 = (k1 + np.uint64(PHILOX_W1)) & mask
+
+    return np.stack([c0, c1, c2, c3], axis=-1)
+
+
+@lru_cache(maxsize=4096)
+def user_hash(user_id: str) -> int:
+    """
+    Stable 64-bit hash of a user id, independent of the order users join in
+    :param user_id: user id of the user
+    :return: hash of the user id
+    """
+    return int.from_bytes(
+        hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), "little"
+    )
+
+
+def study_key(study_seed: int) -> tuple:
+    """Philox key of a study seed"""
+    study_seed = int(study_seed) % 2**64
+    return study_seed & MASK32, study_seed >> 32
+
+
+def decision_counter(user_id: str, decision_time: int) -> tuple:
+    """Philox counter of a decision of a user"""
+    user = user_hash(user_id)
+    return int(decision_time) & MASK32, user & MASK32, user >> 32, 0
+
+
+def counter_seed(study_seed: int, user_id: str, decision_time: int) -> int:
+    """
+    Seed of a decision, the random word of its block, offset to mark it as
+    counter-based
+    :param study_seed: seed of the study
+    :param user_id: user id of the user
+    :param decision_time: decision time of the user
+    :return: seed
+    """
+    word = philox4x32(decision_counter(user_id, decision_time), study_key(study_seed))[0]
+    return COUNTER_SEED_OFFSET + (word >> (32 - COUNTER_SEED_BITS))
+
+
+def counter_seeds(study_seed: int, user_ids: list, decision_times: list) -> np.array:
+    """
+    Seeds of several decisions, identical to counter_seed
+    :param study_seed: seed of the study
+    :param user_ids: user ids of the users
+    :param decision_times: decision times of the users
+    :return: seeds
+    """
+    counters = [
+        decision_counter(user_id, decision_time)
+        for user_id, decision_time in zip(user_ids, decision_times)
+    ]
+    counters = np.array(counters, dtype=np.uint64).reshape(-1, 4)
+    words = philox4x32_batch(counters, study_key(study_seed))[:, 0]
+    words = words >> np.uint64(32 - COUNTER_SEED_BITS)
+    return (COUNTER_SEED_OFFSET + words.astype(np.int64)).astype(int)
+
+
+def is_counter_seed(seed: int) -> bool:
+    """Whether a recorded seed is counter-based, rather than a legacy seed"""
+    return seed >= COUNTER_SEED_OFFSET
+
+
+def seed_uniform(seeds):
+    """Uniform variate in [0, 1) of counter-based seeds"""
+    return (np.asarray(seeds) - COUNTER_SEED_OFFSET) / 2**COUNTER_SEED_BITS
+
+
+def legacy_action(seed: int, act_prob: float) -> int:
+    """Action of a legacy seed, a Bernoulli draw of np.random.default_rng(seed)"""
+    return np.random.default_rng(seed=seed).binomial(1, act_prob)
+
+
+def replay_action(seed: int, act_prob: float) -> int:
+    """
+    Action of a recorded seed and action probability, for either scheme
+    :param seed: seed recorded with the action
+    :param act_prob: probability of taking action
+    :return: action
+    """
+    if is_counter_seed(seed):
+        return int(seed_uniform(seed) < act_prob)
+    return legacy_action(seed, act_prob)
@@ -0,0 +1,189 @@
+# src/algorithm/dispatcher.py
+
+# Micro-batching of concurrent action requests. Requests that arrive within a
+# short window of each other are queued, and a worker thread selects their
+# actions with a single vectorized get_actions call, so bursts of requests
+# around notification times share the table lookups and the seed draws.
+#
+# At burst load the batched selection costs about a quarter of the single one
+# per request, but the hand-off to and from the worker thread outweighs the
+# saving, so the dispatcher gives no throughput gain per core and is off by
+# default (ACTION_DISPATCHER in config.ini).
+
+# Imports
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class ActionDispatcher:
+    """Collects concurrent get_action calls into batches"""
+
+    def __init__(
+        self,
+        algorithm,
+        window_ms: float = 3.0,
+        max_batch_size: int = 64,
+        metrics_size: int = 1000,
+    ) -> None:
+        """
+        Initialize the dispatcher
+        :param algorithm: algorithm with a get_actions method
+        :param window_ms: longest time a request waits for others to join its
+            batch, in milliseconds
+        :param max_batch_size: largest number of requests in a batch, a full
+            batch is dispatched without waiting for the window to end
+        :param metrics_size: number of recent batches the metrics are computed over
+        """
+        self.algorithm = algorithm
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+
+        # Queue of (user id, state, decision time, enqueue time, future)
+        self.queue = []
+        self.condition = threading.Condition()
+        self.worker = None
+
+        # Metrics
+        self.num_requests = 0
+        self.num_batches = 0
+        self.batch_sizes = deque(maxlen=metrics_size)
+        self.queue_delays = deque(maxlen=metrics_size * max_batch_size)
+        self.batch_times = deque(maxlen=metrics_size)
+
+    def get_action(
+        self, user_id: str, state: list, decision_time: int, seed: int = -1
+    ) -> tuple[int, int, float, int]:
+        """
+        Get action, batched with the other requests in the window
+        :param user_id: user id of the user
+        :param state: state of the user
+        :param decision_time: decision time of the user for which action is to be taken
+        :param seed: seed for random number generator, requests with a seed
+            are not batched
+        :return: action, seed, probability of taking action, and policy id
+        """
+        if seed != -1:
+            return self.algorithm.get_action(user_id, state, decision_time, seed)
+
+        return self.submit(user_id, state, decision_time).result()
+
+    def submit(self, user_id: str, state: list, decision_time: int) -> Future:
+        """
+        Queue an action request
+        :param user_id: user id of the user
+        :param state: state of the user
+        :param decision_time: decision time of the user for which action is to be taken
+        :return: future of the action, seed, probability and policy id
+        """
+        if len(state) != 3:
+            raise ValueError("State should be of length 3")
+
+        future = Future()
+        with self.condition:
+            # Started on first use, so that forked server workers get their own
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(
+                    target=self._run, name="ActionDispatcher", daemon=True
+                )
+                self.worker.start()
+
+            self.queue.append(
+                (user_id, state, decision_time, time.perf_counter(), future)
+            )
+            self.condition.notify()
+
+        return future
+
+    def _next_batch(self) -> list:
+        """Wait for a full batch, or for the window of the oldest request to end"""
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+
+            deadline = self.queue[0][3] + self.window_ms / 1000
+            while len(self.queue) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = self.queue[: self.max_batch_size]
+            del self.queue[: self.max_batch_size]
+
+        return batch
+
+    def _run(self) -> None:
+        """Worker loop, dispatches one batch at a time"""
+        while True:
+            self.dispatch(self._next_batch())
+
+    def dispatch(self, batch: list) -> None:
+        """
+        Select the actions of a batch of requests and resolve their futures. If
+        the batch fails, the actions of its requests are selected one by one
+        :param batch: list of (user id, state, decision time, enqueue time, future)
+        """
+        start = time.perf_counter()
+        try:
+            actions, seeds, act_probs, policy_id = self.algorithm.get_actions(
+                [request[0] for request in batch],
+                np.array([request[1] for request in batch]),
+                [request[2] for request in batch],
+            )
+        except Exception:
+            # Select the actions one by one, so that a bad request fails only
+            # its own future
+            for request in batch:
+                try:
+                    result = self.algorithm.get_action(request[0], request[1], request[2])
+                except Exception as e:
+                    request[4].set_exception(e)
+                else:
+                    request[4].set_result(result)
+        else:
+            for i, request in enumerate(batch):
+                request[4].set_result(
+                    (int(actions[i]), int(seeds[i]), float(act_probs[i]), policy_id)
+                )
+
+        end = time.perf_counter()
+        with self.condition:
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            self.batch_sizes.append(len(batch))
+            self.queue_delays.extend(start - request[3] for request in batch)
+            self.batch_times.append(end - start)
+
+    def metrics(self) -> dict:
+        """
+        Configuration and recent performance of the dispatcher
+        :return: dictionary of the window, the batch sizes, and the queueing
+            delays and batch compute times in milliseconds
+        """
+
+        def summary(values, scale=1.0):
+            if len(values) == 0:
+                return None
+            values = scale * np.array(values)
+            return {
+                "mean": float(np.mean(values)),
+                "p50": float(np.percentile(values, 50)),
+                "p99": float(np.percentile(values, 99)),
+                "max": float(np.max(values)),
+            }
+
+        with self.condition:
+            return {
+                "window_ms": self.window_ms,
+                "max_batch_size": self.max_batch_size,
+                "num_requests": self.num_requests,
+                "num_batches": self.num_batches,
+                "queue_length": len(self.queue),
+                "batch_size": summary(self.batch_sizes),
+                "queue_delay_ms": summary(self.queue_delays, 1000),
+                "batch_time_ms": summary(self.batch_times, 1000),
+            }
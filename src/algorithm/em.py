@@ -0,0 +1,179 @@
+# src/algorithm/em.py
+
+# EM estimator of Sigma_u and the noise variance, an alternative to minimizing
+# the marginal objective with one of the optimizers. The population parameters
+# theta_pop and the random effects u_i = theta_i - theta_pop are the missing
+# data. The E-step is the block-structured posterior update_posteriors
+# computes (structured.posterior_blocks), and both M-steps are closed form:
+#   Sigma_u = 1/N sum_i E[u_i u_i^T]
+#   noise_var = 1/T sum_i E[||y_i - X_i theta_i||^2]
+# An iteration costs one posterior, O(N d^3) in float64 NumPy, and never
+# decreases the marginal likelihood, but EM converges linearly, slowly when
+# the noise dominates the random effects. For the diagonal and block
+# parameterizations of Sigma_u the M-step keeps the diagonal or diagonal blocks
+# of the update, which maximizes the expected log likelihood over the structure.
+# The low-rank one has no closed-form M-step.
+
+# Imports
+import numpy as np
+
+from src.algorithm import optimizer, parameterization, structured
+
+
+def em_update(
+    sigma_u: np.array,
+    noise_var: float,
+    A_hat: np.array,
+    B_hat: np.array,
+    prior_mean: np.array,
+    prior_cov: np.array,
+    sum_sq_reward: float,
+    ts: float,
+) -> tuple:
+    """
+    One EM iteration
+    :param sigma_u: current random effects covariance, shape (d, d)
+    :param noise_var: current noise variance
+    :param A_hat: stacked per-user X_i^T X_i, shape (N, d, d)
+    :param B_hat: stacked per-user X_i^T y_i, shape (N, d)
+    :param prior_mean: prior mean of theta_pop, shape (d,)
+    :param prior_cov: prior covariance of theta_pop, shape (d, d)
+    :param sum_sq_reward: sum of the squared rewards of all users
+    :param ts: total number of decisions of all users
+    :return: the updated Sigma_u and noise variance
+    """
+    nusers, size = B_hat.shape
+    blocks = structured.posterior_blocks(
+        A_hat, B_hat, prior_mean, prior_cov, sigma_u, noise_var
+    )
+    user_mean = blocks["user_mean"]
+    theta_pop_mean = blocks["theta_pop_mean"].flatten()
+    theta_pop_cov = blocks["theta_pop_cov"]
+
+    # Cov(theta_i, theta_pop) = G_i Cov(theta_pop), so
+    # Cov(u_i) = W_i + (G_i - I) Cov(theta_pop) (G_i - I)^T. Batched matmuls
+    # rather than einsum, which does not optimize three-operand contractions
+    coupling = blocks["coupling"]
+    shift = coupling - np.identity(size)
+    u_cov = blocks["cond_cov"] + shift @ theta_pop_cov @ shift.transpose(0, 2, 1)
+    u_mean = user_mean - theta_pop_mean
+    new_sigma_u = (u_mean.T @ u_mean + np.sum(u_cov, axis=0)) / nusers
+
+    # Expected residual sum of squares, from the sufficient statistics
+    user_cov = blocks["cond_cov"] + coupling @ theta_pop_cov @ coupling.transpose(0, 2, 1)
+    residual = (
+        sum_sq_reward
+        - 2 * np.sum(user_mean * B_hat)
+        + np.einsum("ni,nij,nj->", user_mean, A_hat, user_mean)
+        + np.einsum("nij,nji->", A_hat, user_cov)
+    )
+
+    return (new_sigma_u + new_sigma_u.T) / 2, float(residual / ts)
+
+
+def relative_change(
+    sigma_u: np.array, noise_var: float, new_sigma_u: np.array, new_noise_var: float
+) -> float:
+    """Largest change of the hyperparameters of an iteration, relative to their scale"""
+    return max(
+        np.max(np.abs(new_sigma_u - sigma_u)) / np.max(np.abs(sigma_u)),
+        abs(new_noise_var - noise_var) / noise_var,
+    )
+
+
+def fit_em(
+    problem: optimizer.HyperparameterProblem, chunk_iters: int = None, progress=None
+) -> optimizer.HyperparameterFit:
+    """
+    Run EM from the starting point of a problem, or from its reset point if
+    the starting point is not valid, until the relative change of the
+    hyperparameters is below em_tolerance or max_iter iterations. The
+    objective of each iteration is the marginal objective of the optimizers,
+    so the fits can be compared. Multi-start settings are ignored.
+    :param problem: the hyperparameter problem
+    :param chunk_iters: call progress every this many iterations, never if None
+    :param progress: called with the number of iterations and the objective,
+        the fit stops early if it returns False
+    :return: the fit, with the convergence diagnostics, status FIT_INVALID if
+        neither starting point nor the estimate is valid, and FIT_STOPPED if
+        it was stopped by progress
+    """
+    data, size = problem.data, problem.size
+    structure = parameterization.as_parameterization(size)
+    if structure.kind == "lowrank":
+        raise ValueError("EM does not support the low-rank parameterization of Sigma_u")
+
+    ltu_flat, noise_precision = problem.init_point
+    init_obj, valid = optimizer.validate(ltu_flat, noise_precision, data, size)
+    if not valid:
+        ltu_flat, noise_precision = problem.reset_point
+        init_obj, valid = optimizer.validate(ltu_flat, noise_precision, data, size)
+        if not valid:
+            return optimizer.HyperparameterFit(
+                optimizer.FIT_INVALID, None, None, 0, 0, float(init_obj)
+            )
+
+    # Padded users are dropped, they would pull Sigma_u towards its current value
+    users = slice(None)
+    if data.user_mask is not None:
+        users = np.asarray(data.user_mask) > 0
+    statistics = (
+        np.asarray(data.A_hat, dtype=float)[users],
+        np.asarray(data.B_hat, dtype=float)[users],
+        np.asarray(data.mu_prior, dtype=float),
+        np.asarray(data.sigma_prior, dtype=float),
+        float(data.sum_sq_reward),
+        float(data.ts),
+    )
+
+    sigma_u = parameterization.sigma_u_of(ltu_flat, structure)
+    noise_var = 1.0 / float(noise_precision)
+
+    status = optimizer.FIT_COMPLETED
+    objectives = [float(init_obj)]
+    changes = []
+    valid = True
+    while len(changes) < problem.max_iter:
+        new_sigma_u, new_noise_var = em_update(sigma_u, noise_var, *statistics)
+        new_sigma_u = parameterization.project(new_sigma_u, structure)
+        changes.append(relative_change(sigma_u, noise_var, new_sigma_u, new_noise_var))
+        sigma_u, noise_var = new_sigma_u, new_noise_var
+
+        obj, valid = optimizer.validate(
+            parameterization.params_of(sigma_u, structure), 1.0 / noise_var, data, size
+        )
+        objectives.append(float(obj))
+
+        if changes[-1] < problem.em_tolerance:
+            break
+        if (
+            progress is not None
+            and chunk_iters is not None
+            and len(changes) % chunk_iters == 0
+            and not progress(len(changes), objectives[-1])
+        ):
+            status = optimizer.FIT_STOPPED
+            break
+
+    diagnostics = {
+        "estimator": "em",
+        "converged": bool(changes) and changes[-1] < problem.em_tolerance,
+        "relative_change": changes[-1] if changes else None,
+        "objective_trace": objectives,
+        "relative_change_trace": changes,
+    }
+    if not valid:
+        return optimizer.HyperparameterFit(
+            optimizer.FIT_INVALID, None, None, len(changes), 0, objectives[-1],
+            diagnostics=diagnostics,
+        )
+
+    return optimizer.HyperparameterFit(
+        status,
+        parameterization.params_of(sigma_u, structure),
+        1.0 / noise_var,
+        len(changes),
+        0,
+        objectives[-1],
+        diagnostics=diagnostics,
+    )
@@ -3,21 +3,31 @@
 # Imports
 import numpy as np
 import pandas as pd
+from src.algorithm import counter_rng
 from src.algorithm.base import RLAlgorithm
 
 
 class FlatProbabilityAlgorithm(RLAlgorithm):
     """Flat probability algorithm"""
 
-    def __init__(self, prob: float = 0.5) -> None:
+    def __init__(
+        self, prob: float = 0.5, rng_scheme: str = "counter", study_seed: int = None
+    ) -> None:
         """
         Initialize flat probability algorithm
         :param nusers: number of users
         :param prob: probability of taking action
+        :param rng_scheme: "counter" for counter-based draws keyed on study_seed,
+            the user and the decision time, or "legacy" for a fresh random seed
+        :param study_seed: seed of the counter-based draws, random if not given
         """
         self.prob = prob
         self.policyid = 0
         self.maxseed = 2**16 - 1
+        self.rng_scheme = rng_scheme
+        if study_seed is None:
+            study_seed = np.random.SeedSequence().entropy % 2**64
+        self.study_seed = int(study_seed)
 
     def get_action(
         self, user_id: str, state: np.ndarray, decision_time: int, seed: int = -1
@@ -31,20 +41,21 @@ class FlatProbabilityAlgorithm(RLAlgorithm):
         :return: action, seed, probability of taking action, and policy id
         """
 
+        # Local generators, the global numpy random state is left untouched
         if seed != -1:
-            np.random.seed(seed)
-        else:
-            # set seed
-            np.random.seed()
-
+            if counter_rng.is_counter_seed(seed):
+                action = int(counter_rng.seed_uniform(seed) < self.prob)
+            else:
+                action = np.random.RandomState(seed).binomial(1, self.prob)
+        elif self.rng_scheme == "legacy":
             # generate seed
-            seed = np.random.randint(0, self.maxseed)
+            seed = np.random.RandomState().randint(0, self.maxseed)
 
-            # set seed
-            np.random.seed(seed)
-
-        # get action
-        action = np.random.binomial(1, self.prob)
+            # get action
+            action = np.random.RandomState(seed).binomial(1, self.prob)
+        else:
+            seed = counter_rng.counter_seed(self.study_seed, user_id, decision_time)
+            action = int(counter_rng.seed_uniform(seed) < self.prob)
 
         return action, seed, self.prob, self.policyid
 
@@ -0,0 +1,129 @@
+# src/algorithm/history.py
+
+# History of the published policies, one record of arrays per policy id. Only
+# the last few records stay in memory, older ones are written to one directory
+# of .npy files per policy id and read back memory-mapped, so the resident
+# memory of the history does not grow with the length of the study. The
+# records on disk outlive the process, and are never overwritten.
+
+# Imports
+import os
+import re
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+from src.algorithm import structured
+
+
+class PolicyHistory:
+    """Records of the published policies, keyed by policy id"""
+
+    def __init__(self, directory: str = None, max_in_memory: int = 4) -> None:
+        """
+        Initialize the history
+        :param directory: directory older records are spilled to, None to
+            drop them instead. The records already in it are part of the
+            history.
+        :param max_in_memory: number of most recent records kept in memory
+        """
+        if max_in_memory < 1:
+            raise ValueError("The history keeps at least one record in memory")
+        self.directory = directory
+        self.max_in_memory = int(max_in_memory)
+
+        # Most recent records, oldest first, and the policy ids on disk
+        self.records = OrderedDict()
+        self.spilled = self.scan()
+
+    def __len__(self) -> int:
+        return len(self.spilled) + len(self.records)
+
+    def __contains__(self, policy_id: int) -> bool:
+        return policy_id in self.records or policy_id in self.spilled
+
+    @property
+    def policy_ids(self) -> list:
+        """Policy ids in the history, oldest first"""
+        return self.spilled + list(self.records)
+
+    @property
+    def last_policy_id(self) -> int:
+        """Newest policy id in the history, including earlier runs, 0 if empty"""
+        return max(self.policy_ids, default=0)
+
+    def scan(self) -> list:
+        """Policy ids of the records in the directory, oldest first"""
+        if self.directory is None or not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            int(match.group(1))
+            for match in map(re.compile(r"policy_(\d+)").fullmatch, os.listdir(self.directory))
+            if match is not None
+        )
+
+    def path(self, policy_id: int) -> str:
+        """Directory of the spilled record of a policy"""
+        return os.path.join(self.directory, f"policy_{int(policy_id)}")
+
+    def append(self, policy_id: int, record: dict) -> None:
+        """
+        Add the record of a new policy, and spill the oldest records in memory
+        :param policy_id: policy id, newer than the ones in the history
+        :param record: arrays (or scalars) of the policy, by name
+        """
+        if policy_id in self:
+            raise ValueError(f"Policy {policy_id} is already in the history")
+        record = {key: np.asarray(value) for key, value in record.items()}
+
+        # An oldest record leaves memory only once it is on disk, so the
+        # history is unchanged if a spill fails
+        while len(self.records) >= self.max_in_memory:
+            old_id, old_record = next(iter(self.records.items()))
+            if self.directory is not None:
+                self.spill(old_id, old_record)
+            del self.records[old_id]
+        self.records[policy_id] = record
+
+    def spill(self, policy_id: int, record: dict) -> None:
+        """Write a record to disk, the directory appears in one step"""
+        path = self.path(policy_id)
+        if os.path.exists(path):
+            raise FileExistsError(f"The record of policy {policy_id} exists: {path}")
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for key, value in record.items():
+            np.save(os.path.join(tmp_path, key + ".npy"), value)
+        os.replace(tmp_path, path)
+        self.spilled.append(policy_id)
+
+    def get(self, policy_id: int) -> dict:
+        """
+        Record of a policy, read lazily from disk if it was spilled
+        :param policy_id: policy id
+        :return: arrays of the policy by name, read-only memory maps for a
+            spilled record
+        """
+        if policy_id in self.records:
+            return self.records[policy_id]
+        if policy_id not in self.spilled:
+            raise KeyError(f"Policy {policy_id} is not in the history")
+
+        path = self.path(policy_id)
+        return {
+            name[: -len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+            for name in sorted(os.listdir(path))
+            if name.endswith(".npy")
+        }
+
+    def __getitem__(self, policy_id: int) -> dict:
+        return self.get(policy_id)
+
+    def posterior(self, policy_id: int) -> structured.BlockPosterior:
+        """Compact posterior of a policy, see structured.BlockPosterior"""
+        record = self.get(policy_id)
+        return structured.BlockPosterior(
+            *(record[field] for field in structured.BlockPosterior._fields)
+        )
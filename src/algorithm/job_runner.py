@@ -0,0 +1,226 @@
+# src/algorithm/job_runner.py
+
+# Hyperparameter fits in a worker process. The server hands a
+# HyperparameterProblem, a copy of the sufficient statistics, to a pool of one
+# process started with spawn, so the fit neither competes with the request
+# handlers for the GIL nor inherits the server's threads and connections. The
+# worker runs the gradient descent in chunks, reports the progress after each
+# chunk over a queue, and stops between chunks when its job is cancelled or
+# runs out of its wall-clock budget. The worker compiles its own executables,
+# so the server warms it up with a few one-iteration fits before the first job.
+
+# Imports
+import multiprocessing
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Callable
+
+from src.algorithm import optimizer
+
+# Statuses of a fit stopped by the runner, in addition to the optimizer ones
+FIT_CANCELLED = "cancelled"
+FIT_TIMED_OUT = "timed out"
+
+# Set in the worker process by _init_worker
+_progress_queue = None
+_cancelled_job = None
+
+
+def _init_worker(progress_queue, cancelled_job, cache_dir: str) -> None:
+    """Initialize the worker process"""
+    global _progress_queue, _cancelled_job
+
+    _progress_queue = progress_queue
+    _cancelled_job = cancelled_job
+    if cache_dir is not None:
+        optimizer.enable_compilation_cache(cache_dir)
+
+
+def _run_job(
+    job_id: int,
+    problem: optimizer.HyperparameterProblem,
+    chunk_iters: int,
+    time_budget: float,
+) -> optimizer.HyperparameterFit:
+    """Fit the hyperparameters of a job, in the worker process"""
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    stopped = []
+
+    def progress(iteration: int, objective: float) -> bool:
+        _progress_queue.put((job_id, iteration, objective))
+        if _cancelled_job.value == job_id:
+            stopped.append(FIT_CANCELLED)
+        elif deadline is not None and time.monotonic() > deadline:
+            stopped.append(FIT_TIMED_OUT)
+        return not stopped
+
+    # Iteration 0 marks the job as started
+    _progress_queue.put((job_id, 0, None))
+    fit = optimizer.fit_hyperparameters(problem, chunk_iters, progress)
+    if fit.status == optimizer.FIT_STOPPED:
+        fit = fit._replace(status=stopped[0])
+
+    return fit
+
+
+def _warm_up(problems: dict, chunk_iters: int) -> dict:
+    """Fit each problem like a job, in the worker process, and time it"""
+    compile_times = {}
+    for key, problem in problems.items():
+        start = time.time()
+        optimizer.fit_hyperparameters(problem, chunk_iters)
+        compile_times[key] = time.time() - start
+    return compile_times
+
+
+class HyperparameterJobRunner:
+    """Runs hyperparameter fits one at a time in a worker process"""
+
+    def __init__(
+        self,
+        on_progress: Callable,
+        on_done: Callable,
+        chunk_iters: int = 25,
+        cache_dir: str = None,
+    ) -> None:
+        """
+        Initialize the runner, the worker process is started on the first job
+        :param on_progress: called with the job id, the iteration and the
+            lowest objective so far (None when the job starts), from a thread
+            of the runner
+        :param on_done: called with the job id, the fit (None if the job
+            failed) and the exception raised by the job (None if it did not
+            fail), from a thread of the runner
+        :param chunk_iters: number of iterations between progress reports,
+            cancellation and time budget checks
+        :param cache_dir: persistent compilation cache directory of the worker
+        """
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.chunk_iters = chunk_iters
+        self.cache_dir = cache_dir
+
+        self.context = multiprocessing.get_context("spawn")
+        self.progress_queue = self.context.Queue()
+        self.cancelled_job = self.context.Value("q", -1)
+        self.executor = None
+        self.listener = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(
+        self,
+        job_id: int,
+        problem: optimizer.HyperparameterProblem,
+        time_budget: float = None,
+    ) -> Future:
+        """
+        Queue a hyperparameter fit
+        :param job_id: id of the job, unique across the lifetime of the runner
+        :param problem: the hyperparameter problem
+        :param time_budget: wall-clock seconds the fit may run for once
+            started, unlimited if None
+        :return: future of the fit
+        """
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(
+                    target=self._listen, name="HyperparameterJobProgress", daemon=True
+                )
+                self.listener.start()
+
+            future = self._submit(_run_job, job_id, problem, self.chunk_iters, time_budget)
+            self.jobs[job_id] = future
+
+        future.add_done_callback(partial(self._done, job_id))
+        return future
+
+    def warm_up(self, problems: dict) -> Future:
+        """
+        Start the worker process, and compile the executables of its fits by
+        running problems of the shapes of the jobs, see
+        MixedEffectsAlgorithm.warm_up_problems
+        :param problems: hyperparameter problems, by name
+        :return: future of the seconds each problem took, by name
+        """
+        with self.lock:
+            return self._submit(_warm_up, problems, self.chunk_iters)
+
+    def _submit(self, *args) -> Future:
+        """Submit a call to the worker process, with the lock held"""
+        try:
+            return self._executor().submit(*args)
+        except BrokenProcessPool:
+            # The previous worker died, start a new one
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            return self._executor().submit(*args)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        """Pool of the worker process, created on first use"""
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=self.context,
+                initializer=_init_worker,
+                initargs=(self.progress_queue, self.cancelled_job, self.cache_dir),
+            )
+        return self.executor
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        Cancel a job, before it starts or at its next progress report
+        :param job_id: id of the job
+        :return: False if the job is not queued or running in this runner
+        """
+        with self.lock:
+            future = self.jobs.get(job_id)
+        if future is None or future.done():
+            return False
+
+        # Outside the lock, a queued job's done callback runs right away
+        if not future.cancel():
+            # Already running, the worker checks the flag between chunks
+            self.cancelled_job.value = job_id
+
+        return True
+
+    def running(self, job_id: int) -> bool:
+        """Whether a job is queued or running in this runner"""
+        with self.lock:
+            return job_id in self.jobs
+
+    def _listen(self) -> None:
+        """Forward the progress reports of the worker"""
+        while True:
+            job_id, iteration, objective = self.progress_queue.get()
+            try:
+                self.on_progress(job_id, iteration, objective)
+            except Exception:
+                # A lost progress report must not stop the listener
+                pass
+
+    def _done(self, job_id: int, future: Future) -> None:
+        """Report the outcome of a job"""
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+        fit, error = None, None
+        try:
+            fit = future.result()
+        except CancelledError:
+            fit = optimizer.HyperparameterFit(FIT_CANCELLED, None, None, 0, 0, None)
+        except Exception as e:
+            error = e
+
+        self.on_done(job_id, fit, error)
+
+    def shutdown(self) -> None:
+        """Stop the worker process, cancelling the queued jobs"""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -6,6 +6,17 @@ import numpy as np
 import pandas as pd
 import pickle as pkl
 from src.algorithm.base import RLAlgorithm
+from src.algorithm import (
+    artifact,
+    backends,
+    counter_rng,
+    history,
+    optimizer,
+    parameterization,
+    policy,
+    structured,
+)
+from src.algorithm.user_store import UserHistoryStore
 from typing import Callable
 import logging
 import scipy.stats as stats
@@ -15,71 +26,43 @@ from functools import partial
 
 import jax
 import jax.numpy as jnp
+import time
 import traceback
 
 from sklearn.linear_model import LogisticRegression
 
 
-@partial(jax.jit, static_argnums=(6, 7, 8, 9, 10))
+@partial(jax.jit, static_argnums=(7, 9))
 def obj_func(
     flat_lower_t: jnp.array,
     noise_precision: float,
-    A: jnp.array,
-    B: jnp.array,
+    A_hat: jnp.array,
+    B_hat: jnp.array,
     mu_prior: jnp.array,
     sigma_prior: jnp.array,
     sum_sq_reward: int,
     size: int,
-    nusers: int,
     ts: int,
     debug: bool = False,
 ):
     """Objective function for optimization"""
 
-    # Construct the lower triangular matrix
-    L = jnp.zeros((size, size), dtype=float)
-    L = L.at[jnp.tril_indices(size)].set(flat_lower_t)
-
-    # Construct the PSD matrix of random effects variance
-    Sigma_u = L @ L.T
-    del L
-
-    # Construct X and y
-    # X = jnp.linalg.inv(jnp.array(sigma_prior) + jnp.kron(jnp.identity(nusers), Sigma_u))
-    X = MixedEffectsAlgorithm.invert_sigma_theta(sigma_prior, Sigma_u, nusers)
-
-    y = noise_precision
-
-    # Evaluate the optimization function
-    s1, part1 = jnp.linalg.slogdet(X)
-    s2, part2 = jnp.linalg.slogdet(X + y * A)
-    part2 = (-1) * part2
-    # part3 = nusers * ts * jnp.log(y)
-    part3 = ts * jnp.log(y)
-    part4 = -1 * y * sum_sq_reward
-    part5 = -1 * mu_prior.T @ X @ mu_prior
-    part6 = (
-        (X @ mu_prior + y * B).T @ jnp.linalg.inv(X + y * A) @ (X @ mu_prior + y * B)
+    # Compute the per-user and population blocks of the objective
+    terms = structured.marginal_terms(
+        flat_lower_t, noise_precision, A_hat, B_hat, mu_prior, sigma_prior, size
     )
 
     if debug:
-        print("Part 1: ", -part1)
-        print("Part 2: ", -part2)
-        print("Part 3: ", -part3)
-        print("Part 4: ", -part4)
-        print("Part 5: ", -part5)
-        print("Part 6: ", -part6)
+        print("User log determinants: ", jnp.sum(terms["user_logdet"]))
+        print("User quadratic terms: ", jnp.sum(terms["user_quad"]))
+        print("Population log determinant: ", terms["pop_logdet"])
+        print("Population quadratic term: ", terms["pop_quad"])
 
     # Check mixed effects model overleaf file, section 5.4, page 20, equation 171
     # Doing negative because we are minimizing
-    result = -1 * (part1 + part2 + part3 + part4 + part5 + part6)
-
-    del part1
-    del part2
-    del part3
-    del part4
-    del part5
-    del part6
+    result = structured.marginal_objective(
+        terms, noise_precision, sum_sq_reward, ts
+    )
 
     return result
 
@@ -104,6 +87,25 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         debug: bool = False,
         logger_path: str = None,
         param_size: list = [8, 8, 8],
+        shape_bucketing: bool = True,
+        batch_alloc_func: Callable = None,
+        rng_scheme: str = "counter",
+        study_seed: int = None,
+        multi_start: bool = False,
+        num_jittered_starts: int = 2,
+        start_jitter: float = 0.1,
+        hyperparam_optimizer: str = "gd",
+        hyperparam_estimator: str = "marginal",
+        em_tolerance: float = 1e-4,
+        sigma_u_parameterization: str = "full",
+        sigma_u_rank: int = 2,
+        hyperparam_backend: str = "jax",
+        posterior_backend: str = "numpy",
+        cost_model_path: str = None,
+        history_dir: str = None,
+        history_in_memory: int = 4,
+        policy_artifact_dir: str = None,
+        policy_artifact_dtype: str = "float64",
     ) -> None:
         """
         Initialize the mixed effects model based RL algorithm
@@ -121,6 +123,53 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         :param maxseed: maximum seed value
         :param debug: debug flag
         :param logger_path: path to log file
+        :param param_size: sizes of the baseline, action centering and advantage terms
+        :param shape_bucketing: pad the users to geometric size classes in the
+            hyperparameter optimization, so it is not recompiled as the cohort grows
+        :param batch_alloc_func: batch version of the allocation function, used to
+            precompute the action probabilities of a policy
+        :param rng_scheme: "counter" to draw each action from a Philox block keyed
+            on study_seed, the user and the decision time, or "legacy" to draw a
+            seed from rng and expand it with np.random.default_rng
+        :param study_seed: seed of the counter-based draws, random if not given
+        :param multi_start: run the hyperparameter optimization from the previous
+            estimate, the initial hyperparameters and jittered copies of both at
+            once (one thread each), and keep the best, instead of from the
+            previous estimate with a fallback to the initial hyperparameters
+        :param num_jittered_starts: number of jittered copies of each starting point
+        :param start_jitter: standard deviation of the log of the factors the
+            Cholesky entries of the jittered starting points are scaled by
+        :param hyperparam_optimizer: optimizer of the hyperparameters, "gd" for
+            the gradient descent, "lbfgs" for L-BFGS or "newton" for damped
+            Newton. The last two optimize the log of the noise precision, and
+            unlike the gradient descent return the noise precision they reach
+        :param hyperparam_estimator: "marginal" to minimize the marginal objective
+            with hyperparam_optimizer, or "em" for the closed-form EM updates
+        :param em_tolerance: relative change of the hyperparameters EM stops at
+        :param sigma_u_parameterization: parameterization of Sigma_u, "full" for
+            the Cholesky factor, or "diagonal", "block" (one block per entry of
+            param_size) or "lowrank" (diagonal plus a factor of rank
+            sigma_u_rank), which have fewer parameters. init_cov_u is replaced
+            by its closest matrix of the structure, see parameterization.py
+        :param sigma_u_rank: rank of the factor of the low-rank parameterization
+        :param hyperparam_backend: backend of the hyperparameter fit, "jax" for
+            the compiled loops, "numpy" for the float64 NumPy gradient descent,
+            or "auto" to choose by number of users with the cost model, only
+            between backends of the same precision
+        :param posterior_backend: backend of the posterior update, "numpy"
+            (float64), "jax" (in the precision of JAX) or "auto"
+        :param cost_model_path: cost model saved by backends.calibrate, the
+            default one if not given or missing, see backends.py
+        :param history_dir: directory the history of the policies older than
+            the last history_in_memory is written to, None to keep only the
+            last history_in_memory policies
+        :param history_in_memory: number of policies the history keeps in memory
+        :param policy_artifact_dir: directory the posterior of every new policy
+            is written to as a binary artifact (see artifact.py), in place of
+            the joint posterior covariance in the parameters returned by update.
+            None to return the joint covariance as a list
+        :param policy_artifact_dtype: "float64" or "float32", dtype of the
+            policy artifacts
         """
 
         # TODO: Decide how the starting time of day works
@@ -128,18 +177,23 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         self.num_days = num_days
         self.prior_mean = prior_mean
         self.prior_cov = prior_cov
-        self.sigma_u = init_cov_u
         self.init_noise_var = init_noise_var
-        self.noise_var = init_noise_var
-
-        self.theta_pop_mean = copy.deepcopy(self.prior_mean)
-        self.theta_pop_cov = copy.deepcopy(self.prior_cov)
 
-        cholesky = np.linalg.cholesky(self.sigma_u)
-        self.ltu_flat = cholesky[np.tril_indices(self.sigma_u.shape[0])].flatten()
-        self.init_ltu_flat = copy.deepcopy(self.ltu_flat)
+        # The parameter vector of Sigma_u keeps the name of the full
+        # parameterization, the lower triangular entries of its Cholesky factor
+        self.parameterization = parameterization.make_parameterization(
+            sigma_u_parameterization, init_cov_u.shape[0], param_size, sigma_u_rank
+        )
+        if self.parameterization.kind == "full":
+            cholesky = np.linalg.cholesky(init_cov_u)
+            init_ltu_flat = cholesky[np.tril_indices(init_cov_u.shape[0])].flatten()
+        else:
+            init_ltu_flat = parameterization.params_of(init_cov_u, self.parameterization)
+            init_cov_u = parameterization.sigma_u_of(init_ltu_flat, self.parameterization)
+        self.init_ltu_flat = copy.deepcopy(init_ltu_flat)
 
         self.allocation_function = alloc_func
+        self.batch_allocation_function = batch_alloc_func
         self.current_study_decision_point = 0
         self.time_of_day = starting_time_of_day
 
@@ -148,30 +202,65 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         self.tolerance = tolerance
         self.rng = rng
         self.maxseed = maxseed
+        if rng_scheme not in ["counter", "legacy"]:
+            raise ValueError(f"Unknown rng scheme: {rng_scheme}")
+        self.rng_scheme = rng_scheme
+        if study_seed is None:
+            study_seed = np.random.SeedSequence().entropy % 2**64
+        self.study_seed = int(study_seed)
         self.bernoulli = stats.bernoulli
-        self.user_data = {}
-        self.num_users = 0
 
-        self.policyid = 0
         self.param_size = param_size
 
-        self.hyperparam_update_flag = False
-
-        self.posterior_mean = None
-        self.posterior_cov = None
-        self.posterior_mean_history = []
-        self.posterior_cov_history = []
-        self.sigma_u_history = []
-        self.noise_var_history = []
-        self.theta_pop_posterior_mean_history = []
-        self.theta_pop_posterior_cov_history = []
+        # Decision history and sufficient statistics of the users
+        self.users = UserHistoryStore(int(num_days), int(np.sum(param_size)))
+
+        # Hyperparameters staged for the next posterior update, as one tuple of
+        # (sigma_u, noise_var, ltu_flat, request id), None if there are none
+        self.pending_hyperparameters = None
+        self.hyperparam_fit_info = {}
+        self.shape_bucketing = shape_bucketing
+        self.multi_start = multi_start
+        self.num_jittered_starts = num_jittered_starts
+        self.start_jitter = start_jitter
+
+        # Fails early on an unknown optimizer
+        optimizer.optimizer_functions(hyperparam_optimizer)
+        self.hyperparam_optimizer = hyperparam_optimizer
+        if hyperparam_estimator not in ["marginal", "em"]:
+            raise ValueError(f"Unknown hyperparameter estimator: {hyperparam_estimator}")
+        self.hyperparam_estimator = hyperparam_estimator
+        self.em_tolerance = em_tolerance
+
+        for backend in [hyperparam_backend, posterior_backend]:
+            if backend not in backends.SELECTIONS:
+                raise ValueError(f"Unknown compute backend: {backend}")
+        if hyperparam_backend == "numpy":
+            optimizer.optimizer_functions(hyperparam_optimizer, hyperparam_backend)
+        self.hyperparam_backend = hyperparam_backend
+        self.posterior_backend = posterior_backend
+        self.cost_model = backends.load_cost_model(cost_model_path)
+
+        # Posterior and hyperparameters of every published policy, see
+        # history.py. The full joint of a compact posterior is assembled on
+        # request with full_cov()
+        self.history = history.PolicyHistory(history_dir, history_in_memory)
+
+        if policy_artifact_dtype not in artifact.DTYPES:
+            raise ValueError(f"Unknown artifact dtype: {policy_artifact_dtype}")
+        self.policy_artifact_dir = policy_artifact_dir
+        self.policy_artifact_dtype = policy_artifact_dtype
+
+        # (policy id, path, SHA-256) of the artifact of the last policy
+        # published by update_posteriors
+        self.policy_artifact = None
+
+        # Policy ids already used outside of the history, e.g. by the
+        # RLWeights rows of a run that could not be restored, new policies get
+        # higher ids
+        self.policy_id_floor = 0
         self.debug = debug
 
-        self.last_update_users_list = []
-        self.last_hyperparam_update_id = 0
-
-        self.user_list = []
-
         # Logging stuff
         logfile = logger_path + "/RL_log.txt"
         self.logger = logging.getLogger("MixedEffects")
@@ -180,6 +269,91 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         fh.setLevel(logging.DEBUG)
         self.logger.addHandler(fh)
 
+        # Publish the initial policy, the prior
+        self.snapshot = self.make_snapshot(
+            policyid=0,
+            user_list=[],
+            posterior_mean=None,
+            posterior=None,
+            theta_pop_mean=copy.deepcopy(self.prior_mean),
+            theta_pop_cov=copy.deepcopy(self.prior_cov),
+            sigma_u=copy.deepcopy(init_cov_u),
+            noise_var=init_noise_var,
+            ltu_flat=init_ltu_flat,
+            hyperparam_update_id=0,
+        )
+
+    @property
+    def user_list(self) -> list:
+        """User ids in the order the users joined"""
+        return self.users.user_ids
+
+    @property
+    def num_users(self) -> int:
+        """Number of users with at least one decision point"""
+        return len(self.users)
+
+    # Read-only views of the current policy. A reader that needs several of
+    # them together should take self.snapshot once instead, since a new policy
+    # can be published between two attribute reads.
+
+    @property
+    def policyid(self) -> int:
+        return self.snapshot.policyid
+
+    @property
+    def posterior_mean(self) -> np.array:
+        return self.snapshot.posterior_mean
+
+    @property
+    def posterior(self) -> structured.BlockPosterior:
+        return self.snapshot.posterior
+
+    @property
+    def theta_pop_mean(self) -> np.array:
+        return self.snapshot.theta_pop_mean
+
+    @property
+    def theta_pop_cov(self) -> np.array:
+        return self.snapshot.theta_pop_cov
+
+    @property
+    def sigma_u(self) -> np.array:
+        return self.snapshot.sigma_u
+
+    @property
+    def noise_var(self) -> float:
+        return self.snapshot.noise_var
+
+    @property
+    def ltu_flat(self) -> np.array:
+        return self.snapshot.ltu_flat
+
+    @property
+    def last_update_users_list(self) -> list:
+        return list(self.snapshot.user_list)
+
+    @property
+    def last_update_users_index(self) -> dict:
+        return self.snapshot.user_index
+
+    @property
+    def last_hyperparam_update_id(self) -> int:
+        return self.snapshot.hyperparam_update_id
+
+    @property
+    def prob_table(self) -> np.array:
+        return self.snapshot.prob_table
+
+    @property
+    def act_prob_table(self) -> np.array:
+        return self.snapshot.act_prob_table
+
+    @property
+    def hyperparam_update_flag(self) -> bool:
+        """Whether hyperparameters are staged for the next posterior update"""
+        return self.pending_hyperparameters is not None
+
     def clip_prob(self, prob, min: float = 0.2, max: float = 0.8):
         """Clip the probability to be between min and max"""
         return np.clip(prob, min, max)
@@ -188,13 +362,12 @@ class MixedEffectsAlgorithm(RLAlgorithm):
     def validate_matrix(
         flat_lower_t: jnp.array,
         noise_precision: float,
-        A: jnp.array,
-        B: jnp.array,
+        A_hat: jnp.array,
+        B_hat: jnp.array,
         mu_prior: jnp.array,
         sigma_prior: jnp.array,
         sum_sq_reward: int,
         size: int,
-        nusers: int,
         ts: int,
         debug: bool = False,
     ):
@@ -203,128 +376,122 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         if the resulting posterior is going to be PSD and within
         reasonable limits
         """
-        # Construct the lower triangular matrix
-        L = jnp.zeros((size, size), dtype=float)
-        L = L.at[jnp.tril_indices(size)].set(flat_lower_t)
-
-        # Construct the PSD matrix of random effects variance
-        Sigma_u = L @ L.T
-        del L
-
-        # Construct X and y
-        # X = jnp.linalg.inv(jnp.array(sigma_prior) + jnp.kron(jnp.identity(nusers), Sigma_u))
-        X = MixedEffectsAlgorithm.invert_sigma_theta(sigma_prior, Sigma_u, nusers)
-        y = noise_precision
-
-        eigvals = jnp.min(jnp.linalg.eigh(X + y * A)[0])
-
-        if eigvals <= 0 or jnp.isnan(eigvals):
-            return 100000, False
-
-        newpost_var = jnp.linalg.inv(X + y * A)
-
-        eigvals = jnp.min(jnp.linalg.eigh(newpost_var)[0])
-
-        if eigvals <= 0 or jnp.isnan(eigvals):
-            return 100000, False
-
-        temp_mean = X @ mu_prior + y * B
-        newpost_mean = newpost_var @ temp_mean
-
-        # Do the sanity checks
-
-        # If any diagonal entry in the covariance matrix is less than 0
-        if jnp.min(jnp.diag(newpost_var)) < 0:
-            return 100000, False
-
-        # If absolute value of any posterior mean entry is greater than 10 (need to think
-        # about this sanity check)
-        if jnp.max(jnp.abs(newpost_mean).flatten()) > 10:
-            return 100000, False
+        data = optimizer.ObjectiveData(
+            A_hat, B_hat, mu_prior, sigma_prior, sum_sq_reward, ts
+        )
+        result, valid = optimizer.validate(flat_lower_t, noise_precision, data, size)
 
-        # Evaluate the optimization function
-        s1, part1 = jnp.linalg.slogdet(X)
-        s2, part2 = jnp.linalg.slogdet(X + y * A)
-        part2 = (-1) * part2
-        part3 = ts * jnp.log(y)
-        part4 = -1 * y * sum_sq_reward
-        part5 = -1 * mu_prior.T @ X @ mu_prior
-        part6 = temp_mean.T @ newpost_mean
+        return result, bool(valid)
 
-        # Check mixed effects model overleaf file, section 5.4, page 20, equation 171
-        # Doing negative because we are minimizing
-        result = -1 * (part1 + part2 + part3 + part4 + part5 + part6)
-        del part1
-        del part2
-        del part3
-        del part4
-        del part5
-        del part6
-        return result, True
+    def create_A_B_matrix(self):
+        """
+        Stack the per-user sufficient statistics up until the current
+        decision point, as maintained by update_design_row
+        :return: per-user X_i^T X_i stacked as (N, d, d)
+        :return: per-user X_i^T y_i stacked as (N, d)
+        :return: sum of squared rewards
+        :return: total number of timesteps
+        :return: list of users with data
+        """
+        return self.users.sufficient_statistics()
 
-    @staticmethod
-    def invert_sigma_theta(Sigma_0: jnp.array, Sigma_u: jnp.array, nusers: int):
+    def user_posterior(
+        self, user: int = None, snapshot: policy.PolicySnapshot = None
+    ) -> tuple[np.array, np.array]:
         """
-        Invert the covariance matrix efficiently
+        Posterior of a user's parameters under a policy
+        :param user: index of the user in the last posterior update,
+            None for users who were not part of it
+        :param snapshot: the policy, the current one if not given
+        :return: posterior mean and covariance
         """
-        C = jnp.linalg.inv(Sigma_u)
-        D = -jnp.linalg.inv(Sigma_u + nusers * Sigma_0) @ Sigma_0 @ C
+        if snapshot is None:
+            snapshot = self.snapshot
+        return snapshot.user_posterior(user)
 
-        inverse = jnp.kron(jnp.ones((nusers, nusers)), D) + jnp.kron(
-            jnp.identity(nusers), C
+    def make_snapshot(self, user_list: list, **fields) -> policy.PolicySnapshot:
+        """
+        Policy snapshot, with the action probabilities of every user in every
+        binary state precomputed, and a last row for users without an update
+        :param user_list: users with a posterior, in posterior order
+        :param fields: the other fields of the snapshot, except the tables
+        :return: the snapshot, not yet published
+        """
+        snapshot = policy.PolicySnapshot.create(
+            user_list, prob_table=None, act_prob_table=None, **fields
+        )
+        posteriors = [snapshot.user_posterior(user) for user in range(len(user_list))]
+        posteriors.append(snapshot.user_posterior(None))
+
+        prob_table = policy.probability_table(
+            [posterior[0] for posterior in posteriors],
+            [posterior[1] for posterior in posteriors],
+            self.allocation_function,
+            self.param_size[2],
+            self.batch_allocation_function,
+        )
+        return snapshot._replace(
+            prob_table=policy.freeze(prob_table),
+            act_prob_table=policy.freeze(self.clip_prob(prob_table)),
         )
 
-        return inverse
-
-    def create_A_B_matrix(self):
+    def update_probability_tables(self) -> None:
         """
-        Create the design matrix and reward matrix up until the current
-        decision point using design rows and reward history for each user
+        Recompute the action probabilities of the current policy, e.g. after
+        the allocation function changed, and publish them
         """
-        design_matrix = []
-        reward_matrix = []
-        indexes = [0]
-        update_user_list = []
-        total_timesteps = 0
-        total_update_users = 0
-
-        for i in self.user_list:
-            if (
-                self.user_data[i]["design_state"][1:-1] == []
-                or self.user_data[i]["reward"][1:] == []
-            ):
-                continue
-            design_matrix.append(self.user_data[i]["design_state"][1:-1])
-            reward_matrix.append(self.user_data[i]["reward"][1:])
-            indexes.append(indexes[-1] + len(self.user_data[i]["design_state"][1:-1]))
-            update_user_list.append(i)
-            total_timesteps += len(self.user_data[i]["design_state"][1:-1])
-            total_update_users += 1
-
-        design_matrix = np.vstack(design_matrix)
-        reward_matrix = np.hstack(reward_matrix)
-
-        A_hat = [
-            design_matrix[indexes[i] : indexes[i + 1]].T
-            @ design_matrix[indexes[i] : indexes[i + 1]]
-            for i in range(total_update_users)
-        ]
+        snapshot = self.snapshot
+        fields = snapshot._asdict()
+        for key in ["user_list", "user_index", "prob_table", "act_prob_table"]:
+            del fields[key]
+        self.snapshot = self.make_snapshot(list(snapshot.user_list), **fields)
 
-        A = linalg.block_diag(*A_hat)
+    def posterior_probability(
+        self,
+        user_id: str,
+        user: int,
+        state: list,
+        snapshot: policy.PolicySnapshot = None,
+    ) -> tuple[float, float]:
+        """
+        Action probability computed from the posterior, for states that are not
+        in the probability tables, or probabilities that are NaN in them
+        :param user_id: user id of the user
+        :param user: index of the user in the last update, None for new users
+        :param state: state of the user
+        :param snapshot: the policy, the current one if not given
+        :return: probability, and the clipped probability
+        """
+        posterior_mean_user, posterior_cov_user = self.user_posterior(user, snapshot)
+        (
+            prob,
+            beta_mean,
+            beta_cov,
+            adv_beta_mean,
+            adv_beta_var,
+        ) = policy.action_probability(
+            posterior_mean_user,
+            posterior_cov_user,
+            policy.advantage_vector(state, self.param_size[2]),
+            self.allocation_function,
+        )
 
-        B = np.array(
-            [
-                design_matrix[indexes[i] : indexes[i + 1]].T
-                @ reward_matrix[indexes[i] : indexes[i + 1]]
-                for i in range(total_update_users)
-            ]
-        ).flatten()
+        # If the probability is NaN, set it to 0.5, and log the error
+        if np.isnan(prob):
+            self.logger.error(
+                f"[{self.current_study_decision_point}] Probability NaN encountered for user: {user_id}"
+            )
+            self.logger.error(f"BETA_MEAN: {beta_mean} VAR: {beta_cov}")
+            self.logger.error(f"ADV_BETA: {adv_beta_mean} VAR: {adv_beta_var}")
+            self.logger.error(f"POST_MEAN: {posterior_mean_user}")
+            self.logger.error(f"POST_VAR: {posterior_cov_user}")
+            prob = 0.5
+            # TODO: Decide whether this is a good idea to handle the exception with 0.5 probability here
 
-        sum_sq_reward = 0
-        for i in range(len(reward_matrix)):
-            sum_sq_reward += reward_matrix[i] ** 2
+        # Clip the probability
+        act_prob = self.clip_prob(prob)
 
-        return A, B, A_hat, sum_sq_reward, total_timesteps, update_user_list
+        return prob, act_prob
 
     def get_action(
         self, user_id: str, state: np.ndarray, decision_time: int, seed: int = -1
@@ -341,21 +508,8 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         if len(state) != 3:
             raise ValueError("State should be of length 3")
 
-        # Compute the advantage
-        advantage_default = [
-            1,
-            state[0],
-            state[1],
-            state[2],
-            state[0] * state[1],
-            state[0] * state[2],
-            state[1] * state[2],
-            state[0] * state[1] * state[2],
-        ]
-
-        advantage_with_intercept = np.array(advantage_default[: self.param_size[2]])
-
-        num_params = np.sum(self.param_size)
+        # Use one policy throughout, a new one may be published meanwhile
+        snapshot = self.snapshot
 
         # If the user is new, add the user to the user list
         # if user_id not in self.user_list:
@@ -372,63 +526,38 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         #         "reward": [],
         #         "design_state": [None],
         #     }
-        if user_id not in self.last_update_users_list:
-            # Since user is new, sample for the current posterior of theta pop
-            posterior_mean_user = self.theta_pop_mean
-            posterior_cov_user = self.theta_pop_cov + self.sigma_u
-
+        if user_id not in snapshot.user_index:
+            # Since user is new, sample for the current posterior of theta pop,
+            # which is the last row of the probability tables
+            user = None
+            row = -1
         else:
-            # Otherwise get the user index and corresponding posteriors
-            user = self.last_update_users_list.index(user_id)
-            posterior_mean_user = self.posterior_mean[
-                user * num_params : (user + 1) * num_params
-            ]
-            posterior_cov_user = self.posterior_cov[
-                user * num_params : (user + 1) * num_params,
-                user * num_params : (user + 1) * num_params,
-            ]
-
-        # Compute the posterior mean of the adv term
-        beta_mean = np.array(posterior_mean_user[-self.param_size[2] :])
-
-        # Compute the posterior covariance of the adv term
-        beta_cov = np.array(
-            posterior_cov_user[-self.param_size[2] :, -self.param_size[2] :]
-        )
-
-        # Compute the posterior mean of the adv*beta distribution
-        adv_beta_mean = advantage_with_intercept.T.dot(beta_mean)
-
-        # Compute the posterior variance of the adv*beta distribution
-        adv_beta_var = advantage_with_intercept.T @ beta_cov @ advantage_with_intercept
-
-        # Call the allocation function
-        prob = self.allocation_function(mean=adv_beta_mean, var=adv_beta_var)
-
-        # If the probability is NaN, set it to 0.5, and log the error
+            # Otherwise get the user index
+            user = snapshot.user_index[user_id]
+            row = user
+
+        # Look up the probability in the tables of the current policy
+        column = policy.state_index(state)
+        prob = np.nan
+        if column is not None:
+            prob = snapshot.prob_table[row, column]
+            act_prob = snapshot.act_prob_table[row, column]
+
+        # Compute it from the posterior if the state is not in the tables,
+        # or to log the details if it is NaN
         if np.isnan(prob):
-            self.logger.error(
-                f"[{self.current_study_decision_point}] Probability NaN encountered for user: {user}"
-            )
-            self.logger.error(f"BETA_MEAN: {beta_mean} VAR: {beta_cov}")
-            self.logger.error(f"ADV_BETA: {adv_beta_mean} VAR: {adv_beta_var}")
-            self.logger.error(f"POST_MEAN: {posterior_mean_user}")
-            self.logger.error(f"POST_VAR: {posterior_cov_user}")
-            prob = 0.5
-            # TODO: Decide whether this is a good idea to handle the exception with 0.5 probability here
-
-        # Clip the probability
-        act_prob = self.clip_prob(prob)
+            prob, act_prob = self.posterior_probability(user_id, user, state, snapshot)
 
-        # Create the rng object using the class rng
+        # Sample the action from the bernoulli distribution
         if seed != -1:
-            rng = np.random.default_rng(seed=seed)
-        else:
+            # Replay a recorded seed, of either scheme
+            action = counter_rng.replay_action(seed, act_prob)
+        elif self.rng_scheme == "legacy":
             seed = self.rng.integers(low=0, high=self.maxseed)
-            rng = np.random.default_rng(seed=seed)
-
-        # Sample the action from the bernoulli distribution
-        action = rng.binomial(1, act_prob)
+            action = counter_rng.legacy_action(seed, act_prob)
+        else:
+            seed = counter_rng.counter_seed(self.study_seed, user_id, decision_time)
+            action = int(counter_rng.seed_uniform(seed) < act_prob)
 
         # Log event to logger
         if self.debug:
@@ -462,31 +591,245 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         # # Update the design state
         # self.user_data[user]["design_state"].append(self.update_design_row(user))
 
-        return action, int(seed), act_prob, self.policyid
+        return action, int(seed), act_prob, snapshot.policyid
 
-    def update_hyperparameters(
-        self, request_id: int, data: pd.DataFrame, use_data: bool = False, debug: bool = False
-    ) -> None:
+    def get_actions(
+        self, user_ids: list, states: np.ndarray, decision_times: list
+    ) -> tuple[np.array, np.array, np.array, int]:
         """
-        Update the hyperparameters
-        :param request_id: request id
-        :param data: data to update algorithm
-        :param use_data: whether to use data or not, or use the user_data
-        :param debug: debug flag
-        :return: None
+        Get actions for several users at once, identical to calling get_action
+        for each user in turn
+        :param user_ids: user ids of the users
+        :param states: states of the users, of shape (users, 3)
+        :param decision_times: decision times of the users
+        :return: actions, seeds, probabilities of taking action, and policy id
         """
 
-        # TODO: Update just using the data in the dataframe
+        states = np.asarray(states)
+        if states.ndim != 2 or states.shape[1] != 3:
+            raise ValueError("State should be of length 3")
 
-        # Check for dataframe columns
-        if use_data:
-            raise NotImplementedError("use_data is not implemented yet")
+        # Use one policy throughout, a new one may be published meanwhile
+        snapshot = self.snapshot
+
+        # Rows of the probability tables, the last row for new users
+        rows = np.array(
+            [snapshot.user_index.get(user_id, -1) for user_id in user_ids],
+            dtype=int,
+        )
+
+        # Look up the probabilities of the users with binary states
+        binary = np.all((states == 0) | (states == 1), axis=1)
+        columns = np.where(binary, 4 * states[:, 0] + 2 * states[:, 1] + states[:, 2], 0)
+        columns = columns.astype(int)
+        probs = np.where(binary, snapshot.prob_table[rows, columns], np.nan)
+        act_probs = np.where(binary, snapshot.act_prob_table[rows, columns], np.nan)
+
+        # Compute the rest from the posterior
+        for i in np.flatnonzero(np.isnan(probs)):
+            user = None if rows[i] == -1 else int(rows[i])
+            probs[i], act_probs[i] = self.posterior_probability(
+                user_ids[i], user, list(states[i]), snapshot
+            )
+
+        # Sample the actions, same as drawing them one user at a time
+        if self.rng_scheme == "legacy":
+            seeds = self.rng.integers(low=0, high=self.maxseed, size=len(user_ids))
+            actions = np.array(
+                [
+                    counter_rng.legacy_action(seed, act_prob)
+                    for seed, act_prob in zip(seeds, act_probs)
+                ],
+                dtype=int,
+            )
+        else:
+            seeds = counter_rng.counter_seeds(
+                self.study_seed, user_ids, decision_times
+            )
+            actions = (counter_rng.seed_uniform(seeds) < act_probs).astype(int)
+
+        # Log event to logger
+        if self.debug:
+            for i, user_id in enumerate(user_ids):
+                self.logger.info(
+                    f"[{self.current_study_decision_point}] \
+                        User: {user_id} State: {list(states[i])} \
+                            Decision Time: {decision_times[i]} \
+                                Seed: {seeds[i]} \
+                                    Prob: {probs[i]} \
+                                        Act Prob: {act_probs[i]} \
+                                            Action: {actions[i]}"
+                )
+
+        return actions, seeds.astype(int), act_probs, snapshot.policyid
+
+    def warm_up(self, max_users: int) -> dict:
+        """
+        Compile the hyperparameter kernels for every user bucket up to max_users,
+        and run the posterior update once, using data of representative shapes
+        :param max_users: largest number of users expected in the study
+        :return: compile time in seconds for each number of (padded) users,
+            and of the posterior update under "posterior"
+        """
+        sigma_u_shape = self.sigma_u.shape[0]
+        size = self.hyperparameter_size()
+        compile_times = {}
+
+        buckets = self.warm_up_buckets(max_users)
+        for bucket in buckets:
+            # Nothing to compile where the NumPy kernels run
+            if self.select_backend("hyperparameters", bucket) == "numpy":
+                continue
+
+            start = time.time()
+
+            # Use exactly the argument types of update_hyperparameters, with a
+            # zero iteration budget, so the same executables get compiled
+            data = self.warm_up_data(bucket)
+            init_obj, _ = optimizer.validate(
+                copy.deepcopy(self.init_ltu_flat), 1.0 / self.init_noise_var, data, size
+            )
+            init_optimizer, run_optimizer = optimizer.optimizer_functions(
+                self.hyperparam_optimizer
+            )
+            state = init_optimizer(
+                self.init_ltu_flat, 1.0 / self.init_noise_var, init_obj, self.learning_rate
+            )
+            state = run_optimizer(
+                state,
+                data,
+                (self.init_ltu_flat, self.init_noise_var),
+                size,
+                0,
+                self.learning_rate,
+                self.tolerance,
+            )
+            jax.block_until_ready(state)
+            optimizer.record_compile_shape(data, size, self.hyperparam_optimizer)
+
+            compile_times[bucket] = time.time() - start
+
+            # Log event to logger
+            self.logger.debug(
+                "Compiled hyperparameter kernels for {} users in {:.2f}s".format(
+                    bucket, compile_times[bucket]
+                )
+            )
+
+        # Warm up the linear algebra used by the posterior update
+        start = time.time()
+        blocks = structured.posterior_blocks(
+            np.zeros((2, sigma_u_shape, sigma_u_shape)),
+            np.zeros((2, sigma_u_shape)),
+            self.prior_mean,
+            self.prior_cov,
+            self.sigma_u,
+            self.noise_var,
+        )
+        structured.block_posterior(blocks)
+        for bucket in buckets:
+            if self.select_backend("posterior", bucket) == "jax":
+                backends.posterior_blocks(
+                    np.zeros((bucket, sigma_u_shape, sigma_u_shape)),
+                    np.zeros((bucket, sigma_u_shape)),
+                    self.prior_mean,
+                    self.prior_cov,
+                    self.sigma_u,
+                    self.noise_var,
+                )
+        compile_times["posterior"] = time.time() - start
+
+        return compile_times
+
+    def warm_up_buckets(self, max_users: int) -> list:
+        """User buckets up to max_users, none without shape bucketing"""
+
+        # Without bucketing there is no way to know the shapes ahead of time
+        buckets = []
+        if self.shape_bucketing:
+            buckets = [optimizer.MIN_USER_BUCKET]
+            while buckets[-1] < optimizer.user_bucket(max_users):
+                buckets.append(buckets[-1] * optimizer.USER_BUCKET_GROWTH)
+        return buckets
+
+    def warm_up_data(self, bucket: int) -> optimizer.ObjectiveData:
+        """Objective data of the shapes of a user bucket, with no decision points"""
+        sigma_u_shape = self.sigma_u.shape[0]
+        return optimizer.pad_objective_data(
+            optimizer.ObjectiveData(
+                np.zeros((1, sigma_u_shape, sigma_u_shape)),
+                np.zeros((1, sigma_u_shape)),
+                self.prior_mean,
+                self.prior_cov,
+                0.0,
+                1.0,
+            ),
+            bucket,
+        )
+
+    def warm_up_problems(self, max_users: int) -> dict:
+        """
+        Hyperparameter problems of one iteration, for the user buckets up to
+        max_users where the fit runs on JAX. Fitting them where the jobs run
+        (see job_runner.py) compiles the executables of the jobs there
+        :param max_users: largest number of users expected in the study
+        :return: the problems by number of (padded) users
+        """
+        return {
+            bucket: self.problem_of(self.warm_up_data(bucket), "jax")._replace(max_iter=1)
+            for bucket in self.warm_up_buckets(max_users)
+            if self.select_backend("hyperparameters", bucket) == "jax"
+        }
+
+    def select_backend(self, kernel: str, nusers: int) -> str:
+        """
+        Backend of a kernel, the configured one or the one the cost model
+        selects for the number of (padded) users. Unless JAX runs in float64
+        (x64 enabled), auto keeps the float64 NumPy backend at every cohort
+        size, so the estimates do not change precision mid-study
+        :param kernel: "hyperparameters" or "posterior"
+        :param nusers: number of users
+        :return: "numpy" or "jax"
+        """
+        setting = self.hyperparam_backend
+        if kernel == "posterior":
+            setting = self.posterior_backend
+        if setting != "auto":
+            return setting
+
+        # The NumPy backend only runs the gradient descent
+        if (
+            kernel == "hyperparameters"
+            and self.hyperparam_optimizer not in backends.NUMPY_OPTIMIZERS
+        ):
+            return "jax"
+        if not jax.config.jax_enable_x64:
+            return "numpy"
+        return backends.select_backend(self.cost_model, kernel, nusers)
+
+    def hyperparameter_size(self):
+        """
+        Static size argument of the hyperparameter kernels, the dimension of
+        Sigma_u for the full parameterization and the parameterization otherwise,
+        so the full one compiles exactly as before
+        """
+        if self.parameterization.kind == "full":
+            return self.parameterization.size
+        return self.parameterization
+
+    def hyperparameter_problem(self, debug: bool = False) -> optimizer.HyperparameterProblem:
+        """
+        Copy of the sufficient statistics and optimizer settings of a
+        hyperparameter update, starting from the hyperparameters of the
+        current policy
+        :param debug: debug flag
+        :return: the hyperparameter problem
+        """
 
         # Create the A, B matrix
         (
-            A,
-            B,
             A_hat,
+            B_hat,
             sum_sq_reward,
             total_ts,
             update_user_list,
@@ -499,197 +842,156 @@ class MixedEffectsAlgorithm(RLAlgorithm):
             )
 
         total_update_users = len(update_user_list)
-        init_ltu_flat = copy.deepcopy(self.ltu_flat)
-        init_noise_var_inv = 1.0 / self.noise_var
-        min_ltu_flat = copy.deepcopy(self.ltu_flat)
-        min_noise_var_inv = init_noise_var_inv
-        skip_count = 0
-        last_update_index = -1
-        reset_flag = False
-        sigma_u_shape = self.sigma_u.shape[0]
+        size = self.hyperparameter_size()
 
-        lr = lr2 = self.learning_rate
-
-        mu_0 = np.kron(np.ones(total_update_users), self.prior_mean)
-
-        old_obj, valid = MixedEffectsAlgorithm.validate_matrix(
-            init_ltu_flat,
-            init_noise_var_inv,
-            A,
-            B,
-            mu_0,
-            self.prior_cov,
-            sum_sq_reward,
-            sigma_u_shape,
-            total_update_users,
-            total_ts,
+        data = optimizer.ObjectiveData(
+            A_hat, B_hat, self.prior_mean, self.prior_cov, sum_sq_reward, total_ts
         )
 
-        # Log event to logger
-        if debug:
-            self.logger.debug("Initial Objective: {}, Valid: {}".format(old_obj, valid))
-
-        if not valid:
-            init_ltu_flat = copy.deepcopy(self.init_ltu_flat)
-            init_noise_var_inv = copy.deepcopy(self.init_noise_var)
-            min_noise_var_inv = init_noise_var_inv
-            old_obj, valid = MixedEffectsAlgorithm.validate_matrix(
-                init_ltu_flat,
-                init_noise_var_inv,
-                A,
-                B,
-                mu_0,
-                self.prior_cov,
-                sum_sq_reward,
-                sigma_u_shape,
-                total_update_users,
-                total_ts,
+        # Pad the users to a size class so the compiled kernels get reused
+        if self.shape_bucketing:
+            data = optimizer.pad_objective_data(
+                data, optimizer.user_bucket(total_update_users)
+            )
+        backend = self.select_backend("hyperparameters", data.A_hat.shape[0])
+        if backend == "jax":
+            cache_hit = optimizer.record_compile_shape(
+                data, size, self.hyperparam_optimizer
             )
 
             # Log event to logger
-            if debug:
-                self.logger.debug(
-                    "Initial Objective after reset: {}, Valid: {}".format(
-                        old_obj, valid
-                    )
+            self.logger.debug(
+                "Hyperparameter kernels for {} users (shape {}): compile cache {}".format(
+                    total_update_users, data.A_hat.shape, "hit" if cache_hit else "miss"
                 )
-
-            if not valid:
-                if debug:
-                    self.logger.error("Initial Objective is not valid after reset")
-                return
-
-        min_obj = copy.deepcopy(old_obj)
-        # Log event to logger
-        if debug:
-            self.logger.debug("Starting optimization with objective: {}", old_obj)
-
-        # Do the optimization
-        for idx in range(self.max_iter):
-            # Compute the gradient
-            jacob = jax.grad(obj_func, argnums=0)(
-                init_ltu_flat,
-                init_noise_var_inv,
-                A,
-                B,
-                mu_0,
-                self.prior_cov,
-                sum_sq_reward,
-                sigma_u_shape,
-                total_update_users,
-                total_ts,
             )
-            grad = jax.grad(obj_func, argnums=1)(
-                init_ltu_flat,
-                init_noise_var_inv,
-                A,
-                B,
-                mu_0,
-                self.prior_cov,
-                sum_sq_reward,
-                sigma_u_shape,
-                total_update_users,
-                total_ts,
+        else:
+            self.logger.debug(
+                "Hyperparameter fit for {} users on the NumPy backend".format(
+                    total_update_users
+                )
             )
 
-            new_ltu_flat = init_ltu_flat - lr * jacob
-
-            # Update the value of the noise variance
-            if init_noise_var_inv - lr2 * grad > 0.0001:
-                new_noise_var_inv = init_noise_var_inv - (lr2 * grad)
+        return self.problem_of(data, backend)
 
-            else:
-                new_noise_var_inv = init_noise_var_inv
-                lr2 = lr2 / 2
-
-            obj_val, valid = MixedEffectsAlgorithm.validate_matrix(
-                new_ltu_flat,
-                new_noise_var_inv,
-                A,
-                B,
-                mu_0,
-                self.prior_cov,
-                sum_sq_reward,
-                sigma_u_shape,
-                total_update_users,
-                total_ts,
-            )
+    def problem_of(
+        self, data: optimizer.ObjectiveData, backend: str
+    ) -> optimizer.HyperparameterProblem:
+        """
+        Hyperparameter problem on some data, with the optimizer settings,
+        starting from the hyperparameters of the current policy
+        :param data: the (padded) objective data
+        :param backend: backend of the fit, "numpy" or "jax"
+        :return: the hyperparameter problem
+        """
+        snapshot = self.snapshot
+        return optimizer.HyperparameterProblem(
+            data=data,
+            init_point=(np.array(snapshot.ltu_flat), 1.0 / snapshot.noise_var),
+            reset_point=(copy.deepcopy(self.init_ltu_flat), self.init_noise_var),
+            size=self.hyperparameter_size(),
+            max_iter=self.max_iter,
+            learning_rate=self.learning_rate,
+            tolerance=self.tolerance,
+            multi_start=self.multi_start,
+            num_jittered_starts=self.num_jittered_starts,
+            start_jitter=self.start_jitter,
+            method=self.hyperparam_optimizer,
+            estimator=self.hyperparam_estimator,
+            em_tolerance=self.em_tolerance,
+            backend=backend,
+        )
 
-            # Reduce the learning rate if objective is either null (i.e. invalid Sigma_u
-            # or objective value explodes, or objective value goes negative, or the resulting
-            # posteriors will be invalid i.e. either mean is too big, or variance is negative
-            # for the diagonal entries)
-            if jnp.isnan(obj_val) or obj_val > 10 * min_obj or obj_val < 0 or not valid:
-                lr = lr / 2
-                skip_count += 1
-            else:
-                if obj_val < min_obj:
-                    min_ltu_flat = new_ltu_flat
-                    init_noise_var_inv = new_noise_var_inv
-                    min_obj = obj_val
-                    last_update_index = idx
-                init_ltu_flat = new_ltu_flat
-                init_noise_var_inv = new_noise_var_inv
-                skip_count = 0
+    def stage_hyperparameters(
+        self, fit: optimizer.HyperparameterFit, request_id: int, debug: bool = False
+    ) -> None:
+        """
+        Stage the result of a hyperparameter fit for the next posterior update
+        :param fit: the completed fit
+        :param request_id: request id
+        :param debug: debug flag
+        """
+        min_ltu_flat = np.array(fit.ltu_flat)
+        min_noise_var_inv = float(fit.noise_precision)
+        sigma_u_shape = self.snapshot.sigma_u.shape[0]
+        self.hyperparam_fit_info = {
+            "iterations": fit.iterations,
+            "resets": fit.resets,
+            "objective": fit.objective,
+            "start": fit.start,
+            "diagnostics": fit.diagnostics,
+        }
 
-            if debug:
-                self.logger.debug(
-                    "Iteration: {}, Noise variance: {}, Objective: {}, Valid: {}, Nan: {}".format(
-                        idx, init_noise_var_inv, obj_val, valid, jnp.isnan(obj_val)
-                    )
+        # Log event to logger
+        self.logger.debug(
+            "Hyperparameter optimization finished after {} iterations ({} resets) with objective {}{}".format(
+                fit.iterations,
+                fit.resets,
+                fit.objective,
+                "" if fit.start is None else ", from the {} start".format(fit.start),
+            )
+        )
+        if fit.diagnostics is not None:
+            self.logger.debug(
+                "EM {} with a relative change of {} in the last iteration".format(
+                    "converged" if fit.diagnostics["converged"] else "did not converge",
+                    fit.diagnostics["relative_change"],
                 )
+            )
+        if debug:
+            self.logger.debug(
+                "Converged at iteration: {} with value {}".format(
+                    fit.iterations - 1, 1.0 / min_noise_var_inv
+                )
+            )
+            self.logger.debug("Sigma_U: {}".format(min_ltu_flat))
 
-            # Check if the change in objective value is small
-            if np.abs(obj_val - old_obj) < self.tolerance or (idx == self.max_iter - 1):
-                if debug:
-                    self.logger.debug(
-                        "Converged at iteration: {} with value {}".format(
-                            idx, 1.0 / min_noise_var_inv
-                        )
-                    )
-                    self.logger.debug("Sigma_U: {}".format(min_ltu_flat))
-                break
-
-            # Restart if we haven't gone below the previous objective value
-            if (idx - last_update_index) > 250 or skip_count > 10:
-                if reset_flag:
-                    # Reset already done once, so just terminate
-                    if debug:
-                        self.logger.debug(
-                            "Converged at iteration: {} with value {}".format(
-                                idx, 1.0 / min_noise_var_inv
-                            )
-                        )
-                        self.logger.debug("Sigma_U: {}".format(min_ltu_flat))
-                    break
-                else:
-                    # Reset back to initial params
-                    init_ltu_flat = self.init_ltu_flat
-                    init_noise_var_inv = self.init_noise_var
-                    lr = lr2 = self.learning_rate
-                    last_update_index = idx
-                    skip_count = 0
-                    reset_flag = True
+        # Set the new noise variance and sigma_u, assign them a pending status
+        if self.parameterization.kind == "full":
+            L = np.zeros((sigma_u_shape, sigma_u_shape), dtype=float)
+            L[np.tril_indices(sigma_u_shape)] = min_ltu_flat
+            new_sigma_u = L @ L.T
+        else:
+            new_sigma_u = parameterization.sigma_u_of(min_ltu_flat, self.parameterization)
+
+        # Staged in a single assignment, for the next posterior update
+        self.pending_hyperparameters = (
+            new_sigma_u,
+            1.0 / min_noise_var_inv,
+            min_ltu_flat,
+            request_id,
+        )
+
+    def update_hyperparameters(
+        self, request_id: int, data: pd.DataFrame, use_data: bool = False, debug: bool = False
+    ) -> None:
+        """
+        Update the hyperparameters in this process, see src/algorithm/job_runner.py
+        for running the fit in a worker process
+        :param request_id: request id
+        :param data: data to update algorithm
+        :param use_data: whether to use data or not, or use the user_data
+        :param debug: debug flag
+        :return: None
+        """
 
-                    if debug:
-                        self.logger.debug("Resetting at iteration: {}".format(idx))
+        # TODO: Update just using the data in the dataframe
 
-            elif skip_count == 0:
-                old_obj = obj_val
+        # Check for dataframe columns
+        if use_data:
+            raise NotImplementedError("use_data is not implemented yet")
 
-        # Set the new noise variance and assign it a pending status
-        self.noise_var_pending = 1.0 / min_noise_var_inv
+        problem = self.hyperparameter_problem(debug)
 
-        # Update the sigma_u
-        self.ltu_flat_pending = min_ltu_flat
+        # Do the optimization, the whole loop runs as a single compiled program
+        fit = optimizer.fit_hyperparameters(problem)
 
-        L = np.zeros(self.sigma_u.shape, dtype=float)
-        L[np.tril_indices(sigma_u_shape)] = self.ltu_flat_pending
-        self.sigma_u_pending = L @ L.T
-        self.hyperparam_requestid_pending = request_id
+        if fit.status == optimizer.FIT_INVALID:
+            if debug:
+                self.logger.error("Initial Objective is not valid after reset")
+            return
 
-        # Set the flag to update the hyperparameters
-        self.hyperparam_update_flag = True
+        self.stage_hyperparameters(fit, request_id, debug)
 
     def update_posteriors(
         self, data: pd.DataFrame, use_data: bool = False, debug: bool = False
@@ -706,104 +1008,105 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         if use_data:
             raise NotImplementedError("use_data is not implemented yet")
 
-        # Check if the hyperparameters have been updated
-        if self.hyperparam_update_flag:
-            self.sigma_u = copy.deepcopy(self.sigma_u_pending)
-            self.noise_var = copy.deepcopy(self.noise_var_pending)
-            self.ltu_flat = copy.deepcopy(self.ltu_flat_pending)
-
-            # Save in history
-            self.sigma_u_history.append(np.array(self.sigma_u))
-            self.noise_var_history.append(self.noise_var)
+        snapshot = self.snapshot
+        policyid = self.next_policy_id()
 
-            # Reset the flag
-            self.hyperparam_update_flag = False
-            self.last_hyperparam_update_id = self.hyperparam_requestid_pending
+        # Check if the hyperparameters have been updated
+        sigma_u = snapshot.sigma_u
+        noise_var = snapshot.noise_var
+        ltu_flat = snapshot.ltu_flat
+        hyperparam_update_id = snapshot.hyperparam_update_id
+        pending = self.pending_hyperparameters
+        if pending is not None:
+            sigma_u, noise_var, ltu_flat, hyperparam_update_id = copy.deepcopy(pending)
 
             # Log event to logger
             self.logger.debug(
                 "Hyperparameters updated for request id {} and used for posterior update".format(
-                    self.last_hyperparam_update_id
+                    hyperparam_update_id
                 )
             )
 
         (
-            A,
-            B,
             A_hat,
+            B_hat,
             _,
             _,
             update_user_list,
         ) = self.create_A_B_matrix()
 
-        total_update_users = len(update_user_list)
-        mu_0 = np.kron(np.ones(total_update_users), self.prior_mean)
-
-        Sigma_theta_t = np.kron(
-            np.ones((total_update_users, total_update_users)), self.prior_cov
-        ) + np.kron(np.identity(total_update_users), self.sigma_u)
+        # The structured parameterizations have a cheaper inverse of Sigma_u
+        sigma_u_inv = None
+        if self.parameterization.kind != "full":
+            sigma_u_inv = parameterization.sigma_u_inverse(ltu_flat, self.parameterization)
 
-        sigma_theta_t_inverse = np.linalg.inv(Sigma_theta_t)
-
-        # Compute the posterior covariance
-        self.posterior_cov = np.linalg.inv(
-            sigma_theta_t_inverse + (1.0 / self.noise_var) * A
+        # Compute the posterior block by block, using the shared population
+        # mean plus i.i.d. random effects structure of the prior
+        backend = self.select_backend(
+            "posterior", optimizer.user_bucket(len(update_user_list))
         )
-
-        # Compute the posterior covariance
-        self.posterior_mean = self.posterior_cov @ (
-            sigma_theta_t_inverse @ mu_0.reshape(-1, 1)
-            + (1.0 / self.noise_var * B).reshape(-1, 1)
+        blocks = backends.POSTERIOR_KERNELS[backend](
+            A_hat,
+            B_hat,
+            self.prior_mean,
+            self.prior_cov,
+            sigma_u,
+            noise_var,
+            sigma_u_inv,
         )
 
-        # Compute the theta pop posterior mean
-
-        zeta1 = zeta2 = zeta3 = zeta4 = None
-        m_inv = 1.0 / total_update_users
-
-        B_hat = np.array(B).reshape(total_update_users, -1)
-
-        for i in range(total_update_users):
-            psi = self.noise_var * np.linalg.inv(self.sigma_u) + A_hat[i]
-            psi_inv = np.linalg.inv(psi)
-            z1 = B_hat[i]
-            z2 = np.array(A_hat[i]) @ psi_inv @ B_hat[i]
-            z3 = np.array(A_hat[i])
-            z4 = np.array(A_hat[i]) @ psi_inv @ np.array(A_hat[i])
-            zeta1 = z1 if zeta1 is None else zeta1 + z1
-            zeta2 = z2 if zeta2 is None else zeta2 + z2
-            zeta3 = z3 if zeta3 is None else zeta3 + z3
-            zeta4 = z4 if zeta4 is None else zeta4 + z4
-
-        zeta1 = m_inv * np.array(zeta1)
-        zeta2 = m_inv * np.array(zeta2)
-        zeta3 = m_inv * np.array(zeta3)
-        zeta4 = m_inv * np.array(zeta4)
-
-        E = (
-            m_inv * np.linalg.inv(self.prior_cov)
-            + (1.0 / self.noise_var) * zeta3
-            - (1.0 / self.noise_var) * zeta4
+        # Keep the per-user blocks of the joint posterior covariance and the
+        # coupling to theta_pop, not the dense (N * d) x (N * d) matrix
+        posterior = structured.block_posterior(blocks)
+        posterior_mean = posterior.user_mean.reshape(-1, 1)
+
+        # Compute the theta pop posterior mean and covariance
+        theta_pop_mean = blocks["theta_pop_mean"]
+        theta_pop_cov = blocks["theta_pop_cov"]
+
+        # Precompute the action probabilities of the new policy
+        new_snapshot = self.make_snapshot(
+            policyid=policyid,
+            user_list=update_user_list,
+            posterior_mean=posterior_mean,
+            posterior=posterior,
+            theta_pop_mean=theta_pop_mean,
+            theta_pop_cov=theta_pop_cov,
+            sigma_u=sigma_u,
+            noise_var=noise_var,
+            ltu_flat=ltu_flat,
+            hyperparam_update_id=hyperparam_update_id,
         )
 
-        E_inv = np.linalg.inv(E)
-
-        self.theta_pop_mean = E_inv @ (
-            m_inv * np.linalg.inv(self.prior_cov) @ self.prior_mean.reshape(-1, 1)
-            + (1.0 / self.noise_var) * zeta1.reshape(-1, 1)
-            - (1.0 / self.noise_var) * zeta2.reshape(-1, 1)
+        # Write the artifact and save the posterior and hyperparameters of the
+        # policy in history before it is published, so if that fails the
+        # current policy keeps serving and the staged hyperparameters stay
+        # staged
+        policy_artifact = None
+        if self.policy_artifact_dir is not None:
+            policy_artifact = (
+                new_snapshot.policyid,
+                *artifact.save_policy(
+                    self.policy_artifact_dir, new_snapshot, self.policy_artifact_dtype
+                ),
+            )
+        self.history.append(
+            new_snapshot.policyid,
+            {
+                **posterior._asdict(),
+                "theta_pop_mean": theta_pop_mean,
+                "sigma_u": sigma_u,
+                "noise_var": noise_var,
+                "ltu_flat": ltu_flat,
+            },
         )
 
-        # Compute the theta pop posterior covariance
-        self.theta_pop_cov = m_inv * E_inv
-
-        # Update the posterior mean and covariance history
-        self.posterior_mean_history.append(self.posterior_mean)
-        self.posterior_cov_history.append(self.posterior_cov)
-        self.theta_pop_posterior_mean_history.append(self.theta_pop_mean)
-        self.theta_pop_posterior_cov_history.append(self.theta_pop_cov)
-
-        self.last_update_users_list = update_user_list
+        # Publish the policy with a single reference swap, and reset the
+        # staged hyperparameters unless newer ones were staged meanwhile
+        self.snapshot = new_snapshot
+        self.policy_artifact = policy_artifact
+        if pending is not None and self.pending_hyperparameters is pending:
+            self.pending_hyperparameters = None
 
     def update(
         self,
@@ -854,9 +1157,8 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         # Check whether to update the posterior or not
         if update_posterior:
             try:
+                # Publishes the new policy, with the next policy id
                 self.update_posteriors(data, use_data)
-                # Update the current policyid
-                self.policyid += 1
                 self.logger.debug("Posteriors updated")
             except Exception as e:
                 if self.debug:
@@ -869,15 +1171,31 @@ class MixedEffectsAlgorithm(RLAlgorithm):
                 return False, message, self.policyid, {}, 404, [], self.last_hyperparam_update_id
 
         # Return the parameters
+        snapshot = self.snapshot
         try:
             return_dict = {
-                "posterior_mean_array": self.posterior_mean.tolist(),
-                "posterior_var_array": self.posterior_cov.tolist(),
-                "posterior_theta_pop_mean_array": self.theta_pop_mean.tolist(),
-                "posterior_theta_pop_var_array": self.theta_pop_cov.tolist(),
-                "noise_var": self.noise_var,
-                "random_eff_cov_array": self.sigma_u.tolist(),
+                "posterior_mean_array": snapshot.posterior_mean.tolist(),
+                "posterior_theta_pop_mean_array": snapshot.theta_pop_mean.tolist(),
+                "posterior_theta_pop_var_array": snapshot.theta_pop_cov.tolist(),
+                "noise_var": snapshot.noise_var,
+                "random_eff_cov_array": snapshot.sigma_u.tolist(),
             }
+            if self.policy_artifact_dir is None:
+                # The RLWeights table stores the full joint
+                return_dict["posterior_var_array"] = snapshot.posterior.full_cov().tolist()
+            else:
+                # The RLWeights table references the artifact, written before
+                # the policy was published, or now if it was not published by
+                # update_posteriors
+                published = self.policy_artifact
+                if published is not None and published[0] == snapshot.policyid:
+                    _, path, sha256 = published
+                else:
+                    path, sha256 = artifact.save_policy(
+                        self.policy_artifact_dir, snapshot, self.policy_artifact_dtype
+                    )
+                return_dict["artifact_path"] = path
+                return_dict["artifact_sha256"] = sha256
         except Exception as e:
             if self.debug:
                 self.logger.error(
@@ -886,9 +1204,9 @@ class MixedEffectsAlgorithm(RLAlgorithm):
                 # Log traceback
                 self.logger.error(traceback.format_exc())
             message = "Error while returning parameters"
-            return False, message, self.policyid, {}, 406, [], self.last_hyperparam_update_id
+            return False, message, snapshot.policyid, {}, 406, [], snapshot.hyperparam_update_id
 
-        return True, None, self.policyid, return_dict, None, self.last_update_users_list, self.last_hyperparam_update_id
+        return True, None, snapshot.policyid, return_dict, None, list(snapshot.user_list), snapshot.hyperparam_update_id
 
     @staticmethod
     def make_state(params: dict) -> list:
@@ -981,6 +1299,72 @@ class MixedEffectsAlgorithm(RLAlgorithm):
             reward = 1
         return reward
 
+    @staticmethod
+    def make_states(params_list: list) -> np.array:
+        """
+        Make the states of several users at once, identical to make_state
+        :param params_list: parameters of each user
+        :return: states, of shape (users, 3)
+        """
+
+        required = [
+            "engagement_data",
+            "recent_cannabis_use",
+            "reward",
+            "time_of_day",
+            "cannabis_use_data",
+        ]
+
+        # Last two engagement values and the reward, left aligned
+        nusers = len(params_list)
+        recent_rewards = np.zeros((nusers, 3))
+        counts = np.zeros(nusers)
+        rewards = np.zeros(nusers)
+        time_of_day = np.zeros(nusers, dtype=int)
+        no_cannabis_use = np.zeros(nusers, dtype=bool)
+        for i, params in enumerate(params_list):
+            for key in required:
+                if key not in params:
+                    raise ValueError(f"{key} not in params")
+            if not isinstance(params["engagement_data"], (list, np.ndarray)):
+                raise ValueError("engagement_data is not a list")
+
+            values = [*params["engagement_data"][-2:], params["reward"]]
+            recent_rewards[i, : len(values)] = values
+            counts[i] = len(values)
+            rewards[i] = params["reward"]
+            time_of_day[i] = params["time_of_day"]
+            no_cannabis_use[i] = np.array(params["recent_cannabis_use"]).size == 0
+
+        # Summed in the same order as np.mean in make_state
+        average_reward = np.sum(recent_rewards, axis=1) / counts
+
+        S1 = average_reward >= 2
+        S2 = time_of_day
+        S3 = no_cannabis_use & (rewards >= 2)
+
+        return np.stack([S1, S2, S3], axis=1).astype(int)
+
+    @staticmethod
+    def make_rewards(params_list: list) -> np.array:
+        """
+        Make the rewards of several users at once, identical to make_reward
+        :param params_list: parameters of each user
+        :return: rewards
+        """
+        for params in params_list:
+            for key in ["user_finished_ema", "used_app", "activity_response"]:
+                if key not in params:
+                    raise ValueError(f"{key} not in params")
+
+        finished_ema = np.array([bool(p["user_finished_ema"]) for p in params_list])
+        activity = np.array([bool(p["activity_response"]) for p in params_list])
+        used_app = np.array([bool(p["used_app"]) for p in params_list])
+
+        return np.where(
+            finished_ema, np.where(activity, 3, 2), np.where(used_app, 1, 0)
+        ).astype(int)
+
     def update_design_row(
         self,
         user_id: str,
@@ -1000,24 +1384,6 @@ class MixedEffectsAlgorithm(RLAlgorithm):
         :return: None
         """
 
-        # Get the state, action, and action probability
-        if user_id not in self.user_list:
-            self.user_list.append(user_id)
-            self.num_users += 1
-            self.user_data[user_id] = {
-                "state": [[], state],
-                "action": [None, action],
-                "act_prob": [None, act_prob],
-                "reward": [reward],
-                "design_state": [None],
-            }
-        else:
-            self.user_data[user_id]["state"].append(state)
-            self.user_data[user_id]["action"].append(action)
-            self.user_data[user_id]["act_prob"].append(act_prob)
-            # The reward is updated for the last decision point
-            self.user_data[user_id]["reward"].append(reward)
-
         # Get the individual state elements
         s1 = state[0]
         s2 = state[1]
@@ -1043,8 +1409,46 @@ class MixedEffectsAlgorithm(RLAlgorithm):
                 )
             )
 
-        # return design_row
-        self.user_data[user_id]["design_state"].append(design_row)
+        # Record the decision point, the reward completes the design row of
+        # the last decision point and is added to the sufficient statistics
+        self.users.append(user_id, state, action, act_prob, reward, design_row)
+
+    @staticmethod
+    def design_matrix(state: np.array, action: np.array, act_prob: np.array) -> np.array:
+        """
+        Design rows of many decision points at once, the rows update_design_row
+        builds one by one
+        :param state: states, shape (T, 3)
+        :param action: actions, shape (T,)
+        :param act_prob: action probabilities, shape (T,)
+        :return: design rows, shape (T, 24)
+        """
+        state = np.asarray(state, dtype=float).reshape(-1, 3)
+        action = np.asarray(action)
+        act_prob = np.asarray(act_prob, dtype=float)
+        s1, s2, s3 = state[:, 0], state[:, 1], state[:, 2]
+
+        # Same products, in the same order, as update_design_row
+        baseline = np.stack(
+            [np.ones_like(s1), s1, s2, s3, s1 * s2, s1 * s3, s2 * s3, s1 * s2 * s3], axis=1
+        )
+        return np.hstack(
+            [
+                baseline,
+                act_prob[:, None] * baseline,
+                (action - act_prob)[:, None] * baseline,
+            ]
+        )
+
+    def next_policy_id(self) -> int:
+        """
+        Policy id of the next policy. Ids continue after the ones in the
+        history, which keeps the records of earlier runs on disk, and after
+        policy_id_floor, so a run that starts again from the prior does not
+        reuse them
+        :return: policy id
+        """
+        return max(self.policyid, self.history.last_policy_id, self.policy_id_floor) + 1
 
     def get_policyid(self) -> int:
         """
@@ -0,0 +1,1081 @@
+# src/algorithm/optimizer.py
+
+# Hyperparameter optimizers for the mixed effects model. The gradient descent
+# loop runs entirely inside one XLA program (lax.while_loop), including the
+# learning rate halving, the reset-on-stall logic and the tolerance check.
+# L-BFGS and damped Newton loops are compiled the same way, on the Cholesky
+# entries of Sigma_u and the log of the noise precision, with a backtracking
+# line search in place of the learning rate.
+
+# Imports
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import NamedTuple
+
+import numpy as np
+
+import jax
+import jax.numpy as jnp
+import jax.scipy.linalg as jlinalg
+from jax import lax
+
+from src.algorithm import parameterization, structured
+
+# Number of iterations without improvement before resetting/terminating
+STALL_WINDOW = 250
+
+# Number of consecutive rejected steps before resetting/terminating
+MAX_SKIPS = 10
+
+# Smallest noise precision a gradient step is allowed to reach
+MIN_NOISE_PRECISION = 0.0001
+
+# Objective value reported for invalid hyperparameters
+INVALID_OBJECTIVE = 100000.0
+
+# Number of curvature pairs kept by L-BFGS
+LBFGS_MEMORY = 10
+
+# Sufficient decrease constant and maximum number of step halvings of the line
+# search of the second-order optimizers
+ARMIJO_DECREASE = 1e-4
+MAX_HALVINGS = 30
+
+# Smallest s.y / y.y of a curvature pair kept by L-BFGS
+CURVATURE_EPS = 1e-10
+
+# Initial, smallest and largest damping of the Newton optimizer, relative to the
+# largest diagonal entry of the Hessian, and its adaptation factor
+NEWTON_INIT_DAMPING = 1e-3
+NEWTON_MIN_DAMPING = 1e-8
+NEWTON_MAX_DAMPING = 1e4
+NEWTON_DAMPING_FACTOR = 4.0
+
+# Number of Hessian columns computed at once, which bounds the memory of the
+# Newton optimizer on large cohorts
+HESSIAN_BLOCK = 32
+
+# Smallest user bucket, and the growth factor between consecutive buckets
+MIN_USER_BUCKET = 8
+USER_BUCKET_GROWTH = 2
+
+# Input shapes the kernels have already been compiled for in this process
+_compiled_shapes = set()
+
+
+class ObjectiveData(NamedTuple):
+    """Sufficient statistics the objective is evaluated on"""
+
+    A_hat: jnp.array
+    B_hat: jnp.array
+    mu_prior: jnp.array
+    sigma_prior: jnp.array
+    sum_sq_reward: float
+    ts: float
+    user_mask: jnp.array = None
+
+
+class GradientDescentState(NamedTuple):
+    """Loop carry of the gradient descent optimizer"""
+
+    idx: int
+    ltu_flat: jnp.array
+    noise_precision: float
+    min_ltu_flat: jnp.array
+    min_noise_precision: float
+    min_obj: float
+    old_obj: float
+    lr: float
+    lr2: float
+    skip_count: int
+    last_update_index: int
+    reset_flag: bool
+    done: bool
+    num_resets: int
+
+
+def _marginal_terms(
+    flat_lower_t: jnp.array, noise_precision: float, data: ObjectiveData, size
+) -> dict:
+    """
+    Per-user and population terms of the objective. The static size argument
+    of the kernels is the dimension of Sigma_u for the full parameterization,
+    flat_lower_t being the entries of its Cholesky factor, or a
+    Parameterization, flat_lower_t being its parameter vector
+    """
+    structure = parameterization.as_parameterization(size)
+    if structure.kind == "full":
+        return structured.marginal_terms(
+            flat_lower_t,
+            noise_precision,
+            data.A_hat,
+            data.B_hat,
+            data.mu_prior,
+            data.sigma_prior,
+            structure.size,
+            data.user_mask,
+        )
+
+    sigma_u_inv, logdet_sigma_u = parameterization.inverse_and_logdet(
+        flat_lower_t, structure
+    )
+    return structured.marginal_terms_from_inverse(
+        sigma_u_inv,
+        logdet_sigma_u,
+        noise_precision,
+        data.A_hat,
+        data.B_hat,
+        data.mu_prior,
+        data.sigma_prior,
+        data.user_mask,
+    )
+
+
+@partial(jax.jit, static_argnums=(3,))
+def objective(
+    flat_lower_t: jnp.array, noise_precision: float, data: ObjectiveData, size: int
+) -> jnp.array:
+    """Negative doubled log marginal likelihood"""
+    terms = _marginal_terms(flat_lower_t, noise_precision, data, size)
+    return structured.marginal_objective(
+        terms, noise_precision, data.sum_sq_reward, data.ts
+    )
+
+
+@partial(jax.jit, static_argnums=(3,))
+def validate(
+    flat_lower_t: jnp.array, noise_precision: float, data: ObjectiveData, size: int
+) -> tuple[jnp.array, jnp.array]:
+    """
+    Objective along with a flag for whether the resulting posterior
+    is going to be PSD and within reasonable limits
+    """
+    terms = _marginal_terms(flat_lower_t, noise_precision, data, size)
+    result = structured.marginal_objective(
+        terms, noise_precision, data.sum_sq_reward, data.ts
+    )
+    newpost_mean, newpost_var_diag = structured.posterior_summary(
+        terms, noise_precision, data.B_hat
+    )
+    if data.user_mask is not None:
+        # Padded users are not part of the posterior
+        newpost_mean = newpost_mean * data.user_mask[:, None]
+        newpost_var_diag = newpost_var_diag * data.user_mask[:, None]
+
+    # The posterior precision is PD iff every per-user block and the population
+    # Schur complement have a Cholesky factor, otherwise those come out as NaN
+    valid = jnp.all(jnp.isfinite(terms["cond_cov"]))
+    valid &= jnp.all(jnp.isfinite(terms["theta_pop_cov"]))
+    valid &= ~jnp.isnan(result)
+
+    # If any diagonal entry in the covariance matrix is less than 0
+    valid &= jnp.min(newpost_var_diag) >= 0
+
+    # If absolute value of any posterior mean entry is greater than 10
+    valid &= jnp.max(jnp.abs(newpost_mean)) <= 10
+
+    return jnp.where(valid, result, INVALID_OBJECTIVE), valid
+
+
+def user_bucket(
+    nusers: int, min_bucket: int = MIN_USER_BUCKET, growth: int = USER_BUCKET_GROWTH
+) -> int:
+    """
+    Geometric size class for a number of users
+    :param nusers: number of users with data
+    :param min_bucket: smallest bucket
+    :param growth: ratio between consecutive buckets
+    :return: smallest min_bucket * growth^k that holds nusers
+    """
+    bucket = min_bucket
+    while bucket < nusers:
+        bucket *= growth
+    return bucket
+
+
+def pad_objective_data(data: ObjectiveData, nusers: int) -> ObjectiveData:
+    """
+    Pad the per-user statistics with zero-weight users up to nusers, so the
+    compiled kernels only see a handful of distinct shapes as the cohort grows.
+    Padded users have no data and a mask of zero, the objective is unchanged.
+    :param data: statistics of the real users
+    :param nusers: padded number of users
+    :return: padded statistics with the user mask set
+    """
+    A_hat = np.asarray(data.A_hat, dtype=float)
+    B_hat = np.asarray(data.B_hat, dtype=float)
+    num_pad = nusers - A_hat.shape[0]
+    if num_pad < 0:
+        raise ValueError("Cannot pad {} users to {}".format(A_hat.shape[0], nusers))
+
+    user_mask = np.ones(nusers)
+    user_mask[A_hat.shape[0] :] = 0.0
+    return data._replace(
+        A_hat=np.concatenate([A_hat, np.zeros((num_pad,) + A_hat.shape[1:])]),
+        B_hat=np.concatenate([B_hat, np.zeros((num_pad,) + B_hat.shape[1:])]),
+        sum_sq_reward=float(data.sum_sq_reward),
+        ts=float(data.ts),
+        user_mask=user_mask,
+    )
+
+
+def enable_compilation_cache(cache_dir: str) -> None:
+    """
+    Persist compiled XLA executables on disk, so a restarted server reuses them
+    instead of compiling the kernels again
+    :param cache_dir: directory of the persistent compilation cache
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+        # The kernels of small buckets compile in under the default minimum
+        # of one second, and would otherwise not be persisted
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    except AttributeError:
+        # Older jax releases only expose the experimental interface
+        from jax.experimental.compilation_cache import compilation_cache
+
+        compilation_cache.initialize_cache(cache_dir)
+
+
+def record_compile_shape(data: ObjectiveData, size: int, method: str) -> bool:
+    """
+    Record the input shapes the kernels of an optimizer are about to be called
+    with. The executables also depend on the optimizer and on the dtype jax
+    computes in, float64 only with x64 enabled.
+    :param data: the padded objective data
+    :param size: number of hyperparameters
+    :param method: the optimizer, see optimizer_functions
+    :return: True if the compiled executables for these shapes are cached
+    """
+    key = (
+        method,
+        str(jnp.result_type(data.A_hat)),
+        np.shape(data.A_hat),
+        data.user_mask is None,
+        size,
+    )
+    hit = key in _compiled_shapes
+    _compiled_shapes.add(key)
+    return hit
+
+
+def init_gradient_descent(
+    ltu_flat: jnp.array, noise_precision: float, init_obj: float, learning_rate: float
+) -> GradientDescentState:
+    """
+    Initial loop carry, starting from a validated point
+    :param ltu_flat: starting lower triangular entries of chol(Sigma_u)
+    :param noise_precision: starting noise precision
+    :param init_obj: objective value at the starting point
+    :param learning_rate: initial learning rate
+    """
+    ltu_flat = jnp.asarray(ltu_flat, dtype=float)
+    noise_precision = jnp.asarray(noise_precision, dtype=float)
+    init_obj = jnp.asarray(init_obj, dtype=float)
+    learning_rate = jnp.asarray(learning_rate, dtype=float)
+    return GradientDescentState(
+        idx=jnp.asarray(0),
+        ltu_flat=ltu_flat,
+        noise_precision=noise_precision,
+        min_ltu_flat=ltu_flat,
+        min_noise_precision=noise_precision,
+        min_obj=init_obj,
+        old_obj=init_obj,
+        lr=learning_rate,
+        lr2=learning_rate,
+        skip_count=jnp.asarray(0),
+        last_update_index=jnp.asarray(-1),
+        reset_flag=jnp.asarray(False),
+        done=jnp.asarray(False),
+        # Strongly typed like the loop output, so the next chunk is not recompiled
+        num_resets=jnp.asarray(0, dtype=int),
+    )
+
+
+def gradient_descent_step(
+    s: GradientDescentState,
+    data: ObjectiveData,
+    reset_point: tuple,
+    size: int,
+    max_iter: int,
+    learning_rate: float,
+    tolerance: float,
+    value_and_grad,
+    validate,
+    xp,
+) -> GradientDescentState:
+    """
+    One iteration of the gradient descent loop, shared by the compiled loop and
+    the NumPy one of backends.py
+    :param s: loop carry
+    :param reset_point: (ltu_flat, noise_precision) arrays to restart from
+    :param value_and_grad: objective and its gradients with respect to the
+        Cholesky entries and the noise precision
+    :param validate: objective and validity flag, see validate
+    :param xp: array module of the kernels, jax.numpy or numpy
+    :return: the next loop carry
+    """
+    reset_ltu_flat, reset_noise_precision = reset_point
+    idx = s.idx
+
+    # Compute the objective gradients in a single forward/backward pass
+    _, (jacob, grad) = value_and_grad(s.ltu_flat, s.noise_precision, data, size)
+
+    new_ltu_flat = s.ltu_flat - s.lr * jacob
+
+    # Update the value of the noise precision if it stays positive
+    noise_step_ok = s.noise_precision - s.lr2 * grad > MIN_NOISE_PRECISION
+    new_noise_precision = xp.where(
+        noise_step_ok, s.noise_precision - s.lr2 * grad, s.noise_precision
+    )
+    lr2 = xp.where(noise_step_ok, s.lr2, s.lr2 / 2)
+
+    obj_val, valid = validate(new_ltu_flat, new_noise_precision, data, size)
+
+    # Reduce the learning rate if objective is either null, explodes,
+    # goes negative, or the resulting posteriors will be invalid
+    rejected = (
+        xp.isnan(obj_val) | (obj_val > 10 * s.min_obj) | (obj_val < 0) | ~valid
+    )
+    improved = ~rejected & (obj_val < s.min_obj)
+
+    lr = xp.where(rejected, s.lr / 2, s.lr)
+    skip_count = xp.where(rejected, s.skip_count + 1, 0)
+    min_ltu_flat = xp.where(improved, new_ltu_flat, s.min_ltu_flat)
+    min_obj = xp.where(improved, obj_val, s.min_obj)
+    last_update_index = xp.where(improved, idx, s.last_update_index)
+    ltu_flat = xp.where(rejected, s.ltu_flat, new_ltu_flat)
+    noise_precision = xp.where(rejected, s.noise_precision, new_noise_precision)
+
+    # Check if the change in objective value is small
+    converged = (xp.abs(obj_val - s.old_obj) < tolerance) | (idx == max_iter - 1)
+
+    # Restart if we haven't gone below the previous objective value,
+    # or terminate if a reset has already been done once
+    stalled = ~converged & (
+        ((idx - last_update_index) > STALL_WINDOW) | (skip_count > MAX_SKIPS)
+    )
+    do_reset = stalled & ~s.reset_flag
+
+    ltu_flat = xp.where(do_reset, reset_ltu_flat, ltu_flat)
+    noise_precision = xp.where(do_reset, reset_noise_precision, noise_precision)
+    lr = xp.where(do_reset, learning_rate, lr)
+    lr2 = xp.where(do_reset, learning_rate, lr2)
+    last_update_index = xp.where(do_reset, idx, last_update_index)
+    skip_count = xp.where(do_reset, 0, skip_count)
+
+    old_obj = xp.where(~converged & ~stalled & (skip_count == 0), obj_val, s.old_obj)
+
+    return GradientDescentState(
+        idx=idx + 1,
+        ltu_flat=ltu_flat,
+        noise_precision=noise_precision,
+        min_ltu_flat=min_ltu_flat,
+        min_noise_precision=s.min_noise_precision,
+        min_obj=min_obj,
+        old_obj=old_obj,
+        lr=lr,
+        lr2=lr2,
+        skip_count=skip_count,
+        last_update_index=last_update_index,
+        reset_flag=s.reset_flag | do_reset,
+        done=converged | (stalled & s.reset_flag),
+        num_resets=s.num_resets + do_reset.astype(int),
+    )
+
+
+@partial(jax.jit, static_argnums=(3,))
+def run_gradient_descent(
+    state: GradientDescentState,
+    data: ObjectiveData,
+    reset_point: tuple,
+    size: int,
+    max_iter: int,
+    learning_rate: float,
+    tolerance: float,
+    stop_at: int = None,
+) -> GradientDescentState:
+    """
+    Run the gradient descent loop until convergence, termination after a reset,
+    max_iter iterations, or stop_at iterations (used to run the loop in chunks)
+    :param state: loop carry from init_gradient_descent or a previous call
+    :param data: sufficient statistics for the objective
+    :param reset_point: (ltu_flat, noise_precision) to restart from when stalled
+    :param size: dimension of the random effects, or a Parameterization of Sigma_u
+    :param max_iter: maximum number of iterations
+    :param learning_rate: learning rate restored on reset
+    :param tolerance: tolerance for convergence
+    :param stop_at: iteration index to pause at, defaults to max_iter
+    :return: the final loop carry
+    """
+    if stop_at is None:
+        stop_at = max_iter
+
+    value_and_grad = jax.value_and_grad(objective, argnums=(0, 1))
+    reset_point = (
+        jnp.asarray(reset_point[0], dtype=float),
+        jnp.asarray(reset_point[1], dtype=float),
+    )
+
+    def cond_fun(s):
+        return ~s.done & (s.idx < stop_at)
+
+    def body_fun(s):
+        return gradient_descent_step(
+            s,
+            data,
+            reset_point,
+            size,
+            max_iter,
+            learning_rate,
+            tolerance,
+            value_and_grad,
+            validate,
+            jnp,
+        )
+
+    return lax.while_loop(cond_fun, body_fun, state)
+
+
+class SecondOrderState(NamedTuple):
+    """
+    Loop carry of the L-BFGS and damped Newton optimizers. They work on
+    x = (ltu_flat, log noise precision) and only ever move to a point with a
+    lower objective, so the current point is also the best one so far
+    """
+
+    idx: int
+    x: jnp.array
+    obj: float
+    prev_grad: jnp.array
+    prev_step: jnp.array
+    s_hist: jnp.array
+    y_hist: jnp.array
+    hist_count: int
+    hist_head: int
+    damping: float
+    steepest: bool
+    done: bool
+    num_resets: int
+
+    @property
+    def min_ltu_flat(self) -> jnp.array:
+        return self.x[:-1]
+
+    @property
+    def min_noise_precision(self) -> jnp.array:
+        return jnp.exp(self.x[-1])
+
+    @property
+    def min_obj(self) -> jnp.array:
+        return self.obj
+
+
+def pack_hyperparameters(ltu_flat: jnp.array, noise_precision: float) -> jnp.array:
+    """Point of the second-order optimizers, with the noise precision on a log scale"""
+    ltu_flat = jnp.asarray(ltu_flat, dtype=float)
+    log_noise_precision = jnp.log(jnp.asarray(noise_precision, dtype=float))
+    return jnp.append(ltu_flat, log_noise_precision)
+
+
+def log_objective(x: jnp.array, data: ObjectiveData, size: int) -> jnp.array:
+    """Objective at a point of the second-order optimizers"""
+    return objective(x[:-1], jnp.exp(x[-1]), data, size)
+
+
+def init_lbfgs(
+    ltu_flat: jnp.array,
+    noise_precision: float,
+    init_obj: float,
+    learning_rate: float,
+    memory: int = LBFGS_MEMORY,
+) -> SecondOrderState:
+    """
+    Initial loop carry of the L-BFGS optimizer, starting from a validated point
+    :param ltu_flat: starting lower triangular entries of chol(Sigma_u)
+    :param noise_precision: starting noise precision
+    :param init_obj: objective value at the starting point
+    :param learning_rate: unused, the step lengths come from the line search
+    :param memory: number of curvature pairs kept
+    """
+    x = pack_hyperparameters(ltu_flat, noise_precision)
+    return SecondOrderState(
+        idx=jnp.asarray(0),
+        x=x,
+        obj=jnp.asarray(init_obj, dtype=float),
+        prev_grad=jnp.zeros_like(x),
+        prev_step=jnp.zeros_like(x),
+        s_hist=jnp.zeros((memory, x.size), dtype=x.dtype),
+        y_hist=jnp.zeros((memory, x.size), dtype=x.dtype),
+        hist_count=jnp.asarray(0),
+        hist_head=jnp.asarray(0),
+        damping=jnp.asarray(NEWTON_INIT_DAMPING, dtype=float),
+        steepest=jnp.asarray(False),
+        done=jnp.asarray(False),
+        num_resets=jnp.asarray(0, dtype=int),
+    )
+
+
+def init_newton(
+    ltu_flat: jnp.array, noise_precision: float, init_obj: float, learning_rate: float
+) -> SecondOrderState:
+    """
+    Initial loop carry of the damped Newton optimizer, starting from a
+    validated point
+    :param ltu_flat: starting lower triangular entries of chol(Sigma_u)
+    :param noise_precision: starting noise precision
+    :param init_obj: objective value at the starting point
+    :param learning_rate: unused, the step lengths come from the line search
+    """
+    return init_lbfgs(ltu_flat, noise_precision, init_obj, learning_rate, memory=0)
+
+
+def _line_search(
+    x: jnp.array,
+    obj: float,
+    grad: jnp.array,
+    direction: jnp.array,
+    data: ObjectiveData,
+    size: int,
+) -> tuple:
+    """
+    Backtracking line search from a unit step, accepting the first step with
+    sufficient decrease to a valid point. As in the gradient descent, steps to
+    an invalid point or a NaN or negative objective are rejected.
+    :return: the step length, the objective after the step and whether the
+        step was accepted
+    """
+    slope = jnp.dot(grad, direction)
+
+    def trial(t):
+        x_new = x + t * direction
+        obj_new, valid = validate(x_new[:-1], jnp.exp(x_new[-1]), data, size)
+        accepted = (
+            valid
+            & jnp.isfinite(obj_new)
+            & (obj_new >= 0)
+            & (obj_new <= obj + ARMIJO_DECREASE * t * slope)
+        )
+        return obj_new, accepted
+
+    def cond_fun(c):
+        _, _, accepted, k = c
+        return ~accepted & (k < MAX_HALVINGS)
+
+    def body_fun(c):
+        t, _, _, k = c
+        t = t / 2
+        obj_new, accepted = trial(t)
+        return t, obj_new, accepted, k + 1
+
+    t = jnp.asarray(1.0, dtype=x.dtype)
+    obj_new, accepted = trial(t)
+    t, obj_new, accepted, _ = lax.while_loop(
+        cond_fun, body_fun, (t, obj_new, accepted, 0)
+    )
+    return t, obj_new, accepted & (slope < 0)
+
+
+def _steepest_direction(grad: jnp.array) -> jnp.array:
+    """Unit length steepest descent direction"""
+    return -grad / jnp.maximum(jnp.linalg.norm(grad), 1e-12)
+
+
+def _lbfgs_direction(
+    grad: jnp.array, s_hist: jnp.array, y_hist: jnp.array, count: int, head: int
+) -> jnp.array:
+    """L-BFGS two-loop recursion over the stored curvature pairs"""
+    memory = s_hist.shape[0]
+    rho = 1.0 / jnp.sum(s_hist * y_hist, axis=1)
+
+    # Newest pair first
+    def first_loop(j, c):
+        q, alpha = c
+        i = (head - 1 - j) % memory
+        a = jnp.where(j < count, rho[i] * jnp.dot(s_hist[i], q), 0.0)
+        return q - a * y_hist[i], alpha.at[i].set(a)
+
+    q, alpha = lax.fori_loop(
+        0, memory, first_loop, (grad, jnp.zeros(memory, dtype=grad.dtype))
+    )
+
+    # Initial inverse Hessian scaled by the newest pair
+    newest = (head - 1) % memory
+    gamma = jnp.dot(s_hist[newest], y_hist[newest]) / jnp.dot(
+        y_hist[newest], y_hist[newest]
+    )
+    r = gamma * q
+
+    # Oldest pair first
+    def second_loop(j, r):
+        i = (head - count + j) % memory
+        b = rho[i] * jnp.dot(y_hist[i], r)
+        return jnp.where(j < count, r + s_hist[i] * (alpha[i] - b), r)
+
+    return -lax.fori_loop(0, memory, second_loop, r)
+
+
+def _hessian(x: jnp.array, data: ObjectiveData, size: int) -> jnp.array:
+    """
+    Hessian of log_objective, as Hessian-vector products of HESSIAN_BLOCK
+    columns at a time rather than all of them at once like jax.hessian
+    """
+    grad_fun = jax.grad(log_objective)
+
+    def hvp(v):
+        return jax.jvp(lambda x: grad_fun(x, data, size), (x,), (v,))[1]
+
+    num_blocks = -(-x.size // HESSIAN_BLOCK)
+    basis = jnp.eye(num_blocks * HESSIAN_BLOCK, x.size, dtype=x.dtype)
+    columns = lax.map(
+        jax.vmap(hvp), basis.reshape(num_blocks, HESSIAN_BLOCK, x.size)
+    )
+    return columns.reshape(-1, x.size)[: x.size]
+
+
+def _newton_direction(hessian: jnp.array, grad: jnp.array, damping: float) -> tuple:
+    """
+    Newton direction of the Hessian damped by a multiple of the identity,
+    relative to its largest diagonal entry. Far from the optimum the Hessian
+    is often indefinite, the damping is raised until the damped Hessian has a
+    Cholesky factor.
+    :return: the damping used and the direction, NaN if no damping up to
+        NEWTON_MAX_DAMPING made the Hessian PD
+    """
+    scale = jnp.maximum(jnp.max(jnp.abs(jnp.diag(hessian))), 1.0)
+    identity = jnp.eye(grad.size, dtype=grad.dtype)
+
+    def solve(damping):
+        factor = jnp.linalg.cholesky(hessian + damping * scale * identity)
+        return -jlinalg.cho_solve((factor, True), grad)
+
+    def cond_fun(c):
+        damping, direction = c
+        return ~jnp.all(jnp.isfinite(direction)) & (damping < NEWTON_MAX_DAMPING)
+
+    def body_fun(c):
+        damping, _ = c
+        damping = jnp.minimum(damping * NEWTON_DAMPING_FACTOR, NEWTON_MAX_DAMPING)
+        return damping, solve(damping)
+
+    return lax.while_loop(cond_fun, body_fun, (damping, solve(damping)))
+
+
+def _run_second_order(
+    state: SecondOrderState,
+    data: ObjectiveData,
+    size: int,
+    max_iter: int,
+    tolerance: float,
+    stop_at: int,
+    newton: bool,
+) -> SecondOrderState:
+    """Loop of the L-BFGS (newton=False) or damped Newton (newton=True) optimizer"""
+    if stop_at is None:
+        stop_at = max_iter
+
+    grad_fun = jax.grad(log_objective)
+    memory = state.s_hist.shape[0]
+
+    def cond_fun(s):
+        return ~s.done & (s.idx < stop_at)
+
+    def body_fun(s):
+        idx, x = s.idx, s.x
+        grad = grad_fun(x, data, size)
+        s_hist, y_hist = s.s_hist, s.y_hist
+        hist_count, hist_head = s.hist_count, s.hist_head
+
+        damping = s.damping
+        if newton:
+            hessian = _hessian(x, data, size)
+            damping, direction = _newton_direction(hessian, grad, damping)
+        else:
+            # Keep the curvature pair of the previous step if it is positive
+            y = grad - s.prev_grad
+            curvature = jnp.dot(s.prev_step, y)
+            keep = (idx > 0) & (curvature > CURVATURE_EPS * jnp.dot(y, y))
+            s_hist = jnp.where(keep, s_hist.at[hist_head].set(s.prev_step), s_hist)
+            y_hist = jnp.where(keep, y_hist.at[hist_head].set(y), y_hist)
+            hist_head = jnp.where(keep, (hist_head + 1) % memory, hist_head)
+            hist_count = jnp.where(keep, jnp.minimum(hist_count + 1, memory), hist_count)
+            direction = _lbfgs_direction(grad, s_hist, y_hist, hist_count, hist_head)
+
+        # Steepest descent on the first L-BFGS iteration, after a failed line
+        # search, or when the damped Hessian is not PD
+        use_steepest = s.steepest | ~jnp.all(jnp.isfinite(direction))
+        if not newton:
+            use_steepest |= hist_count == 0
+        direction = jnp.where(use_steepest, _steepest_direction(grad), direction)
+
+        t, obj_new, accepted = _line_search(x, s.obj, grad, direction, data, size)
+        step = jnp.where(accepted, t * direction, 0.0)
+
+        # A failed line search restarts from steepest descent, unless it
+        # already was the direction, in which case no progress can be made
+        restart = ~accepted & ~use_steepest
+        stuck = ~accepted & use_steepest
+        if not newton:
+            hist_count = jnp.where(restart, 0, hist_count)
+
+        # Less damping after a full Newton step, more after a shortened one
+        damping = jnp.where(
+            use_steepest,
+            damping,
+            jnp.where(
+                accepted & (t == 1.0),
+                jnp.maximum(damping / NEWTON_DAMPING_FACTOR, NEWTON_MIN_DAMPING),
+                jnp.minimum(damping * NEWTON_DAMPING_FACTOR, NEWTON_MAX_DAMPING),
+            ),
+        )
+
+        converged = (
+            (accepted & (jnp.abs(s.obj - obj_new) < tolerance))
+            | (jnp.max(jnp.abs(grad)) < tolerance)
+            | (idx == max_iter - 1)
+        )
+
+        return SecondOrderState(
+            idx=idx + 1,
+            x=x + step,
+            obj=jnp.where(accepted, obj_new, s.obj),
+            prev_grad=grad,
+            prev_step=step,
+            s_hist=s_hist,
+            y_hist=y_hist,
+            hist_count=hist_count,
+            hist_head=hist_head,
+            damping=damping,
+            steepest=restart,
+            done=converged | stuck,
+            num_resets=s.num_resets + restart.astype(int),
+        )
+
+    return lax.while_loop(cond_fun, body_fun, state)
+
+
+@partial(jax.jit, static_argnums=(3,))
+def run_lbfgs(
+    state: SecondOrderState,
+    data: ObjectiveData,
+    reset_point: tuple,
+    size: int,
+    max_iter: int,
+    learning_rate: float,
+    tolerance: float,
+    stop_at: int = None,
+) -> SecondOrderState:
+    """
+    Run the L-BFGS loop, with a backtracking line search, until convergence,
+    a failed steepest descent line search, max_iter iterations, or stop_at
+    iterations (used to run the loop in chunks)
+    :param state: loop carry from init_lbfgs or a previous call
+    :param data: sufficient statistics for the objective
+    :param reset_point: unused, a failed line search restarts from steepest
+        descent at the current point instead
+    :param size: dimension of the random effects, or a Parameterization of Sigma_u
+    :param max_iter: maximum number of iterations
+    :param learning_rate: unused
+    :param tolerance: tolerance for convergence, on the change in objective
+        and on the largest gradient entry
+    :param stop_at: iteration index to pause at, defaults to max_iter
+    :return: the final loop carry
+    """
+    return _run_second_order(state, data, size, max_iter, tolerance, stop_at, False)
+
+
+@partial(jax.jit, static_argnums=(3,))
+def run_newton(
+    state: SecondOrderState,
+    data: ObjectiveData,
+    reset_point: tuple,
+    size: int,
+    max_iter: int,
+    learning_rate: float,
+    tolerance: float,
+    stop_at: int = None,
+) -> SecondOrderState:
+    """
+    Run the damped Newton loop, same as run_lbfgs with the exact Hessian
+    (damped by a multiple of the identity, adapted to the line search)
+    in place of the L-BFGS approximation
+    """
+    return _run_second_order(state, data, size, max_iter, tolerance, stop_at, True)
+
+
+# Loop carry initializer and loop of each optimizer
+OPTIMIZERS = {
+    "gd": (init_gradient_descent, run_gradient_descent),
+    "lbfgs": (init_lbfgs, run_lbfgs),
+    "newton": (init_newton, run_newton),
+}
+
+
+def optimizer_functions(method: str, backend: str = "jax") -> tuple:
+    """
+    Loop carry initializer and loop of an optimizer, which share the signatures
+    of init_gradient_descent and run_gradient_descent
+    :param method: "gd", "lbfgs" or "newton"
+    :param backend: "jax" for the compiled loops, or "numpy" for the NumPy
+        ones of backends.py, gradient descent only
+    """
+    if method not in OPTIMIZERS:
+        raise ValueError(f"Unknown hyperparameter optimizer: {method}")
+    if backend == "jax":
+        return OPTIMIZERS[method]
+    if backend != "numpy":
+        raise ValueError(f"Unknown compute backend: {backend}")
+
+    # Imported here, the NumPy kernels build on this module
+    from src.algorithm import backends
+
+    if method not in backends.NUMPY_OPTIMIZERS:
+        raise ValueError(f"The NumPy backend does not run the {method} optimizer")
+    return backends.NUMPY_OPTIMIZERS[method]
+
+
+def validate_function(backend: str = "jax"):
+    """validate of a backend, "jax" or "numpy" """
+    if backend == "jax":
+        return validate
+    if backend != "numpy":
+        raise ValueError(f"Unknown compute backend: {backend}")
+
+    from src.algorithm import backends
+
+    return backends.validate
+
+
+class HyperparameterProblem(NamedTuple):
+    """
+    Inputs of a hyperparameter fit. Holds copies of the sufficient statistics
+    only, so it can be pickled and fitted in another process
+    """
+
+    data: ObjectiveData
+    init_point: tuple
+    reset_point: tuple
+    size: int
+    max_iter: int
+    learning_rate: float
+    tolerance: float
+    multi_start: bool = False
+    num_jittered_starts: int = 2
+    start_jitter: float = 0.1
+    jitter_seed: int = 0
+    method: str = "gd"
+    estimator: str = "marginal"
+    em_tolerance: float = 1e-4
+    backend: str = "jax"
+
+
+class HyperparameterFit(NamedTuple):
+    """Outcome of a hyperparameter fit"""
+
+    status: str
+    ltu_flat: np.array
+    noise_precision: float
+    iterations: int
+    resets: int
+    objective: float
+    start: str = None
+    diagnostics: dict = None
+
+
+# Statuses of a hyperparameter fit
+FIT_COMPLETED = "completed"
+FIT_INVALID = "invalid"
+FIT_STOPPED = "stopped"
+
+
+def starting_points(problem: HyperparameterProblem) -> tuple[list, np.array, np.array]:
+    """
+    Starting points of a multi-start fit: the starting point of the problem
+    (the previous estimate), its reset point (the prior initialization), and
+    jittered copies of both, with every entry of the Cholesky factor scaled by
+    an independent log-normal factor. The noise precision is not jittered, the
+    fit reports the one it started from (see min_noise_precision)
+    :param problem: the hyperparameter problem
+    :return: names of the starting points
+    :return: lower triangular entries of chol(Sigma_u) of each point, (S, p)
+    :return: noise precision of each point, (S,)
+    """
+    rng = np.random.default_rng(problem.jitter_seed)
+    names, ltu_flats, noise_precisions = [], [], []
+    for name, (ltu_flat, noise_precision) in [
+        ("previous", problem.init_point),
+        ("prior", problem.reset_point),
+    ]:
+        ltu_flat = np.asarray(ltu_flat, dtype=float)
+        names.append(name)
+        ltu_flats.append(ltu_flat)
+        noise_precisions.append(float(noise_precision))
+        for i in range(problem.num_jittered_starts):
+            scale = np.exp(problem.start_jitter * rng.standard_normal(ltu_flat.size))
+            names.append(f"{name}_jitter_{i + 1}")
+            ltu_flats.append(ltu_flat * scale)
+            noise_precisions.append(float(noise_precision))
+
+    return names, np.stack(ltu_flats), np.array(noise_precisions)
+
+
+def staged_objective(state, check, data: ObjectiveData, size: int) -> float:
+    """
+    Objective at the hyperparameters a fit reports. Gradient descent keeps the
+    noise precision it started from (see min_noise_precision), so its min_obj
+    was evaluated at another noise precision
+    :param state: loop carry of the optimizer
+    :param check: validate of the backend of the fit
+    :return: the objective, INVALID_OBJECTIVE if the point is not valid
+    """
+    obj, _ = check(state.min_ltu_flat, state.min_noise_precision, data, size)
+    return float(obj)
+
+
+def fit_hyperparameters(
+    problem: HyperparameterProblem, chunk_iters: int = None, progress=None
+) -> HyperparameterFit:
+    """
+    Run the optimizer of a problem from its starting point, or from its
+    reset point if the starting point is not valid. In multi-start mode, from
+    all the starting_points at once, keeping the best valid one. With the EM
+    estimator, see em.fit_em
+    :param problem: the hyperparameter problem
+    :param chunk_iters: run the loop in chunks of this many iterations, calling
+        progress after each one, in a single call if None
+    :param progress: called with the number of iterations and the lowest
+        objective so far after each chunk, the fit stops early if it returns False
+    :return: the fit, with status FIT_INVALID if no starting point is valid,
+        and FIT_STOPPED if it was stopped by progress
+    """
+    if problem.estimator == "em":
+        # Imported here, the EM estimator builds on this module
+        from src.algorithm import em
+
+        return em.fit_em(problem, chunk_iters, progress)
+    if problem.estimator != "marginal":
+        raise ValueError(f"Unknown hyperparameter estimator: {problem.estimator}")
+    if problem.multi_start:
+        return fit_multi_start(problem, chunk_iters, progress)
+
+    data, size = problem.data, problem.size
+    check = validate_function(problem.backend)
+    ltu_flat, noise_precision = problem.init_point
+    init_obj, valid = check(ltu_flat, noise_precision, data, size)
+    if not valid:
+        ltu_flat, noise_precision = problem.reset_point
+        init_obj, valid = check(ltu_flat, noise_precision, data, size)
+        if not valid:
+            return HyperparameterFit(FIT_INVALID, None, None, 0, 0, float(init_obj))
+
+    init_optimizer, run_optimizer = optimizer_functions(problem.method, problem.backend)
+    state = init_optimizer(ltu_flat, noise_precision, init_obj, problem.learning_rate)
+    args = (
+        data,
+        problem.reset_point,
+        size,
+        problem.max_iter,
+        problem.learning_rate,
+        problem.tolerance,
+    )
+
+    status = FIT_COMPLETED
+    if chunk_iters is None:
+        state = run_optimizer(state, *args)
+    else:
+        while not bool(state.done) and int(state.idx) < problem.max_iter:
+            stop_at = min(int(state.idx) + chunk_iters, problem.max_iter)
+            state = run_optimizer(state, *args, stop_at)
+            if progress is not None and not progress(int(state.idx), float(state.min_obj)):
+                status = FIT_STOPPED
+                break
+
+    return HyperparameterFit(
+        status,
+        np.array(state.min_ltu_flat),
+        float(state.min_noise_precision),
+        int(state.idx),
+        int(state.num_resets),
+        staged_objective(state, check, data, size),
+    )
+
+
+def fit_multi_start(
+    problem: HyperparameterProblem, chunk_iters: int = None, progress=None
+) -> HyperparameterFit:
+    """
+    Multi-start version of fit_hyperparameters. Each start runs the same
+    compiled loop as a single fit, in a thread of its own (XLA releases the
+    GIL), so the starts use one core each and each one stops at its own
+    convergence
+    """
+    names, ltu_flats, noise_precisions = starting_points(problem)
+    data, size = problem.data, problem.size
+
+    check = validate_function(problem.backend)
+    init_optimizer, run_optimizer = optimizer_functions(problem.method, problem.backend)
+
+    # Invalid starting points are dropped
+    states = {}
+    for name, ltu_flat, noise_precision in zip(names, ltu_flats, noise_precisions):
+        init_obj, valid = check(ltu_flat, noise_precision, data, size)
+        if valid:
+            states[name] = init_optimizer(
+                ltu_flat, noise_precision, init_obj, problem.learning_rate
+            )
+    if not states:
+        return HyperparameterFit(FIT_INVALID, None, None, 0, 0, INVALID_OBJECTIVE)
+
+    args = (
+        data,
+        problem.reset_point,
+        size,
+        problem.max_iter,
+        problem.learning_rate,
+        problem.tolerance,
+    )
+
+    status = FIT_COMPLETED
+    num_threads = min(len(states), os.cpu_count() or 1)
+    with ThreadPoolExecutor(num_threads, thread_name_prefix="MultiStart") as pool:
+        if chunk_iters is None:
+            runs = {
+                name: pool.submit(run_optimizer, state, *args)
+                for name, state in states.items()
+            }
+            states = {name: run.result() for name, run in runs.items()}
+        else:
+            iteration = 0
+            while iteration < problem.max_iter and not all(
+                bool(state.done) for state in states.values()
+            ):
+                iteration = min(iteration + chunk_iters, problem.max_iter)
+                runs = {
+                    name: pool.submit(run_optimizer, state, *args, iteration)
+                    for name, state in states.items()
+                    if not bool(state.done)
+                }
+                states.update({name: run.result() for name, run in runs.items()})
+                min_obj = min(float(state.min_obj) for state in states.values())
+                if progress is not None and not progress(iteration, min_obj):
+                    status = FIT_STOPPED
+                    break
+
+    # Lowest objective at the hyperparameters that would be staged, ties go
+    # to the earlier start
+    objectives = {
+        name: staged_objective(state, check, data, size) for name, state in states.items()
+    }
+    best = min(objectives, key=objectives.get)
+    state = states[best]
+    return HyperparameterFit(
+        status,
+        np.array(state.min_ltu_flat),
+        float(state.min_noise_precision),
+        int(state.idx),
+        int(state.num_resets),
+        objectives[best],
+        best,
+    )
@@ -0,0 +1,223 @@
+# src/algorithm/parameterization.py
+
+# Parameterizations of the random effects covariance Sigma_u. The optimizers
+# work on a flat parameter vector, by default ("full") the d (d + 1) / 2 lower
+# triangular entries of the Cholesky factor of Sigma_u (ltu_flat). The
+# structured ones have far fewer parameters and an inverse that costs less
+# than a dense Cholesky factorization:
+#   diagonal  Sigma_u = diag(s^2), d parameters
+#   block     block diagonal, with one Cholesky factor per component of
+#             param_size (baseline, action centering and advantage)
+#   lowrank   Sigma_u = diag(s^2) + V V^T with V of shape (d, rank),
+#             d (rank + 1) parameters, inverted with the Woodbury identity
+# A Parameterization is hashable, the compiled kernels take it as a static
+# argument in place of the dimension of the full parameterization.
+
+# Imports
+from typing import NamedTuple
+
+import numpy as np
+
+import jax.numpy as jnp
+import jax.scipy.linalg as jlinalg
+
+KINDS = ["full", "diagonal", "block", "lowrank"]
+
+# Share of the variance of the largest entries of Sigma_u that the initial
+# low-rank factor carries, a zero factor would be a saddle point
+LOWRANK_INIT_SHARE = 0.5
+
+
+class Parameterization(NamedTuple):
+    """Structure of Sigma_u"""
+
+    kind: str
+    size: int
+    blocks: tuple = ()
+    rank: int = 0
+
+
+def make_parameterization(
+    kind: str, size: int, param_size: list = None, rank: int = 2
+) -> Parameterization:
+    """
+    Parameterization of Sigma_u
+    :param kind: "full", "diagonal", "block" or "lowrank"
+    :param size: dimension of Sigma_u
+    :param param_size: sizes of the diagonal blocks of "block"
+    :param rank: rank of the low-rank factor of "lowrank"
+    :return: the parameterization
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown Sigma_u parameterization: {kind}")
+    blocks = ()
+    if kind == "block":
+        blocks = tuple(int(block) for block in param_size)
+        if sum(blocks) != size:
+            raise ValueError(f"Blocks {blocks} do not add up to {size}")
+    if kind == "lowrank" and not 0 < rank < size:
+        raise ValueError(f"Rank {rank} is not between 0 and {size}")
+    return Parameterization(kind, int(size), blocks, int(rank) if kind == "lowrank" else 0)
+
+
+def as_parameterization(size) -> Parameterization:
+    """Parameterization of a size argument, an int being the full one"""
+    if isinstance(size, Parameterization):
+        return size
+    return Parameterization("full", int(size))
+
+
+def dimension(size) -> int:
+    """Dimension of Sigma_u of a size argument, an int or a Parameterization"""
+    return as_parameterization(size).size
+
+
+def num_params(structure: Parameterization) -> int:
+    """Number of parameters of a parameterization"""
+    d = structure.size
+    if structure.kind == "full":
+        return d * (d + 1) // 2
+    if structure.kind == "diagonal":
+        return d
+    if structure.kind == "block":
+        return sum(k * (k + 1) // 2 for k in structure.blocks)
+    return d * (structure.rank + 1)
+
+
+def block_slices(structure: Parameterization) -> list:
+    """(parameter slice, row slice) of each block"""
+    slices = []
+    start, row = 0, 0
+    for k in structure.blocks:
+        count = k * (k + 1) // 2
+        slices.append((slice(start, start + count), slice(row, row + k)))
+        start += count
+        row += k
+    return slices
+
+
+def params_of(sigma_u: np.array, structure: Parameterization) -> np.array:
+    """
+    Parameters of a covariance matrix, of its diagonal or diagonal blocks for
+    the diagonal and block parameterizations
+    :param sigma_u: PD covariance matrix
+    :param structure: the parameterization
+    :return: flat parameter vector
+    """
+    sigma_u = np.asarray(sigma_u, dtype=float)
+    d = structure.size
+    if structure.kind == "full":
+        return np.linalg.cholesky(sigma_u)[np.tril_indices(d)]
+    if structure.kind == "diagonal":
+        return np.sqrt(np.diag(sigma_u))
+    if structure.kind == "block":
+        return np.concatenate(
+            [
+                np.linalg.cholesky(sigma_u[rows, rows])[np.tril_indices(rows.stop - rows.start)]
+                for _, rows in block_slices(structure)
+            ]
+        )
+
+    # The factor carries a share of the variance along the top eigenvectors
+    eigvals, eigvecs = np.linalg.eigh(sigma_u)
+    top = np.argsort(eigvals)[::-1][: structure.rank]
+    V = eigvecs[:, top] * np.sqrt(LOWRANK_INIT_SHARE * eigvals[top])
+    residual = np.diag(sigma_u) - np.sum(V**2, axis=1)
+    return np.concatenate([np.sqrt(residual), V.flatten()])
+
+
+def sigma_u_of(params: np.array, structure: Parameterization) -> np.array:
+    """Covariance matrix of a parameter vector"""
+    params = np.asarray(params, dtype=float)
+    d = structure.size
+    if structure.kind == "full":
+        L = np.zeros((d, d))
+        L[np.tril_indices(d)] = params
+        return L @ L.T
+    if structure.kind == "diagonal":
+        return np.diag(params**2)
+    if structure.kind == "block":
+        sigma_u = np.zeros((d, d))
+        for entries, rows in block_slices(structure):
+            k = rows.stop - rows.start
+            L = np.zeros((k, k))
+            L[np.tril_indices(k)] = params[entries]
+            sigma_u[rows, rows] = L @ L.T
+        return sigma_u
+
+    V = params[d:].reshape(d, structure.rank)
+    return np.diag(params[:d] ** 2) + V @ V.T
+
+
+def project(sigma_u: np.array, structure: Parameterization) -> np.array:
+    """Closest covariance matrix of the structure, for diagonal and block"""
+    if structure.kind == "diagonal":
+        return np.diag(np.diag(sigma_u))
+    if structure.kind == "block":
+        projected = np.zeros_like(sigma_u)
+        for _, rows in block_slices(structure):
+            projected[rows, rows] = sigma_u[rows, rows]
+        return projected
+    if structure.kind == "lowrank":
+        raise ValueError("The low-rank parameterization has no closed-form projection")
+    return sigma_u
+
+
+def sigma_u_inverse(params: np.array, structure: Parameterization) -> np.array:
+    """
+    Inverse of the covariance matrix of a parameter vector, using its
+    structure, for the posterior update
+    """
+    params = np.asarray(params, dtype=float)
+    d = structure.size
+    if structure.kind == "full":
+        return np.linalg.inv(sigma_u_of(params, structure))
+    if structure.kind == "diagonal":
+        return np.diag(1.0 / params**2)
+    if structure.kind == "block":
+        sigma_u = sigma_u_of(params, structure)
+        inverse = np.zeros((d, d))
+        for _, rows in block_slices(structure):
+            inverse[rows, rows] = np.linalg.inv(sigma_u[rows, rows])
+        return inverse
+
+    V = params[d:].reshape(d, structure.rank)
+    diag_inv = 1.0 / params[:d] ** 2
+    scaled = diag_inv[:, None] * V
+    capacitance = np.identity(structure.rank) + V.T @ scaled
+    return np.diag(diag_inv) - scaled @ np.linalg.solve(capacitance, scaled.T)
+
+
+def inverse_and_logdet(params: jnp.array, structure: Parameterization) -> tuple:
+    """
+    Inverse and log determinant of the covariance matrix of a parameter
+    vector, differentiable, for the marginal objective
+    :return: Sigma_u^-1 and log det Sigma_u
+    """
+    d = structure.size
+    if structure.kind == "full":
+        L = jnp.zeros((d, d), dtype=float).at[jnp.tril_indices(d)].set(params)
+        return jlinalg.cho_solve((L, True), jnp.identity(d)), 2 * jnp.sum(
+            jnp.log(jnp.abs(jnp.diag(L)))
+        )
+    if structure.kind == "diagonal":
+        variance = params**2
+        return jnp.diag(1.0 / variance), jnp.sum(jnp.log(variance))
+    if structure.kind == "block":
+        inverse = jnp.zeros((d, d), dtype=float)
+        logdet = 0.0
+        for entries, rows in block_slices(structure):
+            k = rows.stop - rows.start
+            L = jnp.zeros((k, k), dtype=float).at[jnp.tril_indices(k)].set(params[entries])
+            inverse = inverse.at[rows, rows].set(jlinalg.cho_solve((L, True), jnp.identity(k)))
+            logdet = logdet + 2 * jnp.sum(jnp.log(jnp.abs(jnp.diag(L))))
+        return inverse, logdet
+
+    variance = params[:d] ** 2
+    V = params[d:].reshape(d, structure.rank)
+    scaled = V / variance[:, None]
+    capacitance = jnp.identity(structure.rank) + V.T @ scaled
+    chol = jnp.linalg.cholesky(capacitance)
+    inverse = jnp.diag(1.0 / variance) - scaled @ jlinalg.cho_solve((chol, True), scaled.T)
+    logdet = jnp.sum(jnp.log(variance)) + 2 * jnp.sum(jnp.log(jnp.diag(chol)))
+    return inverse, logdet
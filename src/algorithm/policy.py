@@ -0,0 +1,211 @@
+# src/algorithm/policy.py
+
+# Action probabilities of a published policy. The state is three binary
+# features, so each user only has 8 possible advantage vectors, and the action
+# probabilities of every user can be tabulated when the posterior is published.
+
+# Imports
+import numpy as np
+from types import MappingProxyType
+from typing import Callable, Mapping, NamedTuple
+
+from src.algorithm import structured
+
+# All binary states, in the order of their table column (4 * s0 + 2 * s1 + s2)
+STATES = [[s0, s1, s2] for s0 in [0, 1] for s1 in [0, 1] for s2 in [0, 1]]
+
+
+def state_index(state: list) -> int:
+    """
+    Column of a state in the probability tables
+    :param state: state of the user
+    :return: table column, None if the state is not binary
+    """
+    if any(s not in (0, 1) for s in state):
+        return None
+    return int(4 * state[0] + 2 * state[1] + state[2])
+
+
+def advantage_vector(state: list, size: int) -> np.array:
+    """
+    Advantage features of a state
+    :param state: state of the user
+    :param size: number of advantage parameters
+    :return: advantage vector with intercept
+    """
+    advantage_default = [
+        1,
+        state[0],
+        state[1],
+        state[2],
+        state[0] * state[1],
+        state[0] * state[2],
+        state[1] * state[2],
+        state[0] * state[1] * state[2],
+    ]
+
+    return np.array(advantage_default[:size])
+
+
+def advantage_posterior(
+    posterior_mean_user: np.array,
+    posterior_cov_user: np.array,
+    advantage: np.array,
+) -> tuple[np.array, np.array, float, float]:
+    """
+    Posterior of the advantage of a state
+    :param posterior_mean_user: posterior mean of the user's parameters
+    :param posterior_cov_user: posterior covariance of the user's parameters
+    :param advantage: advantage vector of the state
+    :return: beta mean, beta covariance, adv*beta mean, adv*beta variance
+    """
+    size = advantage.shape[0]
+
+    # Compute the posterior mean of the adv term
+    beta_mean = np.array(posterior_mean_user[-size:])
+
+    # Compute the posterior covariance of the adv term
+    beta_cov = np.array(posterior_cov_user[-size:, -size:])
+
+    # Compute the posterior mean of the adv*beta distribution
+    adv_beta_mean = advantage.T.dot(beta_mean)
+
+    # Compute the posterior variance of the adv*beta distribution
+    adv_beta_var = advantage.T @ beta_cov @ advantage
+
+    return beta_mean, beta_cov, adv_beta_mean, adv_beta_var
+
+
+def action_probability(
+    posterior_mean_user: np.array,
+    posterior_cov_user: np.array,
+    advantage: np.array,
+    alloc_func: Callable,
+) -> tuple[float, np.array, np.array, float, float]:
+    """
+    Action probability of a user given the posterior of their parameters
+    :param posterior_mean_user: posterior mean of the user's parameters
+    :param posterior_cov_user: posterior covariance of the user's parameters
+    :param advantage: advantage vector of the state
+    :param alloc_func: allocation function
+    :return: probability, and the advantage posterior it was computed from
+        (beta mean, beta covariance, adv*beta mean, adv*beta variance)
+    """
+    beta_mean, beta_cov, adv_beta_mean, adv_beta_var = advantage_posterior(
+        posterior_mean_user, posterior_cov_user, advantage
+    )
+
+    # Call the allocation function
+    prob = alloc_func(mean=adv_beta_mean, var=adv_beta_var)
+
+    return prob, beta_mean, beta_cov, adv_beta_mean, adv_beta_var
+
+
+def probability_table(
+    user_means: list,
+    user_covs: list,
+    alloc_func: Callable,
+    size: int,
+    batch_alloc_func: Callable = None,
+) -> np.array:
+    """
+    Action probabilities of every user in every binary state
+    :param user_means: posterior mean of each user's parameters
+    :param user_covs: posterior covariance of each user's parameters
+    :param alloc_func: allocation function
+    :param size: number of advantage parameters
+    :param batch_alloc_func: batch version of the allocation function, used
+        instead of alloc_func if given
+    :return: array of shape (users, 8), unclipped
+    """
+    advantages = [advantage_vector(state, size) for state in STATES]
+    adv_beta_means = np.empty((len(user_means), len(STATES)))
+    adv_beta_vars = np.empty((len(user_means), len(STATES)))
+    for i, (mean, cov) in enumerate(zip(user_means, user_covs)):
+        for j, advantage in enumerate(advantages):
+            _, _, adv_beta_mean, adv_beta_var = advantage_posterior(mean, cov, advantage)
+
+            # Posterior means of shape (d, 1) give arrays of shape (1,)
+            adv_beta_means[i, j] = np.ravel(adv_beta_mean)[0]
+            adv_beta_vars[i, j] = adv_beta_var
+
+    if batch_alloc_func is not None:
+        return batch_alloc_func(adv_beta_means, adv_beta_vars)
+
+    table = np.empty(adv_beta_means.shape)
+    for i in range(table.shape[0]):
+        for j in range(table.shape[1]):
+            table[i, j] = alloc_func(mean=adv_beta_means[i, j], var=adv_beta_vars[i, j])
+
+    return table
+
+
+def freeze(array: np.array) -> np.array:
+    """Mark an array read-only, so a published policy cannot be changed in place"""
+    if array is None:
+        return None
+    array = np.asarray(array)
+    array.flags.writeable = False
+    return array
+
+
+class PolicySnapshot(NamedTuple):
+    """
+    Immutable policy: posterior, hyperparameters and action probability tables
+    of one policy id. A new policy is published by replacing the reference to
+    the snapshot, so a reader that takes the reference once sees a consistent
+    policy without locking, and an old snapshot is freed when the last request
+    holding it finishes.
+    """
+
+    policyid: int
+    user_list: tuple
+    user_index: Mapping[str, int]
+    posterior_mean: np.array
+    posterior: structured.BlockPosterior
+    theta_pop_mean: np.array
+    theta_pop_cov: np.array
+    sigma_u: np.array
+    noise_var: float
+    ltu_flat: np.array
+    hyperparam_update_id: int
+    prob_table: np.array
+    act_prob_table: np.array
+
+    @classmethod
+    def create(cls, user_list: list, **fields) -> "PolicySnapshot":
+        """
+        Snapshot with read-only arrays and a read-only user index
+        :param user_list: users with a posterior, in posterior order
+        :param fields: the other fields of the snapshot
+        :return: the snapshot
+        """
+        fields = {
+            key: freeze(value) if isinstance(value, np.ndarray) else value
+            for key, value in fields.items()
+        }
+        return cls(
+            user_list=tuple(user_list),
+            user_index=MappingProxyType(
+                {user_id: index for index, user_id in enumerate(user_list)}
+            ),
+            **fields,
+        )
+
+    def user_posterior(self, user: int = None) -> tuple[np.array, np.array]:
+        """
+        Posterior of a user's parameters under this policy
+        :param user: index of the user in user_list, None for users without a
+            posterior of their own
+        :return: posterior mean and covariance
+        """
+        if user is None:
+            # Since user is new, use the posterior of theta pop
+            return self.theta_pop_mean, self.theta_pop_cov + self.sigma_u
+
+        num_params = self.theta_pop_mean.shape[0]
+        posterior_mean_user = self.posterior_mean[
+            user * num_params : (user + 1) * num_params
+        ]
+        posterior_cov_user = self.posterior.user_block(user)
+        return posterior_mean_user, posterior_cov_user
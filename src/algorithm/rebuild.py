@@ -0,0 +1,108 @@
+# src/algorithm/rebuild.py
+
+# Cold-start rebuild of the state of a MixedEffectsAlgorithm from the recorded
+# decision points (the rl_action_selection table), when there is no
+# checkpoint. The rows are streamed in chunks ordered by user and decision
+# index, and each user's history is loaded as soon as it is complete, with the
+# design rows and sufficient statistics update_design_row would have built row
+# by row. Users are then ordered by their first action (the smallest rid), the
+# order in which the live instance saw them.
+
+# Imports
+import numpy as np
+import pandas as pd
+
+from src.algorithm import artifact, parameterization, policy, structured
+from src.algorithm.user_store import UserHistoryStore
+
+# Columns of the rows of the rebuild
+COLUMNS = ["user_id", "user_decision_idx", "rid", "state_vector", "action", "act_prob", "reward"]
+
+
+def rebuild_users(algorithm, chunks) -> tuple[int, int]:
+    """
+    Replace the user store of an algorithm by one rebuilt from its rows. Each
+    user is loaded as soon as their rows end, so only the rows of one user are
+    carried from a chunk to the next.
+    :param algorithm: the MixedEffectsAlgorithm
+    :param chunks: iterable of data frames with COLUMNS, ordered by user id
+        and decision index, a user's rows may span several chunks
+    :return: number of users and of decision points loaded
+    """
+    store = UserHistoryStore(
+        algorithm.users.design.shape[1],
+        algorithm.users.num_params,
+        algorithm.users.state_size,
+    )
+    first_rid = {}
+    num_rows = 0
+
+    def load(user_id, parts):
+        rows = pd.concat(parts) if len(parts) > 1 else parts[0]
+        state = np.array(rows["state_vector"].tolist(), dtype=float)
+        action = rows["action"].to_numpy(dtype=int)
+        act_prob = rows["act_prob"].to_numpy(dtype=float)
+        reward = rows["reward"].to_numpy(dtype=float, na_value=np.nan)
+        # Raises if the rows of the user are not contiguous
+        store.load(
+            user_id,
+            state,
+            action,
+            act_prob,
+            reward,
+            algorithm.design_matrix(state, action, act_prob),
+        )
+        first_rid[user_id] = rows["rid"].min()
+        return len(rows)
+
+    # Rows of the user whose rows may continue in the next chunk
+    open_user, open_parts = None, []
+    for chunk in chunks:
+        for user_id, rows in chunk.groupby("user_id", sort=False):
+            if user_id == open_user:
+                open_parts.append(rows)
+                continue
+            if open_parts:
+                num_rows += load(open_user, open_parts)
+            open_user, open_parts = user_id, [rows]
+    if open_parts:
+        num_rows += load(open_user, open_parts)
+
+    # Users in the order of their first action, the order the live instance
+    # registered them in
+    store.reorder(sorted(first_rid, key=first_rid.get))
+
+    # Published in one step
+    algorithm.users = store
+    return len(store), num_rows
+
+
+def restore_policy(algorithm, arrays: dict, metadata: dict, hyperparam_update_id: int) -> None:
+    """
+    Publish the policy of a policy artifact, see artifact.save_policy
+    :param algorithm: the MixedEffectsAlgorithm
+    :param arrays: arrays of the artifact
+    :param metadata: metadata of the artifact
+    :param hyperparam_update_id: hyperparameter update id of the policy
+    :return: None
+    """
+    posterior = artifact.posterior_of(arrays)
+    if posterior is None:
+        raise ValueError("The policy artifact has no compact posterior")
+    posterior = structured.BlockPosterior(
+        *(policy.freeze(np.array(array, dtype=float)) for array in posterior)
+    )
+
+    sigma_u = np.array(arrays["sigma_u"], dtype=float)
+    algorithm.snapshot = algorithm.make_snapshot(
+        policyid=metadata["policy_id"],
+        user_list=metadata["user_list"],
+        posterior_mean=posterior.user_mean.reshape(-1, 1),
+        posterior=posterior,
+        theta_pop_mean=np.array(arrays["theta_pop_mean"], dtype=float),
+        theta_pop_cov=posterior.theta_pop_cov,
+        sigma_u=sigma_u,
+        noise_var=metadata["noise_var"],
+        ltu_flat=parameterization.params_of(sigma_u, algorithm.parameterization),
+        hyperparam_update_id=hyperparam_update_id,
+    )
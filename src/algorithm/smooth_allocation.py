@@ -1,16 +1,98 @@
 import numpy as np
 import pickle as pkl
+from functools import lru_cache
 import scipy.special as special
 from typing import Callable
 import scipy.stats as stats
 
+# Number of (mean, variance) pairs evaluated at once by the batch Monte Carlo
+# allocation functions, small chunks keep the samples in cache
+BATCH_CHUNK_SIZE = 8
+
+# Number of quadrature nodes of the smooth_quadrature allocation function. With
+# 32 nodes the absolute error in the probability is below 1e-4 for means in
+# [-5, 5] and standard deviations in [0.001, 3] (B = 10 / 0.95, C = 5), against
+# a standard error of up to 4e-3 for the Monte Carlo average over 5000 draws
+QUADRATURE_NODES = 32
+
+# Standard deviation of B * x above which the logistic function is too steep for
+# Gauss-Hermite nodes in the normal variable, and the expectation is integrated
+# over the logistic variable instead
+QUADRATURE_SWITCH = 3.0
+
 def load_random_vars(path) -> np.array:
     # Load random variables - normal with mean 0 and var 1
+    if path.endswith(".npy"):
+        # Memory-mapped, the draws are shared by all processes using the file
+        return np.load(path, mmap_mode="r")
+
     with open(path, "rb") as f:
         random_vars = pkl.load(f)
 
     return random_vars
 
+@lru_cache(maxsize=None)
+def quadrature_rules(num_nodes: int) -> tuple:
+    """Gauss-Hermite nodes and weights, and logistic quantiles and Gauss-Legendre weights"""
+    hermite_nodes, hermite_weights = np.polynomial.hermite.hermgauss(num_nodes)
+    legendre_nodes, legendre_weights = np.polynomial.legendre.leggauss(num_nodes)
+    quantiles = special.logit((legendre_nodes + 1) / 2)
+    return (
+        np.sqrt(2) * hermite_nodes,
+        hermite_weights / np.sqrt(np.pi),
+        quantiles,
+        legendre_weights / 2,
+    )
+
+def logistic_normal_expectation(
+    means: np.array, stds: np.array, B: float, C: float, num_nodes: int = QUADRATURE_NODES
+) -> np.array:
+    """
+    E[expit(B * X - log(C))] for X ~ N(means, stds^2), by quadrature.
+
+    For small B * std the integrand is smooth in the normal variable, and
+    Gauss-Hermite quadrature converges quickly. Otherwise the identity
+    E[expit(T)] = P(L < T) = E[Phi((E[T] - L) / std(T))], with L standard
+    logistic, moves the steep part to the normal CDF, and the expectation is
+    computed with Gauss-Legendre quadrature over the quantiles of L.
+    """
+    mu = B * means - np.log(C)
+    tau = B * stds
+    hermite_nodes, hermite_weights, quantiles, legendre_weights = quadrature_rules(
+        num_nodes
+    )
+
+    # Gauss-Hermite in the normal variable
+    normal = special.expit(mu[:, None] + tau[:, None] * hermite_nodes)
+    normal = normal @ hermite_weights
+
+    # Gauss-Legendre over the quantiles of the logistic variable
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logistic = special.ndtr((mu[:, None] - quantiles) / tau[:, None])
+    logistic = logistic @ legendre_weights
+
+    return np.where(tau <= QUADRATURE_SWITCH, normal, logistic)
+
+def quadrature_error(
+    means: np.array,
+    vars: np.array,
+    B: float,
+    C: float = 5.0,
+    L_min: float = 0.2,
+    L_max: float = 0.8,
+    num_nodes: int = QUADRATURE_NODES,
+) -> np.array:
+    """
+    Error estimate of the smooth_quadrature allocation function, the difference
+    to the rule with twice the nodes (a factor 2 covers the observed
+    underestimation of the true error)
+    """
+    means = np.atleast_1d(np.asarray(means, dtype=float))
+    stds = np.sqrt(np.atleast_1d(np.asarray(vars, dtype=float)))
+    coarse = logistic_normal_expectation(means, stds, B, C, num_nodes)
+    fine = logistic_normal_expectation(means, stds, B, C, 2 * num_nodes)
+    return 2 * (L_max - L_min) * np.abs(coarse - fine)
+
 def get_allocation_function(
     func_type: str,
     B: float,
@@ -27,19 +109,19 @@ def get_allocation_function(
         """
         Simple thompson sampling allocation function
         """
-        prob = 1 - stats.norm.cdf(0, mean, np.sqrt(var))
-        return prob
+        std = np.sqrt(var)
+        if not std > 0:
+            # Degenerate distribution, undefined as in stats.norm.cdf
+            return np.nan * np.ones_like(mean)
 
-    def logistic_function_infinity(x: float) -> float:
-        if x >= 0:
-            return L_max
-        else:
-            return L_min
+        # Same as 1 - stats.norm.cdf(0, mean, std), without the overhead
+        prob = 1 - special.ndtr((0 - mean) / std)
+        return prob
 
     def smooth_posterior_sampling_inf(mean: float, var: float) -> float:
         std = np.sqrt(var)
         samples = mean + (randomvars * std)
-        prob = np.mean([logistic_function_infinity(i) for i in samples])
+        prob = np.mean(np.where(samples >= 0, L_max, L_min))
 
         return prob
 
@@ -56,6 +138,10 @@ def get_allocation_function(
         # prob = stats.norm.expect(func=logistic_function, loc=mean, scale=np.sqrt(var))
         return prob
 
+    def smooth_posterior_quadrature(mean: float, var: float) -> float:
+        prob = smooth_posterior_expectation(np.ravel(mean), np.ravel(var))
+        return prob.reshape(np.shape(mean))[()]
+
     if func_type == "thompson":
         return thompson_sampling
     elif func_type == "smooth":
@@ -63,5 +149,94 @@ def get_allocation_function(
             return smooth_posterior_sampling_inf
         else:
             return smooth_posterior_sampling
+    elif func_type == "smooth_quadrature":
+        smooth_posterior_expectation = get_batch_allocation_function(
+            func_type, B, randomvars, C, L_min, L_max
+        )
+        return smooth_posterior_quadrature
+    else:
+        raise NotImplementedError
+
+def get_batch_allocation_function(
+    func_type: str,
+    B: float,
+    randomvars: np.array,
+    C: float = 5.0,
+    L_min: float = 0.2,
+    L_max: float = 0.8,
+    closed_form: bool = False,
+) -> Callable:
+    """
+    Gets the batch version of the allocation function, which takes arrays of
+    means and variances and returns an array of probabilities. Each output is
+    identical to the scalar allocation function, unless closed_form is set,
+    in which case the exact Gaussian expectation replaces the Monte Carlo
+    average over randomvars wherever it exists (B infinite).
+    The smooth_quadrature type computes the same expectation as smooth, using
+    quadrature instead of randomvars (closed form for infinite B).
+    """
+
+    def thompson_sampling(means: np.array, vars: np.array) -> np.array:
+        stds = np.sqrt(vars)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            probs = 1 - special.ndtr((0 - means) / stds)
+        return np.where(stds > 0, probs, np.nan)
+
+    def logistic_function(x: np.array) -> np.array:
+        numerator = L_max - L_min
+        denominator_inverse = special.expit(B * x - np.log(C))
+        return L_min + numerator * denominator_inverse
+
+    def logistic_function_infinity(x: np.array) -> np.array:
+        return np.where(x >= 0, L_max, L_min)
+
+    def monte_carlo(func: Callable) -> Callable:
+        def posterior_sampling(means: np.array, vars: np.array) -> np.array:
+            stds = np.sqrt(vars)
+            probs = np.empty(means.shape)
+            for start in range(0, means.size, BATCH_CHUNK_SIZE):
+                end = start + BATCH_CHUNK_SIZE
+
+                # One row of samples per (mean, variance) pair
+                samples = means[start:end, None] + (randomvars[None, :] * stds[start:end, None])
+                probs[start:end] = np.mean(func(samples), axis=1)
+
+            return probs
+
+        return posterior_sampling
+
+    def smooth_posterior_inf(means: np.array, vars: np.array) -> np.array:
+        # P(mean + std * Z >= 0) = Phi(mean / std)
+        stds = np.sqrt(vars)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            above = special.ndtr(means / stds)
+        return L_min + (L_max - L_min) * above
+
+    def smooth_posterior_quadrature(means: np.array, vars: np.array) -> np.array:
+        expectation = logistic_normal_expectation(means, np.sqrt(vars), B, C)
+        return L_min + (L_max - L_min) * expectation
+
+    def batch(func: Callable) -> Callable:
+        def batch_allocation_function(means: np.array, vars: np.array) -> np.array:
+            means = np.asarray(means, dtype=float)
+            vars = np.asarray(vars, dtype=float)
+            return func(means.ravel(), vars.ravel()).reshape(means.shape)
+
+        return batch_allocation_function
+
+    if func_type == "thompson":
+        return batch(thompson_sampling)
+    elif func_type == "smooth":
+        if np.isinf(B):
+            if closed_form:
+                return batch(smooth_posterior_inf)
+            return batch(monte_carlo(logistic_function_infinity))
+        else:
+            return batch(monte_carlo(logistic_function))
+    elif func_type == "smooth_quadrature":
+        if np.isinf(B):
+            return batch(smooth_posterior_inf)
+        else:
+            return batch(smooth_posterior_quadrature)
     else:
         raise NotImplementedError
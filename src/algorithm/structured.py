@@ -0,0 +1,337 @@
+# src/algorithm/structured.py
+
+# Block-structured linear algebra for the mixed effects model. The prior on the
+# stacked user parameters is theta_i = theta_pop + u_i, with theta_pop shared by
+# all users and u_i i.i.d. N(0, Sigma_u). The posterior therefore never needs a
+# dense (N * d) x (N * d) inverse: everything reduces to per-user d x d blocks
+# and one d x d population block.
+
+# Imports
+from typing import NamedTuple
+
+import numpy as np
+
+import jax.numpy as jnp
+import jax.scipy.linalg as jlinalg
+
+
+def posterior_blocks(
+    A_hat: np.array,
+    B_hat: np.array,
+    prior_mean: np.array,
+    prior_cov: np.array,
+    sigma_u: np.array,
+    noise_var: float,
+    sigma_u_inv: np.array = None,
+) -> dict:
+    """
+    Compute the posterior of the mixed effects model block by block
+    :param A_hat: stacked per-user X_i^T X_i, shape (N, d, d)
+    :param B_hat: stacked per-user X_i^T y_i, shape (N, d)
+    :param prior_mean: prior mean of theta_pop, shape (d,)
+    :param prior_cov: prior covariance of theta_pop, shape (d, d)
+    :param sigma_u: random effects covariance, shape (d, d)
+    :param noise_var: noise variance
+    :param sigma_u_inv: inverse of sigma_u if known from its structure,
+        computed from sigma_u otherwise
+    :return: dictionary with
+        "user_mean": posterior means of theta_i, shape (N, d)
+        "cond_cov": Cov(theta_i | theta_pop), shape (N, d, d)
+        "coupling": G_i such that Cov(theta_i, theta_j) =
+            delta_ij * cond_cov_i + G_i @ theta_pop_cov @ G_j^T, shape (N, d, d)
+        "theta_pop_mean": posterior mean of theta_pop, shape (d, 1)
+        "theta_pop_cov": posterior covariance of theta_pop, shape (d, d)
+    """
+    total_update_users = A_hat.shape[0]
+    m_inv = 1.0 / total_update_users
+    noise_precision = 1.0 / noise_var
+
+    if sigma_u_inv is None:
+        sigma_u_inv = np.linalg.inv(sigma_u)
+    prior_cov_inv = np.linalg.inv(prior_cov)
+
+    # Batched per-user solves, psi_i = noise_var * Sigma_u^-1 + A_i
+    psi = noise_var * sigma_u_inv + A_hat
+    psi_inv = np.linalg.inv(psi)
+
+    # Population-level sufficient statistics (zeta1..zeta4, averaged over users)
+    zeta1 = m_inv * np.sum(B_hat, axis=0)
+    zeta2 = m_inv * np.einsum("nij,njk,nk->i", A_hat, psi_inv, B_hat)
+    zeta3 = m_inv * np.sum(A_hat, axis=0)
+    zeta4 = m_inv * np.einsum("nij,njk,nkl->il", A_hat, psi_inv, A_hat)
+
+    E = m_inv * prior_cov_inv + noise_precision * zeta3 - noise_precision * zeta4
+
+    E_inv = np.linalg.inv(E)
+
+    theta_pop_mean = E_inv @ (
+        m_inv * prior_cov_inv @ prior_mean.reshape(-1, 1)
+        + noise_precision * zeta1.reshape(-1, 1)
+        - noise_precision * zeta2.reshape(-1, 1)
+    )
+    theta_pop_cov = m_inv * E_inv
+
+    # Conditional posterior of each user given theta_pop:
+    # W_i = (Sigma_u^-1 + A_i / noise_var)^-1 = noise_var * psi_i^-1
+    cond_cov = noise_var * psi_inv
+    coupling = cond_cov @ sigma_u_inv
+
+    # E[theta_i] = G_i E[theta_pop] + W_i B_i / noise_var
+    user_mean = np.einsum("nij,j->ni", coupling, theta_pop_mean.flatten())
+    user_mean += np.einsum("nij,nj->ni", psi_inv, B_hat)
+
+    return {
+        "user_mean": user_mean,
+        "cond_cov": cond_cov,
+        "coupling": coupling,
+        "theta_pop_mean": theta_pop_mean,
+        "theta_pop_cov": theta_pop_cov,
+    }
+
+
+def user_cov_blocks(
+    cond_cov: np.array, coupling: np.array, theta_pop_cov: np.array
+) -> np.array:
+    """
+    Per-user posterior covariance blocks Cov(theta_i, theta_i)
+    :return: array of shape (N, d, d)
+    """
+    # Same products, in the same order, as the diagonal blocks of joint_cov
+    return (coupling @ theta_pop_cov) @ coupling.transpose(0, 2, 1) + cond_cov
+
+
+def joint_cov(
+    cond_cov: np.array, coupling: np.array, theta_pop_cov: np.array
+) -> np.array:
+    """
+    Assemble the dense (N * d) x (N * d) joint posterior covariance from its blocks.
+    This is O(N^2 d^2) memory, only use it where the full joint is required.
+    """
+    nusers, size, _ = coupling.shape
+    flat_coupling = coupling.reshape(nusers * size, size)
+    cov = flat_coupling @ theta_pop_cov @ flat_coupling.T
+    for i in range(nusers):
+        cov[i * size : (i + 1) * size, i * size : (i + 1) * size] += cond_cov[i]
+    return cov
+
+
+class BlockPosterior(NamedTuple):
+    """
+    Compact joint posterior of the stacked user parameters, O(N d^2) memory.
+    Only the per-user blocks are stored, any cross-user block follows from the
+    coupling to theta_pop, and the dense joint is only assembled on request.
+    """
+
+    user_mean: np.array
+    user_cov: np.array
+    coupling: np.array
+    theta_pop_cov: np.array
+
+    @property
+    def num_users(self) -> int:
+        return self.user_mean.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the posterior"""
+        return sum(array.nbytes for array in self)
+
+    def user_block(self, user: int) -> np.array:
+        """Posterior covariance Cov(theta_i, theta_i) of a user, shape (d, d)"""
+        return self.user_cov[user]
+
+    def cross_block(self, user: int, other: int) -> np.array:
+        """Posterior covariance Cov(theta_i, theta_j) of two users, shape (d, d)"""
+        if user == other:
+            return self.user_cov[user]
+        return (self.coupling[user] @ self.theta_pop_cov) @ self.coupling[other].T
+
+    def full_cov(self) -> np.array:
+        """
+        Dense (N * d) x (N * d) joint posterior covariance, the same matrix as
+        joint_cov. This is O(N^2 d^2) memory, only use it where the full joint
+        is required, e.g. to export it.
+        """
+        nusers, size, _ = self.coupling.shape
+        flat_coupling = self.coupling.reshape(nusers * size, size)
+        cov = flat_coupling @ self.theta_pop_cov @ flat_coupling.T
+        for i in range(nusers):
+            cov[i * size : (i + 1) * size, i * size : (i + 1) * size] = self.user_cov[i]
+        return cov
+
+
+def block_posterior(blocks: dict) -> BlockPosterior:
+    """
+    Compact posterior of the blocks returned by posterior_blocks, with
+    read-only arrays
+    :param blocks: the posterior blocks
+    :return: the posterior
+    """
+    posterior = BlockPosterior(
+        user_mean=np.asarray(blocks["user_mean"]),
+        user_cov=user_cov_blocks(
+            blocks["cond_cov"], blocks["coupling"], blocks["theta_pop_cov"]
+        ),
+        coupling=np.asarray(blocks["coupling"]),
+        theta_pop_cov=np.asarray(blocks["theta_pop_cov"]),
+    )
+    for array in posterior:
+        array.flags.writeable = False
+    return posterior
+
+
+def lower_triangular(flat_lower_t: jnp.array, size: int) -> jnp.array:
+    """Construct the lower triangular matrix from its flattened entries"""
+    L = jnp.zeros((size, size), dtype=float)
+    return L.at[jnp.tril_indices(size)].set(flat_lower_t)
+
+
+def _cho_inverse(chol: jnp.array) -> jnp.array:
+    """Inverse of (a stack of) PD matrices from their lower Cholesky factors"""
+    identity = jnp.broadcast_to(jnp.identity(chol.shape[-1]), chol.shape)
+    return jlinalg.cho_solve((chol, True), identity)
+
+
+def _cho_logdet(chol: jnp.array) -> jnp.array:
+    """Log determinant of (a stack of) PD matrices from their Cholesky factors"""
+    return 2 * jnp.sum(jnp.log(jnp.abs(jnp.diagonal(chol, axis1=-2, axis2=-1))), axis=-1)
+
+
+def marginal_terms(
+    flat_lower_t: jnp.array,
+    noise_precision: float,
+    A_hat: jnp.array,
+    B_hat: jnp.array,
+    mu_prior: jnp.array,
+    sigma_prior: jnp.array,
+    size: int,
+    user_mask: jnp.array = None,
+) -> dict:
+    """
+    Block-structured pieces of the (negative, doubled) log marginal likelihood.
+
+    Integrating theta_i given theta_pop gives, per user, the precision
+    D_i = Sigma_u^-1 + y A_i and a d x d contribution to the precision of theta_pop.
+    Integrating theta_pop then only needs the d x d matrix S, so one evaluation
+    costs O(N d^3) instead of O((N d)^3).
+    :param flat_lower_t: lower triangular entries of the Cholesky factor of Sigma_u
+    :param noise_precision: noise precision y
+    :param A_hat: stacked per-user X_i^T X_i, shape (N, d, d)
+    :param B_hat: stacked per-user X_i^T y_i, shape (N, d)
+    :param mu_prior: prior mean of theta_pop, shape (d,)
+    :param sigma_prior: prior covariance of theta_pop, shape (d, d)
+    :param size: dimension d of the parameters
+    :param user_mask: optional 0/1 weights of shape (N,), users with weight 0
+        (padding) do not contribute to any of the terms
+    :return: dictionary of the per-user and population terms
+    """
+    # Construct Sigma_u through its Cholesky factor, Sigma_u = L @ L.T
+    L = lower_triangular(flat_lower_t, size)
+    sigma_u_inv = _cho_inverse(L)
+    logdet_sigma_u = _cho_logdet(L)
+
+    return marginal_terms_from_inverse(
+        sigma_u_inv,
+        logdet_sigma_u,
+        noise_precision,
+        A_hat,
+        B_hat,
+        mu_prior,
+        sigma_prior,
+        user_mask,
+    )
+
+
+def marginal_terms_from_inverse(
+    sigma_u_inv: jnp.array,
+    logdet_sigma_u: jnp.array,
+    noise_precision: float,
+    A_hat: jnp.array,
+    B_hat: jnp.array,
+    mu_prior: jnp.array,
+    sigma_prior: jnp.array,
+    user_mask: jnp.array = None,
+) -> dict:
+    """
+    marginal_terms from the inverse and log determinant of Sigma_u, for the
+    structured parameterizations of Sigma_u (see parameterization.py)
+    :param sigma_u_inv: inverse of Sigma_u, shape (d, d)
+    :param logdet_sigma_u: log determinant of Sigma_u
+    :return: dictionary of the per-user and population terms
+    """
+    y = noise_precision
+
+    # Per-user conditional precision D_i and covariance W_i = D_i^-1
+    D = sigma_u_inv + y * A_hat
+    D_chol = jnp.linalg.cholesky(D)
+    W = _cho_inverse(D_chol)
+    logdet_D = _cho_logdet(D_chol)
+
+    # Contributions of each user to the posterior of theta_pop
+    coupling = W @ sigma_u_inv
+    W_B = jnp.einsum("nij,nj->ni", W, B_hat)
+    Q = sigma_u_inv - sigma_u_inv @ coupling
+    r = y * jnp.einsum("ij,nj->ni", sigma_u_inv, W_B)
+    user_logdet = logdet_sigma_u + logdet_D
+    user_quad = (y ** 2) * jnp.einsum("ni,ni->n", B_hat, W_B)
+
+    if user_mask is not None:
+        Q = Q * user_mask[:, None, None]
+        r = r * user_mask[:, None]
+        user_logdet = user_logdet * user_mask
+        user_quad = user_quad * user_mask
+
+    # Posterior precision S and information vector g of theta_pop
+    prior_chol = jnp.linalg.cholesky(sigma_prior)
+    prior_inv = _cho_inverse(prior_chol)
+    S = prior_inv + jnp.sum(Q, axis=0)
+    g = prior_inv @ mu_prior + jnp.sum(r, axis=0)
+    S_chol = jnp.linalg.cholesky(S)
+    theta_pop_cov = _cho_inverse(S_chol)
+    theta_pop_mean = theta_pop_cov @ g
+
+    return {
+        "user_logdet": user_logdet,
+        "user_quad": user_quad,
+        "pop_logdet": _cho_logdet(prior_chol) + _cho_logdet(S_chol),
+        "pop_quad": mu_prior @ prior_inv @ mu_prior - g @ theta_pop_mean,
+        "cond_cov": W,
+        "coupling": coupling,
+        "theta_pop_mean": theta_pop_mean,
+        "theta_pop_cov": theta_pop_cov,
+    }
+
+
+def marginal_objective(
+    terms: dict, noise_precision: float, sum_sq_reward: float, ts: int
+) -> jnp.array:
+    """
+    Negative doubled log marginal likelihood (up to the ts * log(2 pi) constant),
+    the same quantity as equation 171 in the mixed effects model notes
+    """
+    y = noise_precision
+    return (
+        jnp.sum(terms["user_logdet"])
+        - jnp.sum(terms["user_quad"])
+        + y * sum_sq_reward
+        - ts * jnp.log(y)
+        + terms["pop_logdet"]
+        + terms["pop_quad"]
+    )
+
+
+def posterior_summary(
+    terms: dict, noise_precision: float, B_hat: jnp.array
+) -> tuple[jnp.array, jnp.array]:
+    """
+    Posterior means of theta_i and diagonals of Cov(theta_i, theta_i)
+    :return: means of shape (N, d), covariance diagonals of shape (N, d)
+    """
+    W = terms["cond_cov"]
+    coupling = terms["coupling"]
+    mean = jnp.einsum("nij,j->ni", coupling, terms["theta_pop_mean"])
+    mean = mean + noise_precision * jnp.einsum("nij,nj->ni", W, B_hat)
+    var = jnp.diagonal(W, axis1=-2, axis2=-1) + jnp.einsum(
+        "nij,jk,nik->ni", coupling, terms["theta_pop_cov"], coupling
+    )
+    return mean, var
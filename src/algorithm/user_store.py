@@ -0,0 +1,317 @@
+# src/algorithm/user_store.py
+
+# Array-backed history of the users in the study. Every user gets a dense
+# integer index on registration, and their decision points are stored in
+# preallocated arrays of shape (users, decisions, ...), which grow by doubling.
+# Decision points arrive from concurrent request threads, so the registry,
+# the growth of the arrays and the updates of the sufficient statistics are
+# serialized by the lock of the store, which readers also hold while copying.
+
+# Imports
+import threading
+
+import numpy as np
+
+
+class UserHistoryStore:
+    """Per-user decision history and sufficient statistics"""
+
+    def __init__(
+        self,
+        num_decisions: int,
+        num_params: int,
+        state_size: int = 3,
+        capacity: int = 16,
+    ) -> None:
+        """
+        Initialize the store
+        :param num_decisions: expected number of decision points per user
+        :param num_params: length of a design row
+        :param state_size: length of a state
+        :param capacity: initial number of users to allocate for
+        """
+        self.num_params = num_params
+        self.state_size = state_size
+        self.lock = threading.Lock()
+
+        # Registry of user ids to dense indices, and back
+        self.registry = {}
+        self.user_ids = []
+
+        # Number of decision points recorded for each user
+        self.num_decisions = np.zeros(capacity, dtype=int)
+
+        # Decision history
+        self.state = np.zeros((capacity, num_decisions, state_size))
+        self.action = np.zeros((capacity, num_decisions), dtype=np.int8)
+        self.act_prob = np.zeros((capacity, num_decisions))
+        self.reward = np.full((capacity, num_decisions), np.nan)
+        self.design = np.zeros((capacity, num_decisions, num_params))
+
+        # Sufficient statistics of the (design row, next reward) pairs
+        self.A = np.zeros((capacity, num_params, num_params))
+        self.B = np.zeros((capacity, num_params))
+        self.sum_sq_reward = np.zeros(capacity)
+        self.num_timesteps = np.zeros(capacity, dtype=int)
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.registry
+
+    def index(self, user_id: str) -> int:
+        """
+        Dense index of a user
+        :param user_id: user id of the user
+        :return: index of the user, None if the user is not registered
+        """
+        return self.registry.get(user_id)
+
+    def register(self, user_id: str) -> int:
+        """
+        Register a user, if not registered yet
+        :param user_id: user id of the user
+        :return: index of the user
+        """
+        with self.lock:
+            return self._register(user_id)
+
+    def _register(self, user_id: str) -> int:
+        """Register a user, with the lock held"""
+        if user_id in self.registry:
+            return self.registry[user_id]
+
+        index = len(self.user_ids)
+        if index == self.A.shape[0]:
+            self._resize(max(2 * index, 1), self.design.shape[1])
+
+        self.registry[user_id] = index
+        self.user_ids.append(user_id)
+        return index
+
+    def append(
+        self,
+        user_id: str,
+        state: list,
+        action: int,
+        act_prob: float,
+        reward: float,
+        design_row: np.array,
+    ) -> int:
+        """
+        Record a decision point of a user. The reward is the reward for the
+        LAST decision point, so it completes the previous design row.
+        :param user_id: user id of the user
+        :param state: state of the user
+        :param action: action of the user
+        :param act_prob: action probability of the user
+        :param reward: reward of the user for the last decision point
+        :param design_row: design row of this decision point
+        :return: index of the user
+        """
+        with self.lock:
+            return self._append(user_id, state, action, act_prob, reward, design_row)
+
+    def _append(self, user_id, state, action, act_prob, reward, design_row) -> int:
+        """Record a decision point of a user, with the lock held"""
+        index = self._register(user_id)
+        count = self.num_decisions[index]
+        if count == self.design.shape[1]:
+            self._resize(self.A.shape[0], max(2 * count, 1))
+
+        if count > 0:
+            last_design_row = self.design[index, count - 1]
+            self.A[index] += np.outer(last_design_row, last_design_row)
+            self.B[index] += last_design_row * reward
+            self.sum_sq_reward[index] += reward**2
+            self.num_timesteps[index] += 1
+
+        self.state[index, count] = state
+        self.action[index, count] = action
+        self.act_prob[index, count] = act_prob
+        self.reward[index, count] = np.nan if reward is None else reward
+        self.design[index, count] = design_row
+        self.num_decisions[index] = count + 1
+
+        return index
+
+    def load(
+        self,
+        user_id: str,
+        state: np.array,
+        action: np.array,
+        act_prob: np.array,
+        reward: np.array,
+        design: np.array,
+    ) -> int:
+        """
+        Record all the decision points of a new user at once, with the same
+        result as appending them one by one. The sufficient statistics are
+        summed over the decisions in order, like append adds them.
+        :param user_id: user id of the user, without decision points yet
+        :param state: states, shape (T, state_size)
+        :param action: actions, shape (T,)
+        :param act_prob: action probabilities, shape (T,)
+        :param reward: rewards for the LAST decision point, shape (T,), NaN
+            where there is none
+        :param design: design rows, shape (T, num_params)
+        :return: index of the user
+        """
+        with self.lock:
+            return self._load(user_id, state, action, act_prob, reward, design)
+
+    def _load(self, user_id, state, action, act_prob, reward, design) -> int:
+        """Record all the decision points of a new user, with the lock held"""
+        index = self._register(user_id)
+        if self.num_decisions[index] > 0:
+            raise ValueError(f"User {user_id} already has decision points")
+        count = design.shape[0]
+        if count > self.design.shape[1]:
+            self._resize(self.A.shape[0], count)
+
+        self.state[index, :count] = state
+        self.action[index, :count] = action
+        self.act_prob[index, :count] = act_prob
+        self.reward[index, :count] = reward
+        self.design[index, :count] = design
+        self.num_decisions[index] = count
+
+        # The reward of a decision point completes the previous design row.
+        # Sums over the first axis add the terms one after the other.
+        if count > 1:
+            X = design[:-1]
+            y = reward[1:]
+            self.A[index] = np.sum(X[:, :, None] * X[:, None, :], axis=0)
+            self.B[index] = np.sum(X * y[:, None], axis=0)
+            self.sum_sq_reward[index] = np.sum((y**2)[:, None], axis=0)[0]
+            self.num_timesteps[index] = count - 1
+
+        return index
+
+    def reorder(self, user_ids: list) -> None:
+        """
+        Change the dense indices of the users
+        :param user_ids: all the registered user ids, in their new order
+        :return: None
+        """
+        with self.lock:
+            self._reorder(user_ids)
+
+    def _reorder(self, user_ids: list) -> None:
+        """Change the dense indices of the users, with the lock held"""
+        if sorted(user_ids) != sorted(self.user_ids):
+            raise ValueError("The new order must have all the registered users")
+
+        indices = [self.registry[user_id] for user_id in user_ids]
+        for name in [
+            "num_decisions",
+            "state",
+            "action",
+            "act_prob",
+            "reward",
+            "design",
+            "A",
+            "B",
+            "sum_sq_reward",
+            "num_timesteps",
+        ]:
+            array = getattr(self, name)
+            array[: len(indices)] = array[indices]
+
+        self.user_ids = list(user_ids)
+        self.registry = {user_id: index for index, user_id in enumerate(self.user_ids)}
+
+    def history(self, user_id: str) -> dict:
+        """
+        Decision history of a user, as views into the store
+        :param user_id: user id of the user
+        :return: dictionary with the states, actions, action probabilities,
+            rewards (for the last decision point) and design rows
+        """
+        index = self.registry[user_id]
+        count = self.num_decisions[index]
+        return {
+            "state": self.state[index, :count],
+            "action": self.action[index, :count],
+            "act_prob": self.act_prob[index, :count],
+            "reward": self.reward[index, :count],
+            "design_state": self.design[index, :count],
+        }
+
+    def sufficient_statistics(self) -> tuple[np.array, np.array, float, int, list]:
+        """
+        Stacked sufficient statistics of the users with at least one
+        complete (design row, reward) pair, in registration order
+        :return: per-user X_i^T X_i stacked as (N, d, d)
+        :return: per-user X_i^T y_i stacked as (N, d)
+        :return: sum of squared rewards
+        :return: total number of timesteps
+        :return: list of users with data
+        """
+        with self.lock:
+            has_data = self.num_timesteps[: len(self.user_ids)] > 0
+            indices = np.flatnonzero(has_data)
+
+            return (
+                self.A[indices],
+                self.B[indices],
+                float(np.sum(self.sum_sq_reward[indices])),
+                int(np.sum(self.num_timesteps[indices])),
+                [self.user_ids[i] for i in indices],
+            )
+
+    def copy(self, names: list) -> tuple[dict, list]:
+        """
+        Consistent copy of arrays of the store, e.g. for a checkpoint
+        :param names: names of the per-user arrays
+        :return: the arrays of the registered users by name, and their user ids
+        """
+        with self.lock:
+            nusers = len(self.user_ids)
+            return (
+                {name: getattr(self, name)[:nusers].copy() for name in names},
+                list(self.user_ids),
+            )
+
+    def nbytes(self) -> int:
+        """Memory used by the arrays of the store"""
+        return sum(
+            array.nbytes
+            for array in [
+                self.num_decisions,
+                self.state,
+                self.action,
+                self.act_prob,
+                self.reward,
+                self.design,
+                self.A,
+                self.B,
+                self.sum_sq_reward,
+                self.num_timesteps,
+            ]
+        )
+
+    def _resize(self, capacity: int, num_decisions: int) -> None:
+        """
+        Grow the arrays to hold capacity users and num_decisions decisions,
+        with the lock held
+        """
+
+        def grow(array, shape, fill=0):
+            grown = np.full(shape, fill, dtype=array.dtype)
+            grown[tuple(slice(0, n) for n in array.shape)] = array
+            return grown
+
+        old_capacity = self.A.shape[0]
+        self.num_decisions = grow(self.num_decisions, (capacity,))
+        self.state = grow(self.state, (capacity, num_decisions, self.state_size))
+        self.action = grow(self.action, (capacity, num_decisions))
+        self.act_prob = grow(self.act_prob, (capacity, num_decisions))
+        self.reward = grow(self.reward, (capacity, num_decisions), np.nan)
+        self.design = grow(self.design, (capacity, num_decisions, self.num_params))
+        if capacity != old_capacity:
+            self.A = grow(self.A, (capacity, self.num_params, self.num_params))
+            self.B = grow(self.B, (capacity, self.num_params))
+            self.sum_sq_reward = grow(self.sum_sq_reward, (capacity,))
+            self.num_timesteps = grow(self.num_timesteps, (capacity,))
@@ -14,6 +14,7 @@ from src.server.tables import (
 from flask import jsonify, make_response, request
 from flask.views import MethodView
 from src.server.helpers import return_fail_response
+from src.server.dispatch import get_action
 
 import numpy as np
 
@@ -258,7 +259,7 @@ class ActionsAPI(MethodView):
 
                     # Get the action
                     try:
-                        action, seed, act_prob, policy_id = algorithm.get_action(
+                        action, seed, act_prob, policy_id = get_action(
                             user_id=user_id, state=state, decision_time=decision_idx
                         )
 
@@ -0,0 +1,348 @@
+import datetime
+import traceback
+from src.server import app, db
+from src.server.auth.auth import token_required
+from src.server.ActionsAPI import ActionsAPI
+from src.server.tables import (
+    User,
+    UserStatus,
+    UserStudyPhaseEnum,
+    RLActionSelection,
+    UserActionHistory,
+)
+
+
+from flask import jsonify, make_response, request
+from flask.views import MethodView
+from src.server.helpers import return_fail_response
+
+import numpy as np
+
+
+class ActionsBatchAPI(MethodView):
+    """
+    Get actions for a batch of users, e.g. everyone notified at the same time.
+    Each user gets the same result, with the same error codes, as a call to
+    the /actions endpoint, but the database is queried once for all users and
+    all the action history rows are inserted in one transaction.
+    """
+
+    @staticmethod
+    def _get_users_data_for_state(
+        user_ids: list, decision_idxs: list
+    ) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+        """
+        Get the data from database to help generate the states of several users,
+        same as ActionsAPI._get_user_data_for_state for each user
+        :param user_ids: The user ids
+        :param decision_idxs: The decision index of each user
+        :return: The engagement and cannabis use data of each user
+        """
+        engagement_window = app.config["ENGAGEMENT_DATA_WINDOW"]
+        cannabis_use_window = app.config["CANNABIS_USE_DATA_WINDOW"]
+
+        # Get the rows of all users within the largest window of any user
+        earliest_idx = min(decision_idxs) - max(engagement_window, cannabis_use_window)
+        rows = (
+            RLActionSelection.query.filter(
+                RLActionSelection.user_id.in_(user_ids),
+                RLActionSelection.user_decision_idx > earliest_idx,
+            )
+            .with_entities(
+                RLActionSelection.user_id,
+                RLActionSelection.user_decision_idx,
+                RLActionSelection.reward,
+                RLActionSelection.cannabis_use,
+            )
+            .order_by(RLActionSelection.user_id, RLActionSelection.user_decision_idx)
+            .all()
+        )
+
+        user_rows = {user_id: [] for user_id in user_ids}
+        for row in rows:
+            user_rows[row[0]].append(row)
+
+        # Filter each user's rows for their own windows
+        users_data = {}
+        for user_id, decision_idx in zip(user_ids, decision_idxs):
+            engagement_data = [
+                row[2]
+                for row in user_rows[user_id]
+                if row[1] > decision_idx - engagement_window
+            ]
+            cannabis_use_data = [
+                row[3]
+                for row in user_rows[user_id]
+                if row[1] > decision_idx - cannabis_use_window
+            ]
+            users_data[user_id] = (
+                np.array(engagement_data).flatten(),
+                np.array(cannabis_use_data, dtype=object).flatten(),
+            )
+
+        return users_data
+
+    @staticmethod
+    def fail_result(user_id: str, message: str, error_code: int) -> dict:
+        """Result of a user whose action could not be selected"""
+        app.logger.error(message)
+        return {
+            "user_id": user_id,
+            "status": "fail",
+            "message": message,
+            "error_code": error_code,
+        }
+
+    def get_actions(self, payloads: list) -> list:
+        """
+        Select the actions of a batch of users
+        :param payloads: The post data of each user, as for the /actions endpoint
+        :return: The result of each user, in the order of the payloads
+        """
+        results = [None] * len(payloads)
+        user_ids = [
+            payload.get("user_id") if isinstance(payload, dict) else None
+            for payload in payloads
+        ]
+
+        # Check which users exist, with a single query
+        requested = {user_id for user_id in user_ids if isinstance(user_id, str)}
+        existing = {
+            row[0]
+            for row in User.query.filter(User.user_id.in_(requested))
+            .with_entities(User.user_id)
+            .all()
+        }
+
+        pending = []
+        seen = set()
+        for i, (payload, user_id) in enumerate(zip(payloads, user_ids)):
+            if not isinstance(user_id, str) or user_id not in existing:
+                results[i] = self.fail_result(
+                    user_id, f"User {user_id} does not exist.", 203
+                )
+                continue
+
+            # Check all fields are present
+            status, message, ec = ActionsAPI.check_all_fields_present(payload)
+            if not status:
+                results[i] = self.fail_result(user_id, message, ec)
+                continue
+
+            # Only one action per user and decision point
+            if user_id in seen:
+                results[i] = self.fail_result(
+                    user_id, f"Duplicate request for user {user_id}.", 213
+                )
+                continue
+
+            seen.add(user_id)
+            pending.append(i)
+
+        if not pending:
+            return results
+
+        # Get the user statuses, with a single query
+        statuses = {
+            user_status.user_id: user_status
+            for user_status in UserStatus.query.filter(
+                UserStatus.user_id.in_([user_ids[i] for i in pending])
+            ).all()
+        }
+        for i in [i for i in pending if user_ids[i] not in statuses]:
+            app.logger.error(f"No status for user {user_ids[i]}")
+            results[i] = self.fail_result(
+                user_ids[i], "Some error occurred. Please try again.", 207
+            )
+        pending = [i for i in pending if user_ids[i] in statuses]
+        if not pending:
+            return results
+
+        # Get the decision index and time of day
+        decision_idxs = [
+            statuses[user_ids[i]].current_decision_index + 1 for i in pending
+        ]
+        times_of_day = [1 - statuses[user_ids[i]].current_time_of_day for i in pending]
+
+        # Get the algorithm
+        algorithm = app.config.get("ALGORITHM")
+
+        # Make the rewards
+        raw_reward_data = [
+            ActionsAPI.get_raw_reward_data(payloads[i]) for i in pending
+        ]
+        try:
+            rewards = algorithm.make_rewards(raw_reward_data)
+        except Exception as e:
+            app.logger.critical("Failed to compute reward")
+            app.logger.critical(traceback.format_exc())
+            for i in pending:
+                results[i] = self.fail_result(
+                    user_ids[i], "Failed to compute reward", 204
+                )
+            return results
+
+        # Make the states
+        users_data = self._get_users_data_for_state(
+            [user_ids[i] for i in pending], decision_idxs
+        )
+        raw_state_data = []
+        for k, i in enumerate(pending):
+            recent_cannabis_use = payloads[i].get("cannabis_use")
+            if recent_cannabis_use == "NA":
+                recent_cannabis_use = []
+
+            engagement_data, cannabis_use_data = users_data[user_ids[i]]
+            raw_state_data.append(
+                {
+                    "engagement_data": engagement_data,
+                    "cannabis_use_data": cannabis_use_data,
+                    "recent_cannabis_use": recent_cannabis_use,
+                    "time_of_day": times_of_day[k],
+                    "reward": rewards[k].item(),
+                }
+            )
+
+        try:
+            states = algorithm.make_states(raw_state_data)
+        except Exception as e:
+            # Find the users whose state cannot be made, one at a time
+            app.logger.critical("Failed to compute states")
+            app.logger.critical(traceback.format_exc())
+            valid = []
+            for k, i in enumerate(pending):
+                try:
+                    algorithm.make_state(raw_state_data[k])
+                except Exception as e:
+                    app.logger.critical(traceback.format_exc())
+                    results[i] = self.fail_result(
+                        user_ids[i], "Failed to compute state", 205
+                    )
+                else:
+                    valid.append(k)
+
+            pending = [pending[k] for k in valid]
+            decision_idxs = [decision_idxs[k] for k in valid]
+            rewards = rewards[valid]
+            raw_reward_data = [raw_reward_data[k] for k in valid]
+            raw_state_data = [raw_state_data[k] for k in valid]
+            if not pending:
+                return results
+            states = algorithm.make_states(raw_state_data)
+
+        # Get the actions
+        try:
+            actions, seeds, act_probs, policy_id = algorithm.get_actions(
+                [user_ids[i] for i in pending], states, decision_idxs
+            )
+        except Exception as e:
+            app.logger.critical("Failed to compute actions")
+            app.logger.critical(traceback.format_exc())
+            for i in pending:
+                results[i] = self.fail_result(
+                    user_ids[i], "Failed to compute action", 206
+                )
+            return results
+
+        # Insert the action history rows
+        timestamp = datetime.datetime.now()
+        new_useractions = []
+        for k, i in enumerate(pending):
+            new_useractions.append(
+                UserActionHistory(
+                    user_ids[i],
+                    decision_idxs[k],
+                    raw_reward_data[k]["user_finished_ema"],
+                    raw_reward_data[k]["activity_response"],
+                    raw_reward_data[k]["used_app"],
+                    raw_state_data[k]["recent_cannabis_use"],
+                    rewards[k].item(),
+                    states[k].tolist(),
+                    actions[k].item(),
+                    seeds[k].item(),
+                    act_probs[k].item(),
+                    policy_id,
+                    timestamp=timestamp,
+                )
+            )
+
+            # Update the study phase of the user
+            user_status = statuses[user_ids[i]]
+            if user_status.study_phase == UserStudyPhaseEnum.REGISTERED:
+                user_status.study_phase = UserStudyPhaseEnum.STARTED
+            if decision_idxs[k] == app.config.get("STUDY_LENGTH"):
+                user_status.study_phase = UserStudyPhaseEnum.COMPLETED_AWAITING_REVIEW
+
+        db.session.add_all(new_useractions)
+
+        # Flush to get the row ids without reloading every row after the commit
+        db.session.flush()
+        for k, i in enumerate(pending):
+            results[i] = {
+                "user_id": user_ids[i],
+                "status": "success",
+                "rid": new_useractions[k].index,
+                "action": actions[k].item(),
+                "seed": seeds[k].item(),
+                "act_prob": act_probs[k].item(),
+                "policy_id": policy_id,
+                "decision_index": decision_idxs[k],
+                "act_gen_timestamp": timestamp.isoformat(),
+            }
+            app.logger.info(
+                f"Action for user {user_ids[i]} at {decision_idxs[k]} is {actions[k]}"
+            )
+
+        db.session.commit()
+
+        return results
+
+    @token_required
+    def post(self):
+        """
+        Get actions for a batch of users
+        """
+        app.logger.info("Actions batch API called")
+
+        # get the post data
+        post_data = request.get_json()
+
+        payloads = post_data.get("requests") if isinstance(post_data, dict) else None
+        if not isinstance(payloads, list) or len(payloads) == 0:
+            app.logger.error("No list of action requests provided.")
+            return return_fail_response(
+                message="Please provide a list of action requests.",
+                code=202,
+                error_code=211
+            )
+
+        if len(payloads) > app.config.get("ACTIONS_BATCH_MAX_SIZE"):
+            app.logger.error(f"Batch of {len(payloads)} action requests is too large.")
+            return return_fail_response(
+                message="Too many action requests, please split the batch.",
+                code=202,
+                error_code=212
+            )
+
+        app.logger.info(f"Requested actions for {len(payloads)} users")
+
+        try:
+            results = self.get_actions(payloads)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error("Some error occurred while getting actions")
+            app.logger.error(traceback.format_exc())
+            app.logger.error(e)
+            return return_fail_response(
+                message="Some error occurred. Please try again.",
+                code=401,
+                error_code=208
+            )
+
+        # Make the response object
+        responseObject = {
+            "status": "success",
+            "results": results,
+        }
+
+        return make_response(jsonify(responseObject)), 200
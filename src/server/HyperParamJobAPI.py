@@ -0,0 +1,95 @@
+import traceback
+from src.server import app
+from src.server.auth.auth import token_required
+from src.server.tables import RLHyperParamUpdateRequest
+from src.server.helpers import return_fail_response
+from src.server.hyperparam_jobs import ACTIVE_STATUSES, cancel_hyperparameter_job
+
+
+from flask import jsonify, make_response
+from flask.views import MethodView
+
+
+class HyperParamJobAPI(MethodView):
+    """
+    Status and cancellation of a hyperparameter update request
+    """
+
+    @staticmethod
+    def request_status(update_request: RLHyperParamUpdateRequest) -> dict:
+        """Status and progress of an update request"""
+
+        def isoformat(timestamp):
+            return None if timestamp is None else timestamp.isoformat()
+
+        return {
+            "request_id": update_request.id,
+            "request_status": update_request.request_status,
+            "request_message": update_request.request_message,
+            "request_error_code": update_request.request_error_code,
+            "time_budget": update_request.time_budget,
+            "iterations": update_request.iterations,
+            "objective": update_request.objective,
+            "request_timestamp": isoformat(update_request.request_timestamp),
+            "started_timestamp": isoformat(update_request.started_timestamp),
+            "progress_timestamp": isoformat(update_request.progress_timestamp),
+            "completed_timestamp": isoformat(update_request.completed_timestamp),
+        }
+
+    @token_required
+    def get(self, request_id: int):
+        """
+        Get the status of a hyperparameter update request
+        """
+        update_request = RLHyperParamUpdateRequest.query.filter_by(id=request_id).first()
+        if update_request is None:
+            app.logger.error(f"Hyperparameter update request {request_id} does not exist.")
+            return return_fail_response(
+                f"Hyperparameter update request {request_id} does not exist.", 202, 410
+            )
+
+        responseObject = {
+            "status": "success",
+            **self.request_status(update_request),
+        }
+
+        return make_response(jsonify(responseObject)), 200
+
+    @token_required
+    def post(self, request_id: int):
+        """
+        Cancel a hyperparameter update request
+        """
+        update_request = RLHyperParamUpdateRequest.query.filter_by(id=request_id).first()
+        if update_request is None:
+            app.logger.error(f"Hyperparameter update request {request_id} does not exist.")
+            return return_fail_response(
+                f"Hyperparameter update request {request_id} does not exist.", 202, 410
+            )
+
+        try:
+            cancelled = (
+                update_request.request_status in ACTIVE_STATUSES
+                and cancel_hyperparameter_job(request_id)
+            )
+        except Exception as e:
+            app.logger.error("Error cancelling hyperparameter job: %s", e)
+            app.logger.error(traceback.format_exc())
+            return return_fail_response("Some error occurred. Please try again.", 500, 402)
+
+        if not cancelled:
+            app.logger.error(f"Hyperparameter update request {request_id} has finished.")
+            return return_fail_response(
+                f"Hyperparameter update request {request_id} has already finished.", 202, 411
+            )
+
+        app.logger.info("Cancellation of hyperparameter job %s requested", request_id)
+
+        # The request is marked cancelled once the worker has stopped
+        responseObject = {
+            "status": "success",
+            "message": "Cancellation requested",
+            "request_id": request_id,
+        }
+
+        return make_response(jsonify(responseObject)), 202
@@ -0,0 +1,23 @@
+from src.server.auth.auth import token_required
+from src.server.dispatch import get_dispatcher
+
+
+from flask import jsonify, make_response
+from flask.views import MethodView
+
+
+class MetricsAPI(MethodView):
+    """
+    Performance metrics of the RL service
+    """
+
+    @token_required
+    def get(self):
+        dispatcher = get_dispatcher()
+
+        responseObject = {
+            "status": "success",
+            "action_dispatcher": None if dispatcher is None else dispatcher.metrics(),
+        }
+
+        return make_response(jsonify(responseObject)), 200
@@ -0,0 +1,24 @@
+from src.server.helpers import return_fail_response
+from src.server.warmup import ready, warmup_info
+
+
+from flask import jsonify, make_response
+from flask.views import MethodView
+
+
+class ReadinessAPI(MethodView):
+    """
+    Readiness of the RL service, i.e. whether the algorithm warm-up is done
+    """
+
+    def get(self):
+        if not ready.is_set():
+            return return_fail_response("Algorithm warm-up in progress", 503, 601)
+
+        responseObject = {
+            "status": "success",
+            "message": "Ready",
+            "warmup_times": {str(key): value for key, value in warmup_info.items()},
+        }
+
+        return make_response(jsonify(responseObject)), 200
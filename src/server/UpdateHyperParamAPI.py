@@ -1,76 +1,23 @@
 import datetime
 import os
 
-import pandas as pd
 from src.server import db, app
 from src.server.auth.auth import token_required
-from src.server.tables import RLActionSelection, RLHyperParamUpdateRequest
+from src.server.tables import RLHyperParamUpdateRequest
 from src.server.helpers import return_fail_response
+from src.server.hyperparam_jobs import (
+    REQUEST_FAILED,
+    REQUEST_PENDING,
+    start_hyperparameter_job,
+)
 
 
 from flask import jsonify, make_response, request
 from flask.views import MethodView
 
-import threading
-import time
-
 import traceback
 import csv
 
-# @shared_task(ignore_result=False)
-def update_hyperparam_task(id):
-    """Background task for updating hyper-parameters"""
-
-    try:
-
-        with app.app_context():
-            # Get all the data from the RLActionSelection table
-            rl_action_selection = db.session.query(RLActionSelection)
-
-            # Convert to pandas dataframe
-            data = pd.read_sql(
-                str(rl_action_selection.statement), db.engine.connect().connection
-            )
-
-            # Get the algorithm
-            algorithm = app.config.get("ALGORITHM")
-
-            status, message, _, _, ec, _, _ = algorithm.update(data,
-                                                    update_posterior=False,
-                                                    update_hyperparam=True,
-                                                    use_data=False,
-                                                    request_id=id)
-        
-            if not status:
-                app.logger.error("Error updating hyper-parameters: %s", message)
-                app.logger.error(traceback.format_exc())
-
-                # Update the request status to failed
-                request = RLHyperParamUpdateRequest.query.filter_by(id=id).first()
-                request.request_status = "Failed"
-                request.request_message = message
-                request.request_error_code = ec
-                request.completed_timestamp = datetime.datetime.now()
-                db.session.commit()
-            else:
-                app.logger.info("Updated hyper-parameters")
-
-                # Update the request status to completed
-                request = RLHyperParamUpdateRequest.query.filter_by(id=id).first()
-                request.request_status = "Completed"
-                request.completed_timestamp = datetime.datetime.now()
-                db.session.commit()
-
-
-    except Exception as e:
-        app.logger.error("Error updating hyper-parameters: %s", e)
-        app.logger.error(traceback.format_exc())
-        if app.config.get("DEBUG"):
-            print(e)
-            traceback.print_exc()
-    
-
-
 class UpdateHyperParamAPI(MethodView):
     """
     Update model weights of the RL algorithm
@@ -129,6 +76,17 @@ class UpdateHyperParamAPI(MethodView):
             if app.config.get("DEBUG"):
                 print("Update model request received at: ", timenow)
 
+            # Wall-clock budget of the fit, in seconds
+            post_data = request.get_json(silent=True) or {}
+            time_budget = post_data.get("time_budget", app.config.get("HYPERPARAM_TIME_BUDGET"))
+            if (
+                isinstance(time_budget, bool)
+                or not isinstance(time_budget, (int, float))
+                or not time_budget > 0
+            ):
+                app.logger.error("Invalid time budget: %s", time_budget)
+                return return_fail_response("Please provide a positive time budget.", 202, 412)
+
             # First backup all the tables
             status, message, location, ec = self.backup_all_tables(timenow)
 
@@ -142,10 +100,11 @@ class UpdateHyperParamAPI(MethodView):
             # Create a new entry in the RLHyperParamUpdateRequest table
             new_request = RLHyperParamUpdateRequest(backup_location=location, 
                                                     request_timestamp=timenow,
-                                                    request_status="Pending",
+                                                    request_status=REQUEST_PENDING,
                                                     request_message=None,
                                                     request_error_code=None,
-                                                    completed_timestamp=None)
+                                                    completed_timestamp=None,
+                                                    time_budget=float(time_budget))
 
             try:
                 db.session.add(new_request)
@@ -160,22 +119,24 @@ class UpdateHyperParamAPI(MethodView):
             
             request_id = new_request.id
 
-            # Send the data to the rl algorithm update
-            # task_result = update_hyperparam_task.delay()
-            bg_task = threading.Thread(target=update_hyperparam_task, args=(request_id,))
-            bg_task.daemon = True
-            bg_task.start()
-            
-            # task_result = update_hyperparam_task()
-
-            # if app.config.get("DEBUG"):
-            #     print("Scheduled update of hyperparameters: %s", task_result.id)
-            # app.logger.info("Scheduled update of hyperparameters: %s", task_result.id)
+            # Fit the hyperparameters in the worker process, on a copy of the
+            # current sufficient statistics
+            try:
+                start_hyperparameter_job(request_id, float(time_budget))
+            except Exception as e:
+                app.logger.error("Error starting hyperparameter job: %s", e)
+                app.logger.error(traceback.format_exc())
+                new_request.request_status = REQUEST_FAILED
+                new_request.request_message = "Error while updating hyperparameters"
+                new_request.request_error_code = 403
+                new_request.completed_timestamp = datetime.datetime.now()
+                db.session.commit()
+                return return_fail_response("Some error occurred. Please try again.", 500, 402)
 
             responseObject = {
                 "status": "success",
                 "message": "Scheduled update of hyperparameters",
-                # "taskid": task_result.id,
+                "request_id": request_id,
             }
 
             return make_response(jsonify(responseObject)), 201
@@ -6,6 +6,7 @@ from src.server import db, app
 from src.server.auth.auth import token_required
 from src.server.tables import RLActionSelection, RLWeights
 from src.server.helpers import return_fail_response
+from src.server.checkpoints import save_algorithm_checkpoint
 
 
 from flask import jsonify, make_response, request
@@ -121,6 +122,8 @@ class UpdatePosteriorAPI(MethodView):
                 data_pickle_file_path=location,
                 user_list=user_list,
                 hp_update_id=hp_update_id,
+                artifact_path=params.get("artifact_path"),
+                artifact_sha256=params.get("artifact_sha256"),
             )
 
             # Add the rl_weights object to the database
@@ -142,6 +145,9 @@ class UpdatePosteriorAPI(MethodView):
                     print("DB Committed new rl_weights")
                 app.logger.info("DB Committed new rl_weights")
 
+                # The restart point of the algorithm
+                save_algorithm_checkpoint()
+
                 responseObject = {
                     "status": "success",
                     "message": "Successfully updated parameters/posteriors.",
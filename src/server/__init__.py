@@ -34,4 +34,18 @@ from src.server.main import rlservice_blueprint
 
 app.register_blueprint(rlservice_blueprint)
 
+from src.server.checkpoints import restore_algorithm_checkpoint, save_algorithm_checkpoint
+from src.server.rebuild import rebuild_algorithm
+
+if not restore_algorithm_checkpoint() and rebuild_algorithm():
+    save_algorithm_checkpoint()
+
+from src.server.warmup import start_warm_up
+
+start_warm_up()
+
+from src.server.hyperparam_jobs import fail_interrupted_jobs
+
+fail_interrupted_jobs()
+
 app.logger.info("Server started")
\ No newline at end of file
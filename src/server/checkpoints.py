@@ -0,0 +1,106 @@
+# src/server/checkpoints.py
+
+# Checkpoints of the learned state of the algorithm, so a server restart does
+# not reset it to the prior. A checkpoint is written after every posterior
+# update and every staged hyperparameter update, and restored at start if it
+# was saved by the same code version, has the latest policy id of the
+# RLWeights table and every decision point of the rl_action_selection table.
+# Decision points recorded since the last update are not in the checkpoint, so
+# the algorithm is then rebuilt from the database instead, see rebuild.py.
+
+# Imports
+import datetime
+import time
+import traceback
+
+import sqlalchemy
+
+from src.server import app, db
+from src.server.tables import RLActionSelection, RLWeights
+from src.algorithm import checkpoint
+
+
+def save_algorithm_checkpoint() -> None:
+    """Write the checkpoint of the algorithm, errors are only logged"""
+
+    path = app.config.get("CHECKPOINT_PATH")
+    if not path:
+        return
+
+    start = time.time()
+    try:
+        algorithm = app.config.get("ALGORITHM")
+        checkpoint.save_checkpoint(
+            algorithm,
+            path,
+            {
+                "code_version": app.config.get("CODE_VERSION"),
+                "saved_timestamp": datetime.datetime.now().isoformat(),
+            },
+        )
+        app.logger.info(
+            "Saved the algorithm checkpoint of policy %s in %.3fs",
+            algorithm.policyid,
+            time.time() - start,
+        )
+    except Exception as e:
+        app.logger.error("Error saving the algorithm checkpoint: %s", e)
+        app.logger.error(traceback.format_exc())
+
+
+def latest_policy_id() -> int:
+    """Latest policy id of the RLWeights table, 0 if there is none"""
+    if not sqlalchemy.inspect(db.engine).has_table(RLWeights.__tablename__):
+        return 0
+    policy_id = db.session.query(sqlalchemy.func.max(RLWeights.policy_id)).scalar()
+    return 0 if policy_id is None else policy_id
+
+
+def recorded_decisions() -> dict:
+    """Number of decision points of each user in the rl_action_selection table"""
+    if not sqlalchemy.inspect(db.engine).has_table(RLActionSelection.__tablename__):
+        return {}
+    return dict(
+        db.session.query(RLActionSelection.user_id, sqlalchemy.func.count())
+        .group_by(RLActionSelection.user_id)
+        .all()
+    )
+
+
+def restore_algorithm_checkpoint() -> bool:
+    """
+    Restore the algorithm from its checkpoint, if enabled and valid
+    :return: True if the algorithm was restored, False otherwise
+    """
+
+    path = app.config.get("CHECKPOINT_PATH")
+    if not app.config.get("ALGORITHM_RESTORE") or not path:
+        return False
+
+    start = time.time()
+    with app.app_context():
+        try:
+            algorithm = app.config.get("ALGORITHM")
+            metadata = checkpoint.restore_checkpoint(
+                algorithm,
+                path,
+                code_version=app.config.get("CODE_VERSION"),
+                policy_id=latest_policy_id(),
+                num_decisions=recorded_decisions(),
+            )
+        except FileNotFoundError:
+            app.logger.info("No algorithm checkpoint at %s, starting from the prior", path)
+            return False
+        except Exception as e:
+            app.logger.error("Algorithm checkpoint not restored: %s", e)
+            app.logger.error(traceback.format_exc())
+            return False
+
+    app.logger.info(
+        "Restored the algorithm checkpoint of policy %s (%s users, saved at %s) in %.3fs",
+        metadata["policy_id"],
+        len(metadata["user_ids"]),
+        metadata.get("saved_timestamp"),
+        time.time() - start,
+    )
+    return True
@@ -26,6 +26,31 @@ study_length = config["ALGORITHM"]["STUDY_LENGTH"]
 engagement_backlog = config["ALGORITHM"]["ENGAGEMENT_DATA_WINDOW"]
 cannabis_use_backlog = config["ALGORITHM"]["CANNABIS_USE_DATA_WINDOW"]
 seed = config["ALGORITHM"]["SEED"]
+rng_scheme = config["ALGORITHM"].get("RNG_SCHEME", "counter")
+warmup_max_users = config["ALGORITHM"].get("WARMUP_MAX_USERS", "128")
+action_dispatcher = config["ALGORITHM"].getboolean("ACTION_DISPATCHER", fallback=False)
+action_dispatch_window_ms = config["ALGORITHM"].get("ACTION_DISPATCH_WINDOW_MS", "3")
+action_dispatch_max_batch = config["ALGORITHM"].get("ACTION_DISPATCH_MAX_BATCH", "64")
+hyperparam_time_budget = config["ALGORITHM"].get("HYPERPARAM_TIME_BUDGET", "3600")
+hyperparam_progress_iters = config["ALGORITHM"].get("HYPERPARAM_PROGRESS_ITERS", "25")
+hyperparam_multi_start = config["ALGORITHM"].getboolean("HYPERPARAM_MULTI_START", fallback=False)
+hyperparam_jittered_starts = config["ALGORITHM"].get("HYPERPARAM_JITTERED_STARTS", "2")
+hyperparam_optimizer = config["ALGORITHM"].get("HYPERPARAM_OPTIMIZER", "gd")
+hyperparam_estimator = config["ALGORITHM"].get("HYPERPARAM_ESTIMATOR", "marginal")
+hyperparam_em_tolerance = config["ALGORITHM"].get("HYPERPARAM_EM_TOLERANCE", "1e-4")
+sigma_u_parameterization = config["ALGORITHM"].get("SIGMA_U_PARAMETERIZATION", "full")
+sigma_u_rank = config["ALGORITHM"].get("SIGMA_U_RANK", "2")
+hyperparam_backend = config["ALGORITHM"].get("HYPERPARAM_BACKEND", "auto")
+posterior_backend = config["ALGORITHM"].get("POSTERIOR_BACKEND", "numpy")
+cost_model_path = config["ALGORITHM"].get("COST_MODEL_PATH", "./data/cost_model.json")
+history_dir = config["ALGORITHM"].get("HISTORY_DIR", "./data/policy_history")
+history_in_memory = config["ALGORITHM"].get("HISTORY_IN_MEMORY", 4)
+policy_artifact_dir = config["ALGORITHM"].get("POLICY_ARTIFACT_DIR", "./data/policies")
+policy_artifact_dtype = config["ALGORITHM"].get("POLICY_ARTIFACT_DTYPE", "float64")
+checkpoint_path = config["ALGORITHM"].get("CHECKPOINT_PATH", "./data/algorithm_checkpoint.rlstate")
+restore_checkpoint = config["ALGORITHM"].getboolean("RESTORE_CHECKPOINT", fallback=True)
+rebuild_on_start = config["ALGORITHM"].getboolean("REBUILD_ON_START", fallback=True)
+rebuild_chunk_size = config["ALGORITHM"].get("REBUILD_CHUNK_SIZE", 10000)
 
 baseline_prior_mean = np.array(json.loads(config["PRIOR"]["BASELINE_PRIOR_MEAN"]))
 baseline_prior_var = np.diag(json.loads(config["PRIOR"]["BASELINE_PRIOR_VAR"]))
@@ -42,11 +67,23 @@ LOGISTIC_SIGMA = config["ALLOCATION_FUNCTION"]["LOGISTIC_SIGMA"]
 
 B = float(LOGISTIC_B) / float(LOGISTIC_SIGMA)
 
-# Load the random variables
+ALLOCATION_FUNCTION_TYPE = config["ALLOCATION_FUNCTION"].get("FUNC_TYPE", "smooth")
+
+# Load the random variables, only the Monte Carlo allocation function needs them
 random_vars_path = config["ALLOCATION_FUNCTION"]["RANDOM_VARS_PATH"]
-random_vars = smooth_allocation.load_random_vars(random_vars_path)
+random_vars = None
+if ALLOCATION_FUNCTION_TYPE == "smooth":
+    random_vars = smooth_allocation.load_random_vars(random_vars_path)
 allocation_function = smooth_allocation.get_allocation_function(
-    func_type="smooth",
+    func_type=ALLOCATION_FUNCTION_TYPE,
+    B=float(B),
+    randomvars=random_vars,
+    C=float(LOGISTIC_C),
+    L_min=float(L_MIN),
+    L_max=float(L_MAX),
+)
+batch_allocation_function = smooth_allocation.get_batch_allocation_function(
+    func_type=ALLOCATION_FUNCTION_TYPE,
     B=float(B),
     randomvars=random_vars,
     C=float(LOGISTIC_C),
@@ -97,8 +134,24 @@ class BaseConfig:
     STUDY_LENGTH = int(study_length)
     ENGAGEMENT_DATA_WINDOW = int(engagement_backlog)
     CANNABIS_USE_DATA_WINDOW = int(cannabis_use_backlog)
+    ACTIONS_BATCH_MAX_SIZE = 1000
+    ACTION_DISPATCHER = action_dispatcher
+    ACTION_DISPATCH_WINDOW_MS = float(action_dispatch_window_ms)
+    ACTION_DISPATCH_MAX_BATCH = int(action_dispatch_max_batch)
+    HYPERPARAM_TIME_BUDGET = float(hyperparam_time_budget)
+    HYPERPARAM_PROGRESS_ITERS = int(hyperparam_progress_iters)
     STUDY_INDEX = 0
     HEADERS = headers
+    ALGORITHM_WARMUP = True
+    WARMUP_MAX_USERS = int(warmup_max_users)
+    JAX_CACHE_DIR = "./data/jax_cache"
+    COST_MODEL_PATH = cost_model_path
+    POLICY_ARTIFACT_DIR = policy_artifact_dir
+    POLICY_ARTIFACT_DTYPE = policy_artifact_dtype
+    CHECKPOINT_PATH = checkpoint_path
+    ALGORITHM_RESTORE = restore_checkpoint
+    ALGORITHM_REBUILD = rebuild_on_start
+    REBUILD_CHUNK_SIZE = int(rebuild_chunk_size)
 
 
 class DevelopmentConfig(BaseConfig):
@@ -115,7 +168,24 @@ class DevelopmentConfig(BaseConfig):
         init_cov_u=INIT_SIGMA_U,
         init_noise_var=init_noise_var,
         alloc_func=allocation_function,
+        batch_alloc_func=batch_allocation_function,
         rng=np.random.default_rng(int(seed)),
+        rng_scheme=rng_scheme,
+        study_seed=int(seed),
+        multi_start=hyperparam_multi_start,
+        num_jittered_starts=int(hyperparam_jittered_starts),
+        hyperparam_optimizer=hyperparam_optimizer,
+        hyperparam_estimator=hyperparam_estimator,
+        em_tolerance=float(hyperparam_em_tolerance),
+        sigma_u_parameterization=sigma_u_parameterization,
+        sigma_u_rank=int(sigma_u_rank),
+        hyperparam_backend=hyperparam_backend,
+        posterior_backend=posterior_backend,
+        cost_model_path=cost_model_path,
+        history_dir=history_dir,
+        history_in_memory=int(history_in_memory),
+        policy_artifact_dir=policy_artifact_dir,
+        policy_artifact_dtype=policy_artifact_dtype,
         debug=True,
         logger_path="./data/logs",
     )
@@ -130,6 +200,11 @@ class TestingConfig(BaseConfig):
     PRESERVE_CONTEXT_ON_EXCEPTION = False
 
     EMA_API = "http://localhost:4000/ema_study"
+    ALGORITHM_WARMUP = False
+    ALGORITHM_RESTORE = False
+    ALGORITHM_REBUILD = False
+    CHECKPOINT_PATH = None
+    POLICY_ARTIFACT_DIR = None
 
     
     ALGORITHM = mixed_effects.MixedEffectsAlgorithm(
@@ -139,7 +214,24 @@ class TestingConfig(BaseConfig):
         init_cov_u=INIT_SIGMA_U,
         init_noise_var=init_noise_var,
         alloc_func=allocation_function,
+        batch_alloc_func=batch_allocation_function,
         rng=np.random.default_rng(0),
+        rng_scheme=rng_scheme,
+        study_seed=0,
+        multi_start=hyperparam_multi_start,
+        num_jittered_starts=int(hyperparam_jittered_starts),
+        hyperparam_optimizer=hyperparam_optimizer,
+        hyperparam_estimator=hyperparam_estimator,
+        em_tolerance=float(hyperparam_em_tolerance),
+        sigma_u_parameterization=sigma_u_parameterization,
+        sigma_u_rank=int(sigma_u_rank),
+        hyperparam_backend=hyperparam_backend,
+        posterior_backend=posterior_backend,
+        cost_model_path=cost_model_path,
+        history_dir=None,
+        history_in_memory=int(history_in_memory),
+        policy_artifact_dir=None,
+        policy_artifact_dtype=policy_artifact_dtype,
         debug=True,
         logger_path="./data/logs",
     )
@@ -160,7 +252,24 @@ class ProductionConfig(BaseConfig):
         init_cov_u=INIT_SIGMA_U,
         init_noise_var=init_noise_var,
         alloc_func=allocation_function,
+        batch_alloc_func=batch_allocation_function,
         rng=np.random.default_rng(int(seed)),
+        rng_scheme=rng_scheme,
+        study_seed=int(seed),
+        multi_start=hyperparam_multi_start,
+        num_jittered_starts=int(hyperparam_jittered_starts),
+        hyperparam_optimizer=hyperparam_optimizer,
+        hyperparam_estimator=hyperparam_estimator,
+        em_tolerance=float(hyperparam_em_tolerance),
+        sigma_u_parameterization=sigma_u_parameterization,
+        sigma_u_rank=int(sigma_u_rank),
+        hyperparam_backend=hyperparam_backend,
+        posterior_backend=posterior_backend,
+        cost_model_path=cost_model_path,
+        history_dir=history_dir,
+        history_in_memory=int(history_in_memory),
+        policy_artifact_dir=policy_artifact_dir,
+        policy_artifact_dtype=policy_artifact_dtype,
         debug=True,
         logger_path="./data/logs",
     )
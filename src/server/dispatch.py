@@ -0,0 +1,56 @@
+# src/server/dispatch.py
+
+# Optional micro-batching of the /actions requests. When enabled, concurrent
+# requests are collected by an ActionDispatcher in front of the algorithm, and
+# their actions are selected together.
+
+# Imports
+import threading
+
+from src.server import app
+from src.algorithm.dispatcher import ActionDispatcher
+
+# Dispatcher of the current algorithm, created on first use
+_dispatcher = None
+_lock = threading.Lock()
+
+
+def get_dispatcher() -> ActionDispatcher:
+    """
+    Dispatcher in front of the configured algorithm
+    :return: the dispatcher, None if batching is disabled or the algorithm
+        cannot select actions in batches
+    """
+    global _dispatcher
+
+    algorithm = app.config.get("ALGORITHM")
+    if not app.config.get("ACTION_DISPATCHER") or not hasattr(algorithm, "get_actions"):
+        return None
+
+    with _lock:
+        if _dispatcher is None or _dispatcher.algorithm is not algorithm:
+            app.logger.info("Starting the action dispatcher")
+            _dispatcher = ActionDispatcher(
+                algorithm,
+                window_ms=app.config.get("ACTION_DISPATCH_WINDOW_MS"),
+                max_batch_size=app.config.get("ACTION_DISPATCH_MAX_BATCH"),
+            )
+
+    return _dispatcher
+
+
+def get_action(user_id: str, state: list, decision_time: int) -> tuple[int, int, float, int]:
+    """
+    Get action from the algorithm, through the dispatcher if enabled
+    :param user_id: user id of the user
+    :param state: state of the user
+    :param decision_time: decision time of the user for which action is to be taken
+    :return: action, seed, probability of taking action, and policy id
+    """
+    dispatcher = get_dispatcher()
+    if dispatcher is None:
+        return app.config.get("ALGORITHM").get_action(
+            user_id=user_id, state=state, decision_time=decision_time
+        )
+
+    return dispatcher.get_action(user_id, state, decision_time)
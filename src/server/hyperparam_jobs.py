@@ -0,0 +1,164 @@
+# src/server/hyperparam_jobs.py
+
+# Hyperparameter update requests run as jobs of a HyperparameterJobRunner, in
+# a worker process. The progress of each job is written to its row of the
+# RLHyperParamUpdateRequest table, and the fitted hyperparameters are staged
+# on the algorithm for the next posterior update.
+
+# Imports
+import datetime
+import threading
+import traceback
+
+import sqlalchemy
+
+from src.server import app, db
+from src.server.tables import RLHyperParamUpdateRequest
+from src.server.checkpoints import save_algorithm_checkpoint
+from src.algorithm import optimizer
+from src.algorithm.job_runner import (
+    FIT_CANCELLED,
+    FIT_TIMED_OUT,
+    HyperparameterJobRunner,
+)
+
+# Statuses of the update requests
+REQUEST_PENDING = "Pending"
+REQUEST_RUNNING = "Running"
+REQUEST_COMPLETED = "Completed"
+REQUEST_FAILED = "Failed"
+REQUEST_CANCELLED = "Cancelled"
+
+# Statuses of the requests which have not finished
+ACTIVE_STATUSES = [REQUEST_PENDING, REQUEST_RUNNING]
+
+# Runner of the current process, created on first use
+_runner = None
+_lock = threading.Lock()
+
+
+def get_job_runner() -> HyperparameterJobRunner:
+    """Job runner of the server"""
+    global _runner
+
+    with _lock:
+        if _runner is None:
+            app.logger.info("Starting the hyperparameter job runner")
+            _runner = HyperparameterJobRunner(
+                on_progress=record_progress,
+                on_done=record_result,
+                chunk_iters=app.config.get("HYPERPARAM_PROGRESS_ITERS"),
+                cache_dir=app.config.get("JAX_CACHE_DIR"),
+            )
+
+    return _runner
+
+
+def start_hyperparameter_job(request_id: int, time_budget: float) -> None:
+    """
+    Fit the hyperparameters of an update request in the worker process, on a
+    copy of the current sufficient statistics
+    :param request_id: id of the RLHyperParamUpdateRequest row
+    :param time_budget: wall-clock seconds the fit may run for
+    """
+    algorithm = app.config.get("ALGORITHM")
+    problem = algorithm.hyperparameter_problem()
+    get_job_runner().submit(request_id, problem, time_budget)
+    app.logger.info("Queued hyperparameter job %s", request_id)
+
+
+def cancel_hyperparameter_job(request_id: int) -> bool:
+    """
+    Cancel the job of an update request
+    :param request_id: id of the RLHyperParamUpdateRequest row
+    :return: False if the job is not queued or running
+    """
+    return get_job_runner().cancel(request_id)
+
+
+def record_progress(request_id: int, iteration: int, objective: float) -> None:
+    """Write the progress of a job to its request"""
+    with app.app_context():
+        try:
+            request = RLHyperParamUpdateRequest.query.filter_by(id=request_id).first()
+            if request.request_status not in ACTIVE_STATUSES:
+                # Reported after the job finished
+                return
+
+            now = datetime.datetime.now()
+            if request.request_status == REQUEST_PENDING:
+                request.request_status = REQUEST_RUNNING
+                request.started_timestamp = now
+            request.iterations = iteration
+            request.objective = objective
+            request.progress_timestamp = now
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error("Error recording hyperparameter job progress: %s", e)
+            app.logger.error(traceback.format_exc())
+
+
+def record_result(
+    request_id: int, fit: optimizer.HyperparameterFit, error: Exception
+) -> None:
+    """Stage the hyperparameters of a completed job, and finish its request"""
+    with app.app_context():
+        try:
+            status, message, ec = REQUEST_COMPLETED, None, None
+            if error is not None:
+                app.logger.error("Error updating hyperparameters: %s", error)
+                status, message, ec = REQUEST_FAILED, "Error while updating hyperparameters", 403
+            elif fit.status == FIT_CANCELLED:
+                status, message = REQUEST_CANCELLED, "Cancelled"
+            elif fit.status == FIT_TIMED_OUT:
+                status, message, ec = REQUEST_FAILED, "Time budget exceeded", 407
+            elif fit.status == optimizer.FIT_INVALID:
+                status, message, ec = REQUEST_FAILED, "Initial Objective is not valid after reset", 408
+            else:
+                algorithm = app.config.get("ALGORITHM")
+                algorithm.stage_hyperparameters(fit, request_id)
+                app.logger.info("Updated hyperparameters")
+                save_algorithm_checkpoint()
+
+            request = RLHyperParamUpdateRequest.query.filter_by(id=request_id).first()
+            request.request_status = status
+            request.request_message = message
+            request.request_error_code = ec
+            if fit is not None and fit.ltu_flat is not None:
+                request.iterations = fit.iterations
+                request.objective = fit.objective
+            request.completed_timestamp = datetime.datetime.now()
+            db.session.commit()
+            app.logger.info("Hyperparameter job %s finished: %s", request_id, status)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error("Error finishing hyperparameter job: %s", e)
+            app.logger.error(traceback.format_exc())
+
+
+def fail_interrupted_jobs() -> None:
+    """
+    Mark the requests left unfinished by a previous server process as failed,
+    their jobs died with it
+    """
+    with app.app_context():
+        try:
+            table = RLHyperParamUpdateRequest.__tablename__
+            if not sqlalchemy.inspect(db.engine).has_table(table):
+                return
+
+            requests = RLHyperParamUpdateRequest.query.filter(
+                RLHyperParamUpdateRequest.request_status.in_(ACTIVE_STATUSES)
+            ).all()
+            for request in requests:
+                app.logger.error("Hyperparameter job %s was interrupted", request.id)
+                request.request_status = REQUEST_FAILED
+                request.request_message = "Interrupted by a server restart"
+                request.request_error_code = 409
+                request.completed_timestamp = datetime.datetime.now()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error("Error checking for interrupted hyperparameter jobs: %s", e)
+            app.logger.error(traceback.format_exc())
@@ -3,10 +3,14 @@
 # Server code that hosts the main RL API
 
 from src.server.ActionsAPI import ActionsAPI
+from src.server.ActionsBatchAPI import ActionsBatchAPI
 from src.server.DecisionTimeEndAPI import DecisionTimeEndAPI
 from src.server.RegisterAPI import RegisterAPI
 from src.server.UpdatePosteriorAPI import UpdatePosteriorAPI
 from src.server.UpdateHyperParamAPI import UpdateHyperParamAPI
+from src.server.HyperParamJobAPI import HyperParamJobAPI
+from src.server.ReadinessAPI import ReadinessAPI
+from src.server.MetricsAPI import MetricsAPI
 # from src.server.UpdateNotificationTimeAPI import UpdateNotificationTimeAPI
 
 
@@ -23,9 +27,13 @@ rlservice_blueprint = Blueprint("rlservice", __name__)
 # define the API resources
 registration_view = RegisterAPI.as_view("user_register_api")
 action_selection_view = ActionsAPI.as_view("user_actions_api")
+batch_action_selection_view = ActionsBatchAPI.as_view("user_actions_batch_api")
 decision_time_end_view = DecisionTimeEndAPI.as_view("decision_time_end_api")
 update_posterior_view = UpdatePosteriorAPI.as_view("update_model_api")
 update_hyperparameters_view = UpdateHyperParamAPI.as_view("update_hyperparam_api")
+hyperparameter_job_view = HyperParamJobAPI.as_view("hyperparam_job_api")
+readiness_view = ReadinessAPI.as_view("readiness_api")
+metrics_view = MetricsAPI.as_view("metrics_api")
 # update_notification_time_view = UpdateNotificationTimeAPI.as_view(
 #     "update_notification_time_api"
 # )
@@ -37,6 +45,9 @@ rlservice_blueprint.add_url_rule(
 rlservice_blueprint.add_url_rule(
     "/actions", view_func=action_selection_view, methods=["POST"]
 )
+rlservice_blueprint.add_url_rule(
+    "/actions/batch", view_func=batch_action_selection_view, methods=["POST"]
+)
 rlservice_blueprint.add_url_rule(
     "/end_decision_window", view_func=decision_time_end_view, methods=["POST"]
 )
@@ -46,6 +57,22 @@ rlservice_blueprint.add_url_rule(
 rlservice_blueprint.add_url_rule(
     "/update_hyperparameters", view_func=update_hyperparameters_view, methods=["POST"]
 )
+rlservice_blueprint.add_url_rule(
+    "/update_hyperparameters/<int:request_id>",
+    view_func=hyperparameter_job_view,
+    methods=["GET"],
+)
+rlservice_blueprint.add_url_rule(
+    "/update_hyperparameters/<int:request_id>/cancel",
+    view_func=hyperparameter_job_view,
+    methods=["POST"],
+)
+rlservice_blueprint.add_url_rule(
+    "/ready", view_func=readiness_view, methods=["GET"]
+)
+rlservice_blueprint.add_url_rule(
+    "/metrics", view_func=metrics_view, methods=["GET"]
+)
 
 # rlservice_blueprint.add_url_rule(
 #     "/notif_time_change",
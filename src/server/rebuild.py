@@ -0,0 +1,104 @@
+# src/server/rebuild.py
+
+# Cold start of the algorithm from the database, when there is no valid
+# checkpoint: the decision history of the users is rebuilt from the
+# rl_action_selection table, streamed in one ordered query, and the latest
+# policy is published from its artifact in the RLWeights table when it has
+# one. Otherwise the algorithm starts from the prior, and its next policy id
+# follows the latest one of the table. See src/algorithm/rebuild.py.
+
+# Imports
+import time
+import traceback
+
+import pandas as pd
+import sqlalchemy
+
+from src.server import app, db
+from src.server.checkpoints import latest_policy_id
+from src.server.tables import RLActionSelection, RLWeights
+from src.algorithm import artifact, rebuild
+
+
+def stream_action_selection(chunk_size: int):
+    """
+    Rows of the rl_action_selection table, ordered by user and decision index
+    :param chunk_size: number of rows per chunk
+    :return: generator of data frames with the columns of rebuild.COLUMNS
+    """
+    query = (
+        db.session.query(*(getattr(RLActionSelection, column) for column in rebuild.COLUMNS))
+        .order_by(RLActionSelection.user_id, RLActionSelection.user_decision_idx)
+        .yield_per(chunk_size)
+    )
+    rows = []
+    for row in query:
+        rows.append(tuple(row))
+        if len(rows) == chunk_size:
+            yield pd.DataFrame(rows, columns=rebuild.COLUMNS)
+            rows = []
+    if rows:
+        yield pd.DataFrame(rows, columns=rebuild.COLUMNS)
+
+
+def restore_latest_policy(algorithm) -> bool:
+    """
+    Publish the latest policy of the RLWeights table, if it has an artifact
+    with the compact posterior
+    :return: True if the policy was published, False otherwise
+    """
+    row = RLWeights.query.order_by(RLWeights.policy_id.desc(), RLWeights.id.desc()).first()
+    if row is None:
+        return False
+    if row.artifact_path is None:
+        app.logger.warning("Policy %s has no artifact, starting from the prior", row.policy_id)
+        return False
+
+    arrays, metadata = artifact.read_artifact(row.artifact_path, row.artifact_sha256)
+    if artifact.posterior_of(arrays) is None:
+        app.logger.warning(
+            "The artifact of policy %s has no compact posterior, starting from the prior",
+            row.policy_id,
+        )
+        return False
+    rebuild.restore_policy(algorithm, arrays, metadata, row.hp_update_id)
+    return True
+
+
+def rebuild_algorithm(force: bool = False) -> bool:
+    """
+    Rebuild the algorithm from the database, if enabled
+    :param force: rebuild even if ALGORITHM_REBUILD is not set
+    :return: True if the algorithm was rebuilt, False otherwise
+    """
+
+    if not force and not app.config.get("ALGORITHM_REBUILD"):
+        return False
+
+    start = time.time()
+    with app.app_context():
+        try:
+            if not sqlalchemy.inspect(db.engine).has_table(RLActionSelection.__tablename__):
+                return False
+
+            algorithm = app.config.get("ALGORITHM")
+            num_users, num_rows = rebuild.rebuild_users(
+                algorithm, stream_action_selection(app.config.get("REBUILD_CHUNK_SIZE"))
+            )
+            restored = restore_latest_policy(algorithm)
+            if not restored:
+                # New policies must not reuse the ids of the RLWeights rows
+                algorithm.policy_id_floor = latest_policy_id()
+        except Exception as e:
+            app.logger.error("Error rebuilding the algorithm from the database: %s", e)
+            app.logger.error(traceback.format_exc())
+            return False
+
+    app.logger.info(
+        "Rebuilt the algorithm from %s decision points of %s users%s in %.3fs",
+        num_rows,
+        num_users,
+        ", with policy {}".format(algorithm.policyid) if restored else "",
+        time.time() - start,
+    )
+    return True
@@ -119,6 +119,11 @@ class RLHyperParamUpdateRequest(db.Model):
     request_message = db.Column(db.String, nullable=True)
     request_error_code = db.Column(db.Integer, nullable=True)
     completed_timestamp = db.Column(db.DateTime, nullable=True)
+    time_budget = db.Column(db.Float, nullable=True)
+    started_timestamp = db.Column(db.DateTime, nullable=True)
+    progress_timestamp = db.Column(db.DateTime, nullable=True)
+    iterations = db.Column(db.Integer, nullable=True)
+    objective = db.Column(db.Float, nullable=True)
 
     def __init__(
         self,
@@ -128,6 +133,7 @@ class RLHyperParamUpdateRequest(db.Model):
         request_message: str = None,
         request_error_code: int = None,
         completed_timestamp: datetime.datetime = None,
+        time_budget: float = None,
     ):
         self.backup_location = backup_location
         self.request_timestamp = request_timestamp
@@ -135,6 +141,7 @@ class RLHyperParamUpdateRequest(db.Model):
         self.request_message = request_message
         self.request_error_code = request_error_code
         self.completed_timestamp = completed_timestamp
+        self.time_budget = time_budget
 
 
 class RLWeights(db.Model):
@@ -159,6 +166,10 @@ class RLWeights(db.Model):
     data_pickle_file_path = db.Column(db.String, nullable=False)
     user_list = db.Column(ARRAY(db.String), nullable=True)
     hp_update_id = db.Column(db.Integer, nullable=True)
+    # Binary posterior of the policy (see src/algorithm/artifact.py), in place
+    # of posterior_var_array
+    artifact_path = db.Column(db.String, nullable=True)
+    artifact_sha256 = db.Column(db.String(64), nullable=True)
 
     def __init__(
         self,
@@ -174,6 +185,8 @@ class RLWeights(db.Model):
         code_commit_id: str = app.config.get("CODE_VERSION"),
         data_pickle_file_path: str = None,
         user_list: list = None,
+        artifact_path: str = None,
+        artifact_sha256: str = None,
     ):
         self.policy_id = policy_id
         self.update_timestamp = update_timestamp
@@ -187,6 +200,8 @@ class RLWeights(db.Model):
         self.data_pickle_file_path = data_pickle_file_path
         self.user_list = user_list
         self.hp_update_id = hp_update_id
+        self.artifact_path = artifact_path
+        self.artifact_sha256 = artifact_sha256
 
 class RLActionSelection(db.Model):
     """
@@ -0,0 +1,70 @@
+# src/server/warmup.py
+
+# Warm-up of the algorithm kernels at server start, so that the first
+# hyperparameter and posterior updates after a deploy do not pay the
+# compilation cost. The hyperparameter jobs run in the worker process of the
+# job runner, which is started and compiles its own executables before the
+# server reports ready. Compiled executables are persisted under data/.
+
+# Imports
+import threading
+import time
+import traceback
+
+from src.server import app
+from src.server.hyperparam_jobs import get_job_runner
+from src.algorithm import optimizer
+
+# Set once the warm-up has finished (or is disabled)
+ready = threading.Event()
+
+# Compile times of the last warm-up, in seconds
+warmup_info = {}
+
+
+def warm_up_task():
+    """Background task for compiling the algorithm kernels"""
+
+    start = time.time()
+    try:
+        with app.app_context():
+            optimizer.enable_compilation_cache(app.config.get("JAX_CACHE_DIR"))
+
+            # Get the algorithm
+            algorithm = app.config.get("ALGORITHM")
+
+            if hasattr(algorithm, "warm_up"):
+                compile_times = algorithm.warm_up(app.config.get("WARMUP_MAX_USERS"))
+                warmup_info.update(compile_times)
+                for key, seconds in compile_times.items():
+                    app.logger.info("Warm-up of %s kernels took %.2fs", key, seconds)
+
+            if hasattr(algorithm, "warm_up_problems"):
+                problems = algorithm.warm_up_problems(app.config.get("WARMUP_MAX_USERS"))
+                worker_times = get_job_runner().warm_up(problems).result()
+                warmup_info.update({f"worker_{key}": t for key, t in worker_times.items()})
+                for key, seconds in worker_times.items():
+                    app.logger.info(
+                        "Warm-up of %s kernels in the job worker took %.2fs", key, seconds
+                    )
+
+    except Exception as e:
+        app.logger.error("Error warming up the algorithm: %s", e)
+        app.logger.error(traceback.format_exc())
+
+    # Errors only mean the first update pays the compilation cost
+    app.logger.info("Algorithm warm-up finished in %.2fs", time.time() - start)
+    ready.set()
+
+
+def start_warm_up() -> None:
+    """Start the warm-up in a background thread, if enabled"""
+
+    if not app.config.get("ALGORITHM_WARMUP"):
+        ready.set()
+        return
+
+    app.logger.info("Starting algorithm warm-up")
+    bg_task = threading.Thread(target=warm_up_task, name="AlgorithmWarmUp")
+    bg_task.daemon = True
+    bg_task.start()
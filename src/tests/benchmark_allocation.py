@@ -0,0 +1,104 @@
+# src/tests/benchmark_allocation.py
+
+# Accuracy and latency of the smooth allocation function, Monte Carlo over the
+# random variates against quadrature. The reference is adaptive quadrature.
+# Run from the repository root with: python -m src.tests.benchmark_allocation
+
+import configparser
+import time
+
+import numpy as np
+import scipy.integrate as integrate
+import scipy.special as special
+
+from src.algorithm import smooth_allocation
+
+config = configparser.ConfigParser()
+config.read("config.ini")
+
+L_MIN = float(config["ALLOCATION_FUNCTION"]["L_MIN"])
+L_MAX = float(config["ALLOCATION_FUNCTION"]["L_MAX"])
+C = float(config["ALLOCATION_FUNCTION"]["LOGISTIC_C"])
+B = float(config["ALLOCATION_FUNCTION"]["LOGISTIC_B"]) / float(
+    config["ALLOCATION_FUNCTION"]["LOGISTIC_SIGMA"]
+)
+random_vars = smooth_allocation.load_random_vars(
+    config["ALLOCATION_FUNCTION"]["RANDOM_VARS_PATH"]
+)
+
+
+def reference(mean: float, var: float) -> float:
+    """Smooth allocation probability by adaptive quadrature"""
+    std = np.sqrt(var)
+
+    def integrand(z):
+        x = mean + std * z
+        logistic = L_MIN + (L_MAX - L_MIN) * special.expit(B * x - np.log(C))
+        return logistic * np.exp(-z * z / 2) / np.sqrt(2 * np.pi)
+
+    # Split at the midpoint of the logistic function
+    midpoint = (np.log(C) / B - mean) / std
+    points = [midpoint] if -12 < midpoint < 12 else None
+    return integrate.quad(
+        integrand, -12, 12, points=points, epsabs=1e-14, epsrel=1e-12, limit=500
+    )[0]
+
+
+def time_per_call(func, *args, repeat: int = 3) -> float:
+    """Best wall clock time of func(*args) over repeat runs, in seconds"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Means and variances of the advantage seen in practice, and some extremes
+rng = np.random.default_rng(0)
+means = np.concatenate([rng.normal(0, 0.5, 500), np.linspace(-5, 5, 100)])
+vars = np.concatenate([rng.uniform(0.001, 0.5, 500), np.geomspace(1e-6, 9, 100)])
+expected = np.array([reference(m, v) for m, v in zip(means, vars)])
+
+rows = []
+for func_type in ["smooth", "smooth_quadrature"]:
+    scalar = smooth_allocation.get_allocation_function(
+        func_type=func_type, B=B, randomvars=random_vars, C=C, L_min=L_MIN, L_max=L_MAX
+    )
+    batch = smooth_allocation.get_batch_allocation_function(
+        func_type=func_type, B=B, randomvars=random_vars, C=C, L_min=L_MIN, L_max=L_MAX
+    )
+
+    probs = batch(means, vars)
+    error = np.abs(probs - expected)
+
+    scalar_time = time_per_call(
+        lambda: [scalar(mean=m, var=v) for m, v in zip(means, vars)]
+    )
+    batch_time = time_per_call(batch, means, vars)
+
+    rows.append(
+        (
+            func_type,
+            np.max(error),
+            np.mean(error),
+            1e6 * scalar_time / means.size,
+            1e6 * batch_time / means.size,
+        )
+    )
+
+estimate = smooth_allocation.quadrature_error(means, vars, B, C, L_MIN, L_MAX)
+
+print("{} (mean, variance) pairs, B = {:.3f}, C = {}".format(means.size, B, C))
+print(
+    "{:<20}{:>12}{:>12}{:>16}{:>16}".format(
+        "func_type", "max error", "mean error", "scalar (us)", "batch (us)"
+    )
+)
+for row in rows:
+    print("{:<20}{:>12.2e}{:>12.2e}{:>16.2f}{:>16.2f}".format(*row))
+print(
+    "Largest quadrature error estimate: {:.2e} (actual error {:.2e})".format(
+        np.max(estimate), rows[1][1]
+    )
+)
@@ -0,0 +1,70 @@
+# src/tests/benchmark_em.py
+
+# Comparison of the EM estimator with minimizing the marginal objective, on
+# cohorts simulated from the mixed effects model. For each fit: the iterations,
+# wall time, marginal objective, the noise variance (1 in the simulation) and
+# the error of Sigma_u relative to the one the cohort was drawn with.
+# Run from the repository root with: python -m src.tests.benchmark_em
+
+import time
+
+import numpy as np
+
+from src.algorithm import optimizer
+from src.tests.test_structured import simulate_cohort
+
+SIZE = 24
+COHORTS = [16, 64, 256]
+DECISIONS_PER_USER = 100
+MAX_ITER = 500
+FITS = [
+    ("gd", dict(method="gd")),
+    ("lbfgs", dict(method="lbfgs")),
+    ("em", dict(estimator="em")),
+]
+
+
+def sigma_u_error(fit: optimizer.HyperparameterFit, sigma_u: np.array) -> float:
+    """Frobenius error of the fitted Sigma_u, relative to the true one"""
+    L = np.zeros((SIZE, SIZE))
+    L[np.tril_indices(SIZE)] = fit.ltu_flat
+    return np.linalg.norm(L @ L.T - sigma_u) / np.linalg.norm(sigma_u)
+
+
+ltu_flat = np.linalg.cholesky(0.01 * np.identity(SIZE))[np.tril_indices(SIZE)]
+
+print(
+    "{:>6}{:>8}{:>8}{:>10}{:>14}{:>12}{:>14}{:>12}".format(
+        "users", "fit", "iters", "time (s)", "objective", "noise var",
+        "sigma_u err", "converged"
+    )
+)
+for nusers in COHORTS:
+    data, sigma_u = simulate_cohort(nusers, SIZE, DECISIONS_PER_USER)
+    data = optimizer.pad_objective_data(data, optimizer.user_bucket(nusers))
+    problem = optimizer.HyperparameterProblem(
+        data, (ltu_flat, 1.0 / 0.85), (ltu_flat, 0.85), SIZE, MAX_ITER, 0.001, 1e-6
+    )
+
+    for name, settings in FITS:
+        # Compile outside of the timed run
+        optimizer.fit_hyperparameters(problem._replace(max_iter=1, **settings))
+        start = time.perf_counter()
+        fit = optimizer.fit_hyperparameters(problem._replace(**settings))
+        elapsed = time.perf_counter() - start
+
+        converged = "-"
+        if fit.diagnostics is not None:
+            converged = "yes" if fit.diagnostics["converged"] else "no"
+        print(
+            "{:>6}{:>8}{:>8}{:>10.2f}{:>14.3f}{:>12.4f}{:>14.4f}{:>12}".format(
+                nusers,
+                name,
+                fit.iterations,
+                elapsed,
+                fit.objective,
+                1.0 / fit.noise_precision,
+                sigma_u_error(fit, sigma_u),
+                converged,
+            )
+        )
@@ -0,0 +1,76 @@
+# src/tests/benchmark_optimizer.py
+
+# Iterations and wall time of the hyperparameter optimizers on simulated
+# cohorts, and how long L-BFGS and damped Newton take to reach the objective
+# the gradient descent ends at. Each cohort is drawn from the mixed effects
+# model itself, with a known Sigma_u and noise variance. The fits run one
+# iteration per call so the trace can be timed, which adds a dispatch per
+# iteration to the wall times. Newton computes the full Hessian every
+# iteration, expect it to take minutes on the largest cohort.
+# Run from the repository root with: python -m src.tests.benchmark_optimizer
+# (with JAX_ENABLE_X64=1 to compare the optimizers without float32 round-off)
+
+import time
+
+import numpy as np
+
+from src.algorithm import optimizer
+from src.tests.test_structured import simulate_cohort
+
+SIZE = 24
+COHORTS = [16, 64, 256]
+METHODS = ["gd", "lbfgs", "newton"]
+DECISIONS_PER_USER = 20
+MAX_ITER = 500
+
+
+def trace_fit(problem: optimizer.HyperparameterProblem) -> tuple:
+    """Fit one iteration at a time, recording the objective and elapsed time"""
+    trace = []
+    start = time.perf_counter()
+
+    def progress(iteration, objective):
+        trace.append((iteration, objective, time.perf_counter() - start))
+        return True
+
+    fit = optimizer.fit_hyperparameters(problem, 1, progress)
+    return fit, trace, time.perf_counter() - start
+
+
+ltu_flat = np.linalg.cholesky(0.01 * np.identity(SIZE))[np.tril_indices(SIZE)]
+
+print(
+    "{:>6}{:>8}{:>8}{:>10}{:>14}{:>12}{:>14}{:>12}".format(
+        "users", "method", "iters", "time (s)", "objective", "noise var",
+        "iters to gd", "time to gd"
+    )
+)
+for nusers in COHORTS:
+    data, _ = simulate_cohort(nusers, SIZE, DECISIONS_PER_USER)
+    data = optimizer.pad_objective_data(data, optimizer.user_bucket(nusers))
+    problem = optimizer.HyperparameterProblem(
+        data, (ltu_flat, 1.0 / 0.85), (ltu_flat, 0.85), SIZE, MAX_ITER, 0.001, 1e-6
+    )
+
+    target = None
+    for method in METHODS:
+        # Compile outside of the timed run
+        optimizer.fit_hyperparameters(problem._replace(method=method, max_iter=1), 1)
+        fit, trace, elapsed = trace_fit(problem._replace(method=method))
+        if method == "gd":
+            target = fit.objective
+
+        reached = [(i, t) for i, objective, t in trace if objective <= target]
+        iters_to_gd, time_to_gd = reached[0] if reached else ("-", np.nan)
+        print(
+            "{:>6}{:>8}{:>8}{:>10.2f}{:>14.3f}{:>12.4f}{:>14}{:>12.2f}".format(
+                nusers,
+                method,
+                fit.iterations,
+                elapsed,
+                fit.objective,
+                1.0 / fit.noise_precision,
+                iters_to_gd,
+                time_to_gd,
+            )
+        )
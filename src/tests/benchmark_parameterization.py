@@ -0,0 +1,77 @@
+# src/tests/benchmark_parameterization.py
+
+# Number of parameters, time of one objective and gradient evaluation, and an
+# L-BFGS fit for each parameterization of Sigma_u, on cohorts simulated from
+# the mixed effects model with a diagonal Sigma_u. The objective of the
+# structured fits is the marginal objective of the same model, so they can be
+# compared with the full one, and the Sigma_u error is relative to the one the
+# cohort was drawn with.
+# Run from the repository root with: python -m src.tests.benchmark_parameterization
+
+import time
+
+import jax
+import numpy as np
+
+from src.algorithm import optimizer, parameterization
+from src.tests.test_structured import simulate_cohort
+
+SIZES = [24, 48]
+NUSERS = 64
+DECISIONS_PER_USER = 50
+MAX_ITER = 500
+GRADIENT_REPEATS = 20
+KINDS = [("full", {}), ("diagonal", {}), ("block", {}), ("lowrank", dict(rank=2))]
+
+print(
+    "{:>6}{:>10}{:>8}{:>12}{:>8}{:>10}{:>14}{:>14}".format(
+        "size", "kind", "params", "grad (ms)", "iters", "fit (s)", "objective",
+        "sigma_u err"
+    )
+)
+for size in SIZES:
+    data, sigma_u = simulate_cohort(NUSERS, size, DECISIONS_PER_USER)
+    data = optimizer.pad_objective_data(data, optimizer.user_bucket(NUSERS))
+    init_cov_u = 0.01 * np.identity(size)
+    blocks = [size // 3] * 3
+
+    for kind, settings in KINDS:
+        structure = parameterization.make_parameterization(kind, size, blocks, **settings)
+        params = parameterization.params_of(init_cov_u, structure)
+
+        # The full parameterization compiles with the dimension, as the algorithm does
+        static_size = size if kind == "full" else structure
+
+        value_and_grad = jax.jit(
+            jax.value_and_grad(optimizer.objective, argnums=(0, 1)), static_argnums=(3,)
+        )
+        jax.block_until_ready(value_and_grad(params, 1.0 / 0.85, data, static_size))
+        start = time.perf_counter()
+        for _ in range(GRADIENT_REPEATS):
+            jax.block_until_ready(value_and_grad(params, 1.0 / 0.85, data, static_size))
+        grad_ms = 1000 * (time.perf_counter() - start) / GRADIENT_REPEATS
+
+        problem = optimizer.HyperparameterProblem(
+            data, (params, 1.0 / 0.85), (params, 0.85), static_size, MAX_ITER, 0.001,
+            1e-6, method="lbfgs",
+        )
+
+        # Compile outside of the timed run
+        optimizer.fit_hyperparameters(problem._replace(max_iter=1))
+        start = time.perf_counter()
+        fit = optimizer.fit_hyperparameters(problem)
+        elapsed = time.perf_counter() - start
+
+        fitted = parameterization.sigma_u_of(fit.ltu_flat, structure)
+        print(
+            "{:>6}{:>10}{:>8}{:>12.2f}{:>8}{:>10.2f}{:>14.3f}{:>14.4f}".format(
+                size,
+                kind,
+                params.size,
+                grad_ms,
+                fit.iterations,
+                elapsed,
+                fit.objective,
+                np.linalg.norm(fitted - sigma_u) / np.linalg.norm(sigma_u),
+            )
+        )
@@ -0,0 +1,76 @@
+# src/tests/benchmark_rebuild.py
+
+# Time to rebuild the user histories of a study from its rl_action_selection
+# rows, in chunks ordered by user and decision index, against replaying the
+# rows one by one through update_design_row, the way the live instance built
+# them. Both must give the same sufficient statistics.
+# Run from the repository root with: python -m src.tests.benchmark_rebuild
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.algorithm import rebuild
+from src.tests.test_mixed_effects import make_algorithm
+
+NUSERS = [100, 500]
+DECISIONS_PER_USER = 120
+CHUNK_SIZE = 10000
+
+
+def simulate_rows(nusers, num_decisions, seed=0):
+    """Random rows, in the order the decision points happened"""
+    rng = np.random.default_rng(seed)
+    num_rows = nusers * num_decisions
+    reward = rng.integers(0, 4, num_rows).astype(float)
+    reward[:nusers] = np.nan
+    return pd.DataFrame(
+        {
+            "user_id": ["user{}".format(u) for u in np.tile(rng.permutation(nusers), num_decisions)],
+            "user_decision_idx": np.repeat(np.arange(num_decisions), nusers),
+            "rid": np.arange(1, num_rows + 1),
+            "state_vector": rng.integers(0, 2, (num_rows, 3)).tolist(),
+            "action": rng.integers(0, 2, num_rows),
+            "act_prob": rng.uniform(0.2, 0.8, num_rows),
+            "reward": reward,
+        },
+        columns=rebuild.COLUMNS,
+    )
+
+
+print("{:>8}{:>10}{:>14}{:>14}{:>10}".format("users", "rows", "replay (s)", "rebuild (s)", "equal"))
+for nusers in NUSERS:
+    rows = simulate_rows(nusers, DECISIONS_PER_USER)
+
+    replayed = make_algorithm()
+    start = time.time()
+    for row in rows.itertuples():
+        replayed.update_design_row(
+            user_id=row.user_id,
+            state=row.state_vector,
+            action=row.action,
+            act_prob=row.act_prob,
+            reward=None if np.isnan(row.reward) else row.reward,
+            decision_index=row.user_decision_idx,
+        )
+    replay_time = time.time() - start
+
+    rebuilt = make_algorithm()
+    ordered = rows.sort_values(["user_id", "user_decision_idx"])
+    start = time.time()
+    rebuild.rebuild_users(
+        rebuilt,
+        (ordered.iloc[i : i + CHUNK_SIZE] for i in range(0, len(ordered), CHUNK_SIZE)),
+    )
+    rebuild_time = time.time() - start
+
+    equal = all(
+        np.array_equal(value, expected)
+        for value, expected in zip(rebuilt.create_A_B_matrix(), replayed.create_A_B_matrix())
+    )
+    print(
+        "{:>8}{:>10}{:>14.3f}{:>14.3f}{:>10}".format(
+            nusers, len(rows), replay_time, rebuild_time, str(equal)
+        )
+    )
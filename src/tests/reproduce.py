@@ -1,7 +1,7 @@
 from sqlalchemy import create_engine, MetaData, Table
 import configparser
 
-from src.algorithm import mixed_effects
+from src.algorithm import artifact, counter_rng, mixed_effects
 from src.server.config import ProductionConfig, allocation_function
 from src.server.ActionsAPI import ActionsAPI
 import pandas as pd
@@ -122,7 +122,14 @@ for idx, row in action_history.iterrows():
     else:
         post_mean = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_mean_array"].values[0]).reshape(-1, num_params)
         n = post_mean.shape[0]
-        post_var = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_var_array"].values[0]).reshape(num_params * n, num_params * n)
+        path = policy_table[(policy_table["policy_id"] == policy_id)]["artifact_path"].values[0]
+        if isinstance(path, str):
+            # Per-user covariance blocks from the policy artifact
+            sha256 = policy_table[(policy_table["policy_id"] == policy_id)]["artifact_sha256"].values[0]
+            post_var_blocks = artifact.read_artifact(path, sha256)[0]["user_cov"]
+        else:
+            post_var = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_var_array"].values[0]).reshape(num_params * n, num_params * n)
+            post_var_blocks = [post_var[i * num_params: (i + 1) * num_params, i * num_params: (i + 1) * num_params] for i in range(n)]
         theta_mean = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_theta_pop_mean_array"].values[0])
         theta_var = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_theta_pop_var_array"].values[0])
         user_list = policy_table[(policy_table["policy_id"] == policy_id)]["user_list"].values[0]
@@ -134,7 +141,7 @@ for idx, row in action_history.iterrows():
     else:
         user_index = user_list.index(user_id)
         post_mean_user = post_mean[user_index]
-        post_var_user = post_var[user_index * num_params: (user_index + 1) * num_params, user_index * num_params: (user_index + 1) * num_params]
+        post_var_user = post_var_blocks[user_index]
 
     advantage_default = [
             1,
@@ -169,7 +176,6 @@ for idx, row in action_history.iterrows():
 
     seed = int(row["seed"])
 
-    rng = np.random.default_rng(seed=seed)
-    action = rng.binomial(1, prob)
+    action = counter_rng.replay_action(seed, prob)
 
     assert action == int(row["action"])
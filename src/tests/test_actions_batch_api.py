@@ -0,0 +1,143 @@
+# src/tests/test_actions_batch_api.py
+
+
+import json
+import unittest
+
+from src.tests.base import BaseTestCase
+
+def register_client(self, username, password):
+    return self.client.post(
+        '/auth/register',
+        data=json.dumps(dict(
+            api_user=username,
+            api_pass=password
+        )),
+        content_type='application/json',
+    )
+
+def register_user(self, token, userid):
+    return self.client.post(
+        '/register',
+        headers=dict(
+            Authorization='Bearer ' + token
+        ),
+        data=json.dumps(dict(
+            user_id=userid,
+            rl_start_date='2021-01-01',
+            rl_end_date='2021-01-30',
+            consent_start_date='2021-01-01',
+            consent_end_date='2021-01-30',
+            morning_notification_time_start=[8, 8, 8, 8, 8, 8, 8],
+            evening_notification_time_start=[20, 20, 20, 20, 20, 20, 20]
+        )),
+        content_type='application/json'
+    )
+
+class TestActionsBatchAPI(BaseTestCase):
+
+    def test_request_actions_batch(self):
+        """ Test for requesting actions for several users at once """
+        with self.client:
+            response_client = register_client(self, 'joe@gmail.com', '123456')
+            data_register = json.loads(response_client.data.decode())
+            self.assertTrue(data_register['status'] == 'success')
+            token = data_register['auth_token']
+
+            userids = ['test@miwaves.app', 'test2@miwaves.app']
+            for userid in userids:
+                response = register_user(self, token, userid)
+                self.assertEqual(response.status_code, 201)
+
+            response = self.client.post(
+                '/actions/batch',
+                headers=dict(
+                    Authorization='Bearer ' + token
+                ),
+                data=json.dumps(dict(
+                    requests=[
+                        dict(
+                            user_id=userids[0],
+                            finished_ema=False,
+                            activity_question_response="NA",
+                            app_use_flag=False,
+                            cannabis_use=[]
+                        ),
+                        dict(
+                            user_id='unknown@miwaves.app',
+                            finished_ema=False,
+                            activity_question_response="NA",
+                            app_use_flag=False,
+                            cannabis_use=[]
+                        ),
+                        dict(
+                            user_id=userids[1],
+                            finished_ema=True,
+                            activity_question_response=True,
+                            app_use_flag=True,
+                            cannabis_use=[]
+                        ),
+                        dict(
+                            user_id=userids[0],
+                            finished_ema=False,
+                            activity_question_response="NA",
+                            app_use_flag=False,
+                            cannabis_use=[]
+                        ),
+                        dict(
+                            user_id=userids[1],
+                            finished_ema=True,
+                            app_use_flag=True,
+                            cannabis_use=[]
+                        ),
+                    ]
+                )),
+                content_type='application/json'
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['status'] == 'success')
+            results = data['results']
+            self.assertEqual(len(results), 5)
+
+            for result, userid in zip([results[0], results[2]], userids):
+                self.assertTrue(result['status'] == 'success')
+                self.assertTrue(result['user_id'] == userid)
+                self.assertTrue(result['act_gen_timestamp'] is not None)
+                self.assertTrue(result['act_prob'] >= 0.2 and result['act_prob'] <= 0.8)
+                self.assertTrue(result['action'] in [0, 1])
+                self.assertTrue(result['decision_index'] == 1)
+                self.assertTrue(result['policy_id'] == 0)
+            self.assertTrue(results[0]['act_prob'] - 0.38976884669491546 < 1e-5)
+            self.assertEqual({results[0]['rid'], results[2]['rid']}, {1, 2})
+
+            self.assertTrue(results[1]['status'] == 'fail')
+            self.assertEqual(results[1]['error_code'], 203)
+            self.assertTrue(results[3]['status'] == 'fail')
+            self.assertEqual(results[3]['error_code'], 213)
+            self.assertTrue(results[4]['status'] == 'fail')
+            self.assertEqual(results[4]['error_code'], 209)
+
+    def test_request_actions_batch_empty(self):
+        """ Test for requesting actions without a list of requests """
+        with self.client:
+            response_client = register_client(self, 'joe@gmail.com', '123456')
+            data_register = json.loads(response_client.data.decode())
+            token = data_register['auth_token']
+
+            response = self.client.post(
+                '/actions/batch',
+                headers=dict(
+                    Authorization='Bearer ' + token
+                ),
+                data=json.dumps(dict(requests=[])),
+                content_type='application/json'
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'fail')
+            self.assertEqual(data['error_code'], 211)
+            self.assertEqual(response.status_code, 202)
+
+
+if __name__ == '__main__':
+    unittest.main()
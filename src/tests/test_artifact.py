@@ -0,0 +1,117 @@
+# src/tests/test_artifact.py
+
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.algorithm import artifact, structured
+from src.tests.test_mixed_effects import make_algorithm, simulate_design_rows
+
+
+class TestArtifact(unittest.TestCase):
+    """Tests for the binary policy artifacts"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.arrays = {
+            "user_mean": rng.normal(size=(3, 4)),
+            "user_cov": rng.normal(size=(3, 4, 4)),
+            "theta_pop_mean": rng.normal(size=(4, 1)),
+            "empty": np.zeros((0, 4)),
+        }
+        self.metadata = {"policy_id": 2, "user_list": ["a", "b", "c"]}
+
+    def test_round_trip(self):
+        path = os.path.join(self.directory, "policy.rlpolicy")
+        sha256 = artifact.write_artifact(path, self.arrays, self.metadata)
+        self.assertEqual(sha256, artifact.file_sha256(path))
+        self.assertFalse(os.path.exists(path + ".tmp"))
+
+        arrays, metadata = artifact.read_artifact(path, sha256)
+        self.assertEqual(metadata, self.metadata)
+        self.assertEqual(arrays.keys(), self.arrays.keys())
+        for name, array in self.arrays.items():
+            np.testing.assert_array_equal(arrays[name], array)
+            self.assertEqual(arrays[name].dtype, np.float64)
+        self.assertIsInstance(arrays["user_cov"], np.memmap)
+        with self.assertRaises(ValueError):
+            arrays["user_cov"][0, 0, 0] = 0
+
+        # Stored in float32
+        artifact.write_artifact(path, self.arrays, self.metadata, dtype="float32")
+        arrays, _ = artifact.read_artifact(path)
+        self.assertEqual(arrays["user_cov"].dtype, np.float32)
+        np.testing.assert_allclose(arrays["user_cov"], self.arrays["user_cov"], rtol=1e-6)
+        with self.assertRaises(ValueError):
+            artifact.write_artifact(path, self.arrays, dtype="float16")
+
+        # Changed file
+        with self.assertRaises(ValueError):
+            artifact.read_artifact(path, sha256)
+
+    def test_legacy_arrays(self):
+        size, nusers = 4, 3
+        rng = np.random.default_rng(1)
+        blocks = {
+            "user_mean": rng.normal(size=(nusers, size)),
+            "cond_cov": np.stack([np.identity(size)] * nusers),
+            "coupling": rng.normal(size=(nusers, size, size)),
+            "theta_pop_cov": np.identity(size),
+        }
+        posterior = structured.block_posterior(blocks)
+        arrays = artifact.legacy_arrays(
+            posterior.user_mean.reshape(-1, 1).tolist(),
+            posterior.full_cov().tolist(),
+            np.zeros((size, 1)).tolist(),
+            posterior.theta_pop_cov.tolist(),
+            np.identity(size).tolist(),
+        )
+        np.testing.assert_array_equal(arrays["user_cov"], posterior.user_cov)
+        np.testing.assert_array_equal(arrays["user_mean"], posterior.user_mean)
+        np.testing.assert_array_equal(arrays["joint_cov"], posterior.full_cov())
+        self.assertIsNone(artifact.posterior_of(arrays))
+
+    def test_algorithm(self):
+        algorithm = make_algorithm(policy_artifact_dir=self.directory)
+        simulate_design_rows(algorithm, nusers=5, num_decisions=4)
+        status, _, policyid, params, _, user_list, _ = algorithm.update(None)
+        self.assertTrue(status)
+        self.assertNotIn("posterior_var_array", params)
+
+        arrays, metadata = artifact.read_artifact(
+            params["artifact_path"], params["artifact_sha256"]
+        )
+        self.assertEqual(metadata["policy_id"], policyid)
+        self.assertEqual(metadata["user_list"], user_list)
+        self.assertEqual(metadata["noise_var"], algorithm.noise_var)
+        for array, expected in zip(artifact.posterior_of(arrays), algorithm.posterior):
+            np.testing.assert_array_equal(array, expected)
+        np.testing.assert_array_equal(arrays["sigma_u"], algorithm.sigma_u)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        # A policy whose artifact cannot be written is not published, and the
+        # staged hyperparameters stay staged
+        algorithm.update_hyperparameters(1, None)
+        pending = algorithm.pending_hyperparameters
+        algorithm.policy_artifact_dir = os.path.join(self.directory, "not_a_directory")
+        open(algorithm.policy_artifact_dir, "w").close()
+        self.assertFalse(algorithm.update(None)[0])
+        self.assertEqual(algorithm.policyid, policyid)
+        self.assertIs(algorithm.pending_hyperparameters, pending)
+        self.assertNotIn(policyid + 1, algorithm.history)
+
+        # Without an artifact directory, the joint covariance is returned
+        algorithm = make_algorithm()
+        simulate_design_rows(algorithm, nusers=5, num_decisions=4)
+        params = algorithm.update(None)[3]
+        np.testing.assert_array_equal(
+            params["posterior_var_array"], algorithm.posterior.full_cov()
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+# src/tests/test_backends.py
+
+
+import os
+import tempfile
+import unittest
+
+import jax
+import numpy as np
+
+from src.algorithm import backends, optimizer, parameterization, structured
+from src.tests.test_mixed_effects import make_algorithm, simulate_design_rows
+from src.tests.test_structured import simulate_cohort
+
+
+class TestNumpyKernels(unittest.TestCase):
+    """Tests for the NumPy objective, gradient and gradient descent"""
+
+    def setUp(self):
+        self.size = 6
+        data, _ = simulate_cohort(5, self.size, 20)
+        self.data = optimizer.pad_objective_data(data, 8)
+        rng = np.random.default_rng(1)
+        X = rng.normal(size=(self.size, self.size))
+        self.sigma_u = 0.05 * (X @ X.T / self.size + 0.5 * np.identity(self.size))
+        self.ltu_flat = np.linalg.cholesky(self.sigma_u)[np.tril_indices(self.size)]
+
+    def test_value_and_grad(self):
+        structures = [
+            self.size,
+            parameterization.make_parameterization("diagonal", self.size),
+            parameterization.make_parameterization("block", self.size, [2, 2, 2]),
+            parameterization.make_parameterization("lowrank", self.size, rank=2),
+        ]
+        for size in structures:
+            params = parameterization.params_of(
+                self.sigma_u, parameterization.as_parameterization(size)
+            )
+            obj, (params_grad, y_grad) = backends.value_and_grad(
+                params, 0.9, self.data, size
+            )
+
+            # Against the compiled objective, in float32
+            self.assertAlmostEqual(
+                obj, float(optimizer.objective(params, 0.9, self.data, size)), delta=1e-3
+            )
+
+            # Against central differences
+            def f(params, y):
+                return backends.value_and_grad(params, y, self.data, size)[0]
+
+            eps = 1e-6
+            for j in [0, params.size // 2, params.size - 1]:
+                step = np.zeros(params.size)
+                step[j] = eps
+                numeric = (f(params + step, 0.9) - f(params - step, 0.9)) / (2 * eps)
+                self.assertAlmostEqual(
+                    params_grad[j], numeric, delta=1e-4 * max(1, abs(numeric))
+                )
+            numeric = (f(params, 0.9 + eps) - f(params, 0.9 - eps)) / (2 * eps)
+            self.assertAlmostEqual(y_grad, numeric, delta=1e-4 * max(1, abs(numeric)))
+
+    def test_validate(self):
+        obj, valid = backends.validate(self.ltu_flat, 0.9, self.data, self.size)
+        expected_obj, expected_valid = optimizer.validate(
+            self.ltu_flat, 0.9, self.data, self.size
+        )
+        self.assertTrue(valid)
+        self.assertEqual(bool(valid), bool(expected_valid))
+        self.assertAlmostEqual(obj, float(expected_obj), delta=1e-3)
+
+        # Singular Sigma_u
+        obj, valid = backends.validate(
+            np.zeros_like(self.ltu_flat), 0.9, self.data, self.size
+        )
+        self.assertFalse(valid)
+        self.assertEqual(obj, optimizer.INVALID_OBJECTIVE)
+
+    def test_gradient_descent(self):
+        problem = optimizer.HyperparameterProblem(
+            self.data,
+            (self.ltu_flat, 0.9),
+            (self.ltu_flat, 1.0 / 0.9),
+            self.size,
+            40,
+            0.001,
+            1e-6,
+            backend="numpy",
+        )
+        fit = optimizer.fit_hyperparameters(problem)
+        self.assertEqual(fit.status, optimizer.FIT_COMPLETED)
+        init_obj, _ = backends.validate(self.ltu_flat, 0.9, self.data, self.size)
+        self.assertLess(fit.objective, init_obj)
+
+        # Same iterations in chunks
+        chunked = optimizer.fit_hyperparameters(problem, 10, lambda *_: True)
+        self.assertEqual(chunked.iterations, fit.iterations)
+        np.testing.assert_array_equal(chunked.ltu_flat, fit.ltu_flat)
+        self.assertEqual(chunked.objective, fit.objective)
+
+        multi = optimizer.fit_hyperparameters(problem._replace(multi_start=True))
+        self.assertEqual(multi.status, optimizer.FIT_COMPLETED)
+        self.assertLessEqual(multi.objective, fit.objective)
+
+        with self.assertRaises(ValueError):
+            optimizer.fit_hyperparameters(problem._replace(method="lbfgs"))
+        with self.assertRaises(ValueError):
+            optimizer.fit_hyperparameters(problem._replace(backend="torch"))
+
+    def test_posterior_blocks(self):
+        data, _ = simulate_cohort(5, self.size, 20)
+        args = (data.A_hat, data.B_hat, data.mu_prior, data.sigma_prior, self.sigma_u, 0.9)
+        expected = structured.posterior_blocks(*args)
+        blocks = backends.posterior_blocks(*args)
+        self.assertEqual(blocks.keys(), expected.keys())
+        for key in expected:
+            self.assertEqual(blocks[key].shape, expected[key].shape)
+            np.testing.assert_allclose(blocks[key], expected[key], rtol=1e-3, atol=1e-4)
+
+
+class TestCostModel(unittest.TestCase):
+    """Tests for the backend selection"""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "cost_model.json")
+        backends.save_cost_model(
+            backends.CostModel(
+                6, (8, 16), {}, {"hyperparameters": 16, "posterior": None}
+            ),
+            self.path,
+        )
+
+    def test_select_backend(self):
+        model = backends.load_cost_model(self.path)
+        self.assertEqual(model.users, (8, 16))
+        self.assertEqual(backends.select_backend(model, "hyperparameters", 8), "numpy")
+        self.assertEqual(backends.select_backend(model, "hyperparameters", 16), "jax")
+        self.assertEqual(backends.select_backend(model, "posterior", 1024), "numpy")
+        self.assertEqual(
+            backends.load_cost_model(self.path + ".missing"), backends.DEFAULT_COST_MODEL
+        )
+
+        self.assertEqual(backends.crossover_of([8, 16, 32], [1, 2, 3], [2, 1, 1]), 16)
+        self.assertEqual(backends.crossover_of([8, 16, 32], [1, 2, 3], [0, 3, 1]), 32)
+        self.assertIsNone(backends.crossover_of([8, 16, 32], [1, 2, 3], [0, 1, 4]))
+
+    def test_calibrate(self):
+        model = backends.calibrate(6, [8, 16])
+        self.assertEqual(model.users, (8, 16))
+        for kernel in backends.KERNELS:
+            for backend in backends.BACKENDS:
+                self.assertEqual(len(model.timings[kernel][backend]), 2)
+                self.assertTrue(all(t > 0 for t in model.timings[kernel][backend]))
+            self.assertIn(model.crossover[kernel], [None, 8, 16])
+
+    def test_algorithm(self):
+        algorithm = make_algorithm(
+            hyperparam_backend="auto", posterior_backend="auto", cost_model_path=self.path
+        )
+        # JAX in float32 is never mixed with the float64 NumPy kernels
+        self.assertEqual(algorithm.select_backend("hyperparameters", 8), "numpy")
+        self.assertEqual(algorithm.select_backend("hyperparameters", 32), "numpy")
+        with jax.enable_x64(True):
+            self.assertEqual(algorithm.select_backend("hyperparameters", 8), "numpy")
+            self.assertEqual(algorithm.select_backend("hyperparameters", 32), "jax")
+        self.assertEqual(algorithm.select_backend("posterior", 32), "numpy")
+
+        simulate_design_rows(algorithm, nusers=5, num_decisions=4)
+        self.assertEqual(algorithm.hyperparameter_problem().backend, "numpy")
+        algorithm.update_hyperparameters(1, None)
+        algorithm.update(None)
+        self.assertTrue(np.all(np.isfinite(algorithm.posterior.user_cov)))
+
+        # The NumPy backend only runs the gradient descent
+        algorithm = make_algorithm(
+            hyperparam_backend="auto",
+            hyperparam_optimizer="lbfgs",
+            cost_model_path=self.path,
+        )
+        self.assertEqual(algorithm.select_backend("hyperparameters", 8), "jax")
+        with self.assertRaises(ValueError):
+            make_algorithm(hyperparam_backend="numpy", hyperparam_optimizer="lbfgs")
+        with self.assertRaises(ValueError):
+            make_algorithm(posterior_backend="gpu")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# src/tests/test_checkpoint.py
+
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from src.algorithm import artifact, checkpoint, rebuild
+from src.tests.test_mixed_effects import make_algorithm, simulate_design_rows
+from src.tests.test_rebuild import ordered_chunks, simulate_rows
+
+
+class TestCheckpoint(unittest.TestCase):
+    """Tests for the checkpoints of the learned state of the algorithm"""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "checkpoint.rlstate")
+        self.algorithm = make_algorithm(max_iter=20)
+        simulate_design_rows(self.algorithm, nusers=6, num_decisions=4)
+        self.algorithm.update(None, update_hyperparam=True, request_id=1)
+        simulate_design_rows(self.algorithm, nusers=8, num_decisions=6, seed=1)
+        self.algorithm.update_hyperparameters(2, None)
+        checkpoint.save_checkpoint(self.algorithm, self.path, {"code_version": "abc"})
+
+    def test_restore(self):
+        restored = make_algorithm(max_iter=20)
+        metadata = checkpoint.restore_checkpoint(
+            restored, self.path, code_version="abc", policy_id=1
+        )
+        self.assertEqual(metadata["policy_id"], 1)
+
+        old, new = self.algorithm.snapshot, restored.snapshot
+        self.assertEqual(new.policyid, old.policyid)
+        self.assertEqual(new.user_list, old.user_list)
+        self.assertEqual(new.noise_var, old.noise_var)
+        self.assertEqual(new.hyperparam_update_id, old.hyperparam_update_id)
+        for name in ["posterior_mean", "theta_pop_mean", "sigma_u", "prob_table"]:
+            np.testing.assert_array_equal(getattr(new, name), getattr(old, name))
+        for array, expected in zip(new.posterior, old.posterior):
+            np.testing.assert_array_equal(array, expected)
+        with self.assertRaises(ValueError):
+            new.prob_table[0, 0] = 0
+
+        self.assertEqual(restored.user_list, self.algorithm.user_list)
+        for name in checkpoint.STORE_ARRAYS:
+            np.testing.assert_array_equal(
+                getattr(restored.users, name)[: restored.num_users],
+                getattr(self.algorithm.users, name)[: self.algorithm.num_users],
+            )
+        pending, expected = restored.pending_hyperparameters, self.algorithm.pending_hyperparameters
+        for value, expected_value in zip(pending, expected):
+            np.testing.assert_array_equal(value, expected_value)
+
+        # Both continue the same way, and the checkpoint is not changed
+        for algorithm in [self.algorithm, restored]:
+            simulate_design_rows(algorithm, nusers=10, num_decisions=8, seed=2)
+            algorithm.update(None)
+        np.testing.assert_array_equal(restored.posterior_mean, self.algorithm.posterior_mean)
+        np.testing.assert_array_equal(restored.sigma_u, self.algorithm.sigma_u)
+        self.assertEqual(restored.policyid, 2)
+        again = make_algorithm()
+        checkpoint.restore_checkpoint(again, self.path)
+        self.assertEqual(again.num_users, 8)
+
+    def test_mismatch(self):
+        with self.assertRaises(ValueError):
+            checkpoint.restore_checkpoint(make_algorithm(), self.path, code_version="def")
+        with self.assertRaises(ValueError):
+            checkpoint.restore_checkpoint(make_algorithm(), self.path, policy_id=2)
+        with self.assertRaises(FileNotFoundError):
+            checkpoint.restore_checkpoint(make_algorithm(), self.path + ".missing")
+
+        # Nothing was restored
+        algorithm = make_algorithm()
+        with self.assertRaises(ValueError):
+            checkpoint.restore_checkpoint(algorithm, self.path, policy_id=0)
+        self.assertEqual(algorithm.policyid, 0)
+        self.assertEqual(algorithm.num_users, 0)
+
+    def test_decisions_since_checkpoint(self):
+        # Decision points are recorded, and the server restarts before the
+        # next posterior update
+        live = make_algorithm(policy_artifact_dir=tempfile.mkdtemp())
+        rows = simulate_rows(live, nusers=6, num_decisions=4)
+        artifact_path = live.update(None)[3]["artifact_path"]
+        checkpoint.save_checkpoint(live, self.path)
+        rows = pd.concat(
+            [rows, simulate_rows(live, nusers=7, num_decisions=2, seed=1, first_decision=4)]
+        )
+        rows["rid"] = np.arange(1, len(rows) + 1)
+        num_decisions = rows.groupby("user_id").size().to_dict()
+
+        # The checkpoint does not have them, and is not restored
+        restored = make_algorithm()
+        with self.assertRaises(ValueError):
+            checkpoint.restore_checkpoint(restored, self.path, num_decisions=num_decisions)
+        self.assertEqual(restored.num_users, 0)
+
+        # The algorithm is rebuilt from the rows instead, with the policy of
+        # the checkpoint
+        rebuild.rebuild_users(restored, ordered_chunks(rows, 5))
+        arrays, metadata = artifact.read_artifact(artifact_path)
+        rebuild.restore_policy(restored, arrays, metadata, hyperparam_update_id=None)
+        for value, expected in zip(restored.create_A_B_matrix(), live.create_A_B_matrix()):
+            if isinstance(value, np.ndarray):
+                np.testing.assert_array_equal(value, expected)
+            else:
+                self.assertEqual(value, expected)
+
+        # Both continue the same way
+        for algorithm in [live, restored]:
+            simulate_rows(algorithm, nusers=7, num_decisions=1, seed=2, first_decision=6)
+            algorithm.update_posteriors(None)
+        np.testing.assert_array_equal(restored.posterior_mean, live.posterior_mean)
+
+        # A checkpoint with every decision point is restored
+        checkpoint.save_checkpoint(live, self.path)
+        num_decisions = dict(zip(live.users.user_ids, live.users.num_decisions.tolist()))
+        checkpoint.restore_checkpoint(make_algorithm(), self.path, num_decisions=num_decisions)
+
+
+if __name__ == "__main__":
+    unittest.main()
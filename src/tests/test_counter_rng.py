@@ -0,0 +1,87 @@
+# src/tests/test_counter_rng.py
+
+
+import unittest
+
+import numpy as np
+
+from src.algorithm import counter_rng
+
+
+class TestPhilox(unittest.TestCase):
+    """Tests for the Philox4x32-10 blocks"""
+
+    # Known answers of the Random123 reference implementation
+    KNOWN_ANSWERS = [
+        ((0, 0, 0, 0), (0, 0), (0x6627E8D5, 0xE169C58D, 0xBC57AC4C, 0x9B00DBD8)),
+        (
+            (0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF),
+            (0xFFFFFFFF, 0xFFFFFFFF),
+            (0x408F276D, 0x41C83B0E, 0xA20BC7C6, 0x6D5451FD),
+        ),
+        (
+            (0x243F6A88, 0x85A308D3, 0x13198A2E, 0x03707344),
+            (0xA4093822, 0x299F31D0),
+            (0xD16CFE09, 0x94FDCCEB, 0x5001E420, 0x24126EA1),
+        ),
+    ]
+
+    def test_known_answers(self):
+        for counter, key, expected in self.KNOWN_ANSWERS:
+            self.assertEqual(counter_rng.philox4x32(counter, key), expected)
+            batch = counter_rng.philox4x32_batch(np.array([counter]), key)
+            self.assertEqual(tuple(int(word) for word in batch[0]), expected)
+
+
+class TestCounterSeeds(unittest.TestCase):
+    """Tests for the seeds of the action draws"""
+
+    def setUp(self):
+        self.user_ids = ["user{}".format(i) for i in range(50)]
+        self.decision_times = [i % 7 for i in range(50)]
+
+    def test_batch_matches_scalar(self):
+        seeds = counter_rng.counter_seeds(42, self.user_ids, self.decision_times)
+        for user_id, decision_time, seed in zip(
+            self.user_ids, self.decision_times, seeds
+        ):
+            self.assertEqual(seed, counter_rng.counter_seed(42, user_id, decision_time))
+            self.assertTrue(counter_rng.is_counter_seed(seed))
+            self.assertLess(seed, 2**31)
+
+    def test_seeds_differ(self):
+        seeds = counter_rng.counter_seeds(42, self.user_ids, self.decision_times)
+        self.assertEqual(len(set(seeds)), len(seeds))
+        self.assertNotEqual(
+            counter_rng.counter_seed(42, "user0", 1),
+            counter_rng.counter_seed(43, "user0", 1),
+        )
+        self.assertNotEqual(
+            counter_rng.counter_seed(42, "user0", 1),
+            counter_rng.counter_seed(42, "user0", 2),
+        )
+
+    def test_uniform(self):
+        user_ids = ["user{}".format(i) for i in range(20000)]
+        uniforms = counter_rng.seed_uniform(
+            counter_rng.counter_seeds(7, user_ids, [3] * len(user_ids))
+        )
+        self.assertTrue(np.all((uniforms >= 0) & (uniforms < 1)))
+        self.assertAlmostEqual(np.mean(uniforms), 0.5, delta=0.01)
+        self.assertAlmostEqual(np.mean(uniforms < 0.3), 0.3, delta=0.01)
+
+    def test_replay(self):
+        for seed in [0, 1, 1234, 2**16 - 2]:
+            self.assertEqual(
+                counter_rng.replay_action(seed, 0.4),
+                np.random.default_rng(seed=seed).binomial(1, 0.4),
+            )
+
+        seed = counter_rng.counter_seed(42, "user0", 1)
+        uniform = counter_rng.seed_uniform(seed)
+        self.assertEqual(counter_rng.replay_action(seed, uniform + 1e-6), 1)
+        self.assertEqual(counter_rng.replay_action(seed, uniform), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# src/tests/test_dispatcher.py
+
+
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from src.algorithm import policy
+from src.algorithm.dispatcher import ActionDispatcher
+from src.tests.test_mixed_effects import make_algorithm, simulate_design_rows
+
+
+class TestActionDispatcher(unittest.TestCase):
+    """Tests for the micro-batching of concurrent action requests"""
+
+    def setUp(self):
+        self.algorithm = make_algorithm()
+        simulate_design_rows(self.algorithm, nusers=5, num_decisions=4)
+        self.algorithm.update(None)
+
+    def test_batch_matches_get_action(self):
+        user_ids = self.algorithm.user_list + ["new_user"]
+        dispatcher = ActionDispatcher(self.algorithm, window_ms=1000, max_batch_size=6)
+
+        self.algorithm.rng = np.random.default_rng(7)
+        futures = [
+            dispatcher.submit(user_id, policy.STATES[i], i)
+            for i, user_id in enumerate(user_ids)
+        ]
+        results = [future.result(timeout=10) for future in futures]
+
+        # A full batch is dispatched without waiting for the window
+        metrics = dispatcher.metrics()
+        self.assertEqual(metrics["num_batches"], 1)
+        self.assertEqual(metrics["batch_size"]["max"], 6)
+        self.assertLess(metrics["queue_delay_ms"]["max"], 1000)
+
+        self.algorithm.rng = np.random.default_rng(7)
+        for i, user_id in enumerate(user_ids):
+            expected = self.algorithm.get_action(user_id, policy.STATES[i], i)
+            self.assertEqual(results[i], expected)
+
+    def test_window_bounds_delay(self):
+        dispatcher = ActionDispatcher(self.algorithm, window_ms=20, max_batch_size=64)
+        results = []
+
+        def request(i):
+            start = time.perf_counter()
+            dispatcher.get_action("user{}".format(i % 5), [1, 0, 1], 1)
+            results.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        metrics = dispatcher.metrics()
+        self.assertEqual(metrics["num_requests"], 10)
+        self.assertLessEqual(metrics["num_batches"], 10)
+        self.assertEqual(len(results), 10)
+
+        # No request waits much longer than the window
+        self.assertLess(metrics["queue_delay_ms"]["max"], 500)
+
+    def test_errors_resolve_futures(self):
+        dispatcher = ActionDispatcher(self.algorithm, window_ms=1)
+        with self.assertRaises(ValueError):
+            dispatcher.get_action("user0", [1, 0], 1)
+
+        future = dispatcher.submit("user0", [1, 0, "a"], 1)
+        with self.assertRaises(Exception):
+            future.result(timeout=10)
+
+    def test_error_fails_only_its_request(self):
+        dispatcher = ActionDispatcher(self.algorithm, window_ms=1000, max_batch_size=3)
+        futures = [
+            dispatcher.submit("user0", [1, 0, 1], 1),
+            dispatcher.submit("user1", [1, 0, "a"], 1),
+            dispatcher.submit("user2", [0, 1, 1], 1),
+        ]
+
+        with self.assertRaises(Exception):
+            futures[1].result(timeout=10)
+        for future in (futures[0], futures[2]):
+            action, seed, act_prob, policy_id = future.result(timeout=10)
+            self.assertIn(action, (0, 1))
+            self.assertEqual(policy_id, self.algorithm.policyid)
+
+        metrics = dispatcher.metrics()
+        self.assertEqual(metrics["num_batches"], 1)
+        self.assertEqual(metrics["num_requests"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# src/tests/test_em.py
+
+
+import unittest
+
+import numpy as np
+
+from src.algorithm import em, optimizer
+from src.tests.test_structured import simulate_cohort
+
+
+def dense_em_update(data, sigma_u, noise_var):
+    """
+    Reference EM iteration, from the dense joint posterior of
+    z = (theta_pop, u_1, ..., u_N), with theta_i = theta_pop + u_i
+    """
+    A_hat, B_hat = np.asarray(data.A_hat), np.asarray(data.B_hat)
+    nusers, size = B_hat.shape
+
+    # theta = J z
+    J = np.hstack([np.kron(np.ones((nusers, 1)), np.identity(size)),
+                   np.identity(nusers * size)])
+    A = np.zeros((nusers * size, nusers * size))
+    for i in range(nusers):
+        A[i * size : (i + 1) * size, i * size : (i + 1) * size] = A_hat[i]
+
+    prior_precision = np.zeros(((nusers + 1) * size, (nusers + 1) * size))
+    prior_precision[:size, :size] = np.linalg.inv(data.sigma_prior)
+    prior_precision[size:, size:] = np.kron(np.identity(nusers), np.linalg.inv(sigma_u))
+    prior_info = np.zeros((nusers + 1) * size)
+    prior_info[:size] = np.linalg.solve(data.sigma_prior, data.mu_prior)
+
+    cov = np.linalg.inv(prior_precision + J.T @ A @ J / noise_var)
+    mean = cov @ (prior_info + J.T @ B_hat.flatten() / noise_var)
+
+    new_sigma_u = np.zeros((size, size))
+    for i in range(1, nusers + 1):
+        u = slice(i * size, (i + 1) * size)
+        new_sigma_u += np.outer(mean[u], mean[u]) + cov[u, u]
+
+    theta_mean = J @ mean
+    theta_cov = J @ cov @ J.T
+    residual = (
+        data.sum_sq_reward
+        - 2 * theta_mean @ B_hat.flatten()
+        + theta_mean @ A @ theta_mean
+        + np.trace(A @ theta_cov)
+    )
+
+    return new_sigma_u / nusers, residual / data.ts
+
+
+class TestEM(unittest.TestCase):
+    """Tests for the EM estimator of the hyperparameters"""
+
+    def setUp(self):
+        self.size = 6
+        self.data, self.sigma_u = simulate_cohort(8, self.size, 50)
+        self.ltu_flat = np.linalg.cholesky(0.1 * np.identity(self.size))[
+            np.tril_indices(self.size)
+        ]
+        self.problem = optimizer.HyperparameterProblem(
+            self.data,
+            (self.ltu_flat, 1.0 / 0.85),
+            (self.ltu_flat, 0.85),
+            self.size,
+            200,
+            0.001,
+            1e-6,
+            estimator="em",
+        )
+
+    def test_em_update_matches_dense(self):
+        data, _ = simulate_cohort(3, 4, 10)
+        sigma_u = np.diag([0.3, 0.2, 0.1, 0.05]) + 0.01
+        expected_sigma_u, expected_noise_var = dense_em_update(data, sigma_u, 0.7)
+        new_sigma_u, new_noise_var = em.em_update(
+            sigma_u,
+            0.7,
+            data.A_hat,
+            data.B_hat,
+            data.mu_prior,
+            data.sigma_prior,
+            data.sum_sq_reward,
+            data.ts,
+        )
+        np.testing.assert_allclose(new_sigma_u, expected_sigma_u, rtol=1e-8, atol=1e-12)
+        self.assertAlmostEqual(new_noise_var, expected_noise_var, places=10)
+
+    def test_fit_em(self):
+        fit = optimizer.fit_hyperparameters(self.problem)
+        self.assertEqual(fit.status, optimizer.FIT_COMPLETED)
+        self.assertTrue(fit.diagnostics["converged"])
+        self.assertLess(fit.diagnostics["relative_change"], self.problem.em_tolerance)
+        self.assertEqual(len(fit.diagnostics["objective_trace"]), fit.iterations + 1)
+
+        # EM never increases the objective, up to float32 round-off
+        objectives = np.array(fit.diagnostics["objective_trace"])
+        self.assertTrue(np.all(np.diff(objectives) < 1e-4 * objectives[0]))
+        self.assertLess(objectives[-1], objectives[0])
+
+        # Padded users are left out
+        padded = optimizer.fit_hyperparameters(
+            self.problem._replace(data=optimizer.pad_objective_data(self.data, 16))
+        )
+        self.assertEqual(padded.iterations, fit.iterations)
+        np.testing.assert_allclose(padded.ltu_flat, fit.ltu_flat)
+        self.assertAlmostEqual(padded.noise_precision, fit.noise_precision)
+
+        # Stopped by the progress callback after the second report
+        reports = []
+        stopped = optimizer.fit_hyperparameters(
+            self.problem, 5, lambda iteration, _: reports.append(iteration) or len(reports) < 2
+        )
+        self.assertEqual(stopped.status, optimizer.FIT_STOPPED)
+        self.assertEqual(reports, [5, 10])
+        self.assertEqual(stopped.iterations, 10)
+        self.assertFalse(stopped.diagnostics["converged"])
+
+        with self.assertRaises(ValueError):
+            optimizer.fit_hyperparameters(self.problem._replace(estimator="reml"))
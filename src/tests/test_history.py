@@ -0,0 +1,130 @@
+# src/tests/test_history.py
+
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.algorithm import history
+from src.tests.test_mixed_effects import make_algorithm, simulate_design_rows
+
+
+def make_record(policy_id):
+    """Record with arrays and a scalar, with values depending on the policy id"""
+    return {
+        "user_cov": np.full((3, 2, 2), float(policy_id)),
+        "theta_pop_mean": np.arange(2.0) + policy_id,
+        "noise_var": 0.5 * policy_id,
+    }
+
+
+class TestPolicyHistory(unittest.TestCase):
+    """Tests for the history of the published policies"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_spill(self):
+        store = history.PolicyHistory(self.directory, max_in_memory=2)
+        for policy_id in range(1, 6):
+            store.append(policy_id, make_record(policy_id))
+
+        self.assertEqual(len(store), 5)
+        self.assertEqual(store.policy_ids, [1, 2, 3, 4, 5])
+        self.assertEqual(list(store.records), [4, 5])
+        self.assertEqual(sorted(os.listdir(self.directory)), ["policy_1", "policy_2", "policy_3"])
+
+        for policy_id in range(1, 6):
+            record = store[policy_id]
+            expected = make_record(policy_id)
+            self.assertEqual(record.keys(), expected.keys())
+            for key in expected:
+                np.testing.assert_array_equal(record[key], expected[key])
+
+        # Spilled records are read-only memory maps
+        self.assertIsInstance(store[1]["user_cov"], np.memmap)
+        with self.assertRaises(ValueError):
+            store[1]["user_cov"][0, 0, 0] = 1
+        with self.assertRaises(KeyError):
+            store.get(6)
+
+    def test_restart(self):
+        store = history.PolicyHistory(self.directory, max_in_memory=1)
+        for policy_id in range(1, 4):
+            store.append(policy_id, make_record(policy_id))
+
+        # The records spilled by an earlier run are found on disk
+        os.makedirs(os.path.join(self.directory, "policy_9.tmp"))
+        restarted = history.PolicyHistory(self.directory, max_in_memory=1)
+        self.assertEqual(restarted.policy_ids, [1, 2])
+        self.assertIn(2, restarted)
+        np.testing.assert_array_equal(restarted[2]["user_cov"], make_record(2)["user_cov"])
+
+        # and are never replaced
+        with self.assertRaises(ValueError):
+            restarted.append(1, make_record(0))
+        with self.assertRaises(FileExistsError):
+            restarted.spill(2, make_record(0))
+        np.testing.assert_array_equal(restarted[1]["user_cov"], make_record(1)["user_cov"])
+
+    def test_without_directory(self):
+        store = history.PolicyHistory(None, max_in_memory=2)
+        for policy_id in range(1, 6):
+            store.append(policy_id, make_record(policy_id))
+        self.assertEqual(store.policy_ids, [4, 5])
+        self.assertNotIn(3, store)
+        with self.assertRaises(ValueError):
+            history.PolicyHistory(self.directory, max_in_memory=0)
+
+    def test_algorithm(self):
+        algorithm = make_algorithm(history_dir=self.directory, history_in_memory=1)
+        simulate_design_rows(algorithm, nusers=5, num_decisions=4)
+        posteriors = []
+        for _ in range(3):
+            algorithm.update(None)
+            posteriors.append(algorithm.posterior)
+
+        self.assertEqual(algorithm.history.policy_ids, [1, 2, 3])
+        for policy_id, expected in enumerate(posteriors, start=1):
+            posterior = algorithm.history.posterior(policy_id)
+            for array, expected_array in zip(posterior, expected):
+                np.testing.assert_array_equal(array, expected_array)
+            np.testing.assert_array_equal(
+                algorithm.history[policy_id]["sigma_u"], algorithm.sigma_u
+            )
+
+        # A policy whose history record cannot be saved is not published, and
+        # the staged hyperparameters stay staged
+        algorithm.update_hyperparameters(1, None)
+        pending = algorithm.pending_hyperparameters
+        os.makedirs(algorithm.history.path(3))
+        status = algorithm.update(None)
+        self.assertFalse(status[0])
+        self.assertEqual(algorithm.policyid, 3)
+        self.assertIs(algorithm.pending_hyperparameters, pending)
+        self.assertEqual(algorithm.history.policy_ids, [1, 2, 3])
+        os.rmdir(algorithm.history.path(3))
+        self.assertTrue(algorithm.update(None)[0])
+        self.assertEqual(algorithm.policyid, 4)
+        self.assertIsNone(algorithm.pending_hyperparameters)
+        np.testing.assert_array_equal(algorithm.sigma_u, pending[0])
+
+        # A new run starting again from the prior continues after the ids of
+        # the history
+        restarted = make_algorithm(history_dir=self.directory, history_in_memory=1)
+        simulate_design_rows(restarted, nusers=5, num_decisions=4)
+        spilled = restarted.history.policy_ids
+        self.assertTrue(restarted.update(None)[0])
+        self.assertEqual(restarted.policyid, max(spilled) + 1)
+        np.testing.assert_array_equal(
+            restarted.history[spilled[0]]["sigma_u"], algorithm.history[spilled[0]]["sigma_u"]
+        )
+        restarted.policy_id_floor = 10
+        restarted.update(None)
+        self.assertEqual(restarted.policyid, 11)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# src/tests/test_job_runner.py
+
+
+import threading
+import unittest
+
+import numpy as np
+
+from src.algorithm import job_runner, optimizer
+from src.tests.test_mixed_effects import make_algorithm
+from src.tests.test_structured import simulate_blocks
+
+
+class TestHyperparameterJobRunner(unittest.TestCase):
+    """Tests for the hyperparameter fits in a worker process"""
+
+    def setUp(self):
+        size = 24
+        A_hat, B_hat = simulate_blocks(4, size)
+        ts = int(sum(5 + i for i in range(4)))
+        ltu_flat = np.linalg.cholesky(np.diag([0.01] * size))[np.tril_indices(size)]
+        self.problem = optimizer.HyperparameterProblem(
+            optimizer.ObjectiveData(
+                A_hat,
+                B_hat,
+                np.linspace(-0.5, 2.0, size),
+                np.diag(np.linspace(0.01, 0.9, size)),
+                3.0 * ts,
+                ts,
+            ),
+            (ltu_flat, 1.0 / 0.85),
+            (ltu_flat, 0.85),
+            size,
+            40,
+            0.001,
+            1e-6,
+        )
+
+        self.progress = []
+        self.results = {}
+        self.finished = threading.Event()
+        self.runner = job_runner.HyperparameterJobRunner(
+            on_progress=lambda *report: self.progress.append(report),
+            on_done=self.on_done,
+            chunk_iters=10,
+        )
+
+    def tearDown(self):
+        self.runner.shutdown()
+
+    def on_done(self, job_id, fit, error):
+        self.results[job_id] = (fit, error)
+        if len(self.results) == 2:
+            self.finished.set()
+
+    def test_warm_up(self):
+        # The worker fits problems of the shapes of the jobs, before any job
+        problems = make_algorithm().warm_up_problems(16)
+        self.assertEqual(list(problems), [8, 16])
+        self.assertTrue(all(problem.max_iter == 1 for problem in problems.values()))
+        compile_times = self.runner.warm_up(problems).result(timeout=600)
+        self.assertEqual(list(compile_times), [8, 16])
+        self.assertEqual(self.progress, [])
+
+        fit = self.runner.submit(1, self.problem).result(timeout=600)
+        self.assertEqual(fit.status, optimizer.FIT_COMPLETED)
+
+    def test_jobs(self):
+        # The second job is cancelled while the first one runs
+        self.runner.submit(1, self.problem)
+        self.runner.submit(2, self.problem)
+        self.assertTrue(self.runner.cancel(2))
+        self.assertTrue(self.finished.wait(300))
+
+        fit, error = self.results[1]
+        self.assertIsNone(error)
+        expected = optimizer.fit_hyperparameters(self.problem)
+        self.assertEqual(fit.status, optimizer.FIT_COMPLETED)
+        self.assertEqual(fit.iterations, expected.iterations)
+        np.testing.assert_allclose(fit.ltu_flat, expected.ltu_flat, rtol=1e-6)
+
+        fit, error = self.results[2]
+        self.assertIsNone(error)
+        self.assertEqual(fit.status, job_runner.FIT_CANCELLED)
+        self.assertFalse(self.runner.running(1))
+        self.assertFalse(self.runner.cancel(1))
+
+    def test_time_budget(self):
+        problem = self.problem._replace(max_iter=1000, tolerance=0.0)
+        self.runner.submit(1, problem, time_budget=0.0)
+        self.runner.submit(2, problem, time_budget=None)
+
+        # Stopped at the first check, or cancelled at the next one
+        self.runner.cancel(2)
+        self.assertTrue(self.finished.wait(300))
+
+        fit, error = self.results[1]
+        self.assertIsNone(error)
+        self.assertEqual(fit.status, job_runner.FIT_TIMED_OUT)
+        self.assertEqual(fit.iterations, 10)
+        self.assertEqual(self.results[2][0].status, job_runner.FIT_CANCELLED)
+        self.assertIn((1, 0, None), self.progress)
+
+
+if __name__ == "__main__":
+    unittest.main()
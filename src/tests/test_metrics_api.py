@@ -0,0 +1,65 @@
+# src/tests/test_metrics_api.py
+
+
+import json
+import unittest
+
+from src.server import app
+from src.tests.base import BaseTestCase
+
+
+def register_client(self, username, password):
+    return self.client.post(
+        '/auth/register',
+        data=json.dumps(dict(
+            api_user=username,
+            api_pass=password
+        )),
+        content_type='application/json',
+    )
+
+
+def auth_headers(self):
+    response_client = register_client(self, 'joe@gmail.com', '123456')
+    data_register = json.loads(response_client.data.decode())
+    return dict(Authorization='Bearer ' + data_register['auth_token'])
+
+
+class TestMetricsAPI(BaseTestCase):
+
+    def test_metrics_without_token(self):
+        """ Test that the metrics are not served without a token """
+        with self.client:
+            response = self.client.get('/metrics')
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'Unauthorized')
+            self.assertEqual(response.status_code, 401)
+
+    def test_metrics_without_dispatcher(self):
+        """ Test metrics when the action dispatcher is disabled """
+        app.config['ACTION_DISPATCHER'] = False
+        with self.client:
+            response = self.client.get('/metrics', headers=auth_headers(self))
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'success')
+            self.assertTrue(data['action_dispatcher'] is None)
+            self.assertEqual(response.status_code, 200)
+
+    def test_metrics_with_dispatcher(self):
+        """ Test metrics when the action dispatcher is enabled """
+        app.config['ACTION_DISPATCHER'] = True
+        try:
+            with self.client:
+                response = self.client.get('/metrics', headers=auth_headers(self))
+                data = json.loads(response.data.decode())
+                self.assertTrue(data['status'] == 'success')
+                metrics = data['action_dispatcher']
+                self.assertEqual(metrics['window_ms'], app.config['ACTION_DISPATCH_WINDOW_MS'])
+                self.assertEqual(metrics['num_requests'], 0)
+                self.assertEqual(response.status_code, 200)
+        finally:
+            app.config['ACTION_DISPATCHER'] = False
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,295 @@
+# src/tests/test_mixed_effects.py
+
+
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from src.algorithm import policy, smooth_allocation
+from src.algorithm.mixed_effects import MixedEffectsAlgorithm
+
+
+def make_algorithm(**kwargs):
+    """Mixed effects algorithm with a fixed allocation function"""
+    return MixedEffectsAlgorithm(
+        num_days=60,
+        prior_mean=np.zeros(24),
+        prior_cov=np.identity(24),
+        init_cov_u=np.diag([0.01] * 24),
+        init_noise_var=0.85,
+        alloc_func=lambda mean, var: 0.5,
+        rng=np.random.default_rng(0),
+        logger_path=tempfile.mkdtemp(),
+        **kwargs,
+    )
+
+
+def simulate_design_rows(algorithm, nusers, num_decisions, seed=0):
+    """Feed random states, actions and rewards, with users joining over time"""
+    rng = np.random.default_rng(seed)
+    for t in range(num_decisions):
+        for u in range(nusers):
+            if t < u % 3:
+                continue
+            algorithm.update_design_row(
+                user_id="user{}".format(u),
+                state=[int(rng.integers(2)), t % 2, int(rng.integers(2))],
+                action=int(rng.integers(2)),
+                act_prob=float(rng.uniform(0.2, 0.8)),
+                reward=float(rng.integers(0, 4)),
+                decision_index=t,
+            )
+
+
+class TestSufficientStatistics(unittest.TestCase):
+    """Tests for the incrementally maintained per-user statistics"""
+
+    def test_matches_rebuild_from_history(self):
+        algorithm = make_algorithm()
+        simulate_design_rows(algorithm, nusers=7, num_decisions=5)
+        A_hat, B_hat, sum_sq_reward, total_ts, update_user_list = (
+            algorithm.create_A_B_matrix()
+        )
+
+        # The design row of a decision point is paired with the reward that
+        # arrives with the next one
+        expected_users = []
+        expected_ts = 0
+        expected_sum_sq_reward = 0
+        for user_id in algorithm.user_list:
+            history = algorithm.users.history(user_id)
+            X = history["design_state"][:-1]
+            y = history["reward"][1:]
+            if len(y) == 0:
+                continue
+            index = len(expected_users)
+            expected_users.append(user_id)
+            expected_ts += len(y)
+            expected_sum_sq_reward += np.sum(y**2)
+            np.testing.assert_allclose(A_hat[index], X.T @ X)
+            np.testing.assert_allclose(B_hat[index], X.T @ y)
+
+        self.assertEqual(update_user_list, expected_users)
+        self.assertEqual(total_ts, expected_ts)
+        self.assertAlmostEqual(sum_sq_reward, expected_sum_sq_reward)
+
+    def test_single_decision_has_no_data(self):
+        algorithm = make_algorithm()
+        algorithm.update_design_row("user0", [1, 0, 1], 1, 0.4, 2.0, 0)
+        algorithm.update_design_row("user1", [1, 0, 1], 1, 0.4, 2.0, 0)
+        algorithm.update_design_row("user1", [0, 1, 1], 0, 0.6, 3.0, 1)
+        A_hat, B_hat, sum_sq_reward, total_ts, update_user_list = (
+            algorithm.create_A_B_matrix()
+        )
+        self.assertEqual(update_user_list, ["user1"])
+        self.assertEqual(total_ts, 1)
+        self.assertEqual(sum_sq_reward, 9.0)
+        self.assertEqual(A_hat.shape, (1, 24, 24))
+
+
+class TestProbabilityTables(unittest.TestCase):
+    """Tests for the precomputed action probabilities of a policy"""
+
+    def setUp(self):
+        randomvars = np.random.default_rng(1).standard_normal(5000)
+        self.algorithm = make_algorithm()
+        self.algorithm.allocation_function = smooth_allocation.get_allocation_function(
+            func_type="smooth", B=10 / 0.95, randomvars=randomvars
+        )
+        self.algorithm.batch_allocation_function = (
+            smooth_allocation.get_batch_allocation_function(
+                func_type="smooth", B=10 / 0.95, randomvars=randomvars
+            )
+        )
+        simulate_design_rows(self.algorithm, nusers=5, num_decisions=4)
+        self.algorithm.update(None)
+
+    def test_tables_match_posterior(self):
+        for user_id in self.algorithm.user_list + ["new_user"]:
+            user = self.algorithm.last_update_users_index.get(user_id)
+            mean, cov = self.algorithm.user_posterior(user)
+            for state in policy.STATES:
+                prob = policy.action_probability(
+                    mean,
+                    cov,
+                    policy.advantage_vector(state, 8),
+                    self.algorithm.allocation_function,
+                )[0]
+                _, _, act_prob, _ = self.algorithm.get_action(user_id, state, 1, seed=3)
+                self.assertEqual(act_prob, self.algorithm.clip_prob(prob))
+
+    def test_non_binary_state(self):
+        self.assertIsNone(policy.state_index([0.5, 1, 0]))
+        mean, cov = self.algorithm.user_posterior(0)
+        prob = policy.action_probability(
+            mean,
+            cov,
+            policy.advantage_vector([0.5, 1, 0], 8),
+            self.algorithm.allocation_function,
+        )[0]
+        user_id = self.algorithm.last_update_users_list[0]
+        _, _, act_prob, _ = self.algorithm.get_action(user_id, [0.5, 1, 0], 1, seed=3)
+        self.assertEqual(act_prob, self.algorithm.clip_prob(prob))
+
+
+class TestBatchActions(unittest.TestCase):
+    """Tests for selecting the actions of several users at once"""
+
+    setUp = TestProbabilityTables.setUp
+
+    def test_get_actions_matches_get_action(self):
+        user_ids = self.algorithm.user_list + ["new_user", "other_new_user"]
+        states = [policy.STATES[i % 8] for i in range(len(user_ids) - 1)]
+        states.append([0.5, 1, 0])
+        decision_times = list(range(len(user_ids)))
+
+        self.algorithm.rng = np.random.default_rng(7)
+        actions, seeds, act_probs, policy_id = self.algorithm.get_actions(
+            user_ids, states, decision_times
+        )
+
+        self.algorithm.rng = np.random.default_rng(7)
+        for i, user_id in enumerate(user_ids):
+            action, seed, act_prob, expected_policy_id = self.algorithm.get_action(
+                user_id, states[i], decision_times[i]
+            )
+            self.assertEqual(actions[i], action)
+            self.assertEqual(seeds[i], seed)
+            self.assertEqual(act_probs[i], act_prob)
+            self.assertEqual(policy_id, expected_policy_id)
+
+    def test_get_actions_order_independent(self):
+        user_ids = self.algorithm.user_list + ["new_user"]
+        states = [policy.STATES[i % 8] for i in range(len(user_ids))]
+        decision_times = [3] * len(user_ids)
+        actions, seeds, act_probs, _ = self.algorithm.get_actions(
+            user_ids, states, decision_times
+        )
+
+        order = np.random.default_rng(0).permutation(len(user_ids))
+        shuffled = self.algorithm.get_actions(
+            [user_ids[i] for i in order],
+            [states[i] for i in order],
+            [decision_times[i] for i in order],
+        )
+        np.testing.assert_array_equal(shuffled[0], actions[order])
+        np.testing.assert_array_equal(shuffled[1], seeds[order])
+
+        # Recorded seeds replay the same actions
+        for i, user_id in enumerate(user_ids):
+            replayed = self.algorithm.get_action(user_id, states[i], 3, seed=seeds[i])
+            self.assertEqual(replayed[0], actions[i])
+
+    def test_legacy_rng_scheme(self):
+        self.algorithm.rng_scheme = "legacy"
+        self.test_get_actions_matches_get_action()
+
+        self.algorithm.rng = np.random.default_rng(7)
+        _, seed, act_prob, _ = self.algorithm.get_action("new_user", [1, 0, 1], 1)
+        self.assertLess(seed, self.algorithm.maxseed)
+        action, _, _, _ = self.algorithm.get_action("new_user", [1, 0, 1], 1, seed=seed)
+        self.assertEqual(
+            action, np.random.default_rng(seed=seed).binomial(1, act_prob)
+        )
+
+    def test_make_states_matches_make_state(self):
+        rng = np.random.default_rng(3)
+        params_list = []
+        for i in range(200):
+            engagement_data = rng.integers(0, 4, size=rng.integers(0, 4)).astype(float)
+            if i % 10 == 0 and engagement_data.size:
+                engagement_data[-1] = np.nan
+            params_list.append(
+                {
+                    "engagement_data": engagement_data,
+                    "cannabis_use_data": np.array([]),
+                    "recent_cannabis_use": [] if i % 3 else [1.0, 2.0],
+                    "time_of_day": i % 2,
+                    "reward": int(rng.integers(0, 4)),
+                }
+            )
+
+        states = self.algorithm.make_states(params_list)
+        for params, state in zip(params_list, states):
+            self.assertEqual(list(state), self.algorithm.make_state(params))
+
+        with self.assertRaises(ValueError):
+            self.algorithm.make_states([{"engagement_data": []}])
+
+    def test_make_rewards_matches_make_reward(self):
+        params_list = [
+            {
+                "user_finished_ema": finished,
+                "used_app": used_app,
+                "activity_response": activity,
+            }
+            for finished in [True, False]
+            for used_app in [True, False]
+            for activity in [True, False, None]
+        ]
+        rewards = self.algorithm.make_rewards(params_list)
+        for params, reward in zip(params_list, rewards):
+            self.assertEqual(reward, self.algorithm.make_reward(params))
+
+
+class TestPolicySnapshot(unittest.TestCase):
+    """Tests for the immutable policy published by the posterior update"""
+
+    def setUp(self):
+        self.algorithm = make_algorithm()
+        simulate_design_rows(self.algorithm, nusers=5, num_decisions=4)
+
+    def test_snapshot_is_immutable(self):
+        old = self.algorithm.snapshot
+        self.algorithm.update(None)
+        new = self.algorithm.snapshot
+
+        self.assertEqual(new.policyid, old.policyid + 1)
+        self.assertEqual(self.algorithm.policyid, new.policyid)
+        self.assertEqual(old.user_list, ())
+        self.assertEqual(len(new.user_list), 5)
+        for array in [new.posterior_mean, new.posterior.user_cov, new.prob_table]:
+            with self.assertRaises(ValueError):
+                array[0] = 0
+        with self.assertRaises(TypeError):
+            new.user_index["new_user"] = 0
+
+    def test_concurrent_updates(self):
+        snapshots = {0: self.algorithm.snapshot}
+        results = []
+        done = threading.Event()
+        user_ids = self.algorithm.user_list + ["new_user"]
+
+        def request():
+            while not done.is_set():
+                for i, user_id in enumerate(user_ids):
+                    state = policy.STATES[i % 8]
+                    _, _, act_prob, policy_id = self.algorithm.get_action(
+                        user_id, state, 1
+                    )
+                    results.append((policy_id, user_id, i % 8, act_prob))
+
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for t in range(5):
+            simulate_design_rows(self.algorithm, nusers=5, num_decisions=1, seed=t)
+            self.algorithm.update(None)
+            snapshots[self.algorithm.policyid] = self.algorithm.snapshot
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        # Every action probability comes from the tables of the policy whose
+        # id it was returned with
+        self.assertGreater(len(results), 0)
+        for policy_id, user_id, column, act_prob in results:
+            snapshot = snapshots[policy_id]
+            row = snapshot.user_index.get(user_id, -1)
+            self.assertEqual(act_prob, snapshot.act_prob_table[row, column])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+# src/tests/test_optimizer.py
+
+
+import unittest
+
+import numpy as np
+
+from src.algorithm import optimizer
+from src.tests.test_structured import simulate_blocks
+
+
+class TestGradientDescent(unittest.TestCase):
+    """Tests for the compiled gradient descent loop"""
+
+    def setUp(self):
+        self.size = 24
+        A_hat, B_hat = simulate_blocks(4, self.size)
+        ts = int(sum(5 + i for i in range(4)))
+        self.data = optimizer.ObjectiveData(
+            A_hat,
+            B_hat,
+            np.linspace(-0.5, 2.0, self.size),
+            np.diag(np.linspace(0.01, 0.9, self.size)),
+            3.0 * ts,
+            ts,
+        )
+        sigma_u = np.diag([0.01] * self.size)
+        self.ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(self.size)]
+        self.noise_precision = 1.0 / 0.85
+
+    def init_state(self):
+        init_obj, valid = optimizer.validate(
+            self.ltu_flat, self.noise_precision, self.data, self.size
+        )
+        self.assertTrue(bool(valid))
+        return optimizer.init_gradient_descent(
+            self.ltu_flat, self.noise_precision, init_obj, 0.001
+        )
+
+    def test_objective_decreases(self):
+        state = self.init_state()
+        final = optimizer.run_gradient_descent(
+            state, self.data, (self.ltu_flat, 0.85), self.size, 50, 0.001, 1e-6
+        )
+        self.assertLessEqual(int(final.idx), 50)
+        self.assertLess(float(final.min_obj), float(state.min_obj))
+        _, valid = optimizer.validate(
+            final.min_ltu_flat, final.min_noise_precision, self.data, self.size
+        )
+        self.assertTrue(bool(valid))
+
+    def test_chunked_run_matches_single_run(self):
+        args = (self.data, (self.ltu_flat, 0.85), self.size, 40, 0.001, 1e-6)
+        single = optimizer.run_gradient_descent(self.init_state(), *args)
+        chunked = self.init_state()
+        for stop_at in [10, 20, 30, 40]:
+            chunked = optimizer.run_gradient_descent(chunked, *args, stop_at)
+        self.assertEqual(int(single.idx), int(chunked.idx))
+        np.testing.assert_allclose(single.min_ltu_flat, chunked.min_ltu_flat)
+        self.assertEqual(float(single.min_obj), float(chunked.min_obj))
+
+    def test_padding_leaves_objective_unchanged(self):
+        padded = optimizer.pad_objective_data(self.data, optimizer.user_bucket(4))
+        self.assertEqual(padded.A_hat.shape[0], optimizer.MIN_USER_BUCKET)
+        for noise_precision in [self.noise_precision, 2.0]:
+            expected, expected_valid = optimizer.validate(
+                self.ltu_flat, noise_precision, self.data, self.size
+            )
+            result, valid = optimizer.validate(
+                self.ltu_flat, noise_precision, padded, self.size
+            )
+            self.assertEqual(bool(valid), bool(expected_valid))
+            self.assertAlmostEqual(float(result), float(expected), places=3)
+
+        args = ((self.ltu_flat, 0.85), self.size, 40, 0.001, 1e-6)
+        single = optimizer.run_gradient_descent(self.init_state(), self.data, *args)
+        bucketed = optimizer.run_gradient_descent(self.init_state(), padded, *args)
+        np.testing.assert_allclose(
+            single.min_ltu_flat, bucketed.min_ltu_flat, atol=1e-4
+        )
+
+    def test_fit_hyperparameters(self):
+        problem = optimizer.HyperparameterProblem(
+            self.data,
+            (self.ltu_flat, self.noise_precision),
+            (self.ltu_flat, 0.85),
+            self.size,
+            40,
+            0.001,
+            1e-6,
+        )
+        single = optimizer.run_gradient_descent(
+            self.init_state(), self.data, (self.ltu_flat, 0.85), self.size, 40, 0.001, 1e-6
+        )
+        fit = optimizer.fit_hyperparameters(problem)
+        self.assertEqual(fit.status, optimizer.FIT_COMPLETED)
+        self.assertEqual(fit.iterations, int(single.idx))
+        np.testing.assert_array_equal(fit.ltu_flat, np.array(single.min_ltu_flat))
+
+        # Stopped by the progress callback after the second chunk
+        reports = []
+        stopped = optimizer.fit_hyperparameters(
+            problem, 10, lambda iteration, _: reports.append(iteration) or len(reports) < 2
+        )
+        self.assertEqual(stopped.status, optimizer.FIT_STOPPED)
+        self.assertEqual(reports, [10, 20])
+        self.assertEqual(stopped.iterations, 20)
+
+        # Neither the starting point nor the reset point is valid
+        invalid = problem._replace(
+            init_point=(np.nan * self.ltu_flat, self.noise_precision),
+            reset_point=(np.nan * self.ltu_flat, 0.85),
+        )
+        self.assertEqual(
+            optimizer.fit_hyperparameters(invalid).status, optimizer.FIT_INVALID
+        )
+
+    def test_multi_start(self):
+        problem = optimizer.HyperparameterProblem(
+            self.data,
+            (0.5 * self.ltu_flat, self.noise_precision),
+            (self.ltu_flat, 0.85),
+            self.size,
+            40,
+            0.001,
+            1e-6,
+            multi_start=True,
+        )
+        names, ltu_flats, noise_precisions = optimizer.starting_points(problem)
+        self.assertEqual(names[0], "previous")
+        self.assertEqual(names[3], "prior")
+        self.assertEqual(ltu_flats.shape, (6, self.ltu_flat.size))
+        np.testing.assert_array_equal(ltu_flats[3], self.ltu_flat)
+        np.testing.assert_array_equal(noise_precisions[3:], 0.85)
+
+        # Every start runs exactly as a single fit would
+        single = optimizer.fit_hyperparameters(problem._replace(multi_start=False))
+        fit = optimizer.fit_hyperparameters(problem)
+        self.assertEqual(fit.status, optimizer.FIT_COMPLETED)
+        self.assertIn(fit.start, names)
+        self.assertLessEqual(fit.objective, single.objective)
+
+        # The objective is the one of the hyperparameters the fit reports
+        for result in [single, fit]:
+            obj, _ = optimizer.validate(
+                result.ltu_flat, result.noise_precision, self.data, self.size
+            )
+            self.assertEqual(result.objective, float(obj))
+
+        reports = []
+        chunked = optimizer.fit_hyperparameters(
+            problem, 10, lambda iteration, objective: reports.append(iteration) or True
+        )
+        self.assertEqual(reports, [10, 20, 30, 40])
+        self.assertEqual(chunked.start, fit.start)
+        np.testing.assert_allclose(chunked.ltu_flat, fit.ltu_flat)
+
+        # Invalid starting points are dropped
+        invalid = optimizer.fit_hyperparameters(
+            problem._replace(init_point=(np.nan * self.ltu_flat, self.noise_precision))
+        )
+        self.assertTrue(invalid.start.startswith("prior"))
+
+    def test_second_order(self):
+        problem = optimizer.HyperparameterProblem(
+            self.data,
+            (self.ltu_flat, self.noise_precision),
+            (self.ltu_flat, 0.85),
+            self.size,
+            20,
+            0.001,
+            1e-6,
+        )
+        init_obj, _ = optimizer.validate(
+            self.ltu_flat, self.noise_precision, self.data, self.size
+        )
+        for method in ["lbfgs", "newton"]:
+            fit = optimizer.fit_hyperparameters(problem._replace(method=method))
+            self.assertEqual(fit.status, optimizer.FIT_COMPLETED)
+            self.assertLessEqual(fit.iterations, 20)
+            self.assertLess(fit.objective, float(init_obj))
+            self.assertGreater(fit.noise_precision, 0)
+            obj, valid = optimizer.validate(
+                fit.ltu_flat, fit.noise_precision, self.data, self.size
+            )
+            self.assertTrue(bool(valid))
+            self.assertAlmostEqual(float(obj), fit.objective, places=3)
+
+            # Chunks resume from the loop carry, the fit is unchanged
+            chunked = optimizer.fit_hyperparameters(
+                problem._replace(method=method), 5, lambda iteration, objective: True
+            )
+            self.assertEqual(chunked.iterations, fit.iterations)
+            self.assertEqual(chunked.objective, fit.objective)
+
+        with self.assertRaises(ValueError):
+            optimizer.fit_hyperparameters(problem._replace(method="adam"))
+
+    def test_user_bucket(self):
+        self.assertEqual(optimizer.user_bucket(1), 8)
+        self.assertEqual(optimizer.user_bucket(8), 8)
+        self.assertEqual(optimizer.user_bucket(9), 16)
+        self.assertEqual(optimizer.user_bucket(100), 128)
+
+    def test_record_compile_shape(self):
+        data = optimizer.pad_objective_data(self.data, 8)
+        self.assertFalse(optimizer.record_compile_shape(data, 7, "gd"))
+        self.assertTrue(optimizer.record_compile_shape(data, 7, "gd"))
+        # Another optimizer or dtype is compiled separately
+        self.assertFalse(optimizer.record_compile_shape(data, 7, "lbfgs"))
+        half = data._replace(A_hat=data.A_hat.astype(np.float16))
+        self.assertFalse(optimizer.record_compile_shape(half, 7, "gd"))
+
+
+if __name__ == "__main__":
+    unittest.main()
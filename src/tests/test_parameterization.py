@@ -0,0 +1,153 @@
+# src/tests/test_parameterization.py
+
+
+import unittest
+
+import numpy as np
+
+from src.algorithm import optimizer, parameterization
+from src.tests.test_mixed_effects import make_algorithm, simulate_design_rows
+from src.tests.test_structured import simulate_cohort
+
+
+def random_cov(size, seed=0):
+    """Well conditioned dense covariance matrix"""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(size, size))
+    return X @ X.T / size + 0.5 * np.identity(size)
+
+
+class TestParameterization(unittest.TestCase):
+    """Tests for the parameterizations of Sigma_u"""
+
+    def setUp(self):
+        self.size = 6
+        self.structures = [
+            parameterization.make_parameterization("full", self.size),
+            parameterization.make_parameterization("diagonal", self.size),
+            parameterization.make_parameterization("block", self.size, [2, 2, 2]),
+            parameterization.make_parameterization("lowrank", self.size, rank=2),
+        ]
+
+    def test_make_parameterization(self):
+        self.assertEqual(
+            [parameterization.num_params(s) for s in self.structures], [21, 6, 9, 18]
+        )
+        self.assertEqual(
+            parameterization.as_parameterization(self.size), self.structures[0]
+        )
+        with self.assertRaises(ValueError):
+            parameterization.make_parameterization("banded", self.size)
+        with self.assertRaises(ValueError):
+            parameterization.make_parameterization("block", self.size, [2, 2])
+        with self.assertRaises(ValueError):
+            parameterization.make_parameterization("lowrank", self.size, rank=self.size)
+
+    def test_round_trip(self):
+        sigma_u = random_cov(self.size)
+        for structure in self.structures:
+            params = parameterization.params_of(sigma_u, structure)
+            self.assertEqual(params.size, parameterization.num_params(structure))
+            structured_sigma_u = parameterization.sigma_u_of(params, structure)
+
+            # Same diagonal, and the same matrix if it already has the structure.
+            # The low-rank parameters are only a starting point, with a share
+            # of the variance in the factor
+            np.testing.assert_allclose(np.diag(structured_sigma_u), np.diag(sigma_u))
+            if structure.kind == "lowrank":
+                continue
+            np.testing.assert_allclose(
+                structured_sigma_u, parameterization.project(sigma_u, structure)
+            )
+            np.testing.assert_allclose(
+                parameterization.sigma_u_of(
+                    parameterization.params_of(structured_sigma_u, structure), structure
+                ),
+                structured_sigma_u,
+                atol=1e-12,
+            )
+
+    def test_inverse_and_logdet(self):
+        sigma_u = random_cov(self.size, seed=1)
+        for structure in self.structures:
+            params = parameterization.params_of(sigma_u, structure)
+            structured_sigma_u = parameterization.sigma_u_of(params, structure)
+            expected_inverse = np.linalg.inv(structured_sigma_u)
+
+            np.testing.assert_allclose(
+                parameterization.sigma_u_inverse(params, structure),
+                expected_inverse,
+                rtol=1e-8,
+                atol=1e-10,
+            )
+            inverse, logdet = parameterization.inverse_and_logdet(params, structure)
+            np.testing.assert_allclose(inverse, expected_inverse, rtol=1e-4, atol=1e-5)
+            self.assertAlmostEqual(
+                float(logdet), np.linalg.slogdet(structured_sigma_u)[1], places=4
+            )
+
+    def test_objective_matches_full(self):
+        data, _ = simulate_cohort(5, self.size, 20)
+        sigma_u = 0.1 * random_cov(self.size, seed=2)
+        for structure in self.structures[1:]:
+            params = parameterization.params_of(sigma_u, structure)
+            full_params = parameterization.params_of(
+                parameterization.sigma_u_of(params, structure), self.structures[0]
+            )
+            obj, valid = optimizer.validate(params, 1.0, data, structure)
+            full_obj, full_valid = optimizer.validate(full_params, 1.0, data, self.size)
+            self.assertTrue(bool(valid))
+            self.assertTrue(bool(full_valid))
+            self.assertAlmostEqual(
+                float(obj), float(full_obj), delta=1e-4 * abs(float(full_obj))
+            )
+
+    def test_fits(self):
+        data, _ = simulate_cohort(8, self.size, 50)
+        init = np.diag(np.full(self.size, 0.1))
+        for structure in self.structures[1:]:
+            params = parameterization.params_of(init, structure)
+            problem = optimizer.HyperparameterProblem(
+                data, (params, 1.0 / 0.85), (params, 0.85), structure, 200, 0.001, 1e-6,
+                method="lbfgs",
+            )
+            init_obj, _ = optimizer.validate(params, 1.0 / 0.85, data, structure)
+            fit = optimizer.fit_hyperparameters(problem)
+            self.assertEqual(fit.status, optimizer.FIT_COMPLETED)
+            self.assertEqual(fit.ltu_flat.size, params.size)
+            self.assertLess(fit.objective, float(init_obj))
+
+            if structure.kind != "lowrank":
+                em_fit = optimizer.fit_hyperparameters(problem._replace(estimator="em"))
+                self.assertEqual(em_fit.status, optimizer.FIT_COMPLETED)
+                em_sigma_u = parameterization.sigma_u_of(em_fit.ltu_flat, structure)
+                np.testing.assert_allclose(
+                    em_sigma_u, parameterization.project(em_sigma_u, structure)
+                )
+                self.assertLess(em_fit.objective, float(init_obj))
+            else:
+                with self.assertRaises(ValueError):
+                    optimizer.fit_hyperparameters(problem._replace(estimator="em"))
+
+    def test_algorithm(self):
+        for kind in ["diagonal", "block", "lowrank"]:
+            algorithm = make_algorithm(
+                sigma_u_parameterization=kind, hyperparam_optimizer="lbfgs", max_iter=20
+            )
+            structure = algorithm.parameterization
+            self.assertEqual(
+                algorithm.init_ltu_flat.size, parameterization.num_params(structure)
+            )
+            simulate_design_rows(algorithm, nusers=5, num_decisions=6)
+            algorithm.update_hyperparameters(1, None)
+            algorithm.update(None)
+
+            np.testing.assert_allclose(
+                algorithm.sigma_u,
+                parameterization.sigma_u_of(algorithm.ltu_flat, structure),
+            )
+            self.assertTrue(np.all(np.isfinite(algorithm.posterior.user_cov)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+# src/tests/test_readiness_api.py
+
+
+import json
+import unittest
+
+from src.server.warmup import ready
+from src.tests.base import BaseTestCase
+
+
+class TestReadinessAPI(BaseTestCase):
+
+    def test_ready(self):
+        """ Test readiness once the warm-up has finished """
+        ready.set()
+        with self.client:
+            response = self.client.get('/ready')
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'success')
+            self.assertTrue(data['message'] == 'Ready')
+            self.assertEqual(response.status_code, 200)
+
+    def test_not_ready(self):
+        """ Test readiness while the warm-up is in progress """
+        ready.clear()
+        try:
+            with self.client:
+                response = self.client.get('/ready')
+                data = json.loads(response.data.decode())
+                self.assertTrue(data['status'] == 'fail')
+                self.assertEqual(data['error_code'], 601)
+                self.assertEqual(response.status_code, 503)
+        finally:
+            ready.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# src/tests/test_rebuild.py
+
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from src.algorithm import artifact, rebuild
+from src.tests.test_mixed_effects import make_algorithm
+
+
+def simulate_rows(algorithm, nusers, num_decisions, seed=0, first_decision=0):
+    """Feed random decision points, and return them as rl_action_selection rows"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for t in range(first_decision, first_decision + num_decisions):
+        # Users join over time, and not in the order of their ids
+        for u in rng.permutation(nusers):
+            if t < u % 3:
+                continue
+            row = {
+                "user_id": "user{}".format(u),
+                "user_decision_idx": t,
+                "rid": len(rows) + 1,
+                "state_vector": [int(rng.integers(2)), t % 2, int(rng.integers(2))],
+                "action": int(rng.integers(2)),
+                "act_prob": float(rng.uniform(0.2, 0.8)),
+                "reward": float(rng.integers(0, 4)) if t > u % 3 else None,
+            }
+            algorithm.update_design_row(
+                user_id=row["user_id"],
+                state=row["state_vector"],
+                action=row["action"],
+                act_prob=row["act_prob"],
+                reward=row["reward"],
+                decision_index=t,
+            )
+            rows.append(row)
+    return pd.DataFrame(rows, columns=rebuild.COLUMNS)
+
+
+def ordered_chunks(rows, chunk_size):
+    """Rows ordered by user and decision index, in chunks"""
+    rows = rows.sort_values(["user_id", "user_decision_idx"])
+    return [rows.iloc[i : i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+
+class TestRebuild(unittest.TestCase):
+    """Tests for the rebuild of the algorithm from the recorded decision points"""
+
+    def setUp(self):
+        self.live = make_algorithm()
+        self.rows = simulate_rows(self.live, nusers=9, num_decisions=7)
+
+    def test_rebuild_users(self):
+        rebuilt = make_algorithm()
+        # Chunks of 4 rows split the users across chunks
+        num_users, num_rows = rebuild.rebuild_users(rebuilt, ordered_chunks(self.rows, 4))
+        self.assertEqual((num_users, num_rows), (9, len(self.rows)))
+
+        self.assertEqual(rebuilt.user_list, self.live.user_list)
+        for value, expected in zip(rebuilt.create_A_B_matrix(), self.live.create_A_B_matrix()):
+            if isinstance(value, np.ndarray):
+                np.testing.assert_array_equal(value, expected)
+            else:
+                self.assertEqual(value, expected)
+        for name in ["num_decisions", "state", "action", "act_prob", "reward", "design"]:
+            np.testing.assert_array_equal(
+                getattr(rebuilt.users, name)[: rebuilt.num_users],
+                getattr(self.live.users, name)[: self.live.num_users],
+            )
+
+        # Both continue the same way
+        for algorithm in [self.live, rebuilt]:
+            algorithm.update_design_row("user0", [1, 1, 0], 1, 0.4, 2.0, 7)
+            algorithm.update_posteriors(None)
+        np.testing.assert_array_equal(rebuilt.posterior_mean, self.live.posterior_mean)
+
+    def test_user_across_chunks(self):
+        rows = self.rows.sort_values(["user_id", "user_decision_idx"])
+        user = rows[rows["user_id"] == "user4"]
+        self.assertGreater(len(user), 4)
+
+        # One user's rows in three chunks, one of them with only their rows
+        start = rows.index.get_loc(user.index[0])
+        bounds = [0, start + 1, start + 3, start + len(user) - 1, len(rows)]
+        chunks = [rows.iloc[a:b] for a, b in zip(bounds, bounds[1:])]
+        rebuilt = make_algorithm()
+        rebuild.rebuild_users(rebuilt, iter(chunks))
+        np.testing.assert_array_equal(
+            rebuilt.users.history("user4")["design_state"],
+            self.live.users.history("user4")["design_state"],
+        )
+        for value, expected in zip(rebuilt.create_A_B_matrix(), self.live.create_A_B_matrix()):
+            if isinstance(value, np.ndarray):
+                np.testing.assert_array_equal(value, expected)
+            else:
+                self.assertEqual(value, expected)
+
+        # The rows of a user must be contiguous
+        with self.assertRaises(ValueError):
+            rebuild.rebuild_users(make_algorithm(), [chunks[0], chunks[3], chunks[1]])
+
+    def test_load_twice(self):
+        with self.assertRaises(ValueError):
+            self.live.users.load(
+                "user0",
+                np.zeros((1, 3)),
+                np.zeros(1),
+                np.zeros(1),
+                np.full(1, np.nan),
+                np.zeros((1, 24)),
+            )
+
+    def test_restore_policy(self):
+        self.live.update_posteriors(None)
+        path, _ = artifact.save_policy(tempfile.mkdtemp(), self.live.snapshot)
+        arrays, metadata = artifact.read_artifact(path)
+
+        rebuilt = make_algorithm()
+        rebuild.rebuild_users(rebuilt, ordered_chunks(self.rows, 10))
+        rebuild.restore_policy(rebuilt, arrays, metadata, hyperparam_update_id=0)
+        self.assertEqual(rebuilt.policyid, self.live.policyid)
+        self.assertEqual(rebuilt.snapshot.user_list, self.live.snapshot.user_list)
+        np.testing.assert_array_equal(rebuilt.posterior_mean, self.live.posterior_mean)
+        np.testing.assert_array_equal(rebuilt.snapshot.prob_table, self.live.snapshot.prob_table)
+        for array, expected in zip(rebuilt.posterior, self.live.posterior):
+            np.testing.assert_array_equal(array, expected)
+
+        # A legacy artifact, without the compact posterior
+        legacy = {name: array for name, array in arrays.items() if name != "coupling"}
+        with self.assertRaises(ValueError):
+            rebuild.restore_policy(rebuilt, legacy, metadata, hyperparam_update_id=0)
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
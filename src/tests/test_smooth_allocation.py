@@ -0,0 +1,134 @@
+# src/tests/test_smooth_allocation.py
+
+
+import os
+import pickle as pkl
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.integrate as integrate
+import scipy.special as special
+
+from src.algorithm import smooth_allocation
+
+
+class TestBatchAllocationFunction(unittest.TestCase):
+    """Tests for the batch allocation functions"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.randomvars = rng.standard_normal(5000)
+        self.means = rng.normal(0, 1, (13, 8))
+        self.vars = rng.uniform(0.001, 2, (13, 8))
+
+    def assert_matches_scalar(self, func_type, B):
+        scalar = smooth_allocation.get_allocation_function(
+            func_type=func_type, B=B, randomvars=self.randomvars
+        )
+        batch = smooth_allocation.get_batch_allocation_function(
+            func_type=func_type, B=B, randomvars=self.randomvars
+        )
+        probs = batch(self.means, self.vars)
+        self.assertEqual(probs.shape, self.means.shape)
+        for index in np.ndindex(self.means.shape):
+            self.assertEqual(
+                probs[index], scalar(mean=self.means[index], var=self.vars[index])
+            )
+
+    def test_smooth(self):
+        self.assert_matches_scalar("smooth", 10 / 0.95)
+
+    def test_smooth_infinite_B(self):
+        self.assert_matches_scalar("smooth", np.inf)
+
+    def test_thompson(self):
+        self.assert_matches_scalar("thompson", 1.0)
+
+    def test_closed_form_infinite_B(self):
+        monte_carlo = smooth_allocation.get_batch_allocation_function(
+            func_type="smooth", B=np.inf, randomvars=self.randomvars
+        )
+        closed_form = smooth_allocation.get_batch_allocation_function(
+            func_type="smooth", B=np.inf, randomvars=self.randomvars, closed_form=True
+        )
+        np.testing.assert_allclose(
+            closed_form(self.means, self.vars), monte_carlo(self.means, self.vars), atol=0.02
+        )
+
+
+class TestQuadratureAllocationFunction(unittest.TestCase):
+    """Tests for the quadrature version of the smooth allocation function"""
+
+    def setUp(self):
+        self.B = 10 / 0.95
+        self.means = np.array([-1.0, 0.0, 0.15, 0.3, 2.0, 0.15])
+        self.vars = np.array([0.5, 0.01, 0.3, 1e-6, 2.0, 4.0])
+
+    def reference(self, mean, var):
+        """Adaptive quadrature of the smooth allocation function"""
+        std = np.sqrt(var)
+
+        def integrand(z):
+            logistic = 0.2 + 0.6 * special.expit(self.B * (mean + std * z) - np.log(5.0))
+            return logistic * np.exp(-z * z / 2) / np.sqrt(2 * np.pi)
+
+        midpoint = (np.log(5.0) / self.B - mean) / std
+        points = [midpoint] if -12 < midpoint < 12 else None
+        return integrate.quad(integrand, -12, 12, points=points, limit=500)[0]
+
+    def test_matches_reference(self):
+        scalar = smooth_allocation.get_allocation_function(
+            func_type="smooth_quadrature", B=self.B, randomvars=None
+        )
+        batch = smooth_allocation.get_batch_allocation_function(
+            func_type="smooth_quadrature", B=self.B, randomvars=None
+        )
+        probs = batch(self.means, self.vars)
+        errors = smooth_allocation.quadrature_error(self.means, self.vars, self.B)
+        for i, (mean, var) in enumerate(zip(self.means, self.vars)):
+            expected = self.reference(mean, var)
+            self.assertAlmostEqual(probs[i], expected, delta=1e-4)
+            self.assertLess(errors[i], 1e-4)
+            self.assertAlmostEqual(scalar(mean=mean, var=var), probs[i], places=12)
+
+    def test_infinite_B(self):
+        batch = smooth_allocation.get_batch_allocation_function(
+            func_type="smooth_quadrature", B=np.inf, randomvars=None
+        )
+        closed_form = smooth_allocation.get_batch_allocation_function(
+            func_type="smooth", B=np.inf, randomvars=None, closed_form=True
+        )
+        np.testing.assert_array_equal(
+            batch(self.means, self.vars), closed_form(self.means, self.vars)
+        )
+
+
+class TestLoadRandomVars(unittest.TestCase):
+    """Tests for loading the random variates"""
+
+    def test_npy_matches_pickle(self):
+        random_vars = np.random.default_rng(0).standard_normal(100)
+        with tempfile.TemporaryDirectory() as folder:
+            pickle_path = os.path.join(folder, "randomvars.pkl")
+            with open(pickle_path, "wb") as f:
+                pkl.dump(random_vars, f)
+            npy_path = os.path.join(folder, "randomvars.npy")
+            np.save(npy_path, random_vars)
+
+            from_pickle = smooth_allocation.load_random_vars(pickle_path)
+            from_npy = smooth_allocation.load_random_vars(npy_path)
+            np.testing.assert_array_equal(from_pickle, from_npy)
+
+            scalar = smooth_allocation.get_allocation_function(
+                func_type="smooth", B=10 / 0.95, randomvars=from_npy
+            )
+            expected = smooth_allocation.get_allocation_function(
+                func_type="smooth", B=10 / 0.95, randomvars=from_pickle
+            )
+            self.assertEqual(scalar(mean=0.3, var=0.2), expected(mean=0.3, var=0.2))
+            del from_npy, scalar
+
+
+if __name__ == "__main__":
+    unittest.main()
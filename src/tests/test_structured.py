@@ -0,0 +1,212 @@
+# src/tests/test_structured.py
+
+
+import unittest
+
+import numpy as np
+
+from src.algorithm import optimizer, structured
+from src.algorithm.mixed_effects import obj_func, MixedEffectsAlgorithm
+
+
+def simulate_blocks(nusers, size=24, seed=0):
+    """Random per-user Gram matrices and design-reward products"""
+    rng = np.random.default_rng(seed)
+    A_hat = []
+    B_hat = []
+    for i in range(nusers):
+        X = rng.integers(0, 2, size=(5 + i, size)).astype(float)
+        y = rng.integers(0, 4, size=5 + i).astype(float)
+        A_hat.append(X.T @ X)
+        B_hat.append(X.T @ y)
+    return np.array(A_hat), np.array(B_hat)
+
+
+def simulate_cohort(nusers, size=24, decisions=20, seed=0):
+    """
+    Sufficient statistics of a cohort drawn from the mixed effects model, with
+    a unit noise variance, along with the Sigma_u it was drawn with
+    """
+    rng = np.random.default_rng(seed)
+    theta_pop = rng.normal(0, 0.3, size)
+    sigma_u = np.diag(rng.uniform(0.01, 0.2, size))
+    A_hat, B_hat = [], []
+    sum_sq_reward = 0.0
+    for _ in range(nusers):
+        X = rng.integers(0, 2, size=(decisions, size)).astype(float)
+        theta = theta_pop + rng.multivariate_normal(np.zeros(size), sigma_u)
+        y = X @ theta + rng.normal(0, 1.0, decisions)
+        A_hat.append(X.T @ X)
+        B_hat.append(X.T @ y)
+        sum_sq_reward += y @ y
+
+    data = optimizer.ObjectiveData(
+        np.array(A_hat),
+        np.array(B_hat),
+        np.zeros(size),
+        0.5 * np.identity(size),
+        sum_sq_reward,
+        nusers * decisions,
+    )
+    return data, sigma_u
+
+
+def dense_posterior(A_hat, B_hat, prior_mean, prior_cov, sigma_u, noise_var):
+    """Reference posterior computed with the dense (N * d) x (N * d) inverse"""
+    nusers = A_hat.shape[0]
+    A = np.zeros((nusers * prior_mean.size, nusers * prior_mean.size))
+    for i in range(nusers):
+        A[i * prior_mean.size : (i + 1) * prior_mean.size,
+          i * prior_mean.size : (i + 1) * prior_mean.size] = A_hat[i]
+    mu_0 = np.kron(np.ones(nusers), prior_mean)
+    sigma_theta = np.kron(np.ones((nusers, nusers)), prior_cov) + np.kron(
+        np.identity(nusers), sigma_u
+    )
+    sigma_theta_inv = np.linalg.inv(sigma_theta)
+    cov = np.linalg.inv(sigma_theta_inv + A / noise_var)
+    mean = cov @ (sigma_theta_inv @ mu_0 + B_hat.flatten() / noise_var)
+    return mean, cov
+
+
+class TestStructuredPosterior(unittest.TestCase):
+    """Tests for the block-structured posterior update"""
+
+    def setUp(self):
+        self.size = 24
+        self.prior_mean = np.linspace(-0.5, 2.0, self.size)
+        self.prior_cov = np.diag(np.linspace(0.01, 0.9, self.size))
+        self.sigma_u = np.diag(np.linspace(0.01, 0.05, self.size))
+        self.noise_var = 0.85
+
+    def test_matches_dense_posterior(self):
+        for nusers in [1, 4, 15]:
+            A_hat, B_hat = simulate_blocks(nusers, self.size, seed=nusers)
+            mean, cov = dense_posterior(
+                A_hat, B_hat, self.prior_mean, self.prior_cov, self.sigma_u, self.noise_var
+            )
+            blocks = structured.posterior_blocks(
+                A_hat, B_hat, self.prior_mean, self.prior_cov, self.sigma_u, self.noise_var
+            )
+            np.testing.assert_allclose(blocks["user_mean"].flatten(), mean, atol=1e-8)
+            np.testing.assert_allclose(
+                structured.joint_cov(
+                    blocks["cond_cov"], blocks["coupling"], blocks["theta_pop_cov"]
+                ),
+                cov,
+                atol=1e-10,
+            )
+
+            user_cov = structured.user_cov_blocks(
+                blocks["cond_cov"], blocks["coupling"], blocks["theta_pop_cov"]
+            )
+            for i in range(nusers):
+                np.testing.assert_allclose(
+                    user_cov[i],
+                    cov[i * self.size : (i + 1) * self.size, i * self.size : (i + 1) * self.size],
+                    atol=1e-10,
+                )
+
+    def test_block_posterior(self):
+        nusers = 6
+        A_hat, B_hat = simulate_blocks(nusers, self.size, seed=3)
+        blocks = structured.posterior_blocks(
+            A_hat, B_hat, self.prior_mean, self.prior_cov, self.sigma_u, self.noise_var
+        )
+        cov = structured.joint_cov(
+            blocks["cond_cov"], blocks["coupling"], blocks["theta_pop_cov"]
+        )
+        posterior = structured.block_posterior(blocks)
+
+        # Any block, and the full joint, on request
+        np.testing.assert_allclose(posterior.full_cov(), cov, rtol=1e-12, atol=1e-14)
+        for i, j in [(0, 0), (1, 4), (4, 1), (5, 5)]:
+            np.testing.assert_allclose(
+                posterior.cross_block(i, j),
+                cov[i * self.size : (i + 1) * self.size, j * self.size : (j + 1) * self.size],
+                rtol=1e-12,
+                atol=1e-14,
+            )
+        self.assertEqual(posterior.num_users, nusers)
+        self.assertEqual(posterior.user_block(2).shape, (self.size, self.size))
+
+        # Linear in the number of users
+        self.assertEqual(
+            posterior.nbytes,
+            8 * (nusers * self.size * (2 * self.size + 1) + self.size**2),
+        )
+        with self.assertRaises(ValueError):
+            posterior.user_cov[0, 0, 0] = 0
+
+
+def dense_objective(flat_lower_t, noise_precision, A_hat, B_hat, prior_mean, prior_cov,
+                    sum_sq_reward, ts):
+    """Reference objective built from the dense inverse of Sigma_theta"""
+    size = prior_mean.size
+    nusers = A_hat.shape[0]
+    L = np.zeros((size, size))
+    L[np.tril_indices(size)] = flat_lower_t
+    sigma_u = L @ L.T
+    A = np.zeros((nusers * size, nusers * size))
+    for i in range(nusers):
+        A[i * size : (i + 1) * size, i * size : (i + 1) * size] = A_hat[i]
+    mu = np.kron(np.ones(nusers), prior_mean)
+    X = np.linalg.inv(
+        np.kron(np.ones((nusers, nusers)), prior_cov) + np.kron(np.identity(nusers), sigma_u)
+    )
+    y = noise_precision
+    h = X @ mu + y * B_hat.flatten()
+    return -(
+        np.linalg.slogdet(X)[1]
+        - np.linalg.slogdet(X + y * A)[1]
+        + ts * np.log(y)
+        - y * sum_sq_reward
+        - mu @ X @ mu
+        + h @ np.linalg.solve(X + y * A, h)
+    )
+
+
+class TestStructuredObjective(unittest.TestCase):
+    """Tests for the block-structured hyperparameter objective"""
+
+    def setUp(self):
+        self.size = 24
+        self.prior_mean = np.linspace(-0.5, 2.0, self.size)
+        self.prior_cov = np.diag(np.linspace(0.01, 0.9, self.size))
+        sigma_u = np.diag(np.linspace(0.01, 0.05, self.size))
+        self.ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(self.size)]
+
+    def test_matches_dense_objective(self):
+        for nusers in [1, 6]:
+            A_hat, B_hat = simulate_blocks(nusers, self.size, seed=nusers)
+            ts = int(sum(5 + i for i in range(nusers)))
+            sum_sq_reward = 3.0 * ts
+            for noise_precision in [1.0 / 0.85, 2.0]:
+                expected = dense_objective(
+                    self.ltu_flat, noise_precision, A_hat, B_hat, self.prior_mean,
+                    self.prior_cov, sum_sq_reward, ts,
+                )
+                result = obj_func(
+                    self.ltu_flat, noise_precision, A_hat, B_hat, self.prior_mean,
+                    self.prior_cov, sum_sq_reward, self.size, ts,
+                )
+                self.assertAlmostEqual(float(result), expected, delta=1e-4 * abs(expected))
+
+                value, valid = MixedEffectsAlgorithm.validate_matrix(
+                    self.ltu_flat, noise_precision, A_hat, B_hat, self.prior_mean,
+                    self.prior_cov, sum_sq_reward, self.size, ts,
+                )
+                self.assertTrue(valid)
+                self.assertAlmostEqual(float(value), float(result), places=3)
+
+    def test_invalid_sigma_u(self):
+        A_hat, B_hat = simulate_blocks(3, self.size)
+        value, valid = MixedEffectsAlgorithm.validate_matrix(
+            np.zeros_like(self.ltu_flat), 1.0, A_hat, B_hat, self.prior_mean,
+            self.prior_cov, 10.0, self.size, 20,
+        )
+        self.assertFalse(valid)
+        self.assertEqual(value, 100000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -230,3 +230,58 @@ class TestUpdateHyperParamAPI(BaseTestCase):
             print(data)
             self.assertTrue(data['status'] == 'success')
             self.assertTrue(data['message'] == 'Successfully updated parameters/posteriors.')
+
+    def test_hyperparam_job_status(self):
+        """ Test for polling and cancelling a hyperparameter update request """
+        with self.client:
+            response_client = register_client(self, 'joe@gmail.com', '123456')
+            data_register = json.loads(response_client.data.decode())
+            token = data_register['auth_token']
+            headers = dict(Authorization='Bearer ' + token)
+
+            response = self.client.post(
+                '/update_hyperparameters',
+                headers=headers,
+                data=json.dumps(dict(time_budget=-1)),
+                content_type='application/json'
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'fail')
+            self.assertEqual(data['error_code'], 412)
+
+            response = self.client.post(
+                '/update_hyperparameters',
+                headers=headers,
+                data=json.dumps(dict(time_budget=600)),
+                content_type='application/json'
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'success')
+            request_id = data['request_id']
+
+            response = self.client.get(
+                f'/update_hyperparameters/{request_id}',
+                headers=headers,
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['status'] == 'success')
+            self.assertEqual(data['request_id'], request_id)
+            self.assertEqual(data['time_budget'], 600)
+            self.assertTrue(data['request_status'] in ['Pending', 'Running'])
+
+            response = self.client.post(
+                f'/update_hyperparameters/{request_id}/cancel',
+                headers=headers,
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 202)
+            self.assertTrue(data['status'] == 'success')
+
+            response = self.client.get(
+                f'/update_hyperparameters/{request_id + 1}',
+                headers=headers,
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'fail')
+            self.assertEqual(data['error_code'], 410)
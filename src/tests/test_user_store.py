@@ -0,0 +1,97 @@
+# src/tests/test_user_store.py
+
+
+import threading
+import unittest
+
+import numpy as np
+
+from src.algorithm.user_store import UserHistoryStore
+
+
+class TestUserHistoryStore(unittest.TestCase):
+    """Tests for the array-backed user history store"""
+
+    def test_registry(self):
+        store = UserHistoryStore(num_decisions=4, num_params=2, capacity=2)
+        self.assertIsNone(store.index("a"))
+        self.assertEqual(store.register("a"), 0)
+        self.assertEqual(store.register("b"), 1)
+        self.assertEqual(store.register("a"), 0)
+        self.assertTrue("b" in store)
+        self.assertFalse("c" in store)
+        self.assertEqual(len(store), 2)
+
+    def test_reorder(self):
+        store = UserHistoryStore(num_decisions=3, num_params=2, capacity=4)
+        for t in range(3):
+            for u in range(3):
+                store.append("user{}".format(u), [u, t, 0], 1, 0.5, float(u + t), np.array([u, t]))
+        A, B = store.A.copy(), store.B.copy()
+
+        store.reorder(["user2", "user0", "user1"])
+        self.assertEqual(store.user_ids, ["user2", "user0", "user1"])
+        self.assertEqual(store.index("user2"), 0)
+        np.testing.assert_array_equal(store.A[:3], A[[2, 0, 1]])
+        np.testing.assert_array_equal(store.B[:3], B[[2, 0, 1]])
+        np.testing.assert_array_equal(store.history("user2")["design_state"][:, 0], [2, 2, 2])
+        with self.assertRaises(ValueError):
+            store.reorder(["user2", "user0"])
+
+    def test_concurrent_appends(self):
+        # Many threads register users and grow the arrays at the same time
+        store = UserHistoryStore(num_decisions=1, num_params=2, capacity=1)
+        num_threads, num_decisions = 8, 20
+        barrier = threading.Barrier(num_threads)
+
+        def record(u):
+            barrier.wait()
+            for t in range(num_decisions):
+                store.append("user{}".format(u), [u, t, 0], 1, 0.5, 1.0, np.array([u, 1.0]))
+
+        threads = [threading.Thread(target=record, args=(u,)) for u in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expected = sorted("user{}".format(u) for u in range(num_threads))
+        self.assertEqual(sorted(store.user_ids), expected)
+        self.assertEqual(sorted(store.registry.values()), list(range(num_threads)))
+        A, B, _, total_ts, user_list = store.sufficient_statistics()
+        self.assertEqual(total_ts, num_threads * (num_decisions - 1))
+        for index, user_id in enumerate(user_list):
+            u = int(user_id[len("user"):])
+            row = np.array([u, 1.0])
+            np.testing.assert_array_equal(store.history(user_id)["design_state"][:, 0], u)
+            np.testing.assert_array_equal(A[index], (num_decisions - 1) * np.outer(row, row))
+            np.testing.assert_array_equal(B[index], (num_decisions - 1) * row)
+
+    def test_growth_keeps_history(self):
+        store = UserHistoryStore(num_decisions=2, num_params=2, capacity=1)
+        rows = {}
+        for t in range(5):
+            for u in range(3):
+                row = np.array([u, t + 0.5])
+                store.append("user{}".format(u), [u, t % 2, 1], t % 2, 0.5, float(t), row)
+                rows.setdefault(u, []).append(row)
+
+        self.assertGreaterEqual(store.A.shape[0], 3)
+        self.assertGreaterEqual(store.design.shape[1], 5)
+        for u in range(3):
+            history = store.history("user{}".format(u))
+            np.testing.assert_array_equal(history["design_state"], np.array(rows[u]))
+            np.testing.assert_array_equal(history["reward"], np.arange(5.0))
+            np.testing.assert_array_equal(history["action"], np.arange(5) % 2)
+
+        A_hat, B_hat, sum_sq_reward, total_ts, user_list = store.sufficient_statistics()
+        X = np.array(rows[2][:-1])
+        np.testing.assert_allclose(A_hat[2], X.T @ X)
+        np.testing.assert_allclose(B_hat[2], X.T @ np.arange(1.0, 5.0))
+        self.assertEqual(total_ts, 12)
+        self.assertEqual(sum_sq_reward, 3 * 30.0)
+        self.assertEqual(user_list, ["user0", "user1", "user2"])
+
+
+if __name__ == "__main__":
+    unittest.main()